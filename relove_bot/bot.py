@@ -24,6 +24,9 @@ from .middlewares.database import DatabaseMiddleware
 from .middlewares.session_check import SessionCheckMiddleware
 from .middlewares.profile_update import ProfileUpdateMiddleware
 from .db.session import async_session
+from .utils.http_client import close_http_session
+from .db.vector import close_vector_db, init_vector_db
+from .db.write_behind import close_activity_log_writer, close_user_touch_coalescer
 
 # Создаем директорию для логов если её нет
 os.makedirs(settings.LOG_DIR, exist_ok=True)
@@ -70,18 +73,29 @@ def setup_logging():
 
 logger = setup_logging()
 
+def create_fsm_storage() -> BaseStorage:
+    """
+    Хранилище FSM: Redis при USE_REDIS (общее для реплик и переживает
+    перезапуск), иначе память процесса.
+    """
+    if settings.USE_REDIS:
+        if settings.REDIS_URL:
+            return RedisStorage.from_url(settings.REDIS_URL)
+        logger.warning("USE_REDIS включён, но REDIS_URL не задан — FSM хранится в памяти")
+    return MemoryStorage()
+
 def create_bot_and_dispatcher(storage: BaseStorage = None) -> Tuple[Bot, Dispatcher]:
     """
     Инициализация и возвращение экземпляров бота и диспетчера.
-    :param storage: Хранилище для FSM (по умолчанию MemoryStorage)
+    :param storage: Хранилище для FSM (по умолчанию — create_fsm_storage())
     :return: кортеж (bot, dispatcher)
     """
     try:
         bot = Bot(token=settings.bot_token.get_secret_value(), parse_mode=ParseMode.HTML)
-        # Всегда используем MemoryStorage для упрощения
-        storage = MemoryStorage()
+        if storage is None:
+            storage = create_fsm_storage()
         dp = Dispatcher(storage=storage)
-        logger.info("Bot and Dispatcher initialized with MemoryStorage.")
+        logger.info(f"Bot and Dispatcher initialized with {type(storage).__name__}.")
         return bot, dp
     except Exception as e:
         logger.exception(f"Ошибка инициализации бота/диспетчера: {e}")
@@ -159,17 +173,30 @@ async def main():
         
         # Восстановление активных сессий из БД
         await restore_active_sessions()
-        
-        # Запуск фоновых задач
+
+        # Коллекция Qdrant / встроенный индекс для /similar
         try:
-            background_tasks = await start_background_tasks()
+            if not await init_vector_db():
+                logger.warning("⚠️ Векторное хранилище недоступно, /similar не будет находить пользователей")
         except Exception as e:
-            logger.warning(f"⚠️ Не удалось запустить фоновые задачи: {e}")
-            background_tasks = []
+            logger.warning(f"⚠️ Ошибка инициализации векторного хранилища: {e}")
+        
+        # Запуск фоновых задач (при нескольких репликах — только на первой, иначе рассылки задвоятся)
+        background_tasks = []
+        if settings.replica_index == 0:
+            try:
+                background_tasks = await start_background_tasks()
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось запустить фоновые задачи: {e}")
         
         # Запуск бота
-        logger.info("✅ Starting bot...")
-        await dp.start_polling(bot)
+        logger.info(f"✅ Starting bot ({settings.bot_mode})...")
+        if settings.bot_mode == "webhook":
+            from .webhook import run_webhook
+
+            await run_webhook(bot, dp)
+        else:
+            await dp.start_polling(bot)
         
     except KeyboardInterrupt:
         logger.info("🛑 Bot stopped by user")
@@ -183,11 +210,38 @@ async def main():
         else:
             logger.error(f"❌ Ошибка при запуске бота: {e}", exc_info=True)
     finally:
+        # Ответы, которые уже генерируются, дописываем до закрытия сессий
+        try:
+            await common.close_message_queue()
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка при остановке очереди сообщений: {e}")
         # Закрытие сессии бота
         try:
             await bot.session.close()
         except Exception as e:
             logger.warning(f"⚠️ Ошибка при закрытии сессии бота: {e}")
+        # Закрытие общего HTTP-клиента LLM
+        try:
+            await close_http_session()
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка при закрытии HTTP-клиента LLM: {e}")
+        # Журнал активности и касания пользователей копятся в буферах — дописываем их до выхода
+        try:
+            await close_activity_log_writer()
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка при записи журнала активности: {e}")
+        try:
+            await close_user_touch_coalescer()
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка при записи last_seen пользователей: {e}")
+        try:
+            await close_vector_db()
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка при закрытии клиента Qdrant: {e}")
+        try:
+            await dp.storage.close()
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка при закрытии хранилища FSM: {e}")
 
 async def restore_active_sessions():
     """Восстанавливает активные сессии из БД при перезапуске"""
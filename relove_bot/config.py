@@ -1,4 +1,4 @@
-from typing import Literal, Optional, Set, List
+from typing import Any, Dict, Literal, Optional, Set, List
 from pydantic import Field, SecretStr, HttpUrl, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 import os
@@ -31,6 +31,15 @@ class Settings(BaseSettings):
     web_server_host: str = Field("0.0.0.0", env='WEB_SERVER_HOST', description="Host for the web server")
     web_server_port: int = Field(8080, env='WEB_SERVER_PORT', description="Port for the web server")
 
+    # Режим работы и шардирование апдейтов между репликами (webhook)
+    bot_mode: Literal['polling', 'webhook'] = Field('polling', env='BOT_MODE', description="Как получать апдейты: long polling (одна реплика) или webhook")
+    replica_index: int = Field(0, env='REPLICA_INDEX', description="Номер этой реплики (0..REPLICA_COUNT-1); фоновые задачи и установка webhook — только на 0")
+    replica_count: int = Field(1, env='REPLICA_COUNT', description="Сколько реплик бота делят апдейты")
+    update_shards: int = Field(64, env='UPDATE_SHARDS', description="Число шардов апдейтов в Redis (одинаковое на всех репликах)")
+    update_stream_maxlen: int = Field(10000, env='UPDATE_STREAM_MAXLEN', description="Сколько апдейтов хранит поток одного шарда в Redis")
+    update_max_inflight: int = Field(200, env='UPDATE_MAX_INFLIGHT', description="Сколько апдейтов реплика держит в обработке; дальше шарды не читаются (webhook без Redis отвечает 503)")
+    update_max_concurrency: int = Field(50, env='UPDATE_MAX_CONCURRENCY', description="Сколько пользователей реплика обслуживает одновременно")
+
     # Admin settings
     admin_ids: Set[int] = Field(default_factory=set, env='ADMIN_IDS', description="Set of Telegram User IDs for admins")
 
@@ -42,6 +51,40 @@ class Settings(BaseSettings):
     
     # Hugging Face settings
     hugging_face_token: Optional[SecretStr] = Field(None, env='HUGGING_FACE_TOKEN', description="Hugging Face API token")
+    local_model_name: Optional[str] = Field(None, env='LOCAL_MODEL_NAME', description="Модель transformers для локальной генерации (загружается лениво)")
+    local_model_4bit: bool = Field(False, env='LOCAL_MODEL_4BIT', description="Загружать локальную модель в 4 бита (bitsandbytes)")
+    local_model_threads: Optional[int] = Field(None, env='LOCAL_MODEL_THREADS', description="Потоков torch в процессе локального инференса (пусто — по умолчанию)")
+    llm_local_worker_max_batch: int = Field(8, env='LLM_LOCAL_WORKER_MAX_BATCH', description="Максимум промптов в одном пакете локальной модели")
+    llm_local_worker_batch_wait: float = Field(0.02, env='LLM_LOCAL_WORKER_BATCH_WAIT', description="Сколько секунд ждать попутных запросов перед запуском пакета")
+    llm_local_kv_cache_mb: int = Field(1024, env='LLM_LOCAL_KV_CACHE_MB', description="Бюджет памяти KV-кэша на пакет в МБ (ограничивает размер пакета)")
+    llm_classification_backend: Literal['api', 'local'] = Field('api', env='LLM_CLASSIFICATION_BACKEND', description="Кто выполняет пакетную классификацию: API или локальная модель")
+    embedding_model_name: str = Field('sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2', env='EMBEDDING_MODEL_NAME', description="Локальная модель эмбеддингов (имя на Hugging Face Hub или путь)")
+    embedding_onnx_path: Optional[str] = Field(None, env='EMBEDDING_ONNX_PATH', description="Экспорт модели эмбеддингов в ONNX (по умолчанию model.onnx в каталоге модели, если есть)")
+    embedding_dim: int = Field(384, env='EMBEDDING_DIM', description="Размерность векторов модели эмбеддингов (векторный индекс и коллекция Qdrant)")
+    embedding_batch_size: int = Field(32, env='EMBEDDING_BATCH_SIZE', description="Максимум текстов в одном проходе модели эмбеддингов")
+    embedding_batch_wait: float = Field(0.01, env='EMBEDDING_BATCH_WAIT', description="Сколько секунд ждать попутных текстов перед кодированием")
+    embedding_cache_size: int = Field(10000, env='EMBEDDING_CACHE_SIZE', description="Векторов в кэше эмбеддингов в памяти")
+    embedding_cache_path: Optional[str] = Field(None, env='EMBEDDING_CACHE_PATH', description="Файл SQLite для кэша эмбеддингов на диске (пусто — только память)")
+    embedding_worker_process: bool = Field(True, env='EMBEDDING_WORKER_PROCESS', description="Считать эмбеддинги в отдельном процессе (иначе — в потоке)")
+    vector_backend: Literal['local', 'qdrant'] = Field('local', env='VECTOR_BACKEND', description="Где хранить векторы профилей для /similar: встроенный индекс или Qdrant")
+    vector_index_path: str = Field('data/vector_index', env='VECTOR_INDEX_PATH', description="Каталог встроенного векторного индекса")
+    vector_index_dtype: Literal['float32', 'float16'] = Field('float32', env='VECTOR_INDEX_DTYPE', description="Тип хранения векторов во встроенном индексе (float16 — вдвое меньше памяти)")
+    vector_index_nprobe: int = Field(8, env='VECTOR_INDEX_NPROBE', description="Сколько кластеров IVF просматривать при поиске (больше — точнее и медленнее)")
+    qdrant_url: str = Field('http://localhost:6333', env='QDRANT_URL', description="Адрес Qdrant (при VECTOR_BACKEND=qdrant)")
+    qdrant_api_key: Optional[SecretStr] = Field(None, env='QDRANT_API_KEY', description="API-ключ Qdrant")
+    qdrant_timeout: float = Field(5.0, env='QDRANT_TIMEOUT', description="Таймаут запроса к Qdrant в секундах")
+    qdrant_pool_size: int = Field(10, env='QDRANT_POOL_SIZE', description="Максимум одновременных соединений с Qdrant")
+    qdrant_upsert_batch: int = Field(256, env='QDRANT_UPSERT_BATCH', description="Векторов в одном запросе upsert к Qdrant")
+    activity_log_batch_size: int = Field(200, env='ACTIVITY_LOG_BATCH_SIZE', description="Максимум записей журнала активности в одном INSERT")
+    activity_log_flush_interval: float = Field(0.5, env='ACTIVITY_LOG_FLUSH_INTERVAL', description="Сколько секунд запись журнала активности может ждать в буфере")
+    activity_log_max_pending: int = Field(10000, env='ACTIVITY_LOG_MAX_PENDING', description="Максимум записей журнала активности в буфере")
+    activity_log_put_timeout: float = Field(0.5, env='ACTIVITY_LOG_PUT_TIMEOUT', description="Сколько секунд ждать места в полном буфере, прежде чем отбросить запись")
+    user_touch_flush_interval: float = Field(5.0, env='USER_TOUCH_FLUSH_INTERVAL', description="На сколько секунд last_seen и служебные маркеры пользователя могут отставать в БД")
+    user_touch_max_pending: int = Field(5000, env='USER_TOUCH_MAX_PENDING', description="Пользователей в буфере касаний, при котором запись идёт досрочно")
+    message_queue_max_concurrency: int = Field(20, env='MESSAGE_QUEUE_MAX_CONCURRENCY', description="Сколько пользователей получают ответ на свободное сообщение одновременно")
+    message_queue_max_per_user: int = Field(5, env='MESSAGE_QUEUE_MAX_PER_USER', description="Сколько сообщений одного пользователя может ждать обработки")
+    message_queue_max_pending: int = Field(500, env='MESSAGE_QUEUE_MAX_PENDING', description="Сколько сообщений всего может ждать обработки (дальше — ответ «занят»)")
+    message_queue_merge_window: float = Field(0.4, env='MESSAGE_QUEUE_MERGE_WINDOW', description="Сколько секунд ждать следующего сообщения серии, чтобы ответить на всю серию разом (0 — не ждать)")
 
     # Channel for fill_all_profiles
     our_channel_id: str = Field(..., env='OUR_CHANNEL_ID', description="Telegram channel ID для массового обновления summary")
@@ -80,6 +123,71 @@ class Settings(BaseSettings):
     llm_api_key: SecretStr = Field(..., env='LLM_API_KEY', description="API key для OpenAI/OpenRouter/Groq")
     llm_api_base: str = Field("https://api.openai.com/v1", env='LLM_API_BASE', description="Base URL для OpenAI/OpenRouter/Groq")
 
+    # Маршрутизация запросов между провайдерами LLM
+    llm_backends: List[Dict[str, Any]] = Field(default_factory=list, env='LLM_BACKENDS', description="Бэкенды LLM, JSON [{name, base_url, api_key, model}] (по умолчанию LLM_API_BASE и OPENAI_API_BASE)")
+    llm_hedge_enabled: bool = Field(True, env='LLM_HEDGE_ENABLED', description="Дублировать медленный запрос на следующий бэкенд")
+    llm_hedge_percentile: float = Field(0.9, env='LLM_HEDGE_PERCENTILE', description="Перцентиль латентности бэкенда, после которого уходит дубль")
+    llm_hedge_min_delay: float = Field(1.0, env='LLM_HEDGE_MIN_DELAY', description="Минимальная задержка перед дублирующим запросом, сек")
+    llm_hedge_default_delay: float = Field(4.0, env='LLM_HEDGE_DEFAULT_DELAY', description="Задержка перед дублем, пока статистики латентности мало, сек")
+    llm_circuit_failure_threshold: int = Field(5, env='LLM_CIRCUIT_FAILURE_THRESHOLD', description="Сбоев бэкенда подряд до размыкания circuit breaker")
+    llm_circuit_recovery_timeout: float = Field(30.0, env='LLM_CIRCUIT_RECOVERY_TIMEOUT', description="Пауза до пробного запроса к отключённому бэкенду, сек")
+    llm_telemetry_jsonl_path: Optional[str] = Field(None, env='LLM_TELEMETRY_JSONL_PATH', description="JSONL-файл, куда пишется каждый вызов LLM (пусто — не писать)")
+    llm_token_prices: Dict[str, Dict[str, float]] = Field(default_factory=dict, env='LLM_TOKEN_PRICES', description="Цены моделей в USD за 1M токенов: {модель: {prompt, completion}}")
+    llm_stream_include_usage: bool = Field(True, env='LLM_STREAM_INCLUDE_USAGE', description="Запрашивать usage в потоковых ответах (stream_options)")
+    llm_prompt_cache_hints: Literal['auto', 'always', 'off'] = Field('auto', env='LLM_PROMPT_CACHE_HINTS', description="Отмечать системный промпт cache_control: auto — только моделям, которым это нужно (Anthropic, Gemini)")
+    llm_prompt_cache_min_tokens: int = Field(1024, env='LLM_PROMPT_CACHE_MIN_TOKENS', description="Минимальная длина системного промпта в токенах для отметки cache_control")
+    llm_structured_output_mode: Literal['json_schema', 'json_object', 'off'] = Field('json_object', env='LLM_STRUCTURED_OUTPUT_MODE', description="JSON mode провайдера для структурированных ответов: схема, просто JSON или выключен")
+    llm_structured_max_repairs: int = Field(1, env='LLM_STRUCTURED_MAX_REPAIRS', description="Сколько раз просить модель исправить ответ, не прошедший проверку схемы")
+    llm_batch_classify_size: int = Field(20, env='LLM_BATCH_CLASSIFY_SIZE', description="Сколько пользователей классифицировать одним запросом к LLM")
+
+    # Общий HTTP-клиент для LLM API (keep-alive пул)
+    llm_http_pool_limit: int = Field(100, env='LLM_HTTP_POOL_LIMIT', description="Общий лимит соединений HTTP-клиента LLM")
+    llm_http_limit_per_host: int = Field(20, env='LLM_HTTP_LIMIT_PER_HOST', description="Лимит соединений на один хост LLM API")
+    llm_http_dns_ttl: int = Field(300, env='LLM_HTTP_DNS_TTL', description="TTL DNS-кэша HTTP-клиента в секундах")
+    llm_http_keepalive_timeout: float = Field(60, env='LLM_HTTP_KEEPALIVE_TIMEOUT', description="Время жизни простаивающего keep-alive соединения в секундах")
+    llm_http_timeout: float = Field(60, env='LLM_HTTP_TIMEOUT', description="Таймаут запроса к LLM API по умолчанию в секундах")
+
+    # Лимиты запросов к LLM (token bucket)
+    llm_rate_limit_per_minute: float = Field(20, env='LLM_RATE_LIMIT_PER_MINUTE', description="Запросов к LLM в минуту на API-ключ")
+    llm_rate_limit_per_day: float = Field(1000, env='LLM_RATE_LIMIT_PER_DAY', description="Запросов к LLM в сутки на API-ключ (0 — без лимита)")
+    llm_model_rate_limits: Dict[str, float] = Field(default_factory=dict, env='LLM_MODEL_RATE_LIMITS', description="Запросов в минуту на модель, JSON {модель: лимит}")
+    llm_rate_limit_max_wait: float = Field(60, env='LLM_RATE_LIMIT_MAX_WAIT', description="Максимальное ожидание слота лимитера в секундах")
+
+    # Планировщик запросов к LLM по приоритетам
+    llm_total_slots: int = Field(8, env='LLM_TOTAL_SLOTS', description="Общий лимит одновременных запросов к LLM")
+    llm_interactive_slots: int = Field(8, env='LLM_INTERACTIVE_SLOTS', description="Слоты для интерактивных ответов")
+    llm_proactive_slots: int = Field(3, env='LLM_PROACTIVE_SLOTS', description="Слоты для проактивных сообщений")
+    llm_batch_slots: int = Field(2, env='LLM_BATCH_SLOTS', description="Слоты для пакетных задач (ротация профилей и т.п.)")
+    llm_interactive_slo_seconds: float = Field(8.0, env='LLM_INTERACTIVE_SLO_SECONDS', description="Целевая латентность интерактивного ответа LLM")
+    llm_preempt_batch: bool = Field(True, env='LLM_PREEMPT_BATCH', description="Вытеснять пакетные запросы ради интерактивных")
+
+    # Бюджеты промптов в токенах
+    prompt_budget_reply_tokens: int = Field(8000, env='PROMPT_BUDGET_REPLY_TOKENS', description="Бюджет промпта ответа в чате, токенов")
+    prompt_budget_profile_tokens: int = Field(20000, env='PROMPT_BUDGET_PROFILE_TOKENS', description="Бюджет текста для психологического профиля, токенов")
+
+    # Потоковый вывод ответов LLM в Telegram
+    llm_streaming_enabled: bool = Field(True, env='LLM_STREAMING_ENABLED', description="Выводить ответы LLM в чат по мере генерации")
+    telegram_stream_edit_interval: float = Field(1.0, env='TELEGRAM_STREAM_EDIT_INTERVAL', description="Минимальный интервал правки сообщения при потоковом выводе, сек")
+    telegram_stream_group_edit_interval: float = Field(3.0, env='TELEGRAM_STREAM_GROUP_EDIT_INTERVAL', description="Интервал правки при потоковом выводе в группах, сек")
+
+    # Кэш ответов LLM
+    llm_cache_enabled: bool = Field(True, env='LLM_CACHE_ENABLED', description="Включить кэш ответов LLM")
+    llm_cache_backend: Literal['memory', 'sqlite', 'redis'] = Field('memory', env='LLM_CACHE_BACKEND', description="Персистентный бэкенд кэша LLM")
+    llm_cache_ttl: float = Field(24 * 3600, env='LLM_CACHE_TTL', description="Время жизни записи кэша LLM в секундах")
+    llm_cache_max_entries: int = Field(5000, env='LLM_CACHE_MAX_ENTRIES', description="Максимум записей кэша LLM в памяти")
+    llm_cache_max_bytes: int = Field(32 * 1024 * 1024, env='LLM_CACHE_MAX_BYTES', description="Лимит памяти кэша LLM в байтах")
+    llm_cache_sqlite_path: str = Field('data/llm_cache.sqlite3', env='LLM_CACHE_SQLITE_PATH', description="Путь к SQLite-файлу кэша LLM")
+
+    # Семантический кэш ответов на короткие сообщения (включается явно)
+    semantic_cache_enabled: bool = Field(False, env='SEMANTIC_CACHE_ENABLED', description="Переиспользовать ответы на близкие по смыслу короткие сообщения")
+    semantic_cache_topics: List[str] = Field(default_factory=lambda: ['reply'], env='SEMANTIC_CACHE_TOPICS', description="Темы, для которых включён семантический кэш")
+    semantic_cache_threshold: float = Field(0.9, env='SEMANTIC_CACHE_THRESHOLD', description="Минимальная косинусная близость сообщений для попадания")
+    semantic_cache_ttl: float = Field(3600.0, env='SEMANTIC_CACHE_TTL', description="Время жизни записи семантического кэша, сек")
+    semantic_cache_max_entries: int = Field(500, env='SEMANTIC_CACHE_MAX_ENTRIES', description="Максимум записей семантического кэша на тему")
+    semantic_cache_max_chars: int = Field(120, env='SEMANTIC_CACHE_MAX_CHARS', description="Сообщения длиннее не кэшируются")
+    semantic_cache_variants: int = Field(3, env='SEMANTIC_CACHE_VARIANTS', description="Сколько вариантов ответа хранить на одно сообщение")
+    semantic_cache_embedder: str = Field('hashing', env='SEMANTIC_CACHE_EMBEDDER', description="Эмбеддер: 'hashing' или 'package.module:factory'")
+
     @property
     def log_file_path(self) -> str:
         """Получение пути к файлу лога"""
@@ -0,0 +1,101 @@
+"""
+Ленивая сессия БД для обработчиков апдейтов.
+
+DbSessionMiddleware кладёт в data["session"] не AsyncSession, а LazySession:
+настоящая сессия создаётся при первом обращении к ней (execute, get, add...),
+а апдейты, которым БД не нужна (callback-и, команды без данных, свободный
+текст, который обработчик уводит в фон), не открывают сессию и не берут
+соединение из пула. release() возвращает соединение в пул посреди
+обработчика — например, перед долгим запросом к LLM; сессию после этого
+можно использовать дальше.
+"""
+import time
+from typing import Any, Callable, Dict, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+_stats = {
+    "updates": 0, "updates_without_db": 0, "sessions_opened": 0, "open_now": 0, "max_open": 0,
+}
+_hold_time = 0.0
+_max_hold_time = 0.0
+
+
+def get_db_session_stats() -> Dict[str, Any]:
+    """Сколько апдейтов обошлись без сессии и сколько сессии жили"""
+    opened = _stats["sessions_opened"]
+    return {
+        **_stats,
+        "avg_hold_ms": round(_hold_time / opened * 1000, 2) if opened else 0.0,
+        "max_hold_ms": round(_max_hold_time * 1000, 2),
+    }
+
+
+def record_update(used_db: bool) -> None:
+    """Учитывает завершённый апдейт (вызывается middleware)"""
+    _stats["updates"] += 1
+    if not used_db:
+        _stats["updates_without_db"] += 1
+
+
+class LazySession:
+    """
+    Заместитель AsyncSession: атрибуты и методы берутся у настоящей сессии,
+    которая создаётся при первом обращении.
+
+    Args:
+        session_factory: Фабрика AsyncSession (async_sessionmaker)
+    """
+
+    def __init__(self, session_factory: Callable[[], AsyncSession]):
+        self._factory = session_factory
+        self._session: Optional[AsyncSession] = None
+        self._opened_at = 0.0
+        self.used = False
+
+    @property
+    def session(self) -> AsyncSession:
+        """Настоящая сессия (создаётся при первом обращении)"""
+        if self._session is None:
+            self._session = self._factory()
+            self._opened_at = time.perf_counter()
+            self.used = True
+            _stats["sessions_opened"] += 1
+            _stats["open_now"] += 1
+            _stats["max_open"] = max(_stats["max_open"], _stats["open_now"])
+        return self._session
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.session, name)
+
+    async def __aenter__(self) -> AsyncSession:
+        return self.session
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def release(self) -> None:
+        """Возвращает соединение в пул (транзакция откатывается); сессия остаётся рабочей"""
+        if self._session is not None:
+            await self._session.close()
+
+    async def rollback(self) -> None:
+        if self._session is not None:
+            await self._session.rollback()
+
+    async def close(self) -> None:
+        """Закрывает сессию, если она создавалась"""
+        global _hold_time, _max_hold_time
+        session, self._session = self._session, None
+        if session is None:
+            return
+        try:
+            await session.close()
+        finally:
+            held = time.perf_counter() - self._opened_at
+            _hold_time += held
+            _max_hold_time = max(_max_hold_time, held)
+            _stats["open_now"] -= 1
+
+    def __repr__(self) -> str:
+        return f"<LazySession {'open' if self._session is not None else 'idle'}>"
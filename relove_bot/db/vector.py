@@ -1,86 +1,275 @@
+"""
+Векторный поиск похожих пользователей (/similar).
+
+По умолчанию векторы хранятся во встроенном индексе (db/vector_index.py) в
+каталоге VECTOR_INDEX_PATH — внешний сервис не нужен. Qdrant остаётся
+опциональным бэкендом (VECTOR_BACKEND=qdrant).
+
+Все функции модуля асинхронные и не блокируют цикл событий: поиск во
+встроенном индексе идёт в потоке, а к Qdrant ходит один общий
+AsyncQdrantClient (пул keep-alive соединений, таймаут на запрос), созданный
+при первом обращении. Импорт модуля сети не трогает; коллекция создаётся
+явно — init_vector_db() при старте бота или в скрипте индексации.
+"""
+import asyncio
 import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
-logger = logging.getLogger(__name__)
+from relove_bot.config import settings
 
-# Qdrant опционален - обрабатываем отсутствие
-qdrant = None
-try:
-    from qdrant_client import QdrantClient
-    from qdrant_client.http.models import Distance, VectorParams, PointStruct
-    qdrant = QdrantClient("localhost", port=6333)
-    logger.info("[Qdrant] Клиент инициализирован")
-except ImportError:
-    logger.warning("[Qdrant] Библиотека qdrant-client не установлена. Команда /similar недоступна.")
-except Exception as e:
-    logger.warning(f"[Qdrant] Ошибка инициализации: {e}. Команда /similar недоступна.")
+logger = logging.getLogger(__name__)
 
 COLLECTION_NAME = "user_profiles"
+# Пауза перед повторной попыткой подключиться к Qdrant после ошибки
+QDRANT_RETRY_INTERVAL = 30.0
 
-# Автоматическая инициализация коллекции при импорте
-if qdrant:
-    try:
-        collections = [c.name for c in qdrant.get_collections().collections]
-        if COLLECTION_NAME not in collections:
-            qdrant.recreate_collection(
-                collection_name=COLLECTION_NAME,
-                vectors_config=VectorParams(size=1536, distance=Distance.COSINE)
+_index = None
+_index_lock = threading.Lock()
+# Встроенный индекс изменён в памяти и ещё не сброшен на диск
+_index_dirty = False
+_qdrant = None
+_qdrant_lock: Optional[asyncio.Lock] = None
+_qdrant_failed_at: Optional[float] = None
+
+
+def _local_index():
+    """Встроенный индекс (создаётся или загружается с диска при первом обращении)"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                from relove_bot.db.vector_index import VectorIndex
+
+                _index = VectorIndex(
+                    settings.embedding_dim,
+                    path=settings.vector_index_path,
+                    dtype=settings.vector_index_dtype,
+                    nprobe=settings.vector_index_nprobe,
+                )
+    return _index
+
+
+async def _qdrant_client():
+    """
+    Общий AsyncQdrantClient или None, если библиотека не установлена или
+    последняя попытка подключения упала меньше QDRANT_RETRY_INTERVAL назад.
+    """
+    global _qdrant, _qdrant_lock, _qdrant_failed_at
+    if _qdrant is not None:
+        return _qdrant
+    if _qdrant_failed_at is not None and time.monotonic() - _qdrant_failed_at < QDRANT_RETRY_INTERVAL:
+        return None
+    if _qdrant_lock is None:
+        _qdrant_lock = asyncio.Lock()
+    async with _qdrant_lock:
+        if _qdrant is not None:
+            return _qdrant
+        try:
+            import httpx
+            from qdrant_client import AsyncQdrantClient
+
+            api_key = settings.qdrant_api_key.get_secret_value() if settings.qdrant_api_key else None
+            _qdrant = AsyncQdrantClient(
+                url=settings.qdrant_url,
+                api_key=api_key,
+                timeout=settings.qdrant_timeout,
+                # Передаётся в httpx.AsyncClient: одно соединение на запрос не открывается
+                limits=httpx.Limits(
+                    max_connections=settings.qdrant_pool_size,
+                    max_keepalive_connections=settings.qdrant_pool_size,
+                ),
             )
-        logger.info(f"[Qdrant] Коллекция '{COLLECTION_NAME}' готова.")
-    except Exception as e:
-        logger.error(f"[Qdrant] Ошибка инициализации коллекции: {e}")
-        qdrant = None  # Отключаем Qdrant при ошибке
-
-def init_vector_db():
-    """Инициализирует векторную БД (оставлено для явного вызова, если нужно)"""
-    global qdrant
-    if not qdrant:
-        logger.warning("[Qdrant] Клиент недоступен. Убедитесь, что Qdrant запущен и qdrant-client установлен.")
-        return False
+            _qdrant_failed_at = None
+        except ImportError:
+            _qdrant_failed_at = time.monotonic()
+            logger.warning("[Qdrant] Библиотека qdrant-client не установлена. Команда /similar недоступна.")
+        except Exception as e:
+            _qdrant_failed_at = time.monotonic()
+            logger.warning(f"[Qdrant] Ошибка создания клиента: {e}. Команда /similar недоступна.")
+    return _qdrant
+
+
+def _qdrant_unavailable(message: str) -> None:
+    """Откладывает следующие обращения к Qdrant после сетевой ошибки"""
+    global _qdrant_failed_at
+    _qdrant_failed_at = time.monotonic()
+    logger.error(f"[Qdrant] {message}")
+
+
+async def init_vector_db() -> bool:
+    """
+    Явная инициализация векторного хранилища: создаёт коллекцию Qdrant, если
+    её нет, или загружает встроенный индекс с диска. Вызывается при старте
+    бота и в скрипте индексации, а не при импорте модуля.
+    """
+    if settings.vector_backend == 'qdrant':
+        client = await _qdrant_client()
+        if not client:
+            return False
+        try:
+            from qdrant_client.http.models import Distance, VectorParams
+
+            if not await client.collection_exists(COLLECTION_NAME):
+                await client.create_collection(
+                    collection_name=COLLECTION_NAME,
+                    vectors_config=VectorParams(size=settings.embedding_dim, distance=Distance.COSINE)
+                )
+            logger.info(f"[Qdrant] Коллекция '{COLLECTION_NAME}' готова.")
+            return True
+        except Exception as e:
+            _qdrant_unavailable(f"Ошибка инициализации коллекции '{COLLECTION_NAME}': {e}")
+            return False
     try:
-        collections = [c.name for c in qdrant.get_collections().collections]
-        if COLLECTION_NAME not in collections:
-            qdrant.recreate_collection(
-                collection_name=COLLECTION_NAME,
-                vectors_config=VectorParams(size=1536, distance=Distance.COSINE)
-            )
-        logger.info(f"[Qdrant] Коллекция '{COLLECTION_NAME}' готова.")
+        index = await asyncio.to_thread(_local_index)
+        logger.info(f"[VectorIndex] Векторов в индексе: {len(index)}")
         return True
     except Exception as e:
-        logger.error(f"[Qdrant] Ошибка инициализации коллекции: {e}")
-        qdrant = None
+        logger.error(f"[VectorIndex] Ошибка загрузки индекса {settings.vector_index_path}: {e}")
         return False
 
-def upsert_user_embedding(user_id: int, embedding: list[float], metadata: dict):
-    """Сохраняет эмбеддинг пользователя в Qdrant (опционально)"""
-    if not qdrant:
-        logger.debug(f"[Qdrant] Пропуск сохранения для {user_id} - Qdrant недоступен")
-        return
+
+def _local_flush() -> bool:
+    global _index_dirty
+    with _index_lock:
+        if _index is None or not _index_dirty:
+            return False
+        _index_dirty = False
+    _index.save()
+    return True
+
+
+async def flush_vector_db() -> bool:
+    """
+    Сбрасывает встроенный индекс на диск, если он менялся. Upsert пишет
+    только в память: сохранение переписывает индекс целиком, поэтому
+    скрипт индексации сохраняет его один раз после всех пачек.
+
+    Returns:
+        True, если индекс был сохранён
+    """
     try:
-        qdrant.upsert(
-            collection_name=COLLECTION_NAME,
-            points=[
-                PointStruct(
-                    id=user_id,
-                    vector=embedding,
-                    payload=metadata
+        return await asyncio.to_thread(_local_flush)
+    except Exception as e:
+        logger.error(f"[VectorIndex] Ошибка сохранения индекса {settings.vector_index_path}: {e}")
+        return False
+
+
+async def close_vector_db() -> None:
+    """Сохраняет встроенный индекс и закрывает соединения с Qdrant (при остановке бота)"""
+    global _qdrant
+    await flush_vector_db()
+    client, _qdrant = _qdrant, None
+    if client is not None:
+        await client.close()
+
+
+def _local_upsert(items: List[Tuple[int, List[float], Dict[str, Any]]]) -> int:
+    global _index_dirty
+    index = _local_index()
+    saved = index.upsert(items)
+    if saved:
+        _index_dirty = True
+    return saved
+
+
+def _local_search(query_embedding, top_k: int, filters: Dict[str, Any]):
+    return _local_index().search(query_embedding, top_k=top_k, filters=filters)
+
+
+async def upsert_user_embeddings(items: Iterable[Tuple[int, List[float], Dict[str, Any]]]) -> int:
+    """
+    Сохраняет эмбеддинги пользователей пачкой.
+
+    Args:
+        items: (user_id, вектор, метаданные); gender, is_active и streams
+            из метаданных доступны как фильтры поиска
+
+    Returns:
+        Сколько векторов сохранено
+    """
+    items = list(items)
+    if not items:
+        return 0
+    if settings.vector_backend == 'qdrant':
+        client = await _qdrant_client()
+        if not client:
+            logger.debug(f"[Qdrant] Пропуск сохранения {len(items)} векторов - Qdrant недоступен")
+            return 0
+        from qdrant_client.http.models import PointStruct
+
+        saved = 0
+        batch_size = max(1, settings.qdrant_upsert_batch)
+        try:
+            for start in range(0, len(items), batch_size):
+                batch = items[start:start + batch_size]
+                await client.upsert(
+                    collection_name=COLLECTION_NAME,
+                    points=[PointStruct(id=user_id, vector=list(map(float, vector)), payload=metadata) for user_id, vector, metadata in batch]
                 )
-            ]
-        )
+                saved += len(batch)
+        except Exception as e:
+            _qdrant_unavailable(f"Ошибка сохранения эмбеддингов (сохранено {saved} из {len(items)}): {e}")
+        return saved
+    try:
+        return await asyncio.to_thread(_local_upsert, items)
     except Exception as e:
-        logger.error(f"[Qdrant] Ошибка сохранения эмбеддинга для {user_id}: {e}")
+        logger.error(f"[VectorIndex] Ошибка сохранения {len(items)} эмбеддингов: {e}")
+        return 0
 
-def search_similar_users(query_embedding: list[float], top_k: int = 5):
-    """Ищет похожих пользователей в Qdrant (опционально)"""
-    if not qdrant:
-        logger.debug("[Qdrant] Поиск недоступен - Qdrant не запущен")
-        return []
+
+async def upsert_user_embedding(user_id: int, embedding: list[float], metadata: dict) -> bool:
+    """Сохраняет эмбеддинг пользователя"""
+    return await upsert_user_embeddings([(user_id, embedding, metadata)]) == 1
+
+
+def _qdrant_filter(filters: Dict[str, Any]):
+    from qdrant_client.http.models import FieldCondition, Filter, HasIdCondition, MatchAny, MatchValue
+
+    must = []
+    if filters.get("gender"):
+        must.append(FieldCondition(key="gender", match=MatchValue(value=filters["gender"])))
+    if filters.get("is_active") is not None:
+        must.append(FieldCondition(key="is_active", match=MatchValue(value=bool(filters["is_active"]))))
+    if filters.get("streams"):
+        must.append(FieldCondition(key="streams", match=MatchAny(any=list(filters["streams"]))))
+    must_not = [HasIdCondition(has_id=list(filters["exclude_ids"]))] if filters.get("exclude_ids") else None
+    return Filter(must=must or None, must_not=must_not) if must or must_not else None
+
+
+async def search_similar_users(query_embedding: list[float], top_k: int = 5, filters: Optional[Dict[str, Any]] = None):
+    """
+    Ищет похожих пользователей.
+
+    Args:
+        query_embedding: Вектор запроса
+        top_k: Сколько пользователей вернуть
+        filters: gender ('male'/'female'), is_active, streams (любой из), exclude_ids
+
+    Returns:
+        Результаты с полями id, score и payload
+    """
+    filters = filters or {}
+    if settings.vector_backend == 'qdrant':
+        client = await _qdrant_client()
+        if not client:
+            logger.debug("[Qdrant] Поиск недоступен - Qdrant не запущен")
+            return []
+        try:
+            response = await client.query_points(
+                collection_name=COLLECTION_NAME,
+                query=list(map(float, query_embedding)),
+                query_filter=_qdrant_filter(filters),
+                limit=top_k,
+                with_payload=True,
+            )
+            return response.points
+        except Exception as e:
+            _qdrant_unavailable(f"Ошибка поиска: {e}")
+            return []
     try:
-        hits = qdrant.search(
-            collection_name=COLLECTION_NAME,
-            query_vector=query_embedding,
-            limit=top_k
-        )
-        return hits
+        return await asyncio.to_thread(_local_search, query_embedding, top_k, filters)
     except Exception as e:
-        logger.error(f"[Qdrant] Ошибка поиска: {e}")
+        logger.error(f"[VectorIndex] Ошибка поиска: {e}")
         return []
@@ -0,0 +1,385 @@
+"""
+Встроенный ANN-индекс векторов профилей для /similar.
+
+Индекс IVF (inverted file) поверх массивов NumPy: векторы нормируются и
+хранятся в float32 или float16 в файле .npy, открытом через memmap, так что
+индекс на миллион профилей не обязан целиком сидеть в памяти. Пока векторов
+меньше exact_threshold, поиск точный (один матричный проход). Дальше индекс
+обучает центроиды сферическим k-means и ищет только в nprobe ближайших к
+запросу кластерах.
+
+Upsert инкрементальный: новый вектор дописывается в конец и сразу
+относится к ближайшему центроиду, существующий перезаписывается на месте.
+Когда индекс вырастает вдвое с последнего обучения, центроиды
+переобучаются. Фильтры по полу, активности и потокам reLove — булевы маски
+по колонкам метаданных, без обращения к payload.
+"""
+import json
+import logging
+import math
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+GENDER_CODES = {"male": 1, "female": 2}
+MAX_STREAMS = 64  # потоки хранятся битовой маской uint64
+SEARCH_CHUNK_ROWS = 65536
+
+_ARRAYS = ("ids", "alive", "gender", "active", "streams", "assign")
+
+
+@dataclass
+class VectorHit:
+    """Результат поиска (те же поля, что у ScoredPoint из Qdrant)"""
+    id: int
+    score: float
+    payload: Dict[str, Any] = field(default_factory=dict)
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def spherical_kmeans(vectors: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Центроиды для косинусной близости (векторы нормированы).
+
+    Returns:
+        Нормированные центроиды (k × dim, float32)
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assign = nearest_centroids(vectors, centroids)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=k)
+        nonempty = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+        sums = np.add.reduceat(vectors[order].astype(np.float32), starts, axis=0)
+        updated = centroids.copy()
+        updated[nonempty] = sums
+        # Пустые кластеры получают случайную точку, иначе nlist фактически меньше
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            updated[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        centroids = normalize_rows(updated).astype(np.float32)
+    return centroids
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), SEARCH_CHUNK_ROWS):
+        chunk = vectors[start:start + SEARCH_CHUNK_ROWS].astype(np.float32)
+        assign[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assign
+
+
+class VectorIndex:
+    """
+    IVF-индекс с фильтрами по метаданным.
+
+    Args:
+        dim: Размерность векторов
+        path: Каталог индекса на диске (None — только в памяти)
+        dtype: 'float32' или 'float16' (вдвое меньше памяти, чуть ниже точность)
+        nprobe: Сколько ближайших кластеров просматривать при поиске
+        exact_threshold: До стольких векторов поиск точный и центроиды не обучаются
+        initial_capacity: Начальная ёмкость (растёт удвоением)
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        path: Optional[str] = None,
+        dtype: str = "float32",
+        nprobe: int = 8,
+        exact_threshold: int = 20000,
+        initial_capacity: int = 1024,
+    ):
+        self.dim = dim
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.nprobe = nprobe
+        self.exact_threshold = exact_threshold
+        self._lock = threading.RLock()
+        self.count = 0
+        self.capacity = 0
+        self.centroids: Optional[np.ndarray] = None
+        self.trained_size = 0
+        self.payloads: Dict[int, Dict[str, Any]] = {}
+        self.stream_bits: Dict[str, int] = {}
+        self._rows: Dict[int, int] = {}
+
+        if path and os.path.exists(os.path.join(path, "meta.json")):
+            self._load()
+        else:
+            if path:
+                os.makedirs(path, exist_ok=True)
+            self._allocate(initial_capacity)
+
+    # --- хранение ---
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _new_vectors(self, capacity: int, filename: str = "vectors.npy") -> np.ndarray:
+        if self.path:
+            return np.lib.format.open_memmap(self._file(filename), mode="w+", dtype=self.dtype, shape=(capacity, self.dim))
+        return np.zeros((capacity, self.dim), dtype=self.dtype)
+
+    def _allocate(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.vectors = self._new_vectors(capacity)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.gender = np.zeros(capacity, dtype=np.int8)
+        self.active = np.zeros(capacity, dtype=bool)
+        self.streams = np.zeros(capacity, dtype=np.uint64)
+        self.assign = np.full(capacity, -1, dtype=np.int32)
+
+    def _grow(self, needed: int) -> None:
+        capacity = max(needed, self.capacity * 2)
+        if self.path:
+            # Новый memmap рядом, затем атомарная замена файла
+            vectors = self._new_vectors(capacity, "vectors.tmp.npy")
+            vectors[:self.count] = self.vectors[:self.count]
+            vectors.flush()
+            del self.vectors
+            os.replace(self._file("vectors.tmp.npy"), self._file("vectors.npy"))
+            self.vectors = np.load(self._file("vectors.npy"), mmap_mode="r+")
+        else:
+            vectors = np.zeros((capacity, self.dim), dtype=self.dtype)
+            vectors[:self.count] = self.vectors[:self.count]
+            self.vectors = vectors
+        for name in _ARRAYS:
+            old = getattr(self, name)
+            fill = -1 if name == "assign" else 0
+            new = np.full(capacity, fill, dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def save(self) -> None:
+        """Сбрасывает индекс на диск (векторы уже в memmap, остальное — рядом)"""
+        if not self.path:
+            return
+        with self._lock:
+            self.vectors.flush()
+            for name in _ARRAYS:
+                self._save_array(name, getattr(self, name)[:self.count])
+            if self.centroids is not None:
+                self._save_array("centroids", self.centroids)
+            self._write_json("payloads.json", {str(key): value for key, value in self.payloads.items()})
+            # meta.json пишется последним: по нему индекс считается целым
+            self._write_json("meta.json", {
+                "dim": self.dim,
+                "dtype": self.dtype.name,
+                "count": self.count,
+                "trained_size": self.trained_size,
+                "stream_bits": self.stream_bits,
+            })
+
+    def _save_array(self, name: str, array: np.ndarray) -> None:
+        tmp = self._file(f"{name}.tmp.npy")
+        np.save(tmp, array)
+        os.replace(tmp, self._file(f"{name}.npy"))
+
+    def _write_json(self, name: str, data: Any) -> None:
+        tmp = self._file(f"{name}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, self._file(name))
+
+    def _load(self) -> None:
+        with open(self._file("meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["dim"] != self.dim:
+            raise ValueError(f"Индекс {self.path} построен для размерности {meta['dim']}, а не {self.dim}")
+        self.dtype = np.dtype(meta["dtype"])
+        self.count = meta["count"]
+        self.trained_size = meta["trained_size"]
+        self.stream_bits = meta["stream_bits"]
+        self.vectors = np.load(self._file("vectors.npy"), mmap_mode="r+")
+        self.capacity = len(self.vectors)
+        for name in _ARRAYS:
+            stored = np.load(self._file(f"{name}.npy"))
+            array = np.full(self.capacity, -1 if name == "assign" else 0, dtype=stored.dtype)
+            array[:self.count] = stored
+            setattr(self, name, array)
+        if os.path.exists(self._file("centroids.npy")):
+            self.centroids = np.load(self._file("centroids.npy"))
+        with open(self._file("payloads.json"), encoding="utf-8") as f:
+            self.payloads = {int(key): value for key, value in json.load(f).items()}
+        self._rows = {int(user_id): row for row, user_id in enumerate(self.ids[:self.count]) if self.alive[row]}
+        logger.info(f"Векторный индекс загружен: {len(self)} векторов из {self.path}")
+
+    # --- изменение ---
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _streams_mask(self, streams: Optional[Sequence[str]], create: bool) -> int:
+        mask = 0
+        for stream in streams or ():
+            bit = self.stream_bits.get(stream)
+            if bit is None:
+                if not create or len(self.stream_bits) >= MAX_STREAMS:
+                    continue
+                bit = self.stream_bits[stream] = len(self.stream_bits)
+            mask |= 1 << bit
+        return mask
+
+    def upsert(self, items: Iterable[Tuple[int, Sequence[float], Optional[Dict[str, Any]]]]) -> int:
+        """
+        Добавляет или обновляет векторы.
+
+        Args:
+            items: (id, вектор, метаданные); метаданные gender, is_active и
+                streams становятся фильтрами, весь словарь — payload
+
+        Returns:
+            Число записанных векторов
+        """
+        items = list(items)
+        if not items:
+            return 0
+        vectors = np.asarray([vector for _, vector, _ in items], dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            raise ValueError(f"Ожидались векторы размерности {self.dim}, получено {vectors.shape}")
+        vectors = normalize_rows(vectors)
+
+        with self._lock:
+            new_rows = sum(1 for item_id, _, _ in items if int(item_id) not in self._rows)
+            if self.count + new_rows > self.capacity:
+                self._grow(self.count + new_rows)
+
+            rows = np.empty(len(items), dtype=np.int64)
+            for i, (item_id, _, metadata) in enumerate(items):
+                item_id = int(item_id)
+                row = self._rows.get(item_id)
+                if row is None:
+                    row = self._rows[item_id] = self.count
+                    self.count += 1
+                rows[i] = row
+                metadata = dict(metadata or {})
+                self.ids[row] = item_id
+                self.alive[row] = True
+                self.gender[row] = GENDER_CODES.get(str(metadata.get("gender") or "").lower(), 0)
+                self.active[row] = bool(metadata.get("is_active", True))
+                self.streams[row] = np.uint64(self._streams_mask(metadata.get("streams"), create=True))
+                if metadata:
+                    self.payloads[item_id] = metadata
+                else:
+                    self.payloads.pop(item_id, None)
+
+            # Векторы с одинаковым id в одной пачке: побеждает последний
+            self.vectors[rows] = vectors.astype(self.dtype)
+            if self.centroids is not None:
+                self.assign[rows] = nearest_centroids(vectors, self.centroids)
+
+            if len(self) >= self.exact_threshold and len(self) >= 2 * self.trained_size:
+                self.train()
+        return len(items)
+
+    def delete(self, ids: Iterable[int]) -> int:
+        """Убирает векторы из поиска (строка остаётся занятой, id можно добавить снова)"""
+        removed = 0
+        with self._lock:
+            for item_id in ids:
+                row = self._rows.pop(int(item_id), None)
+                if row is not None:
+                    self.alive[row] = False
+                    self.payloads.pop(int(item_id), None)
+                    removed += 1
+        return removed
+
+    def train(self, points_per_cluster: int = 32, iterations: int = 8) -> None:
+        """Обучает центроиды IVF на выборке живых векторов и переразмечает все строки"""
+        with self._lock:
+            rows = np.flatnonzero(self.alive[:self.count])
+            if len(rows) == 0:
+                return
+            nlist = int(min(2048, max(16, 2 * math.sqrt(len(rows)))))
+            # Для k-means хватает нескольких десятков точек на кластер
+            sample_size = nlist * points_per_cluster
+            rng = np.random.default_rng(0)
+            sample = rows if len(rows) <= sample_size else np.sort(rng.choice(rows, sample_size, replace=False))
+            self.centroids = spherical_kmeans(np.asarray(self.vectors[sample], dtype=np.float32), nlist, iterations)
+            self.assign[:self.count] = nearest_centroids(self.vectors[:self.count], self.centroids)
+            self.trained_size = len(rows)
+            logger.info(f"Векторный индекс: обучено {len(self.centroids)} кластеров на {len(sample)} векторах")
+
+    # --- поиск ---
+
+    def _filter_mask(self, filters: Optional[Dict[str, Any]]) -> np.ndarray:
+        mask = self.alive[:self.count].copy()
+        filters = filters or {}
+        if filters.get("gender"):
+            mask &= self.gender[:self.count] == GENDER_CODES.get(str(filters["gender"]).lower(), -1)
+        if filters.get("is_active") is not None:
+            mask &= self.active[:self.count] == bool(filters["is_active"])
+        if filters.get("streams"):
+            wanted = self._streams_mask(filters["streams"], create=False)
+            # Хотя бы один из потоков
+            mask &= (self.streams[:self.count] & np.uint64(wanted)) != 0
+        for item_id in filters.get("exclude_ids") or ():
+            row = self._rows.get(int(item_id))
+            if row is not None:
+                mask[row] = False
+        return mask
+
+    def search(
+        self,
+        query: Sequence[float],
+        top_k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+        nprobe: Optional[int] = None,
+        exact: bool = False,
+    ) -> List[VectorHit]:
+        """
+        Ближайшие по косинусу векторы.
+
+        Args:
+            query: Вектор запроса
+            top_k: Сколько результатов вернуть
+            filters: gender ('male'/'female'), is_active, streams (любой из), exclude_ids
+            nprobe: Кластеров для просмотра (по умолчанию из конструктора)
+            exact: Точный поиск по всем векторам (для проверки полноты)
+        """
+        q = np.asarray(query, dtype=np.float32)
+        q = q / max(float(np.linalg.norm(q)), 1e-12)
+        with self._lock:
+            mask = self._filter_mask(filters)
+            if not exact and self.centroids is not None and len(self) >= self.exact_threshold:
+                probes = np.argsort(-(self.centroids @ q))[:nprobe or self.nprobe]
+                mask &= np.isin(self.assign[:self.count], probes)
+            rows = np.flatnonzero(mask)
+            if len(rows) == 0:
+                return []
+
+            if len(rows) > self.count // 4:
+                # Плотная маска: последовательное чтение блоков быстрее выборки отдельных строк
+                scores = np.empty(self.count, dtype=np.float32)
+                for start in range(0, self.count, SEARCH_CHUNK_ROWS):
+                    block = self.vectors[start:min(start + SEARCH_CHUNK_ROWS, self.count)]
+                    scores[start:start + len(block)] = np.asarray(block, dtype=np.float32) @ q
+                scores = scores[rows]
+            else:
+                scores = np.empty(len(rows), dtype=np.float32)
+                for start in range(0, len(rows), SEARCH_CHUNK_ROWS):
+                    chunk = rows[start:start + SEARCH_CHUNK_ROWS]
+                    scores[start:start + len(chunk)] = np.asarray(self.vectors[chunk], dtype=np.float32) @ q
+            k = min(top_k, len(rows))
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [
+                VectorHit(int(self.ids[rows[i]]), float(scores[i]), self.payloads.get(int(self.ids[rows[i]]), {}))
+                for i in best
+            ]
@@ -0,0 +1,418 @@
+"""
+Отложенная запись в БД (write-behind) для данных, которые не нужны
+обработчику сразу.
+
+Журнал активности (UserActivityLog) пишется на каждый апдейт. Раньше это был
+отдельный INSERT и COMMIT на каждое сообщение — при всплеске трафика один
+поход в Postgres и один fsync на апдейт. ActivityLogWriter складывает строки
+в ограниченную очередь, а фоновая задача пишет их одним многострочным
+INSERT, когда набралось batch_size строк или прошло flush_interval секунд.
+Если очередь заполнена, add() ждёт свободного места не дольше put_timeout
+(обратное давление на обработку апдейтов) и только потом отбрасывает строку.
+close() дописывает всё накопленное — вызывается при остановке бота.
+
+UserTouchCoalescer делает то же для «касаний» пользователя: last_seen_date и
+служебных маркеров вроде last_message. Десять сообщений подряд раньше давали
+десять UPDATE одной строки; теперь в памяти держится только последнее
+касание каждого пользователя, и раз в flush_interval секунд (допустимое
+отставание данных в БД) все они пишутся одним UPDATE ... FROM (VALUES ...).
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import BigInteger, DateTime, bindparam, column, insert, select, update, values
+
+from relove_bot.db.models import User, UserActivityLog
+
+logger = logging.getLogger(__name__)
+
+# Маркер остановки фоновой задачи в очереди
+_STOP = object()
+
+
+class ActivityLogWriter:
+    """
+    Буфер записей UserActivityLog с пакетной записью.
+
+    Args:
+        session_factory: Фабрика AsyncSession (по умолчанию SessionLocal)
+        batch_size: Максимум строк в одном INSERT
+        flush_interval: Сколько секунд строка может ждать записи
+        max_pending: Максимум строк в очереди (ограничение памяти)
+        put_timeout: Сколько секунд add() ждёт места в полной очереди
+    """
+
+    def __init__(
+        self,
+        session_factory: Optional[Callable[[], Any]] = None,
+        batch_size: int = 200,
+        flush_interval: float = 0.5,
+        max_pending: int = 10000,
+        put_timeout: float = 0.5,
+    ):
+        self._session_factory = session_factory
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_pending = max(1, max_pending)
+        self.put_timeout = put_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        self._stats = {
+            "added": 0, "written": 0, "failed": 0, "dropped": 0, "backpressure_waits": 0,
+            "flushes": 0, "fallback_flushes": 0, "max_rows_per_flush": 0,
+        }
+        self._flush_time = 0.0
+        self._max_flush_time = 0.0
+        self._last_flush_time = 0.0
+
+    def _sessions(self):
+        if self._session_factory is None:
+            from relove_bot.db.session import SessionLocal
+
+            self._session_factory = SessionLocal
+        return self._session_factory
+
+    def _ensure_started(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_pending)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="activity-log-writer")
+
+    async def add(
+        self,
+        user_id: int,
+        activity_type: str,
+        chat_id: Optional[int] = None,
+        details: Optional[Dict[str, Any]] = None,
+        timestamp: Optional[datetime] = None,
+    ) -> bool:
+        """
+        Ставит запись в очередь. Время события фиксируется сейчас, а не при
+        записи в БД.
+
+        Returns:
+            False, если запись отброшена из-за переполнения очереди
+        """
+        row = {
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "activity_type": activity_type,
+            "details": details,
+            "timestamp": timestamp or datetime.now(timezone.utc),
+        }
+        self._stats["added"] += 1
+        if self._closed:
+            # После остановки буфера запись идёт напрямую, чтобы не потерять её
+            await self._flush([row])
+            return True
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self._stats["backpressure_waits"] += 1
+            try:
+                await asyncio.wait_for(self._queue.put(row), self.put_timeout)
+            except asyncio.TimeoutError:
+                self._stats["dropped"] += 1
+                logger.warning(
+                    f"Очередь журнала активности заполнена ({self.max_pending}), запись пользователя {user_id} отброшена"
+                )
+                return False
+        return True
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        while True:
+            item = await queue.get()
+            if item is _STOP:
+                return
+            batch: List[Dict[str, Any]] = [item]
+            deadline = loop.time() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    if queue.empty():
+                        item = await asyncio.wait_for(queue.get(), max(0.0, deadline - loop.time()))
+                    else:
+                        item = queue.get_nowait()
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stop:
+                return
+
+    async def _flush(self, rows: List[Dict[str, Any]]) -> None:
+        started = time.perf_counter()
+        try:
+            async with self._sessions()() as session:
+                # Один многострочный INSERT (insertmanyvalues в SQLAlchemy 2)
+                await session.execute(insert(UserActivityLog), rows)
+                await session.commit()
+            written = len(rows)
+        except Exception as e:
+            # Одна плохая строка (например, нарушение внешнего ключа) не должна
+            # уносить с собой всю пачку — повторяем по одной
+            logger.warning(f"Ошибка пакетной записи журнала активности ({len(rows)} строк): {e}")
+            self._stats["fallback_flushes"] += 1
+            written = await self._flush_one_by_one(rows)
+        elapsed = time.perf_counter() - started
+        self._stats["flushes"] += 1
+        self._stats["written"] += written
+        self._stats["failed"] += len(rows) - written
+        self._stats["max_rows_per_flush"] = max(self._stats["max_rows_per_flush"], len(rows))
+        self._flush_time += elapsed
+        self._last_flush_time = elapsed
+        self._max_flush_time = max(self._max_flush_time, elapsed)
+        logger.debug(f"Журнал активности: записано {written}/{len(rows)} строк за {elapsed * 1000:.1f} мс")
+
+    async def _flush_one_by_one(self, rows: List[Dict[str, Any]]) -> int:
+        written = 0
+        for row in rows:
+            try:
+                async with self._sessions()() as session:
+                    await session.execute(insert(UserActivityLog), [row])
+                    await session.commit()
+                written += 1
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала активности пользователя {row['user_id']}: {e}")
+        return written
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Дописывает накопленные записи и останавливает фоновую задачу"""
+        self._closed = True
+        task, self._task = self._task, None
+        if task is None or task.done():
+            return
+        await self._queue.put(_STOP)
+        try:
+            await asyncio.wait_for(task, timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Журнал активности не дописан за {timeout} с, в очереди {self._queue.qsize()} строк")
+        logger.info(f"Журнал активности остановлен: {self.stats()}")
+
+    def stats(self) -> Dict[str, Any]:
+        flushes = self._stats["flushes"]
+        return {
+            **self._stats,
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "avg_rows_per_flush": round((self._stats["written"] + self._stats["failed"]) / flushes, 1) if flushes else 0.0,
+            "avg_flush_ms": round(self._flush_time / flushes * 1000, 2) if flushes else 0.0,
+            "last_flush_ms": round(self._last_flush_time * 1000, 2),
+            "max_flush_ms": round(self._max_flush_time * 1000, 2),
+        }
+
+
+_activity_log_writer: Optional[ActivityLogWriter] = None
+
+
+def get_activity_log_writer() -> ActivityLogWriter:
+    """Общий для процесса буфер журнала активности, настроенный из settings"""
+    global _activity_log_writer
+    if _activity_log_writer is None:
+        from relove_bot.config import settings
+
+        _activity_log_writer = ActivityLogWriter(
+            batch_size=settings.activity_log_batch_size,
+            flush_interval=settings.activity_log_flush_interval,
+            max_pending=settings.activity_log_max_pending,
+            put_timeout=settings.activity_log_put_timeout,
+        )
+    return _activity_log_writer
+
+
+async def close_activity_log_writer() -> None:
+    """Дописывает журнал активности при остановке бота"""
+    if _activity_log_writer is not None:
+        await _activity_log_writer.close()
+
+
+class UserTouchCoalescer:
+    """
+    Склеивает обновления last_seen_date и маркеров пользователя.
+
+    Args:
+        session_factory: Фабрика AsyncSession (по умолчанию SessionLocal)
+        flush_interval: Сколько секунд изменения могут не доходить до БД
+        max_pending: При стольких пользователях в буфере запись идёт досрочно
+    """
+
+    def __init__(
+        self,
+        session_factory: Optional[Callable[[], Any]] = None,
+        flush_interval: float = 5.0,
+        max_pending: int = 5000,
+    ):
+        self._session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.max_pending = max(1, max_pending)
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        self._stats = {"touches": 0, "absorbed": 0, "flushes": 0, "users_written": 0, "users_failed": 0}
+        self._flush_time = 0.0
+        self._max_flush_time = 0.0
+
+    def _sessions(self):
+        if self._session_factory is None:
+            from relove_bot.db.session import SessionLocal
+
+            self._session_factory = SessionLocal
+        return self._session_factory
+
+    def _ensure_started(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="user-touch-coalescer")
+
+    async def touch(
+        self,
+        user_id: int,
+        seen_at: Optional[datetime] = None,
+        markers: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        Запоминает касание пользователя: время последней активности и
+        маркеры, которые нужно дописать в User.markers (поверх текущих).
+        """
+        seen_at = seen_at or datetime.now(timezone.utc)
+        self._stats["touches"] += 1
+        entry = self._pending.get(user_id)
+        if entry is None:
+            entry = self._pending[user_id] = {"seen_at": seen_at, "markers": {}}
+        else:
+            # Предыдущее касание ещё не записано — эта запись поглощена
+            self._stats["absorbed"] += 1
+            entry["seen_at"] = max(entry["seen_at"], seen_at)
+        if markers:
+            entry["markers"].update(markers)
+        if self._closed:
+            await self.flush()
+            return
+        self._ensure_started()
+        if len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Пишет накопленные касания в БД одной транзакцией"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        started = time.perf_counter()
+        try:
+            async with self._sessions()() as session:
+                await self._apply(session, pending)
+                await session.commit()
+            self._stats["users_written"] += len(pending)
+        except Exception as e:
+            # Последнее касание не критично: следующее сообщение пользователя его обновит
+            self._stats["users_failed"] += len(pending)
+            logger.error(f"Ошибка записи касаний {len(pending)} пользователей: {e}")
+        elapsed = time.perf_counter() - started
+        self._stats["flushes"] += 1
+        self._flush_time += elapsed
+        self._max_flush_time = max(self._max_flush_time, elapsed)
+        logger.debug(f"Касания пользователей: {len(pending)} за {elapsed * 1000:.1f} мс")
+
+    async def _apply(self, session, pending: Dict[int, Dict[str, Any]]) -> None:
+        users = User.__table__
+        seen = [(user_id, entry["seen_at"]) for user_id, entry in pending.items()]
+        if session.get_bind().dialect.name == "postgresql":
+            touches = values(
+                column("id", BigInteger), column("seen_at", DateTime(timezone=True)), name="touches"
+            ).data(seen)
+            await session.execute(
+                update(User)
+                .where(User.id == touches.c.id)
+                .values(last_seen_date=touches.c.seen_at)
+                .execution_options(synchronize_session=False)
+            )
+        else:
+            # Без UPDATE ... FROM (VALUES) — один UPDATE с пакетом параметров;
+            # пользователи, которых ещё нет в БД, просто не обновляются
+            await session.execute(
+                update(users).where(users.c.id == bindparam("user_id")).values(last_seen_date=bindparam("seen_at")),
+                [{"user_id": user_id, "seen_at": seen_at} for user_id, seen_at in seen],
+            )
+
+        patches = {user_id: entry["markers"] for user_id, entry in pending.items() if entry["markers"]}
+        if patches:
+            # JSON-маркеры сливаются с текущими, поэтому их нужно прочитать
+            rows = await session.execute(select(User.id, User.markers).where(User.id.in_(list(patches))))
+            updates = [
+                {"user_id": user_id, "new_markers": {**(markers or {}), **patches[user_id]}, "seen_at": pending[user_id]["seen_at"]}
+                for user_id, markers in rows
+            ]
+            if updates:
+                # last_seen_date задаётся явно, иначе onupdate=now() перезапишет его временем записи
+                await session.execute(
+                    update(users)
+                    .where(users.c.id == bindparam("user_id"))
+                    .values(markers=bindparam("new_markers"), last_seen_date=bindparam("seen_at")),
+                    updates,
+                )
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Останавливает фоновую задачу и записывает последние касания"""
+        self._closed = True
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(task, timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Касания пользователей не записаны за {timeout} с")
+        await self.flush()
+        logger.info(f"Буфер касаний пользователей остановлен: {self.stats()}")
+
+    def stats(self) -> Dict[str, Any]:
+        flushes = self._stats["flushes"]
+        touches = self._stats["touches"]
+        return {
+            **self._stats,
+            "pending": len(self._pending),
+            "absorbed_ratio": round(self._stats["absorbed"] / touches, 3) if touches else 0.0,
+            "avg_flush_ms": round(self._flush_time / flushes * 1000, 2) if flushes else 0.0,
+            "max_flush_ms": round(self._max_flush_time * 1000, 2),
+        }
+
+
+_user_touch_coalescer: Optional[UserTouchCoalescer] = None
+
+
+def get_user_touch_coalescer() -> UserTouchCoalescer:
+    """Общий для процесса буфер касаний пользователей, настроенный из settings"""
+    global _user_touch_coalescer
+    if _user_touch_coalescer is None:
+        from relove_bot.config import settings
+
+        _user_touch_coalescer = UserTouchCoalescer(
+            flush_interval=settings.user_touch_flush_interval,
+            max_pending=settings.user_touch_max_pending,
+        )
+    return _user_touch_coalescer
+
+
+async def close_user_touch_coalescer() -> None:
+    """Записывает последние касания пользователей при остановке бота"""
+    if _user_touch_coalescer is not None:
+        await _user_touch_coalescer.close()
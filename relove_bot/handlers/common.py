@@ -1,5 +1,6 @@
 import logging
 import asyncio
+from typing import Optional
 from aiogram import Router, types
 from aiogram.types import CallbackQuery
 from aiogram.filters import Command, CommandStart
@@ -12,6 +13,9 @@ from ..db.models import UserActivityLog, User, GenderEnum
 from datetime import datetime
 from relove_bot.db.memory_index import user_memory_index
 from relove_bot.services.llm_service import llm_service
+from relove_bot.utils.prompt_budget import PromptBudget
+from relove_bot.utils.semantic_cache import context_fingerprint, get_semantic_cache
+from relove_bot.utils.telegram_stream import stream_reply
 from relove_bot.services.prompts import MESSAGE_SUMMARY_PROMPT, NATASHA_PROVOCATIVE_PROMPT
 
 logger = logging.getLogger(__name__)
@@ -19,6 +23,9 @@ router = Router()
 
 from ..rag.pipeline import get_profile_summary
 from ..db.vector import search_similar_users
+from ..db.write_behind import get_user_touch_coalescer
+from ..utils.user_queue import SubmitResult, UserWorkQueue
+from ..rag.embeddings import get_text_embedding
 from ..utils.user_utils import select_users
 import logging
 
@@ -259,29 +266,107 @@ async def handle_admin_user_info(message: types.Message):
         logging.error(f"Ошибка в handle_admin_user_info: {e}")
         await message.reply(f"Ошибка при получении информации: {e}")
 
+_BUSY_REPLY = "Сейчас очень много сообщений 🙏 Дай мне минутку и напиши ещё раз."
+
+_message_queue: Optional[UserWorkQueue] = None
+
+
+def _get_message_queue() -> UserWorkQueue:
+    """Очередь свободных сообщений: по порядку для пользователя, с общим лимитом"""
+    global _message_queue
+    if _message_queue is None:
+        _message_queue = UserWorkQueue(
+            _process_turn,
+            max_concurrency=settings.message_queue_max_concurrency,
+            max_per_user=settings.message_queue_max_per_user,
+            max_pending=settings.message_queue_max_pending,
+            merge_window=settings.message_queue_merge_window,
+        )
+    return _message_queue
+
+
+def get_message_queue_stats() -> dict:
+    return _message_queue.stats() if _message_queue is not None else {}
+
+
+async def close_message_queue(timeout: float = 30.0) -> None:
+    """Дожидается ответов, которые уже генерируются (при остановке бота)"""
+    if _message_queue is not None:
+        await _message_queue.close(timeout)
+
+
+@router.message(Command(commands=["similar"]))
+async def handle_similar(message: types.Message):
+    try:
+        args = (message.text or "").partition(" ")[2].strip()
+        top_k = 5
+        if args.isdigit():
+            top_k = int(args)
+        async with SessionLocal() as session:
+            profile_summary = await get_profile_summary(message.from_user.id, session)
+        if not profile_summary:
+            await message.answer("Ваш профиль ещё не проанализирован. Напишите несколько сообщений для формирования профиля.")
+            return
+        try:
+            query_embedding = await get_text_embedding(profile_summary)
+            hits = await search_similar_users(
+                query_embedding,
+                top_k=top_k,
+                filters={"is_active": True, "exclude_ids": [message.from_user.id]}
+            )
+            if not hits:
+                await message.answer(
+                    "Похожие пользователи не найдены. "
+                    "Профили индексируются скриптом scripts/profiles/index_profile_embeddings.py"
+                )
+                return
+        except Exception as e:
+            logging.error(f"Ошибка при получении эмбеддинга или поиске: {e}")
+            await message.answer("Ошибка при поиске похожих пользователей. Попробуйте позже.")
+            return
+        response = "Похожие пользователи:\n"
+        for hit in hits:
+            user_id = hit.id
+            username = hit.payload.get("username") if hit.payload else None
+            user_context = hit.payload.get("context") if hit.payload else None
+            response += f"ID: {user_id} | username: {username or '-'} | контекст: {user_context or '-'}\n"
+        await message.answer(response)
+    except Exception as e:
+        logging.error(f"Ошибка в /similar: {e}")
+        await message.answer("Ошибка при поиске похожих пользователей. Попробуйте позже.")
+
+
+# Ловит любое сообщение: aiogram берёт первый подходящий обработчик, поэтому команды регистрируются выше
 @router.message()
 async def handle_message(message: types.Message):
     """Оптимизированный обработчик сообщений с асинхронной обработкой"""
     user_id = message.from_user.id
     
     try:
-        # 1. МГНОВЕННЫЙ ОТКЛИК - показываем "печатает..." и отправляем в фон
+        # 1. Ставим сообщение в очередь пользователя (обработка в фоне, по порядку)
+        if _get_message_queue().submit(user_id, message) is SubmitResult.REJECTED:
+            await message.answer(_BUSY_REPLY)
+            return
+        
+        # 2. МГНОВЕННЫЙ ОТКЛИК - показываем "печатает..."
         try:
             await message.chat.do("typing")
         except Exception:
             pass  # Игнорируем ошибки при отправке статуса
         
-        # 2. Запускаем обработку в фоне (не ждем результата)
-        asyncio.create_task(
-            _process_message_async(user_id, message)
-        )
-        
     except Exception as e:
         logging.error(f"Ошибка в handle_message: {e}", exc_info=True)
 
 
-async def _process_message_async(user_id: int, message: types.Message):
+async def _process_turn(user_id: int, messages: list):
+    """Один ход диалога: серия быстрых сообщений отвечается одним ответом на последнее"""
+    texts = [m.text for m in messages if m.text]
+    await _process_message_async(user_id, messages[-1], "\n".join(texts) or None)
+
+
+async def _process_message_async(user_id: int, message: types.Message, text: Optional[str] = None):
     """Асинхронная обработка сообщения в фоне"""
+    text = text or message.text
     try:
         # Таймаут 30 сек на всю обработку
         async with asyncio.timeout(30):
@@ -292,23 +377,57 @@ async def _process_message_async(user_id: int, message: types.Message):
                 await message.answer("❌ Ошибка при обработке профиля.")
                 return
             
-            # 2. Генерируем ответ (основная работа)
-            feedback = await _generate_response(user_id, message.text, user_data)
-            
-            # 3. Отправляем ответ
+            # 2. Короткие типовые реплики («привет», «не знаю») — из семантического кэша
+            semantic_cache = get_semantic_cache()
+            fingerprint = context_fingerprint(user_data.get('markers', {}).get('relove_context', ''))
+            # Запрос нового варианта генерируется в обход точного кэша LLM, иначе вернётся тот же ответ
+            feedback, refresh = await semantic_cache.probe("reply", text, fingerprint)
             if feedback:
                 await message.answer(feedback)
+            
+            # 3. Генерируем и отправляем ответ (основная работа)
+            elif settings.llm_streaming_enabled:
+                completed, streamed = [], []
+                
+                async def chunks():
+                    async for chunk in llm_service.stream_text(
+                        prompt=_build_response_prompt(text, user_data),
+                        max_tokens=300,
+                        temperature=0.7,
+                        use_cache=not refresh
+                    ):
+                        streamed.append(chunk)
+                        yield chunk
+                    completed.append(True)
                 
+                # Ответ появляется в чате по мере генерации
+                try:
+                    async with asyncio.timeout(20):  # 20 сек на LLM
+                        feedback = (await stream_reply(message, chunks())).strip()
+                except asyncio.TimeoutError:
+                    # Начало ответа stream_reply уже дописал; если не пришло ничего — сообщаем о таймауте
+                    feedback = "".join(streamed).strip()
+                    if not feedback:
+                        feedback = _TIMEOUT_REPLY
+                        await message.answer(feedback)
+                if completed and feedback:
+                    await semantic_cache.store("reply", text, feedback, fingerprint)
+            else:
+                feedback = await _generate_response(user_id, text, user_data, use_cache=not refresh)
+                if feedback:
+                    await message.answer(feedback)
+                    if feedback != _TIMEOUT_REPLY:
+                        await semantic_cache.store("reply", text, feedback, fingerprint)
+            
+            if feedback:
                 # 4. Добавляем реакцию (не критично, если не получится)
                 try:
                     await message.react([{"type": "emoji", "emoji": "👁"}])
                 except Exception:
                     pass
             
-            # 5. Обновляем профиль в фоне (не блокируем)
-            asyncio.create_task(
-                _update_user_profile_async(user_id, message.text)
-            )
+            # 5. Обновляем маркеры профиля (запись в БД — пачкой в фоне)
+            await _update_user_profile_async(user_id, text)
             
     except asyncio.TimeoutError:
         logging.warning(f"Таймаут обработки сообщения от {user_id}")
@@ -372,24 +491,26 @@ async def _get_or_create_user_cached(user_id: int, tg_user) -> dict:
         return None
 
 
-async def _generate_response(user_id: int, text: str, user_data: dict) -> str:
+def _build_response_prompt(text: str, user_data: dict) -> str:
+    """Формирует промпт ответа в пределах бюджета токенов"""
+    # Получаем контекст из кэша
+    relove_context = user_data.get('markers', {}).get('relove_context', '')
+    
+    # Системный промпт обязателен, затем новое сообщение, затем контекст
+    budget = PromptBudget(settings.prompt_budget_reply_tokens, model=settings.model_name, name="reply")
+    budget.add("system", NATASHA_PROVOCATIVE_PROMPT, priority=0, required=True)
+    budget.add("context", f"Контекст: {relove_context}" if relove_context else None, priority=2, max_tokens=300)
+    budget.add("message", f"Сообщение: {text}", priority=1, max_tokens=300)
+    return budget.pack().text
+
+
+_TIMEOUT_REPLY = "Обработка заняла слишком много времени. Попробуйте позже."
+
+
+async def _generate_response(user_id: int, text: str, user_data: dict, use_cache: bool = True) -> str:
     """Генерирует ответ с использованием LLM"""
     try:
-        # Получаем контекст из кэша
-        relove_context = user_data.get('markers', {}).get('relove_context', '')
-        
-        # Формируем промпт (минимальный размер для скорости)
-        if relove_context:
-            full_prompt = (
-                f"{NATASHA_PROVOCATIVE_PROMPT}\n\n"
-                f"Контекст: {relove_context[:500]}\n"  # Ограничиваем размер контекста
-                f"Сообщение: {text[:200]}"  # Ограничиваем размер сообщения
-            )
-        else:
-            full_prompt = (
-                f"{NATASHA_PROVOCATIVE_PROMPT}\n\n"
-                f"Сообщение: {text[:200]}"
-            )
+        full_prompt = _build_response_prompt(text, user_data)
         
         # Генерируем ответ с таймаутом
         try:
@@ -397,10 +518,11 @@ async def _generate_response(user_id: int, text: str, user_data: dict) -> str:
                 feedback = await llm_service.generate_text(
                     prompt=full_prompt,
                     max_tokens=300,  # Меньше токенов = быстрее
-                    temperature=0.7  # Немного ниже для стабильности
+                    temperature=0.7,  # Немного ниже для стабильности
+                    use_cache=use_cache
                 )
         except asyncio.TimeoutError:
-            feedback = "Обработка заняла слишком много времени. Попробуйте позже."
+            feedback = _TIMEOUT_REPLY
         
         return feedback.strip() if feedback else None
         
@@ -410,65 +532,24 @@ async def _generate_response(user_id: int, text: str, user_data: dict) -> str:
 
 
 async def _update_user_profile_async(user_id: int, text: str):
-    """Обновляет профиль пользователя в фоне (не блокирует основной поток)"""
+    """
+    Обновляет служебные маркеры профиля. В БД они уходят пачкой через буфер
+    касаний: серия сообщений одного пользователя даёт одну запись.
+    """
     try:
-        async with asyncio.timeout(10):  # 10 сек на обновление
-            async with SessionLocal() as session:
-                user = await session.get(User, user_id)
-                if user:
-                    user.markers = user.markers or {}
-                    user.markers['last_message'] = text[:500]  # Ограничиваем размер
-                    user.markers['last_update'] = str(datetime.now())
-                    await session.commit()
-                    
-                    # Обновляем кэш
-                    if user_id in _user_cache:
-                        _user_cache[user_id]['markers'] = user.markers
+        patch = {
+            'last_message': text[:500],  # Ограничиваем размер
+            'last_update': str(datetime.now()),
+        }
+        await get_user_touch_coalescer().touch(user_id, markers=patch)
+        
+        # Кэш обновляется сразу, не дожидаясь записи в БД
+        if user_id in _user_cache:
+            _user_cache[user_id]['markers'] = {**_user_cache[user_id].get('markers', {}), **patch}
                         
-    except asyncio.TimeoutError:
-        logging.debug(f"Таймаут обновления профиля {user_id}")
     except Exception as e:
         logging.debug(f"Ошибка при обновлении профиля {user_id}: {e}")
 
-@router.message(Command(commands=["similar"]))
-async def handle_similar(message: types.Message):
-    try:
-        args = message.get_args().strip()
-        top_k = 5
-        if args.isdigit():
-            top_k = int(args)
-        async with SessionLocal() as session:
-            profile_summary = await get_profile_summary(message.from_user.id, session)
-        if not profile_summary:
-            await message.answer("Ваш профиль ещё не проанализирован. Напишите несколько сообщений для формирования профиля.")
-            return
-        try:
-            query_embedding = await get_text_embedding(profile_summary)
-            hits = search_similar_users(query_embedding, top_k=top_k)
-            if not hits:
-                await message.answer(
-                    "Похожие пользователи не найдены. "
-                    "Убедитесь, что Qdrant запущен (docker run -p 6333:6333 qdrant/qdrant)"
-                )
-                return
-        except Exception as e:
-            logging.error(f"Ошибка при получении эмбеддинга или поиске: {e}")
-            await message.answer(
-                "Ошибка при поиске похожих пользователей. "
-                "Убедитесь, что Qdrant запущен и настроен."
-            )
-            return
-        response = "Похожие пользователи:\n"
-        for hit in hits:
-            user_id = hit.id
-            username = hit.payload.get("username") if hit.payload else None
-            user_context = hit.payload.get("context") if hit.payload else None
-            response += f"ID: {user_id} | username: {username or '-'} | контекст: {user_context or '-'}\n"
-        await message.answer(response)
-    except Exception as e:
-        logging.error(f"Ошибка в /similar: {e}")
-        await message.answer("Ошибка при поиске похожих пользователей. Попробуйте позже.")
-
 @router.message(Command(commands=["help"]))
 async def handle_help(message: types.Message):
     """Справка по боту"""
@@ -5,24 +5,29 @@
 вдохновлённый работой Наташи Волкош с участниками reLove.
 """
 import logging
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from pydantic import BaseModel, Field, field_validator
 from sqlalchemy.ext.asyncio import AsyncSession
 from relove_bot.services.session_service import SessionService
 from relove_bot.db.repository import UserRepository
 
+from relove_bot.config import settings
 from relove_bot.services.llm_service import llm_service
 from relove_bot.services.prompts import (
     NATASHA_PROVOCATIVE_PROMPT,
-    STREAM_INVITATION_PROMPT
+    STREAM_INVITATION_PROMPT,
+    get_analysis_prompt
 )
 from relove_bot.services.metaphysical_service import metaphysical_service
 from relove_bot.db.models import User
 from relove_bot.keyboards.psychological import get_stream_selection_keyboard
+from relove_bot.utils.telegram_stream import stream_reply
+from relove_bot.utils.prompt_prefix import assemble_prompt
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -35,6 +40,28 @@ class ProvocativeStates(StatesGroup):
     choosing_stream = State()
 
 
+class SessionSummary(BaseModel):
+    """Итоговая сводка провокативной сессии."""
+    insights: List[str] = Field(default_factory=list, description="Ключевые прозрения")
+    patterns: List[str] = Field(default_factory=list, description="Вскрытые паттерны")
+    core: str = Field("", description="Изначальная травма или обида")
+    difficulties: List[str] = Field(default_factory=list, description="Что мешает человеку")
+    themes: List[str] = Field(default_factory=list, description="Повторяющиеся темы")
+    next_steps: List[str] = Field(default_factory=list, description="Шаги для трансформации")
+
+    @field_validator('insights', 'patterns', 'difficulties', 'themes', 'next_steps', mode='before')
+    @classmethod
+    def _as_list(cls, value):
+        if value is None:
+            return []
+        return [value] if isinstance(value, str) else value
+
+    @field_validator('core', mode='before')
+    @classmethod
+    def _as_text(cls, value):
+        return " ".join(value) if isinstance(value, list) else (value or "")
+
+
 class ProvocativeSession:
     """
     Класс для управления провокативной сессией с пользователем.
@@ -67,27 +94,16 @@ class ProvocativeSession:
             context_parts.append(f"{role}: {msg['content']}")
         return "\n".join(context_parts)
     
-    async def generate_provocative_response(self, user_message: str) -> str:
-        """
-        Генерирует провокативный ответ в стиле Наташи.
-        LLM сама принимает решения об этапах и направлении работы.
-        
-        Args:
-            user_message: Сообщение пользователя
-            
-        Returns:
-            str: Ответ в стиле Наташи
-        """
+    def _begin_turn(self, user_message: str) -> str:
+        """Добавляет сообщение пользователя в историю и формирует промпт для LLM."""
         self.add_message("user", user_message)
         self.question_count += 1
         
         # Формируем контекст диалога
         context = self.get_conversation_context()
         
-        # Формируем промпт для LLM с полной историей
-        prompt = f"""
-{NATASHA_PROVOCATIVE_PROMPT}
-
+        # Формируем промпт для LLM с полной историей; персона уходит в системный префикс
+        return f"""
 ИСТОРИЯ ДИАЛОГА:
 {context}
 
@@ -106,26 +122,76 @@ class ProvocativeSession:
 Ответь в стиле Наташи — коротко, провокативно, точно.
 Максимум 2-3 короткие фразы или 1-2 вопроса.
 """
+
+    def _finish_turn(self, response: str) -> None:
+        """Сохраняет ответ в историю диалога."""
+        self.add_message("assistant", response)
+        
+        # Если LLM упоминает потоки, помечаем это
+        if any(stream in response.lower() for stream in ["путь героя", "прошлые жизни", "открытие сердца", "трансформация тени", "пробуждение"]):
+            logger.info(f"LLM предложила поток для пользователя {self.user_id}")
+    
+    async def generate_provocative_response(self, user_message: str) -> str:
+        """
+        Генерирует провокативный ответ в стиле Наташи.
+        LLM сама принимает решения об этапах и направлении работы.
+        
+        Args:
+            user_message: Сообщение пользователя
+            
+        Returns:
+            str: Ответ в стиле Наташи
+        """
+        prompt = self._begin_turn(user_message)
         
         try:
             response = await llm_service.analyze_text(
                 prompt=prompt,
                 system_prompt=NATASHA_PROVOCATIVE_PROMPT,
-                max_tokens=200
+                max_tokens=200,
+                site="natasha.reply"
             )
             
-            self.add_message("assistant", response)
-            
-            # Если LLM упоминает потоки, помечаем это
-            if any(stream in response.lower() for stream in ["путь героя", "прошлые жизни", "открытие сердца", "трансформация тени", "пробуждение"]):
-                logger.info(f"LLM предложила поток для пользователя {self.user_id}")
-            
+            self._finish_turn(response)
             return response
             
         except Exception as e:
             logger.error(f"Ошибка при генерации провокативного ответа: {e}")
             return "..."
     
+    async def stream_provocative_response(self, user_message: str) -> AsyncIterator[str]:
+        """
+        Потоковый вариант generate_provocative_response: отдаёт ответ фрагментами.
+        В историю ответ попадает после окончания потока.
+        
+        Args:
+            user_message: Сообщение пользователя
+            
+        Yields:
+            str: Очередной фрагмент ответа
+        """
+        prompt = self._begin_turn(user_message)
+        parts = []
+        
+        try:
+            # Те же сообщения и параметры, что в analyze_text, — общий кэш ответов
+            assembled = assemble_prompt("natasha.reply", [NATASHA_PROVOCATIVE_PROMPT], prompt, llm_service.model)
+            async for chunk in llm_service.stream_text(
+                prompt=get_analysis_prompt(assembled.content),
+                system_prompt=assembled.system_prompt,
+                max_tokens=200,
+                temperature=0.4
+            ):
+                parts.append(chunk)
+                yield chunk
+        except Exception as e:
+            logger.error(f"Ошибка при потоковой генерации провокативного ответа: {e}")
+            if not parts:
+                parts.append("...")
+                yield "..."
+        
+        self._finish_turn("".join(parts).strip())
+    
     async def analyze_readiness_for_stream(
         self,
         activity_history: Optional[str] = None
@@ -222,84 +288,28 @@ class ProvocativeSession:
 {context}
 
 ЗАДАЧА:
-Создай итоговый анализ в формате:
-
-ИНСАЙТЫ:
-[Ключевые прозрения, которые получил человек - 2-3 пункта]
-
-ОБНАРУЖЕННЫЕ ПАТТЕРНЫ:
-[Какие паттерны были вскрыты: вампиризм/обида/война/самообман/бегство]
-
-КОРЕНЬ:
-[Изначальная травма или обида, если удалось выявить]
-
-ТРУДНОСТИ:
-[С чем человек сталкивается, что мешает - 2-3 пункта]
-
-ОБЩИЕ ТЕМЫ:
-[Повторяющиеся темы в диалоге]
-
-ПУТЬ ДАЛЬШЕ:
-[Конкретные шаги для трансформации]
+- insights: ключевые прозрения, которые получил человек (2-3 пункта)
+- patterns: какие паттерны были вскрыты (вампиризм/обида/война/самообман/бегство)
+- core: изначальная травма или обида, если удалось выявить
+- difficulties: с чем человек сталкивается, что мешает (2-3 пункта)
+- themes: повторяющиеся темы в диалоге
+- next_steps: конкретные шаги для трансформации
 
 Будь конкретен и опирайся только на то, что было в диалоге.
 """
         
         try:
-            response = await llm_service.analyze_text(
+            summary = await llm_service.generate_structured(
+                SessionSummary,
                 prompt=prompt,
                 system_prompt=NATASHA_PROVOCATIVE_PROMPT,
                 max_tokens=500
             )
-            
-            return self._parse_session_summary(response)
+            return summary.model_dump()
             
         except Exception as e:
             logger.error(f"Ошибка при генерации сводки сессии: {e}")
             return {}
-    
-    def _parse_session_summary(self, response: str) -> Dict[str, any]:
-        """Парсит сводку сессии."""
-        summary = {
-            "insights": [],
-            "patterns": [],
-            "core": "",
-            "difficulties": [],
-            "themes": [],
-            "next_steps": []
-        }
-        
-        current_section = None
-        lines = response.split('\n')
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            if line.startswith("ИНСАЙТЫ:"):
-                current_section = "insights"
-            elif line.startswith("ОБНАРУЖЕННЫЕ ПАТТЕРНЫ:"):
-                current_section = "patterns"
-            elif line.startswith("КОРЕНЬ:"):
-                current_section = "core"
-            elif line.startswith("ТРУДНОСТИ:"):
-                current_section = "difficulties"
-            elif line.startswith("ОБЩИЕ ТЕМЫ:"):
-                current_section = "themes"
-            elif line.startswith("ПУТЬ ДАЛЬШЕ:"):
-                current_section = "next_steps"
-            elif line.startswith("-") or line.startswith("•"):
-                content = line.lstrip("-• ").strip()
-                if current_section and current_section != "core":
-                    summary[current_section].append(content)
-            elif current_section == "core" and not line.startswith(("ИНСАЙТЫ", "ОБНАРУЖЕННЫЕ", "ТРУДНОСТИ", "ОБЩИЕ", "ПУТЬ")):
-                summary["core"] += line + " "
-        
-        # Очищаем корень
-        summary["core"] = summary["core"].strip()
-        
-        return summary
 
 
 async def get_or_create_session(user_id: int, db_session: AsyncSession) -> ProvocativeSession:
@@ -408,10 +418,20 @@ async def handle_provocative_response(message: Message, state: FSMContext, sessi
     
     user_message = message.text
     
-    # Генерируем провокативный ответ
-    response = await provocative_session.generate_provocative_response(user_message)
+    # Ответ генерируется секунды — соединение с БД на это время возвращаем в пул
+    await session.release()
     
-    await message.answer(response)
+    # Генерируем провокативный ответ
+    if settings.llm_streaming_enabled:
+        # Показываем ответ по мере генерации
+        response = (await stream_reply(
+            message,
+            provocative_session.stream_provocative_response(user_message),
+            fallback_text="..."
+        )).strip()
+    else:
+        response = await provocative_session.generate_provocative_response(user_message)
+        await message.answer(response)
     
     # Сохраняем в БД через SessionService
     await provocative_session._session_service.add_message(
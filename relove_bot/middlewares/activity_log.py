@@ -2,8 +2,7 @@ import logging
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Message
-from sqlalchemy.ext.asyncio import AsyncSession
-from relove_bot.db.models import UserActivityLog
+from relove_bot.db.write_behind import get_activity_log_writer
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +16,6 @@ class ActivityLogMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any],
     ) -> Any:
-        session: AsyncSession = data.get("session")
         user_id = None
         chat_id = None
         activity_type = None
@@ -34,18 +32,16 @@ class ActivityLogMiddleware(BaseMiddleware):
             else:
                 activity_type = "other"
         # Можно добавить обработку CallbackQuery и других типов
-        # Записываем лог только если есть user и сессия
-        if session and user_id:
+        # Записываем лог только если есть user; в БД он уходит пачкой из буфера
+        if user_id:
             try:
-                log = UserActivityLog(
+                await get_activity_log_writer().add(
                     user_id=user_id,
                     chat_id=chat_id,
                     activity_type=activity_type or "unknown",
                     details=details
                 )
-                session.add(log)
-                await session.commit()
-                logger.debug(f"Activity log written: {log}")
+                logger.debug(f"Activity log queued: user={user_id} type={activity_type}")
             except Exception as e:
                 logger.error(f"Failed to write activity log: {e}")
         return await handler(event, data)
@@ -5,6 +5,8 @@ from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
 from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 
+from relove_bot.db.lazy_session import LazySession, record_update
+
 logger = logging.getLogger(__name__)
 
 class DbSessionMiddleware(BaseMiddleware):
@@ -24,18 +26,18 @@ class DbSessionMiddleware(BaseMiddleware):
             # return await handler(event, data) # Пропустить, если БД не критична для всех хендлеров
             raise RuntimeError("Database session pool is not available.")
 
-        async with self.session_pool() as session:
-            data["session"] = session # Передаем сессию в data для доступа в хендлерах
-            logger.debug("DB session provided to handler via middleware.")
-            try:
-                result = await handler(event, data)
-            except Exception as e:
-                logger.error(f"Rolling back session due to exception in handler: {e}", exc_info=True)
-                await session.rollback()
-                raise
-            finally:
-                # Коммит здесь не нужен, т.к. сессия закрывается контекстным менеджером
-                # await session.commit() # Не нужно
-                session.close() # Закрываем для надежности, хотя менеджер должен это делать
-                logger.debug("DB session closed after handler execution.")
-            return result 
\ No newline at end of file
+        # Сессия создаётся при первом обращении хендлера к ней: апдейты без
+        # работы с БД не открывают сессию и не занимают соединение из пула
+        session = LazySession(self.session_pool)
+        data["session"] = session # Передаем сессию в data для доступа в хендлерах
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            logger.error(f"Rolling back session due to exception in handler: {e}", exc_info=True)
+            await session.rollback()
+            raise
+        finally:
+            # Коммит здесь не нужен: хендлеры коммитят сами, незакоммиченное откатывается
+            await session.close()
+            record_update(session.used)
+            logger.debug(f"DB session {'closed' if session.used else 'not used'} after handler execution.")
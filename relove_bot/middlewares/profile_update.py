@@ -1,21 +1,34 @@
 """
 Middleware для автоматического обновления профиля пользователя при каждом контакте.
-Обновляет last_seen_date, сохраняет в UserActivityLog и запускает фоновое обновление профиля.
+Обновляет last_seen_date, сохраняет в UserActivityLog и (если включено) запускает
+фоновое обновление профиля.
 """
 import asyncio
 import logging
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Callable, Dict, Any, Awaitable
 
 from aiogram import BaseMiddleware
-from aiogram.types import TelegramObject, Message, CallbackQuery
+from aiogram.types import TelegramObject, Message, CallbackQuery, Update
 from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
 
-from relove_bot.db.models import User, UserActivityLog
+from relove_bot.db.models import User
+from relove_bot.db.write_behind import get_activity_log_writer, get_user_touch_coalescer
+from relove_bot.utils.llm_scheduler import LLMPriority, llm_priority
+from relove_bot.utils.llm_telemetry import llm_caller
 
 logger = logging.getLogger(__name__)
 
+# Как часто (секунд) перепроверять возраст профиля одного пользователя
+PROFILE_CHECK_INTERVAL = 600
+PROFILE_CHECK_MAX_USERS = 10000
+# Фоновое обновление профиля выключено: ProfileRotationService.build_update_prompt
+# читает несуществующий User.psychological_summary и зовёт отсутствующий
+# telegram_service.get_user_posts. Включать после починки сервиса
+PROFILE_REFRESH_ENABLED = False
+
 
 class ProfileUpdateMiddleware(BaseMiddleware):
     """Middleware для обновления профиля пользователя при каждом контакте"""
@@ -23,6 +36,8 @@ class ProfileUpdateMiddleware(BaseMiddleware):
     def __init__(self):
         super().__init__()
         self._profile_update_tasks = {}  # Словарь для отслеживания фоновых задач
+        # Когда возраст профиля проверялся в последний раз (monotonic)
+        self._profile_checked_at: OrderedDict[int, float] = OrderedDict()
     
     async def __call__(
         self,
@@ -30,28 +45,30 @@ class ProfileUpdateMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: Dict[str, Any],
     ) -> Any:
+        # Middleware зарегистрирован на dp.update — сообщение лежит внутри Update
+        target = event
+        if isinstance(event, Update):
+            target = event.message or event.callback_query
+        
         # Обрабатываем только сообщения и callback query
-        if not isinstance(event, (Message, CallbackQuery)):
+        if not isinstance(target, (Message, CallbackQuery)):
             return await handler(event, data)
         
-        user_id = event.from_user.id if event.from_user else None
+        user_id = target.from_user.id if target.from_user else None
         if not user_id:
             return await handler(event, data)
         
-        db_session: AsyncSession = data.get("session")
-        if not db_session:
-            logger.warning(f"DB session not found in data for user {user_id}")
-            return await handler(event, data)
-        
         try:
             # 1. Обновляем last_seen_date
-            await self._update_last_seen(db_session, user_id)
+            await self._update_last_seen(user_id)
             
             # 2. Сохраняем в UserActivityLog
-            await self._save_activity_log(db_session, event, user_id)
+            await self._save_activity_log(target, user_id)
             
-            # 3. Проверяем возраст профиля и запускаем фоновое обновление если нужно
-            await self._check_and_schedule_profile_update(db_session, user_id)
+            # 3. Проверяем возраст профиля и запускаем фоновое обновление если нужно;
+            # профиль стареет днями, поэтому SELECT на каждое сообщение не нужен
+            if PROFILE_REFRESH_ENABLED and self._profile_check_due(user_id):
+                await self._check_and_schedule_profile_update(user_id)
             
         except Exception as e:
             logger.error(f"Error in ProfileUpdateMiddleware for user {user_id}: {e}")
@@ -59,25 +76,27 @@ class ProfileUpdateMiddleware(BaseMiddleware):
         
         return await handler(event, data)
     
-    async def _update_last_seen(self, session: AsyncSession, user_id: int):
-        """Обновляет last_seen_date пользователя"""
+    def _profile_check_due(self, user_id: int) -> bool:
+        """Проверять ли возраст профиля (не чаще PROFILE_CHECK_INTERVAL на пользователя)"""
+        now = time.monotonic()
+        checked_at = self._profile_checked_at.get(user_id)
+        if checked_at is not None and now - checked_at < PROFILE_CHECK_INTERVAL:
+            return False
+        self._profile_checked_at[user_id] = now
+        self._profile_checked_at.move_to_end(user_id)
+        while len(self._profile_checked_at) > PROFILE_CHECK_MAX_USERS:
+            self._profile_checked_at.popitem(last=False)
+        return True
+    
+    async def _update_last_seen(self, user_id: int):
+        """Обновляет last_seen_date пользователя (пачкой, раз в USER_TOUCH_FLUSH_INTERVAL)"""
         try:
-            result = await session.execute(
-                select(User).where(User.id == user_id)
-            )
-            user = result.scalar_one_or_none()
-            
-            if user:
-                user.last_seen_date = datetime.now()
-                await session.commit()
-                logger.debug(f"Updated last_seen_date for user {user_id}")
+            await get_user_touch_coalescer().touch(user_id)
         except Exception as e:
             logger.error(f"Error updating last_seen_date for user {user_id}: {e}")
-            await session.rollback()
     
     async def _save_activity_log(
         self, 
-        session: AsyncSession, 
         event: TelegramObject, 
         user_id: int
     ):
@@ -111,38 +130,36 @@ class ProfileUpdateMiddleware(BaseMiddleware):
                 activity_type = "callback_query"
                 details = {"data": event.data}
             
-            log = UserActivityLog(
+            # Запись уходит в БД пачкой из фонового буфера, а не отдельным COMMIT
+            await get_activity_log_writer().add(
                 user_id=user_id,
                 chat_id=chat_id,
                 activity_type=activity_type,
                 details=details
             )
-            
-            session.add(log)
-            await session.commit()
-            logger.debug(f"Saved activity log for user {user_id}: {activity_type}")
+            logger.debug(f"Queued activity log for user {user_id}: {activity_type}")
             
         except Exception as e:
             logger.error(f"Error saving activity log for user {user_id}: {e}")
-            await session.rollback()
     
-    async def _check_and_schedule_profile_update(
-        self, 
-        session: AsyncSession, 
-        user_id: int
-    ):
+    async def _check_and_schedule_profile_update(self, user_id: int):
         """Проверяет возраст профиля и запускает фоновое обновление если нужно"""
         try:
-            result = await session.execute(
-                select(User).where(User.id == user_id)
-            )
-            user = result.scalar_one_or_none()
+            # Своя короткая сессия: соединение возвращается в пул сразу, а не
+            # держится сессией апдейта до конца работы хендлера
+            from relove_bot.db.session import async_session
+            
+            async with async_session() as session:
+                result = await session.execute(
+                    select(User.id, User.markers).where(User.id == user_id)
+                )
+                row = result.first()
             
-            if not user:
+            if not row:
                 return
             
             # Проверяем markers['profile_updated_at']
-            markers = user.markers or {}
+            markers = row.markers or {}
             profile_updated_at_str = markers.get('profile_updated_at')
             
             if profile_updated_at_str:
@@ -212,9 +229,11 @@ class ProfileUpdateMiddleware(BaseMiddleware):
                     logger.warning(f"User {user_id} not found for background update")
                     return
                 
-                # Обновляем профиль через ProfileRotationService
+                # Обновляем профиль через ProfileRotationService;
+                # запросы к LLM идут с пакетным приоритетом, чтобы не тормозить чат
                 service = ProfileRotationService(session)
-                await service.update_user_profile(user)
+                with llm_priority(LLMPriority.BATCH), llm_caller("profile_update"):
+                    await service.update_user_profile(user)
                 
                 logger.info(f"Completed background profile update for user {user_id}")
             
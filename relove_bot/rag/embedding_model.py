@@ -0,0 +1,116 @@
+"""
+Локальная модель эмбеддингов предложений (CPU).
+
+Как и llm_local.py, модуль импортируется только там, где векторы реально
+считаются — в процессе эмбеддингов (rag/embeddings.py) или в офлайн-скрипте:
+torch и transformers не должны замедлять старт бота.
+
+Если рядом с моделью лежит экспорт ONNX (model.onnx) и установлен
+onnxruntime, кодирование идёт через него — на CPU это заметно быстрее
+torch; токенизатор в обоих случаях берётся из transformers.
+"""
+import logging
+import os
+from typing import List, Optional
+
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+logger = logging.getLogger(__name__)
+
+
+class SentenceEmbeddingModel:
+    """
+    Модель эмбеддингов: mean pooling по токенам и L2-нормировка.
+
+    Args:
+        model_name: Имя модели на Hugging Face Hub или путь к ней
+        onnx_path: Путь к model.onnx (по умолчанию ищется в каталоге модели)
+        threads: Число потоков на CPU (None — по умолчанию)
+        max_length: Максимум токенов на текст, хвост обрезается
+        token: Токен Hugging Face для закрытых моделей
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        onnx_path: Optional[str] = None,
+        threads: Optional[int] = None,
+        max_length: int = 256,
+        token: Optional[str] = None,
+    ):
+        self.model_name = model_name
+        self.onnx_path = onnx_path
+        self.threads = threads
+        self.max_length = max_length
+        self.token = token
+        self.tokenizer = None
+        self.model = None
+        self.onnx_session = None
+        self._dim: Optional[int] = None
+
+    def _find_onnx(self) -> Optional[str]:
+        if self.onnx_path:
+            return self.onnx_path
+        candidate = os.path.join(self.model_name, "model.onnx")
+        return candidate if os.path.isfile(candidate) else None
+
+    def load(self) -> None:
+        """Загружает токенизатор и модель (один раз)"""
+        if self.model is not None or self.onnx_session is not None:
+            return
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, token=self.token)
+
+        onnx_path = self._find_onnx()
+        if onnx_path:
+            try:
+                import onnxruntime
+
+                options = onnxruntime.SessionOptions()
+                if self.threads:
+                    options.intra_op_num_threads = self.threads
+                self.onnx_session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+                logger.info(f"Модель эмбеддингов {self.model_name} загружена (ONNX: {onnx_path})")
+                return
+            except ImportError:
+                logger.warning("onnxruntime не установлен, эмбеддинги считаются через torch")
+
+        self.model = AutoModel.from_pretrained(self.model_name, token=self.token)
+        self.model.eval()
+        self._dim = self.model.config.hidden_size
+        logger.info(f"Модель эмбеддингов {self.model_name} загружена (torch)")
+
+    @property
+    def dim(self) -> int:
+        """Размерность вектора"""
+        if self._dim is None:
+            self._dim = len(self.encode(["dim"])[0])
+        return self._dim
+
+    def _hidden_states(self, inputs) -> torch.Tensor:
+        if self.onnx_session is not None:
+            names = {item.name for item in self.onnx_session.get_inputs()}
+            feed = {name: tensor.numpy() for name, tensor in inputs.items() if name in names}
+            return torch.from_numpy(self.onnx_session.run(None, feed)[0])
+        return self.model(**inputs).last_hidden_state
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        """
+        Кодирует пакет текстов одним проходом модели.
+
+        Returns:
+            Нормированные векторы в порядке текстов
+        """
+        self.load()
+        if not texts:
+            return []
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="pt")
+        with torch.no_grad():
+            hidden = self._hidden_states(inputs)
+            # Среднее по настоящим токенам, без выравнивающих
+            mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            pooled = torch.nn.functional.normalize(pooled, p=2, dim=1)
+        return pooled.tolist()
@@ -0,0 +1,327 @@
+"""
+Локальные эмбеддинги текстов: профили для /similar, реплики для
+семантического кэша, офлайн-скрипты — без сети и без платного API.
+
+Модель (небольшая sentence-embedding модель, см. embedding_model.py)
+работает на CPU в отдельном процессе: кодирование держит GIL и не должно
+останавливать цикл событий бота. Одновременные запросы копятся batch_wait
+секунд и кодируются одним проходом модели, повторяющиеся тексты — один раз.
+Готовые векторы кэшируются по хешу содержимого в памяти (LRU) и, если задан
+путь, в SQLite на диске, чтобы офлайн-скрипты не пересчитывали профили при
+каждом запуске.
+"""
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from relove_bot.rag.worker_process import load_factory, spawn_context
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = "relove_bot.rag.embedding_model:SentenceEmbeddingModel"
+
+
+class EmbeddingError(RuntimeError):
+    """Ошибка модели эмбеддингов"""
+
+
+def content_hash(model_name: str, text: str) -> str:
+    """Ключ кэша: модель + текст (векторы разных моделей несовместимы)"""
+    return hashlib.sha256(f"{model_name}\x1f{text}".encode("utf-8")).hexdigest()
+
+
+# Модель внутри процесса эмбеддингов (создаётся инициализатором пула)
+_worker_model = None
+
+
+def _init_worker(backend: str, model_name: str, model_kwargs: Dict[str, Any]) -> None:
+    global _worker_model
+    logging.basicConfig(level=logging.INFO)
+    _worker_model = load_factory(backend)(model_name, **model_kwargs)
+    _worker_model.load()
+
+
+def _encode_in_worker(texts: List[str]) -> List[List[float]]:
+    return _worker_model.encode(texts)
+
+
+class DiskVectorCache:
+    """
+    Векторы на диске (SQLite): переживают перезапуск бота и скриптов.
+
+    Args:
+        path: Файл базы
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            # SQLite ограничивает число параметров запроса
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM vectors WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+        return found
+
+    def put_many(self, items: Iterable[Tuple[str, List[float]]]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO vectors (key, vector) VALUES (?, ?)",
+                [(key, array("f", vector).tobytes()) for key, vector in items],
+            )
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class EmbeddingService:
+    """
+    Пакетное кодирование текстов с кэшем по хешу содержимого.
+
+    Подходит как эмбеддер семантического кэша (метод embed).
+
+    Args:
+        model_name: Модель эмбеддингов (имя на Hugging Face Hub или путь)
+        backend: Класс модели 'module:Class' (по умолчанию SentenceEmbeddingModel)
+        batch_size: Максимум текстов в одном проходе модели
+        batch_wait: Сколько секунд ждать попутных запросов перед кодированием
+        cache_size: Векторов в кэше в памяти
+        cache_path: Файл SQLite для кэша на диске (None — только память)
+        use_process: Кодировать в отдельном процессе (иначе — в потоке)
+        model_kwargs: Аргументы модели (onnx_path, threads, max_length, token)
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        backend: str = DEFAULT_BACKEND,
+        batch_size: int = 32,
+        batch_wait: float = 0.01,
+        cache_size: int = 10000,
+        cache_path: Optional[str] = None,
+        use_process: bool = True,
+        **model_kwargs: Any,
+    ):
+        self.model_name = model_name
+        self.backend = backend
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.cache_size = cache_size
+        self.use_process = use_process
+        self.model_kwargs = model_kwargs
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._disk = DiskVectorCache(cache_path) if cache_path else None
+        self._pending: List[Tuple[str, str]] = []
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._drainer: Optional[asyncio.Task] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.dim: Optional[int] = None
+        self.requests = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.deduplicated = 0
+        self.encoded = 0
+        self.batches = 0
+
+    async def embed(self, text: str) -> List[float]:
+        """Вектор одного текста"""
+        return (await self.embed_many([text]))[0]
+
+    async def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """
+        Векторы текстов в исходном порядке.
+
+        Raises:
+            EmbeddingError: Модель не загрузилась или кодирование упало
+        """
+        texts = [(text or "").strip() for text in texts]
+        keys = [content_hash(self.model_name, text) for text in texts]
+        self.requests += len(texts)
+        vectors: Dict[str, List[float]] = {}
+
+        for key in keys:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                vectors[key] = vector
+                self.memory_hits += 1
+
+        missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+        if missing and self._disk is not None:
+            found = await asyncio.to_thread(self._disk.get_many, missing)
+            self.disk_hits += len(found)
+            for key, vector in found.items():
+                self._remember(key, vector)
+            vectors.update(found)
+
+        futures = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in futures:
+                futures[key] = self._submit(key, text)
+        if futures:
+            results = await asyncio.gather(*futures.values())
+            vectors.update(zip(futures.keys(), results))
+        return [vectors[key] for key in keys]
+
+    def _submit(self, key: str, text: str) -> asyncio.Future:
+        future = self._inflight.get(key)
+        if future is not None:
+            self.deduplicated += 1
+            return future
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self._pending.append((key, text))
+        if self._drainer is None:
+            self._drainer = asyncio.create_task(self._drain())
+        return future
+
+    async def _drain(self) -> None:
+        try:
+            await asyncio.sleep(self.batch_wait)
+            while self._pending:
+                batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+                await self._run_batch(batch)
+        finally:
+            self._drainer = None
+
+    async def _run_batch(self, batch: List[Tuple[str, str]]) -> None:
+        # Тексты близкой длины — меньше выравнивания внутри прохода модели
+        batch = sorted(batch, key=lambda item: len(item[1]))
+        try:
+            vectors = await self._encode([text for _, text in batch])
+        except Exception as e:
+            logger.error(f"Ошибка кодирования {len(batch)} текстов: {e}")
+            error = e if isinstance(e, EmbeddingError) else EmbeddingError(str(e))
+            for key, _ in batch:
+                future = self._inflight.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(error)
+            return
+
+        self.batches += 1
+        self.encoded += len(batch)
+        if vectors and self.dim is None:
+            self.dim = len(vectors[0])
+        items = [(key, vector) for (key, _), vector in zip(batch, vectors)]
+        for key, vector in items:
+            self._remember(key, vector)
+            future = self._inflight.pop(key, None)
+            if future is not None and not future.done():
+                future.set_result(vector)
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.put_many, items)
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.cache_size:
+            self._memory.popitem(last=False)
+
+    async def _encode(self, texts: List[str]) -> List[List[float]]:
+        if not self.use_process:
+            return await asyncio.to_thread(self._encode_inline, texts)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=spawn_context(),
+                initializer=_init_worker,
+                initargs=(self.backend, self.model_name, self.model_kwargs),
+            )
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, _encode_in_worker, texts)
+        except BrokenProcessPool as e:
+            # Процесс упал или модель не загрузилась — следующий запрос поднимет его заново
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            raise EmbeddingError(f"Процесс эмбеддингов {self.model_name} завершился: {e}") from e
+
+    def _encode_inline(self, texts: List[str]) -> List[List[float]]:
+        with self._model_lock:
+            if self._model is None:
+                self._model = load_factory(self.backend)(self.model_name, **self.model_kwargs)
+                self._model.load()
+            return self._model.encode(texts)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.model_name,
+            "dim": self.dim,
+            "process": self.use_process,
+            "requests": self.requests,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "deduplicated": self.deduplicated,
+            "encoded": self.encoded,
+            "batches": self.batches,
+            "avg_batch": round(self.encoded / self.batches, 2) if self.batches else 0.0,
+            "cached": len(self._memory),
+            "pending": len(self._pending),
+        }
+
+    def close(self) -> None:
+        """Останавливает процесс модели и закрывает кэш на диске"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+
+_service: Optional[EmbeddingService] = None
+
+
+def get_embedding_service() -> EmbeddingService:
+    """Общий сервис эмбеддингов процесса (настройки из settings)"""
+    global _service
+    if _service is None:
+        from relove_bot.config import settings
+
+        _service = EmbeddingService(
+            settings.embedding_model_name,
+            batch_size=settings.embedding_batch_size,
+            batch_wait=settings.embedding_batch_wait,
+            cache_size=settings.embedding_cache_size,
+            cache_path=settings.embedding_cache_path,
+            use_process=settings.embedding_worker_process,
+            onnx_path=settings.embedding_onnx_path,
+            threads=settings.local_model_threads,
+            token=settings.hugging_face_token.get_secret_value() if settings.hugging_face_token else None,
+        )
+    return _service
+
+
+def get_embedder() -> EmbeddingService:
+    """Эмбеддер для семантического кэша: SEMANTIC_CACHE_EMBEDDER=relove_bot.rag.embeddings"""
+    return get_embedding_service()
+
+
+async def get_text_embedding(text: str) -> List[float]:
+    """Вектор текста локальной моделью эмбеддингов"""
+    return await get_embedding_service().embed(text)
+
+
+def get_embedding_stats() -> Optional[Dict[str, Any]]:
+    """Статистика сервиса эмбеддингов (None, если он не создавался)"""
+    return _service.stats() if _service is not None else None
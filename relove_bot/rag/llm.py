@@ -2,18 +2,20 @@ import asyncio
 import base64
 import json
 import logging
-from openai import AsyncOpenAI
-from ..utils.rate_limiter import llm_rate_limiter
-from transformers import AutoTokenizer, AutoModelForCausalLM, AutoModelForSequenceClassification, pipeline, BitsAndBytesConfig
-from huggingface_hub import login, InferenceClient
+from ..utils.circuit_breaker import CircuitOpenError
+from ..utils.rate_limiter import RateLimitExceeded
+from ..utils.llm_cache import get_llm_cache, make_cache_key
+from ..utils.single_flight import get_single_flight
+from ..utils.llm_scheduler import get_llm_scheduler
+from ..utils.llm_telemetry import get_llm_telemetry
+from ..utils.prompt_prefix import apply_cache_hints
+from .llm_router import get_llm_router
 from relove_bot.config import settings
-import torch
 from relove_bot.services.prompts import (
     RAG_SUMMARY_PROMPT,
     RAG_ASSISTANT_PROMPT
 )
-from typing import Dict, Any
-import openai
+from typing import Any, AsyncIterator, Dict, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -34,107 +36,106 @@ class LLM:
             return ""
             
         try:
-            return await self._generate_with_openai(prompt, max_tokens, temperature)
+            return await get_llm_scheduler().run(
+                lambda: self._generate_with_openai(prompt, max_tokens, temperature)
+            )
         except Exception as e:
             logger.error(f"Ошибка при генерации текста: {e}")
             return ""
             
     async def _generate_with_openai(self, prompt: str, max_tokens: int, temperature: float) -> str:
         """Генерация текста с помощью OpenAI API."""
-        try:
-            response = await self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=max_tokens,
-                temperature=temperature,
-            )
+        async with get_llm_telemetry().track("generate", self.model_name) as call:
+            try:
+                response = await self.router.chat(
+                    model=self.model_name,
+                    messages=[{"role": "user", "content": prompt}],
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                )
             
-            # Проверяем структуру ответа
-            if not response or not hasattr(response, 'choices') or not response.choices:
-                logger.error("Пустой ответ от OpenAI API")
-                return ""
+                # Проверяем структуру ответа
+                if not response or not hasattr(response, 'choices') or not response.choices:
+                    logger.error("Пустой ответ от OpenAI API")
+                    return ""
                 
-            # Получаем первый выбор
-            choice = response.choices[0]
-            if not hasattr(choice, 'message') or not choice.message:
-                logger.error("Некорректная структура ответа от OpenAI API")
-                return ""
+                # Получаем первый выбор
+                choice = response.choices[0]
+                if not hasattr(choice, 'message') or not choice.message:
+                    logger.error("Некорректная структура ответа от OpenAI API")
+                    return ""
                 
-            # Получаем контент сообщения
-            content = choice.message.content
-            if not content:
-                logger.error("Пустой контент в ответе от OpenAI API")
-                return ""
+                # Получаем контент сообщения
+                content = choice.message.content
+                if not content:
+                    logger.error("Пустой контент в ответе от OpenAI API")
+                    return ""
                 
-            return content
+                return content
             
-        except Exception as e:
-            logger.error(f"Ошибка при генерации текста с OpenAI: {e}")
-            return ""
+            except Exception as e:
+                call.fail(e)
+                logger.error(f"Ошибка при генерации текста с OpenAI: {e}")
+                return ""
             
     async def _generate_with_hf_api(self, prompt: str, max_tokens: int, temperature: float) -> str:
         """Генерация текста с помощью HuggingFace API."""
         try:
-            response = await asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda: self.client.text_generation(
-                    prompt,
-                    max_new_tokens=max_tokens,
-                    temperature=temperature,
-                    return_full_text=False
-                )
-            )
-            return response
+            return await self._get_hf_backend().generate(prompt, max_tokens, temperature)
         except Exception as e:
             logger.error(f"Ошибка при генерации текста с HuggingFace API: {e}")
             return ""
             
     async def _generate_with_local(self, prompt: str, max_tokens: int, temperature: float) -> str:
         """Генерация текста с локальной моделью."""
-        if not hasattr(self, 'model') or not self.model:
-            raise RuntimeError("Локальная модель не загружена")
-            
         try:
-            inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
-            
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=max_tokens,
-                    temperature=temperature,
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.eos_token_id
-                )
-                
-            # Декодируем только сгенерированную часть (исключая промпт)
-            generated = outputs[0][inputs.input_ids.shape[-1]:]
-            return self.tokenizer.decode(generated, skip_special_tokens=True)
+            return await self._get_local_backend().generate(
+                [{"role": "user", "content": prompt}], max_tokens, temperature
+            )
         except Exception as e:
             logger.error(f"Ошибка при локальной генерации текста: {e}")
             return ""
             
     def __init__(self):
         self.model_name = settings.model_name
-        self.client = None
-        self.tokenizer = None
-        self.model = None
+        self._local_backend = None
+        self._hf_backend = None
+        # Модели, отклонившие response_format (JSON mode)
+        self._no_response_format = set()
         
-        # OpenAI/OpenRouter/Groq API
-        self.client = AsyncOpenAI(
-            api_key=settings.llm_api_key.get_secret_value(),
-            base_url=settings.llm_api_base,
-            default_headers={
-                "HTTP-Referer": "https://github.com/relove-bot",
-                "X-Title": "reLove Bot",
-                "Content-Type": "application/json"
-            }
+        # OpenAI/OpenRouter/Groq API: запросы распределяются между бэкендами,
+        # лимиты считаются по ключу каждого бэкенда внутри маршрутизатора
+        self.router = get_llm_router()
+
+    @staticmethod
+    def _with_cache_hints(messages, model: str):
+        """Отметка кэшируемого системного промпта для провайдеров, которым она нужна"""
+        return apply_cache_hints(
+            messages, model, settings.llm_prompt_cache_hints, settings.llm_prompt_cache_min_tokens
         )
-        # Для HuggingFace и local — отдельная инициализация ниже при необходимости
+
+    def _hf_token(self) -> Optional[str]:
+        return settings.hugging_face_token.get_secret_value() if settings.hugging_face_token else None
+
+    def _get_local_backend(self):
+        """Клиент процесса локального инференса; torch и transformers грузятся только в нём"""
+        if self._local_backend is None:
+            from .local_worker import get_local_inference_client
+
+            self._local_backend = get_local_inference_client()
+        return self._local_backend
+
+    def _get_hf_backend(self):
+        """HF Inference API; huggingface_hub импортируется только здесь"""
+        if self._hf_backend is None:
+            from .llm_hf import HFInferenceBackend
+
+            self._hf_backend = HFInferenceBackend(settings.local_model_name or self.model_name, token=self._hf_token())
+        return self._hf_backend
 
     async def generate(self, prompt: str, max_tokens: int = 100) -> str:
         raise NotImplementedError("Метод generate поддерживается только для локального режима")
 
-    @llm_rate_limiter
     async def _analyze_content_api(
         self,
         content: str,
@@ -142,7 +143,8 @@ class LLM:
         max_tokens: int = 512,
         temperature: float = 0.4,
         system_prompt: str = RAG_SUMMARY_PROMPT,
-        timeout: int = 60
+        timeout: int = 60,
+        response_format: Optional[Dict[str, Any]] = None
     ) -> dict:
         """
         Анализ контента через API.
@@ -154,24 +156,58 @@ class LLM:
             temperature: Температура генерации
             system_prompt: Системный промпт
             timeout: Таймаут в секундах
+            response_format: Формат ответа (JSON mode), если модель его поддерживает
             
         Returns:
             dict: Результат анализа
         """
-        try:
-            response = await self.client.chat.completions.create(
-                model=model or self.model_name,
-                messages=[
+        # SDK openai импортируется при первом запросе, а не при старте бота
+        import openai
+
+        model = model or self.model_name
+        if model in self._no_response_format:
+            response_format = None
+        async with get_llm_telemetry().track("analyze", model) as call:
+            try:
+                params = {"response_format": response_format} if response_format else {}
+                messages = self._with_cache_hints([
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": content}
-                ],
-                max_tokens=max_tokens,
-                temperature=temperature,
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            logger.error(f"Ошибка при анализе контента: {e}")
-            return ""
+                ], model)
+                try:
+                    response = await self.router.chat(
+                        model=model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        **params
+                    )
+                except openai.BadRequestError as e:
+                    if not params:
+                        raise
+                    # Модель не поддерживает response_format: схема остаётся в промпте
+                    logger.warning(f"Модель {model} отклонила response_format ({e}), JSON mode для неё отключён")
+                    self._no_response_format.add(model)
+                    response = await self.router.chat(
+                        model=model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                    )
+                return response.choices[0].message.content
+            except (openai.RateLimitError, RateLimitExceeded) as e:
+                # Пауза из Retry-After уже передана общему лимитеру маршрутизатором
+                call.fail(e)
+                logger.error(f"Превышен лимит API при анализе контента: {e}")
+                return ""
+            except CircuitOpenError as e:
+                call.fail(e)
+                logger.warning(f"LLM недоступна, анализ контента пропущен: {e}")
+                return ""
+            except Exception as e:
+                call.fail(e)
+                logger.error(f"Ошибка при анализе контента: {e}")
+                return ""
 
     async def analyze_content(
         self,
@@ -180,7 +216,9 @@ class LLM:
         max_tokens: int = 512,
         temperature: float = 0.4,
         system_prompt: str = RAG_SUMMARY_PROMPT,
-        timeout: int = 60
+        timeout: int = 60,
+        use_cache: bool = True,
+        response_format: Optional[Dict[str, Any]] = None
     ) -> dict:
         """
         Анализ контента.
@@ -192,20 +230,49 @@ class LLM:
             temperature: Температура генерации
             system_prompt: Системный промпт
             timeout: Таймаут в секундах
+            use_cache: Использовать кэш ответов LLM
+            response_format: Формат ответа (JSON mode), если модель его поддерживает
             
         Returns:
             dict: Результат анализа
         """
         try:
-            result = await self._analyze_content_api(
-                content=content,
-                model=model,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                system_prompt=system_prompt,
-                timeout=timeout
+            use_cache = use_cache and settings.llm_cache_enabled
+            cache = get_llm_cache()
+            cache_key = make_cache_key(
+                model or self.model_name,
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": content}
+                ],
+                temperature,
+                max_tokens,
+                response_format
             )
-            return result
+            if use_cache:
+                cached = await cache.get(cache_key)
+                if cached is not None:
+                    get_llm_telemetry().record_cache_hit("analyze", model or self.model_name)
+                    return cached
+
+            async def fetch():
+                result = await get_llm_scheduler().run(
+                    lambda: self._analyze_content_api(
+                        content=content,
+                        model=model or self.model_name,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        system_prompt=system_prompt,
+                        timeout=timeout,
+                        response_format=response_format
+                    )
+                )
+                if use_cache and isinstance(result, str) and result:
+                    await cache.set(cache_key, result)
+                return result
+
+            # Одинаковые одновременные запросы ждут один общий ответ
+            return await get_single_flight().do(f"rag:{cache_key}", fetch)
         except Exception as e:
             logger.error(f"Ошибка при анализе контента: {e}")
             return {
@@ -215,6 +282,76 @@ class LLM:
                 "error": str(e)
             }
 
+    async def stream_content(
+        self,
+        content: str,
+        model: str = None,
+        max_tokens: int = 512,
+        temperature: float = 0.4,
+        system_prompt: Optional[str] = None,
+        use_cache: bool = True
+    ) -> AsyncIterator[str]:
+        """
+        Потоковая генерация ответа: отдаёт текст фрагментами по мере прихода токенов.
+        
+        Args:
+            content: Текст запроса пользователя
+            model: Имя модели для использования
+            max_tokens: Максимальное количество токенов
+            temperature: Температура генерации
+            system_prompt: Системный промпт (опционально)
+            use_cache: Использовать кэш ответов LLM
+            
+        Yields:
+            str: Очередной фрагмент ответа
+        """
+        model = model or self.model_name
+        messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        messages.append({"role": "user", "content": content})
+
+        use_cache = use_cache and settings.llm_cache_enabled
+        cache = get_llm_cache()
+        cache_key = make_cache_key(model, messages, temperature, max_tokens)
+        telemetry = get_llm_telemetry()
+        if use_cache:
+            cached = await cache.get(cache_key)
+            if cached is not None:
+                telemetry.record_cache_hit("stream", model)
+                yield cached
+                return
+
+        parts = []
+        # Поток нельзя перезапустить с середины, поэтому слот держится до конца ответа
+        async with get_llm_scheduler().slot(), telemetry.track("stream", model) as call:
+            params = {"stream_options": {"include_usage": True}} if settings.llm_stream_include_usage else {}
+            stream = await self.router.stream(
+                model=model,
+                messages=self._with_cache_hints(messages, model),
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **params
+            )
+            try:
+                async for chunk in stream:
+                    # С include_usage последний фрагмент несёт usage без choices
+                    call.set_usage(getattr(chunk, "usage", None))
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        call.mark_first_byte()
+                        parts.append(delta)
+                        yield delta
+            finally:
+                # Закрываем соединение, даже если потребитель прервал чтение
+                await stream.close()
+                if not call.total_tokens:
+                    call.estimate_usage("\n".join(m["content"] for m in messages), "".join(parts))
+
+        text = "".join(parts)
+        if use_cache and text:
+            await cache.set(cache_key, text)
+
     async def _analyze_content_local(
         self,
         content: str,
@@ -248,41 +385,20 @@ class LLM:
             }
 
         try:
-            # Формируем промпт
-            prompt = f"""
-            {system_prompt}
-
-            Text:
-            {content}
-            """
-
-            # Используем локальную модель
-            if not hasattr(self, 'generator'):
-                raise RuntimeError("Локальная модель не инициализирована")
-                
-            # Генерируем ответ
-            response = self.generator(
-                prompt,
-                max_length=max_tokens,
-                num_return_sequences=1,
-                temperature=temperature,
-                do_sample=True,
-                top_p=0.9,
-                top_k=50,
-                return_full_text=False
+            # Генерация идёт в процессе локального инференса (модель загружается при первом запросе)
+            generated_text = await self._get_local_backend().generate(
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": content}
+                ],
+                max_tokens=max_tokens,
+                temperature=temperature
             )
-            
-            # Извлекаем сгенерированный текст
-            if isinstance(response, list) and len(response) > 0:
-                generated_text = response[0].get('generated_text', '')
-            else:
-                generated_text = str(response)
-                
+
             return {
                 'summary': generated_text.strip(),
                 'usage': {},
-                'finish_reason': 'stop',
-                'raw_response': response
+                'finish_reason': 'stop'
             }
             
         except Exception as e:
@@ -422,11 +538,12 @@ class LLM:
                 {"role": "user", "content": f"Контекст:\n{context}\n\nВопрос: {query}"}
             ]
             
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=256
-            )
+            async with get_llm_telemetry().track("assistant", self.model_name):
+                response = await self.router.chat(
+                    model=self.model_name,
+                    messages=messages,
+                    max_tokens=256
+                )
             
             if not response.choices:
                 return ''
@@ -0,0 +1,36 @@
+"""
+Hugging Face Inference API для LLM.
+
+Импортируется лениво, только при обращении к HF-бэкенду.
+"""
+import asyncio
+import logging
+from typing import Optional
+
+from huggingface_hub import InferenceClient
+
+logger = logging.getLogger(__name__)
+
+
+class HFInferenceBackend:
+    """
+    Генерация через Hugging Face Inference API.
+
+    Args:
+        model_name: Имя модели на Hugging Face Hub
+        token: Токен Hugging Face
+    """
+
+    def __init__(self, model_name: str, token: Optional[str] = None):
+        self.model_name = model_name
+        self.client = InferenceClient(model=model_name, token=token)
+
+    async def generate(self, prompt: str, max_tokens: int, temperature: float) -> str:
+        # Клиент синхронный — выполняем запрос в потоке
+        return await asyncio.to_thread(
+            self.client.text_generation,
+            prompt,
+            max_new_tokens=max_tokens,
+            temperature=temperature,
+            return_full_text=False
+        )
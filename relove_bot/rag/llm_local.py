@@ -0,0 +1,117 @@
+"""
+Локальная модель (transformers/torch) для LLM.
+
+Модуль импортируется только внутри процесса локального инференса
+(rag/local_worker.py): torch и transformers добавляют секунды и сотни
+мегабайт памяти к старту бота, веб-приложения и скриптов, которые работают
+через API, а генерация на CPU не должна занимать цикл событий бота.
+"""
+import logging
+from typing import Any, Dict, List, Optional
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+logger = logging.getLogger(__name__)
+
+
+class LocalModelBackend:
+    """
+    Модель transformers с пакетной генерацией.
+
+    Args:
+        model_name: Имя модели на Hugging Face Hub или путь к ней
+        quantize_4bit: Загрузить модель в 4 бита (bitsandbytes, нужна CUDA)
+        token: Токен Hugging Face для закрытых моделей
+        threads: Число потоков torch на CPU (None — по умолчанию)
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        quantize_4bit: bool = False,
+        token: Optional[str] = None,
+        threads: Optional[int] = None,
+    ):
+        self.model_name = model_name
+        self.quantize_4bit = quantize_4bit
+        self.token = token
+        self.threads = threads
+        self.tokenizer = None
+        self.model = None
+
+    def load(self) -> None:
+        """Загружает токенизатор и модель (один раз)"""
+        if self.model is not None:
+            return
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        logger.info(f"Загрузка локальной модели {self.model_name}...")
+        kwargs: Dict[str, Any] = {"token": self.token}
+        if self.quantize_4bit:
+            kwargs["quantization_config"] = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.float16,
+            )
+            kwargs["device_map"] = "auto"
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, token=self.token)
+        # Для пакета промпты выравниваются слева, чтобы генерация шла с общего края
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(self.model_name, **kwargs)
+        self.model.eval()
+        logger.info(f"Локальная модель {self.model_name} загружена на {self.model.device}")
+
+    @property
+    def kv_bytes_per_token(self) -> int:
+        """Размер KV-кэша на один токен последовательности в байтах"""
+        self.load()
+        config = self.model.config
+        layers = getattr(config, "num_hidden_layers", 0)
+        hidden = getattr(config, "hidden_size", 0)
+        heads = getattr(config, "num_attention_heads", 1) or 1
+        kv_heads = getattr(config, "num_key_value_heads", None) or heads
+        dtype_bytes = torch.finfo(self.model.dtype).bits // 8
+        # Ключи и значения на каждом слое; при GQA голов KV меньше, чем голов внимания
+        return 2 * layers * hidden * kv_heads // heads * dtype_bytes
+
+    def format_prompt(self, messages: List[Dict[str, str]]) -> str:
+        """Промпт из сообщений: шаблон чата модели, если он есть"""
+        self.load()
+        if getattr(self.tokenizer, "chat_template", None):
+            return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        return "\n\n".join(message["content"] for message in messages) + "\n\n"
+
+    def count_tokens(self, text: str) -> int:
+        self.load()
+        return len(self.tokenizer(text).input_ids)
+
+    def generate_batch(self, prompts: List[str], max_tokens: List[int], temperature: float) -> List[str]:
+        """
+        Генерирует ответы на пакет промптов одним вызовом model.generate.
+
+        Args:
+            prompts: Готовые промпты
+            max_tokens: Лимит новых токенов для каждого промпта
+            temperature: Общая температура пакета (0 — жадная генерация)
+
+        Returns:
+            Ответы в порядке промптов
+        """
+        self.load()
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+        sampling = {"do_sample": True, "temperature": temperature, "top_p": 0.9} if temperature > 0 else {"do_sample": False}
+        with torch.no_grad():
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=max(max_tokens),
+                pad_token_id=self.tokenizer.pad_token_id,
+                **sampling
+            )
+        # Декодируем только сгенерированную часть, обрезая по лимиту каждого запроса
+        prompt_length = inputs.input_ids.shape[-1]
+        return [
+            self.tokenizer.decode(output[prompt_length:prompt_length + limit], skip_special_tokens=True).strip()
+            for output, limit in zip(outputs, max_tokens)
+        ]
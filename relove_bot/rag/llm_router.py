@@ -0,0 +1,402 @@
+"""
+Маршрутизатор запросов к нескольким OpenAI-совместимым провайдерам LLM.
+
+Бэкенды (OpenRouter, Groq, локальный сервер и т.п.) упорядочиваются по
+оценке здоровья. Если основной бэкенд отвечает дольше своего перцентиля
+латентности, дублирующий запрос уходит на следующий (hedging): побеждает
+первый успешный ответ, проигравший отменяется. Ошибка бэкенда сразу
+переводит запрос на следующий (failover). У каждого бэкенда свой circuit
+breaker: пока провайдер лежит, запросы к нему отклоняются мгновенно.
+
+Список бэкендов задаётся в LLM_BACKENDS (JSON), по умолчанию строится из
+LLM_API_BASE и OPENAI_API_BASE.
+"""
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Sequence
+
+from relove_bot.utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+from relove_bot.utils.llm_telemetry import current_llm_call
+from relove_bot.utils.rate_limiter import RateLimitExceeded, TokenBucketLimiter, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+
+class NoBackendAvailable(RuntimeError):
+    """Ни один бэкенд не смог обработать запрос"""
+
+
+def _is_backend_failure(error: BaseException) -> bool:
+    """Считается ли ошибка сбоем провайдера (4xx — ошибка самого запроса, 429 — дело лимитера)"""
+    import openai
+
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return True
+
+
+def _is_rate_limited(error: BaseException) -> bool:
+    import openai
+
+    return isinstance(error, openai.RateLimitError)
+
+
+class LLMBackend:
+    """
+    Один OpenAI-совместимый провайдер со статистикой латентности и ошибок.
+
+    Args:
+        name: Имя бэкенда для логов и статистики
+        base_url: Base URL API
+        api_key: API-ключ
+        model: Модель этого провайдера (если задана, заменяет модель из запроса)
+        timeout: Таймаут запроса в секундах
+        max_retries: Повторы внутри SDK (при нескольких бэкендах лучше 0 — повторяет роутер)
+        failure_threshold: Сбоев подряд до размыкания circuit breaker
+        recovery_timeout: Время до пробного запроса после размыкания, сек
+    """
+
+    # Скорость восстановления оценки здоровья после ошибок, сек
+    RECOVERY_TIME = 60.0
+    LATENCY_WINDOW = 200
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        api_key: str,
+        model: Optional[str] = None,
+        timeout: float = 60,
+        max_retries: int = 0,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+    ):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._client = None
+        self.breaker = CircuitBreaker(name, failure_threshold=failure_threshold, recovery_timeout=recovery_timeout)
+        self._latencies: Deque[float] = deque(maxlen=self.LATENCY_WINDOW)
+        self._health = 1.0
+        self._last_error_at = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.inflight = 0
+
+    @property
+    def client(self) -> Any:
+        """AsyncOpenAI создаётся при первом запросе: импорт SDK openai не замедляет старт бота"""
+        if self._client is None:
+            from openai import AsyncOpenAI
+
+            self._client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                timeout=self.timeout,
+                max_retries=self.max_retries,
+                default_headers={
+                    "HTTP-Referer": "https://github.com/relove-bot",
+                    "X-Title": "reLove Bot",
+                },
+            )
+        return self._client
+
+    @client.setter
+    def client(self, client: Any) -> None:
+        self._client = client
+
+    @property
+    def health(self) -> float:
+        """Оценка здоровья 0..1; после ошибок постепенно возвращается к 1"""
+        if self._health >= 1.0:
+            return 1.0
+        elapsed = time.monotonic() - self._last_error_at
+        return 1.0 - (1.0 - self._health) * math.exp(-elapsed / self.RECOVERY_TIME)
+
+    def record_success(self, latency: float) -> None:
+        self._latencies.append(latency)
+        self._health = 0.8 * self.health + 0.2
+
+    def record_error(self) -> None:
+        self.errors += 1
+        self._health = 0.5 * self.health
+        self._last_error_at = time.monotonic()
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(percentile * len(ordered)))
+        return ordered[index]
+
+    def stats(self) -> Dict[str, Any]:
+        p50 = self.latency_percentile(0.5)
+        p90 = self.latency_percentile(0.9)
+        return {
+            "base_url": self.base_url,
+            "model": self.model,
+            "health": round(self.health, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": round(self.errors / self.requests, 3) if self.requests else 0.0,
+            "cancelled": self.cancelled,
+            "inflight": self.inflight,
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p90_ms": round(p90 * 1000, 1) if p90 is not None else None,
+            "circuit": self.breaker.stats(),
+        }
+
+
+class LLMRouter:
+    """
+    Маршрутизатор с hedging и failover между бэкендами.
+
+    Args:
+        backends: Бэкенды в порядке предпочтения
+        limiter: Общий лимитер; бюджет считается отдельно по ключу каждого бэкенда
+        hedge: Отправлять дублирующий запрос на медленном основном бэкенде
+        hedge_percentile: Перцентиль латентности основного бэкенда, после которого уходит дубль
+        hedge_min_delay: Нижняя граница задержки перед дублем в секундах
+        hedge_default_delay: Задержка перед дублем, пока статистики мало
+    """
+
+    # Сколько замеров нужно, чтобы доверять перцентилю
+    MIN_SAMPLES = 10
+
+    def __init__(
+        self,
+        backends: Sequence[LLMBackend],
+        limiter: Optional[TokenBucketLimiter] = None,
+        hedge: bool = True,
+        hedge_percentile: float = 0.9,
+        hedge_min_delay: float = 1.0,
+        hedge_default_delay: float = 4.0,
+    ):
+        if not backends:
+            raise ValueError("Нужен хотя бы один бэкенд LLM")
+        self.backends: List[LLMBackend] = list(backends)
+        self.limiter = limiter
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    @property
+    def primary(self) -> LLMBackend:
+        return self.backends[0]
+
+    def ranked(self) -> List[LLMBackend]:
+        """
+        Бэкенды по убыванию здоровья; при равной оценке — в порядке конфигурации.
+        Бэкенды с разомкнутым circuit breaker — в конце.
+        """
+        order = {id(backend): index for index, backend in enumerate(self.backends)}
+        return sorted(
+            self.backends,
+            key=lambda b: (not b.breaker.is_available(), -round(b.health, 1), order[id(b)])
+        )
+
+    def is_available(self) -> bool:
+        """Есть ли бэкенд, который примет запрос прямо сейчас"""
+        return any(backend.breaker.is_available() for backend in self.backends)
+
+    def hedge_delay(self, backend: LLMBackend) -> float:
+        if len(backend._latencies) < self.MIN_SAMPLES:
+            return self.hedge_default_delay
+        return max(self.hedge_min_delay, backend.latency_percentile(self.hedge_percentile))
+
+    async def _call(self, backend: LLMBackend, params: Dict[str, Any], max_wait: Optional[float] = ...) -> Any:
+        model = backend.model or params.get("model")
+        # Разомкнутый выключатель отклоняет запрос сразу, не дожидаясь лимитера
+        backend.breaker.before_call()
+        if self.limiter is not None:
+            try:
+                await self.limiter.acquire(key=backend.api_key, model=model, max_wait=max_wait)
+            except BaseException:
+                backend.breaker.record_ignored()
+                raise
+
+        backend.requests += 1
+        backend.inflight += 1
+        started = time.monotonic()
+        try:
+            response = await backend.client.chat.completions.create(**{**params, "model": model})
+        except asyncio.CancelledError:
+            backend.cancelled += 1
+            backend.breaker.record_ignored()
+            raise
+        except Exception as e:
+            backend.record_error()
+            if _is_backend_failure(e):
+                backend.breaker.record_failure()
+            else:
+                backend.breaker.record_ignored()
+            if _is_rate_limited(e) and self.limiter is not None:
+                retry_after = parse_retry_after(e.response.headers.get('retry-after')) if e.response is not None else None
+                await self.limiter.penalize(key=backend.api_key, model=model, retry_after=retry_after)
+            raise
+        finally:
+            backend.inflight -= 1
+        backend.record_success(time.monotonic() - started)
+        backend.breaker.record_success()
+        call = current_llm_call()
+        if call is not None:
+            call.backend = backend.name
+            if not params.get("stream"):
+                call.set_usage(getattr(response, "usage", None))
+        return response
+
+    async def chat(self, **params) -> Any:
+        """
+        Выполняет chat.completions.create на лучшем доступном бэкенде.
+
+        Args:
+            **params: Параметры запроса OpenAI (model, messages, max_tokens, ...)
+
+        Returns:
+            Ответ OpenAI SDK (ChatCompletion)
+        """
+        if params.get("stream"):
+            return await self.stream(**params)
+
+        candidates = self.ranked()
+        loop = asyncio.get_running_loop()
+        pending: Dict[asyncio.Task, LLMBackend] = {}
+        errors: List[BaseException] = []
+        next_index = 0
+        hedged = False
+
+        def launch(max_wait: Optional[float] = ...) -> None:
+            nonlocal next_index
+            backend = candidates[next_index]
+            next_index += 1
+            pending[asyncio.ensure_future(self._call(backend, params, max_wait=max_wait))] = backend
+
+        launch()
+        hedge_at = loop.time() + self.hedge_delay(candidates[0])
+        try:
+            while pending:
+                timeout = None
+                if self.hedge and not hedged and next_index < len(candidates):
+                    timeout = max(0.0, hedge_at - loop.time())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # Основной бэкенд медленнее обычного — дублируем запрос, не дожидаясь лимитера
+                    hedged = True
+                    self.hedged += 1
+                    launch(max_wait=0)
+                    continue
+
+                for task in done:
+                    backend = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        if hedged and backend is not candidates[0]:
+                            self.hedge_wins += 1
+                        return task.result()
+                    errors.append(error)
+                    if not isinstance(error, (RateLimitExceeded, CircuitOpenError)):
+                        logger.warning(f"Бэкенд LLM {backend.name} вернул ошибку: {error}")
+
+                if not pending and next_index < len(candidates):
+                    self.failovers += 1
+                    launch(max_wait=0)
+        finally:
+            # Проигравшие запросы больше не нужны
+            for task in pending:
+                task.cancel()
+
+        raise errors[-1] if errors else NoBackendAvailable("Нет доступных бэкендов LLM")
+
+    async def stream(self, **params) -> Any:
+        """
+        Открывает потоковый ответ на лучшем доступном бэкенде.
+
+        Поток нельзя продублировать без двойного вывода, поэтому здесь только
+        failover: если бэкенд не смог начать ответ, пробуем следующий.
+
+        Returns:
+            Асинхронный поток фрагментов OpenAI SDK (AsyncStream)
+        """
+        params = {**params, "stream": True}
+        last_error: Optional[BaseException] = None
+        for index, backend in enumerate(self.ranked()):
+            if index:
+                self.failovers += 1
+            try:
+                return await self._call(backend, params, max_wait=... if index == 0 else 0)
+            except Exception as e:
+                last_error = e
+                if not isinstance(e, CircuitOpenError):
+                    logger.warning(f"Бэкенд LLM {backend.name} не начал поток: {e}")
+        raise last_error or NoBackendAvailable("Нет доступных бэкендов LLM")
+
+    def stats(self) -> Dict[str, Any]:
+        """Латентность, ошибки и здоровье по бэкендам, счётчики hedging и failover"""
+        return {
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "backends": {backend.name: backend.stats() for backend in self.backends},
+        }
+
+
+def _backends_from_settings(settings) -> List[LLMBackend]:
+    configs: List[Dict[str, Any]] = list(settings.llm_backends)
+    if not configs:
+        configs.append({"name": "default", "base_url": settings.llm_api_base})
+        if settings.openai_api_base.rstrip('/') != settings.llm_api_base.rstrip('/'):
+            key = settings.openrouter_api_key or settings.llm_api_key
+            configs.append({
+                "name": "openrouter",
+                "base_url": settings.openai_api_base,
+                "api_key": key.get_secret_value(),
+            })
+
+    # Повторы внутри SDK оставляем, только когда переключаться некуда
+    max_retries = 2 if len(configs) == 1 else 0
+    return [
+        LLMBackend(
+            name=config.get("name") or config["base_url"],
+            base_url=config["base_url"],
+            api_key=config.get("api_key") or settings.llm_api_key.get_secret_value(),
+            model=config.get("model"),
+            timeout=config.get("timeout", settings.llm_http_timeout),
+            max_retries=config.get("max_retries", max_retries),
+            failure_threshold=settings.llm_circuit_failure_threshold,
+            recovery_timeout=settings.llm_circuit_recovery_timeout,
+        )
+        for config in configs
+    ]
+
+
+_llm_router: Optional[LLMRouter] = None
+
+
+def get_llm_router() -> LLMRouter:
+    """Общий для процесса маршрутизатор LLM, настроенный из settings"""
+    global _llm_router
+    if _llm_router is None:
+        from relove_bot.config import settings
+        from relove_bot.utils.rate_limiter import get_llm_limiter
+
+        _llm_router = LLMRouter(
+            _backends_from_settings(settings),
+            limiter=get_llm_limiter(),
+            hedge=settings.llm_hedge_enabled,
+            hedge_percentile=settings.llm_hedge_percentile,
+            hedge_min_delay=settings.llm_hedge_min_delay,
+            hedge_default_delay=settings.llm_hedge_default_delay,
+        )
+    return _llm_router
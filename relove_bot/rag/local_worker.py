@@ -0,0 +1,424 @@
+"""
+Локальный инференс в отдельном процессе.
+
+Генерация на CPU занимает секунды и держит GIL, поэтому модель живёт в
+дочернем процессе, а бот общается с ним через очереди. Процесс копит
+попутные запросы (до max_batch_size или batch_wait секунд) и выполняет их
+одним вызовом generate. Пакеты составляются так, чтобы уложиться в бюджет
+KV-кэша: его размер растёт как число промптов × (самый длинный промпт +
+лимит ответа), поэтому промпты сортируются по длине и группируются по
+температуре — generate принимает одну температуру на пакет.
+
+Пакетирование на уровне запросов, а не итераций: transformers не умеет
+добавлять запросы в уже идущую генерацию. Пока пакет считается, новые запросы
+ждут в очереди и уходят следующим пакетом.
+"""
+import asyncio
+import itertools
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from relove_bot.rag.worker_process import load_factory, spawn_context
+from relove_bot.services.prompts import RAG_SUMMARY_PROMPT
+from relove_bot.utils.llm_telemetry import get_llm_telemetry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = "relove_bot.rag.llm_local:LocalModelBackend"
+
+
+class LocalInferenceError(RuntimeError):
+    """Ошибка процесса локального инференса"""
+
+
+@dataclass
+class InferenceJob:
+    """Запрос внутри процесса инференса"""
+    request_id: int
+    prompt: str
+    prompt_tokens: int
+    max_tokens: int
+    temperature: float
+    order: int = 0
+
+
+def kv_cache_batch_limit(seq_tokens: int, kv_bytes_per_token: int, kv_budget_bytes: int, max_batch_size: int) -> int:
+    """Сколько последовательностей длиной seq_tokens помещается в бюджет KV-кэша"""
+    if kv_bytes_per_token <= 0 or kv_budget_bytes <= 0 or seq_tokens <= 0:
+        return max_batch_size
+    return max(1, min(max_batch_size, kv_budget_bytes // (seq_tokens * kv_bytes_per_token)))
+
+
+def plan_batches(
+    jobs: Sequence[InferenceJob],
+    max_batch_size: int,
+    kv_budget_bytes: int = 0,
+    kv_bytes_per_token: int = 0,
+) -> List[List[InferenceJob]]:
+    """
+    Разбивает запросы на пакеты.
+
+    В пакет попадают запросы с одной температурой; внутри группы запросы
+    идут по длине промпта, чтобы меньше тратить на выравнивание, и пакет
+    растёт, пока padded-размер KV-кэша укладывается в бюджет. Запрос,
+    который не помещается даже один, выполняется отдельным пакетом.
+
+    Returns:
+        Пакеты в порядке поступления самого раннего запроса
+    """
+    groups: Dict[float, List[InferenceJob]] = {}
+    for job in jobs:
+        groups.setdefault(round(job.temperature, 2), []).append(job)
+
+    batches: List[List[InferenceJob]] = []
+    for group in groups.values():
+        batch: List[InferenceJob] = []
+        longest_prompt = longest_answer = 0
+        for job in sorted(group, key=lambda j: (j.prompt_tokens, j.order)):
+            prompt_tokens = max(longest_prompt, job.prompt_tokens)
+            answer_tokens = max(longest_answer, job.max_tokens)
+            limit = kv_cache_batch_limit(prompt_tokens + answer_tokens, kv_bytes_per_token, kv_budget_bytes, max_batch_size)
+            if batch and len(batch) + 1 > limit:
+                batches.append(batch)
+                batch = []
+                prompt_tokens, answer_tokens = job.prompt_tokens, job.max_tokens
+            batch.append(job)
+            longest_prompt, longest_answer = prompt_tokens, answer_tokens
+        if batch:
+            batches.append(batch)
+    batches.sort(key=lambda b: min(job.order for job in b))
+    return batches
+
+
+def _worker_main(config: Dict[str, Any], requests, responses) -> None:
+    """
+    Цикл процесса инференса.
+
+    Запрос: (request_id, messages, max_tokens, temperature), None — остановка.
+    Ответ: (request_id, ok, текст или ошибка, размер пакета).
+    """
+    logging.basicConfig(level=config.get("log_level", logging.INFO))
+    backend = load_factory(config["backend"])(config["model_name"], **config["backend_kwargs"])
+    load_error: Optional[str] = None
+    kv_bytes_per_token = 0
+    try:
+        backend.load()
+        kv_bytes_per_token = int(getattr(backend, "kv_bytes_per_token", 0) or 0)
+    except Exception as e:
+        logger.error(f"Локальная модель {config['model_name']} не загрузилась: {e}", exc_info=True)
+        load_error = f"Локальная модель не загрузилась: {e}"
+
+    max_batch_size = config["max_batch_size"]
+    order = itertools.count()
+    pending: List[InferenceJob] = []
+    stopping = False
+
+    def accept(item) -> None:
+        request_id, messages, max_tokens, temperature = item
+        if load_error:
+            responses.put((request_id, False, load_error, 0))
+            return
+        try:
+            prompt = backend.format_prompt(messages)
+            pending.append(InferenceJob(request_id, prompt, backend.count_tokens(prompt), max_tokens, temperature, next(order)))
+        except Exception as e:
+            responses.put((request_id, False, f"Ошибка подготовки промпта: {e}", 0))
+
+    def run(batch: List[InferenceJob]) -> None:
+        try:
+            texts = backend.generate_batch(
+                [job.prompt for job in batch], [job.max_tokens for job in batch], batch[0].temperature
+            )
+        except Exception as e:
+            if len(batch) > 1:
+                # Один проблемный промпт не должен ронять соседей по пакету
+                logger.warning(f"Пакет из {len(batch)} запросов упал ({e}), выполняем по одному")
+                for job in batch:
+                    run([job])
+                return
+            responses.put((batch[0].request_id, False, str(e), 1))
+            return
+        for job, text in zip(batch, texts):
+            responses.put((job.request_id, True, text, len(batch)))
+
+    while not stopping:
+        # Ждём первый запрос и попутные к нему; если остались запросы
+        # прошлого раунда, забираем из очереди только то, что уже пришло
+        wait = 0.0
+        if not pending:
+            item = requests.get()
+            if item is None:
+                break
+            accept(item)
+            wait = config["batch_wait"]
+        deadline = time.monotonic() + wait
+        while len(pending) < max_batch_size:
+            try:
+                item = requests.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            accept(item)
+        if not pending:
+            continue
+
+        batches = plan_batches(pending, max_batch_size, config["kv_cache_bytes"], kv_bytes_per_token)
+        # Выполняем один пакет, остальные объединяются с новыми запросами
+        batch = batches[0]
+        started = set(job.request_id for job in batch)
+        pending = [job for job in pending if job.request_id not in started]
+        run(batch)
+
+    # Принятые до остановки запросы досчитываем
+    for batch in plan_batches(pending, max_batch_size, config["kv_cache_bytes"], kv_bytes_per_token):
+        run(batch)
+
+
+class LocalInferenceClient:
+    """
+    Асинхронный клиент процесса локального инференса.
+
+    Процесс запускается при первом запросе. Если он завершится, ожидающие
+    запросы получают ошибку, а следующий запрос запустит процесс заново.
+
+    Args:
+        model_name: Модель transformers
+        max_batch_size: Максимум промптов в пакете
+        batch_wait: Сколько секунд процесс ждёт попутных запросов
+        kv_cache_bytes: Бюджет KV-кэша на пакет (0 — без ограничения)
+        quantize_4bit: Загрузить модель в 4 бита
+        token: Токен Hugging Face
+        threads: Потоков torch в процессе
+        backend: Путь 'package.module:Class' к бэкенду модели
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        max_batch_size: int = 8,
+        batch_wait: float = 0.02,
+        kv_cache_bytes: int = 0,
+        quantize_4bit: bool = False,
+        token: Optional[str] = None,
+        threads: Optional[int] = None,
+        backend: str = DEFAULT_BACKEND,
+    ):
+        self.model_name = model_name
+        self._config = {
+            "backend": backend,
+            "model_name": model_name,
+            "backend_kwargs": {"quantize_4bit": quantize_4bit, "token": token, "threads": threads},
+            "max_batch_size": max(1, max_batch_size),
+            "batch_wait": batch_wait,
+            "kv_cache_bytes": kv_cache_bytes,
+            "log_level": logging.getLogger().level or logging.INFO,
+        }
+        self._context = spawn_context()
+        self._process = None
+        self._requests = None
+        self._responses = None
+        self._reader: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._pending: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+        self._ids = itertools.count(1)
+        self._stats = {"requests": 0, "completed": 0, "errors": 0, "batched_requests": 0, "restarts": 0}
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._process is not None and self._process.is_alive():
+                return
+            if self._process is not None:
+                # Запросы к упавшему процессу завершаются ошибкой до перезапуска
+                self._stats["restarts"] += 1
+                self._fail_waiters_locked(f"Процесс локального инференса завершился (код {self._process.exitcode})")
+            self._requests = self._context.Queue()
+            self._responses = self._context.Queue()
+            self._process = self._context.Process(
+                target=_worker_main,
+                args=(self._config, self._requests, self._responses),
+                name="relove-local-llm",
+                daemon=True,
+            )
+            self._process.start()
+            self._reader = threading.Thread(
+                target=self._read_responses, args=(self._process, self._responses), daemon=True
+            )
+            self._reader.start()
+            logger.info(f"Запущен процесс локального инференса {self.model_name} (pid {self._process.pid})")
+
+    def _read_responses(self, process, responses) -> None:
+        """Поток-читатель: передаёт ответы процесса в циклы событий ожидающих"""
+        while True:
+            try:
+                request_id, ok, payload, batch_size = responses.get(timeout=0.5)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                self._fail_pending(f"Процесс локального инференса завершился (код {process.exitcode})", process)
+                return
+            except (EOFError, OSError):
+                self._fail_pending("Очередь процесса локального инференса закрыта", process)
+                return
+            with self._lock:
+                waiter = self._pending.pop(request_id, None)
+                if ok:
+                    self._stats["completed"] += 1
+                    if batch_size > 1:
+                        self._stats["batched_requests"] += 1
+                else:
+                    self._stats["errors"] += 1
+            if waiter is not None:
+                loop, future = waiter
+                loop.call_soon_threadsafe(_resolve, future, ok, payload)
+
+    def _fail_pending(self, reason: str, process=None) -> None:
+        with self._lock:
+            # Процесс уже заменён новым — его запросы завершены при перезапуске
+            if process is not None and self._process is not process:
+                return
+            self._fail_waiters_locked(reason)
+
+    def _fail_waiters_locked(self, reason: str) -> None:
+        waiters = list(self._pending.values())
+        self._pending.clear()
+        self._stats["errors"] += len(waiters)
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future, False, reason)
+
+    async def generate(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 512,
+        temperature: float = 0.4,
+        timeout: float = 60,
+    ) -> str:
+        """
+        Генерирует ответ на сообщения чата.
+
+        Raises:
+            LocalInferenceError: Ошибка модели или процесса
+            asyncio.TimeoutError: Ответ не пришёл за timeout секунд
+        """
+        self._ensure_started()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        request_id = next(self._ids)
+        with self._lock:
+            self._pending[request_id] = (loop, future)
+            self._stats["requests"] += 1
+        async with get_llm_telemetry().track("local", self.model_name) as call:
+            call.backend = "local"
+            try:
+                self._requests.put((request_id, messages, max_tokens, temperature))
+                text = await asyncio.wait_for(future, timeout)
+            finally:
+                with self._lock:
+                    self._pending.pop(request_id, None)
+            call.estimate_usage("\n".join(m["content"] for m in messages), text)
+        return text
+
+    async def analyze_content(
+        self,
+        content: str,
+        model: str = None,
+        max_tokens: int = 512,
+        temperature: float = 0.4,
+        system_prompt: str = RAG_SUMMARY_PROMPT,
+        timeout: int = 60,
+        use_cache: bool = True
+    ) -> Any:
+        """
+        Анализ контента локальной моделью; сигнатура и результат как у LLM.analyze_content.
+
+        model и use_cache принимаются для совместимости: модель задаётся при
+        создании клиента, а кэш для локальной модели не нужен.
+
+        Returns:
+            Текст ответа или словарь с ключом error при ошибке
+        """
+        if not content:
+            return {'error': 'Text is required for analysis'}
+        try:
+            return await self.generate(
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": content}
+                ],
+                max_tokens=max_tokens,
+                temperature=temperature,
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"Таймаут локальной модели ({timeout} с)")
+            return {'error': f'Timeout after {timeout} seconds'}
+        except LocalInferenceError as e:
+            logger.error(f"Ошибка локальной модели: {e}")
+            return {'error': str(e)}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+        stats["alive"] = bool(self._process is not None and self._process.is_alive())
+        stats["max_batch_size"] = self._config["max_batch_size"]
+        return stats
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Останавливает процесс: дожидается текущего пакета, затем завершает принудительно"""
+        with self._lock:
+            process, requests = self._process, self._requests
+            self._process = None
+        if process is None:
+            return
+        try:
+            requests.put(None)
+        except (ValueError, OSError):
+            pass
+        process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+            process.join(1.0)
+        self._fail_pending("Процесс локального инференса остановлен")
+
+
+def _resolve(future: asyncio.Future, ok: bool, payload: str) -> None:
+    if future.done():
+        return
+    if ok:
+        future.set_result(payload)
+    else:
+        future.set_exception(LocalInferenceError(payload))
+
+
+_client: Optional[LocalInferenceClient] = None
+
+
+def get_local_inference_client() -> LocalInferenceClient:
+    """Общий клиент локального инференса (настройки из settings)"""
+    global _client
+    if _client is None:
+        from relove_bot.config import settings
+
+        if not settings.local_model_name:
+            raise RuntimeError("Локальная модель не задана (LOCAL_MODEL_NAME)")
+        _client = LocalInferenceClient(
+            settings.local_model_name,
+            max_batch_size=settings.llm_local_worker_max_batch,
+            batch_wait=settings.llm_local_worker_batch_wait,
+            kv_cache_bytes=settings.llm_local_kv_cache_mb * 1024 * 1024,
+            quantize_4bit=settings.local_model_4bit,
+            token=settings.hugging_face_token.get_secret_value() if settings.hugging_face_token else None,
+            threads=settings.local_model_threads,
+        )
+    return _client
+
+
+def get_local_inference_stats() -> Optional[Dict[str, Any]]:
+    """Статистика клиента локального инференса (None, если он не создавался)"""
+    return _client.stats() if _client is not None else None
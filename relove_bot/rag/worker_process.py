@@ -0,0 +1,19 @@
+"""
+Общее для моделей, которые работают в отдельном процессе (эмбеддинги,
+локальный инференс): загрузка бэкенда по строке «модуль:атрибут» и
+контекст multiprocessing для дочерних процессов.
+"""
+import importlib
+import multiprocessing
+
+
+def load_factory(spec: str):
+    """Класс или фабрика модели по строке вида «package.module:Name»"""
+    module_name, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def spawn_context():
+    """Контекст для процессов с моделью"""
+    # spawn, а не fork: torch и потоки цикла событий плохо переживают fork
+    return multiprocessing.get_context("spawn")
@@ -6,14 +6,24 @@ import base64
 import logging
 import json
 import re
-from typing import Optional, Dict, Any, List
+from contextlib import nullcontext
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, List, Mapping, Optional, Sequence, Type, TypeVar
 from enum import Enum
 import aiohttp
+from pydantic import BaseModel
 
 from relove_bot.config import settings
 from relove_bot.rag.llm import LLM
 from relove_bot.db.models import GenderEnum
-from relove_bot.utils.api_rate_limiter import APIRateLimiter
+from relove_bot.utils.batch_classifier import BatchClassifier
+from relove_bot.utils.circuit_breaker import CircuitOpenError
+from relove_bot.utils.http_client import get_http_session
+from relove_bot.utils.llm_cache import get_llm_cache, make_cache_key
+from relove_bot.utils.single_flight import get_single_flight
+from relove_bot.utils.llm_scheduler import get_llm_scheduler
+from relove_bot.utils.llm_telemetry import current_llm_caller, get_llm_telemetry, llm_caller
+from relove_bot.utils.prompt_prefix import assemble_prompt
+from relove_bot.utils.structured_output import generate_structured, response_format_for
 from relove_bot.services.prompts import (
     GENDER_TEXT_ANALYSIS_PROMPT,
     GENDER_PHOTO_ANALYSIS_PROMPT,
@@ -23,6 +33,8 @@ from relove_bot.services.prompts import (
 
 logger = logging.getLogger(__name__)
 
+M = TypeVar('M', bound=BaseModel)
+
 class LLMService:
     _instance = None
     
@@ -41,8 +53,8 @@ class LLMService:
         self.api_base = settings.openai_api_base
         self.model = settings.model_name
         self.attempts = settings.llm_attempts
-        self.cache = {}  # Добавляем кэш
-        self.rate_limiter = APIRateLimiter(max_requests_per_minute=20, max_requests_per_day=1000)
+        self.cache = get_llm_cache()
+        self.single_flight = get_single_flight()
         
         # Инициализируем LLM
         self.llm = LLM()
@@ -57,79 +69,161 @@ class LLMService:
         
         self._initialized = True
         
-    async def generate_text(self, prompt: str, max_tokens: int = 1000, temperature: float = 0.7, model: str = None) -> str:
+    def _headers(self) -> Dict[str, str]:
+        """Заголовки запроса к OpenAI-совместимому API"""
+        return {
+            "Authorization": f"Bearer {self.api_key.get_secret_value()}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://relove.com",
+            "X-Title": "reLove_communication_bot"
+        }
+
+    async def _post_chat_completion(self, payload: Dict[str, Any], timeout: float) -> tuple:
+        """
+        Отправляет запрос к /chat/completions через общий пул соединений.
+        
+        Args:
+            payload: Тело запроса
+            timeout: Таймаут запроса в секундах
+            
+        Returns:
+            tuple: (HTTP-статус, тело ответа как dict или str, заголовки ответа)
+        """
+        session = await get_http_session()
+        async with get_llm_telemetry().track("vision", payload.get("model", self.model)) as call:
+            async with session.post(
+                f"{self.api_base}/chat/completions",
+                headers=self._headers(),
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                call.mark_first_byte()
+                try:
+                    body = await response.json(content_type=None)
+                except (aiohttp.ContentTypeError, json.JSONDecodeError):
+                    body = await response.text()
+                if isinstance(body, dict):
+                    call.set_usage(body.get('usage'))
+                if response.status != 200:
+                    call.status = "error"
+                    call.error = f"HTTP {response.status}"
+                return response.status, body, response.headers
+
+    @staticmethod
+    def _extract_error_message(body: Any) -> str:
+        """Достаёт текст ошибки из ответа API"""
+        if isinstance(body, dict):
+            error = body.get('error')
+            if isinstance(error, dict):
+                return error.get('message', 'Unknown error')
+            if error:
+                return str(error)
+            return 'Unknown error'
+        return str(body) if body else 'Unknown error'
+
+    async def generate_text(
+        self,
+        prompt: str,
+        max_tokens: int = 1000,
+        temperature: float = 0.7,
+        model: str = None,
+        use_cache: bool = True
+    ) -> str:
         """Генерирует текст через LLM"""
         try:
             # Проверяем кэш
-            cache_key = f"prompt_{hash(prompt)}_{max_tokens}_{temperature}_{model or self.model}"
-            if cache_key in self.cache:
-                logger.info(f"Используем кэшированный ответ для: {prompt[:50]}...")
-                return self.cache[cache_key]
-            
-            # Ждем, пока не будет превышен лимит
-            await self.rate_limiter.wait_for_limit(self.api_key.get_secret_value())
-            
-            # Логируем детали запроса
-            logger.info("=== Детали запроса к LLM ===")
-            logger.info(f"URL: {self.api_base}/chat/completions")
-            logger.info(f"Модель: {model or self.model}")
-            logger.info(f"Размер промпта: {len(prompt)} символов")
-            logger.info("==========================")
-            
-            # Отправляем запрос с повторными попытками
-            max_retries = 3
-            retry_delay = 5
+            use_cache = use_cache and settings.llm_cache_enabled
+            cache_key = make_cache_key(
+                model or self.model,
+                [{"role": "user", "content": prompt}],
+                temperature,
+                max_tokens
+            )
+            if use_cache:
+                cached = await self.cache.get(cache_key)
+                if cached is not None:
+                    logger.info(f"Используем кэшированный ответ для: {prompt[:50]}...")
+                    get_llm_telemetry().record_cache_hit("generate", model or self.model)
+                    return cached
+
+            async def fetch() -> str:
+                content = await get_llm_scheduler().run(
+                    lambda: self._request_text(prompt, max_tokens, temperature, model)
+                )
+                if use_cache and content:
+                    await self.cache.set(cache_key, content)
+                return content
+
+            # Одинаковые одновременные запросы ждут один общий ответ
+            return await self.single_flight.do(f"service:{cache_key}", fetch)
+
+        except Exception as e:
+            logger.error(f"Ошибка при генерации текста: {str(e)}", exc_info=True)
+            raise
+
+    def is_available(self) -> bool:
+        """Примет ли LLM запрос прямо сейчас (не все бэкенды отключены circuit breaker)"""
+        return self.llm.router.is_available()
+
+    async def stream_text(
+        self,
+        prompt: str,
+        system_prompt: str = None,
+        max_tokens: int = 1000,
+        temperature: float = 0.7,
+        model: str = None,
+        use_cache: bool = True
+    ) -> AsyncIterator[str]:
+        """Генерирует текст через LLM потоково, фрагментами по мере готовности"""
+        async for chunk in self.llm.stream_content(
+            content=prompt,
+            model=model or self.model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            system_prompt=system_prompt,
+            use_cache=use_cache
+        ):
+            yield chunk
+
+    async def _request_text(self, prompt: str, max_tokens: int, temperature: float, model: str = None) -> str:
+        """Отправляет запрос к API с повторными попытками (без кэша)"""
+        # Логируем детали запроса
+        logger.info("=== Детали запроса к LLM ===")
+        logger.info(f"Бэкенды: {', '.join(backend.name for backend in self.llm.router.ranked())}")
+        logger.info(f"Модель: {model or self.model}")
+        logger.info(f"Размер промпта: {len(prompt)} символов")
+        logger.info("==========================")
+        
+        # Отправляем запрос с повторными попытками; переключение между бэкендами,
+        # лимиты и Retry-After обрабатывает маршрутизатор
+        max_retries = 3
+        retry_delay = 5
+        async with get_llm_telemetry().track("generate", model or self.model) as call:
             for attempt in range(max_retries):
+                call.retries = attempt
                 try:
-                    payload = {
-                        "model": model or self.model,
-                        "messages": [{"role": "user", "content": prompt}],
-                        "temperature": temperature,
-                        "max_tokens": max_tokens
-                    }
-                    
-                    async with aiohttp.ClientSession() as session:
-                        async with session.post(
-                            f"{self.api_base}/chat/completions",
-                            headers={
-                                "Authorization": f"Bearer {self.api_key.get_secret_value()}",
-                                "Content-Type": "application/json",
-                                "HTTP-Referer": "https://relove.com",
-                                "X-Title": "reLove_communication_bot"
-                            },
-                            json=payload,
-                            timeout=30  # Увеличиваем таймаут
-                        ) as response:
-                            # Проверяем статус ответа
-                            if response.status != 200:
-                                error_msg = await response.json().get('error', {}).get('message', 'Unknown error')
-                                if 'Rate limit' in error_msg:
-                                    logger.warning(f"Превышение лимита API, попытка {attempt + 1}/{max_retries}")
-                                    await asyncio.sleep(retry_delay * (attempt + 1))
-                                    continue
-                                raise ValueError(f"Ошибка API: {error_msg}")
-                            
-                            result = await response.json()
-                            
-                            # Проверяем наличие ответа
-                            if not result or not result.get('choices'):
-                                raise ValueError("Пустой ответ от API")
-                            
-                            # Кэшируем результат
-                            self.cache[cache_key] = result['choices'][0]['message']['content']
-                            return result['choices'][0]['message']['content']
-                            
+                    response = await self.llm.router.chat(
+                        model=model or self.model,
+                        messages=[{"role": "user", "content": prompt}],
+                        temperature=temperature,
+                        max_tokens=max_tokens
+                    )
+
+                    # Проверяем наличие ответа
+                    if not response or not response.choices:
+                        raise ValueError("Пустой ответ от API")
+
+                    return response.choices[0].message.content
+
+                except CircuitOpenError:
+                    # Все бэкенды недоступны — не ждём, вызывающий код уйдёт на запасной вариант
+                    raise
                 except Exception as e:
                     if attempt == max_retries - 1:
                         logger.error(f"Ошибка при генерации текста после {max_retries} попыток: {str(e)}", exc_info=True)
                         raise
                     logger.warning(f"Ошибка при попытке {attempt + 1}/{max_retries}: {str(e)}")
                     await asyncio.sleep(retry_delay * (attempt + 1))
-                    continue
-            
-        except Exception as e:
-            logger.error(f"Ошибка при генерации текста: {str(e)}", exc_info=True)
-            raise
 
     async def analyze_gender(
         self,
@@ -250,6 +344,157 @@ class LLMService:
             
         return None
         
+    async def analyze_text_gender_batch(
+        self,
+        users: Mapping[Hashable, Dict[str, Optional[str]]]
+    ) -> Dict[Hashable, Optional[GenderEnum]]:
+        """
+        Определяет пол многих пользователей пакетными запросами.
+
+        Args:
+            users: Ключ пользователя -> поля first_name, last_name, username, bio
+
+        Returns:
+            Ключ -> GenderEnum; None, если пол неоднозначен или не определён
+        """
+        def describe(fields: Dict[str, Optional[str]]) -> str:
+            return (
+                f"Имя: {fields.get('first_name') or ''}; Фамилия: {fields.get('last_name') or ''}; "
+                f"Логин: {fields.get('username') or ''}; Описание: {fields.get('bio') or ''}"
+            )
+
+        def parse_label(label: Any) -> Optional[str]:
+            label = str(label or '').strip().lower()
+            return label if label in ('male', 'female', 'unknown') else None
+
+        labels = await self.classify_batch(
+            name="gender",
+            instruction=GENDER_TEXT_ANALYSIS_PROMPT.strip() + "\nМетка каждой записи — строка 'male', 'female' или 'unknown'.",
+            items={key: describe(fields) for key, fields in users.items()},
+            parse_label=parse_label,
+            item_max_tokens=120,
+            label_tokens=12,
+        )
+        return {
+            key: GenderEnum(label) if label in ('male', 'female') else None
+            for key, label in labels.items()
+        }
+
+    async def classify_batch(
+        self,
+        name: str,
+        instruction: str,
+        items: Mapping[Hashable, str],
+        parse_label: Callable[[Any], Any],
+        item_max_tokens: int = 300,
+        label_tokens: int = 16,
+        batch_size: int = None,
+        model: str = None
+    ) -> Dict[Hashable, Any]:
+        """
+        Классифицирует много элементов, упаковывая их в общие запросы.
+
+        Элементы, которые модель пропустила или разметила недопустимой меткой,
+        переспрашиваются по одному.
+
+        Args:
+            name: Имя задачи для логов
+            instruction: Что определить для каждой записи и какие метки допустимы
+            items: Ключ -> текст элемента
+            parse_label: Проверка и приведение метки (None — метка недопустима)
+            item_max_tokens: Лимит текста одного элемента в токенах
+            label_tokens: Токенов ответа на один элемент
+            batch_size: Элементов в запросе (по умолчанию из settings)
+            model: Модель
+
+        Returns:
+            Ключ -> метка или None
+        """
+        model = model or self.model
+        analyzer = self.llm
+        if settings.llm_classification_backend == 'local':
+            # Офлайн-классификация маленькой моделью в процессе локального инференса
+            from relove_bot.rag.local_worker import get_local_inference_client
+
+            analyzer = get_local_inference_client()
+
+        async def complete(system_prompt: str, prompt: str, max_tokens: int) -> str:
+            result = await analyzer.analyze_content(
+                content=prompt,
+                model=model,
+                system_prompt=system_prompt,
+                max_tokens=max_tokens,
+                temperature=0.0
+            )
+            if isinstance(result, dict):
+                raise ValueError(result.get('error') or 'Пустой ответ от API')
+            return result
+
+        classifier = BatchClassifier(
+            name=name,
+            instruction=instruction,
+            parse_label=parse_label,
+            complete=complete,
+            batch_size=batch_size or settings.llm_batch_classify_size,
+            item_max_tokens=item_max_tokens,
+            label_tokens=label_tokens,
+            model=model,
+        )
+        return await classifier.classify(items)
+
+    async def generate_structured(
+        self,
+        schema: Type[M],
+        prompt: str,
+        system_prompt: str = "",
+        max_tokens: int = 512,
+        temperature: float = 0.0,
+        model: str = None
+    ) -> M:
+        """
+        Запрашивает ответ в виде JSON и возвращает проверенный объект схемы.
+
+        Схема передаётся в промпте и, если провайдер поддерживает, через
+        response_format. Невалидный ответ чинится локально, затем — просьбой
+        к модели исправить его по списку ошибок.
+
+        Args:
+            schema: pydantic-модель ответа
+            prompt: Промпт
+            system_prompt: Системный промпт
+            max_tokens: Лимит ответа
+            temperature: Температура генерации
+            model: Модель
+
+        Returns:
+            Объект схемы
+
+        Raises:
+            StructuredOutputError: Ответ не удалось привести к схеме
+        """
+        model = model or self.model
+
+        async def complete(system: str, content: str, limit: int, response_format: Optional[Dict[str, Any]]) -> str:
+            result = await self.llm.analyze_content(
+                content=content,
+                model=model,
+                system_prompt=system,
+                max_tokens=limit,
+                temperature=temperature,
+                response_format=response_format
+            )
+            return result if isinstance(result, str) else ''
+
+        return await generate_structured(
+            schema,
+            complete,
+            prompt=prompt,
+            system_prompt=system_prompt,
+            max_tokens=max_tokens,
+            response_format=response_format_for(schema, settings.llm_structured_output_mode),
+            max_repairs=settings.llm_structured_max_repairs,
+        )
+
     async def _analyze_photo_gender(self, photo_bytes: bytes) -> GenderEnum:
         """
         Анализирует фотографию для определения пола.
@@ -324,69 +569,81 @@ class LLMService:
             ]
             
             # Отправляем запрос
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.api_base}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key.get_secret_value()}",
-                        "Content-Type": "application/json",
-                        "HTTP-Referer": "https://relove.com",
-                        "X-Title": "reLove_communication_bot"
-                    },
-                    json={
-                        "model": self.model,
-                        "messages": messages,
-                        "max_tokens": max_tokens,
-                        "temperature": 0.7
-                    },
-                    timeout=aiohttp.ClientTimeout(total=60)
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        content = result.get('choices', [{}])[0].get('message', {}).get('content', '')
-                        return content.strip()
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Vision API error: {response.status} - {error_text}")
-                        return ""
+            status, result, _ = await self._post_chat_completion(
+                {
+                    "model": self.model,
+                    "messages": messages,
+                    "max_tokens": max_tokens,
+                    "temperature": 0.7
+                },
+                timeout=60
+            )
+            if status == 200 and isinstance(result, dict):
+                content = result.get('choices', [{}])[0].get('message', {}).get('content', '')
+                return content.strip()
+            else:
+                logger.error(f"Vision API error: {status} - {self._extract_error_message(result)}")
+                return ""
         
         except Exception as e:
             logger.error(f"Ошибка при анализе с изображением: {e}", exc_info=True)
             return ""
 
-    async def analyze_text(self, prompt: str, system_prompt: str = None, max_tokens: int = 64, user_info: dict = None, image_url: str = None) -> str:
+    async def analyze_text(
+        self,
+        prompt: str,
+        system_prompt: str = None,
+        max_tokens: int = 64,
+        user_info: dict = None,
+        image_url: str = None,
+        static_prompts: Sequence[str] = (),
+        site: str = None
+    ) -> str:
         """
         Анализирует текст через LLM, опционально с изображением.
         
+        Системный промпт и static_prompts образуют стабильный префикс запроса,
+        который провайдер может кэшировать между вызовами; их копии в prompt
+        вырезаются, чтобы не платить за них дважды.
+        
         Args:
             prompt: Текст для анализа
             system_prompt: Системный промпт
             max_tokens: Максимальное количество токенов
             user_info: Информация о пользователе
             image_url: URL изображения для анализа (опционально)
+            static_prompts: Статичные дополнения системного промпта (например, промпт этапа пути)
+            site: Место вызова для отчёта об экономии токенов (по умолчанию — тег вызывающего)
             
         Returns:
             str: Результат анализа
         """
         try:
+            assembled = assemble_prompt(
+                site or current_llm_caller(),
+                [system_prompt or PSYCHOLOGICAL_ANALYSIS_PROMPT, *static_prompts],
+                prompt,
+                self.model
+            )
             # Формируем промпт для анализа
-            analysis_prompt = get_analysis_prompt(prompt)
+            analysis_prompt = get_analysis_prompt(assembled.content)
             
-            # Если есть изображение, используем vision API
-            if image_url:
-                result = await self._analyze_with_vision(
-                    text=analysis_prompt,
-                    image_url=image_url,
-                    system_prompt=system_prompt or PSYCHOLOGICAL_ANALYSIS_PROMPT,
-                    max_tokens=max_tokens
-                )
-            else:
-                # Отправляем запрос к LLM без изображения
-                result = await self.llm.analyze_content(
-                    content=analysis_prompt,
-                    system_prompt=system_prompt or PSYCHOLOGICAL_ANALYSIS_PROMPT,
-                    max_tokens=max_tokens
-                )
+            with llm_caller(site) if site else nullcontext():
+                # Если есть изображение, используем vision API
+                if image_url:
+                    result = await self._analyze_with_vision(
+                        text=analysis_prompt,
+                        image_url=image_url,
+                        system_prompt=assembled.system_prompt,
+                        max_tokens=max_tokens
+                    )
+                else:
+                    # Отправляем запрос к LLM без изображения
+                    result = await self.llm.analyze_content(
+                        content=analysis_prompt,
+                        system_prompt=assembled.system_prompt,
+                        max_tokens=max_tokens
+                    )
             
             if not result:
                 return ''
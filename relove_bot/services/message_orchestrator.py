@@ -3,8 +3,9 @@ Message Orchestrator - координирует все сообщения бот
 Управляет потоком диалога, определяет этап пути и форматирует с UI.
 """
 import logging
+import random
 from dataclasses import dataclass
-from typing import Optional, Dict, Any
+from typing import Callable, Optional, Dict, Any
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -13,6 +14,13 @@ from relove_bot.services.journey_service import JourneyTrackingService
 from relove_bot.services.session_service import SessionService
 from relove_bot.services.ui_manager import UIManager
 from relove_bot.services.llm_service import llm_service
+from relove_bot.services.natasha_patterns import (
+    TRIGGER_PHRASES,
+    TechniqueType,
+    UserState,
+    get_support_phrase,
+    get_trigger_phrase,
+)
 from relove_bot.services.prompts import NATASHA_PROVOCATIVE_PROMPT
 from relove_bot.core.journey_behaviors import get_provocation_prompt
 
@@ -232,6 +240,36 @@ class MessageOrchestrator:
             logger.error(f"Error getting session context: {e}", exc_info=True)
             return None
     
+    async def _ask_llm(
+        self,
+        prompt: str,
+        max_tokens: int,
+        fallback: Callable[[], str],
+        site: str,
+        stage_prompt: str = ""
+    ) -> str:
+        """
+        Запрос к LLM в стиле Наташи.
+        
+        Персона и промпт этапа уходят статичным префиксом в системный промпт,
+        в prompt — только меняющаяся часть. Пока LLM недоступна (circuit
+        breaker разомкнут) или ответ пустой, сразу возвращает фразу из
+        natasha_patterns вместо ожидания таймаута.
+        """
+        if llm_service.is_available():
+            response = await llm_service.analyze_text(
+                prompt=prompt,
+                system_prompt=NATASHA_PROVOCATIVE_PROMPT,
+                max_tokens=max_tokens,
+                static_prompts=[stage_prompt],
+                site=site
+            )
+            if response:
+                return response
+        else:
+            logger.info("LLM unavailable, using natasha_patterns fallback")
+        return fallback() or "..."
+    
     async def _generate_stage_aware_response(
         self,
         user_message: str,
@@ -250,12 +288,8 @@ class MessageOrchestrator:
             if context.current_stage:
                 stage_prompt = get_provocation_prompt(context.current_stage)
             
-            # Формируем полный промпт
+            # Персона и этап — в системном префиксе, здесь только диалог
             full_prompt = f"""
-{NATASHA_PROVOCATIVE_PROMPT}
-
-{stage_prompt}
-
 ИСТОРИЯ ДИАЛОГА:
 {conversation_text}
 
@@ -267,14 +301,14 @@ class MessageOrchestrator:
 """
             
             # Генерируем ответ через LLM
-            response = await llm_service.analyze_text(
-                prompt=full_prompt,
-                system_prompt=NATASHA_PROVOCATIVE_PROMPT,
-                max_tokens=200
+            return await self._ask_llm(
+                full_prompt,
+                max_tokens=200,
+                fallback=lambda: get_trigger_phrase(random.choice(list(TRIGGER_PHRASES))),
+                site="orchestrator.reply",
+                stage_prompt=stage_prompt
             )
             
-            return response
-            
         except Exception as e:
             logger.error(f"Error generating stage-aware response: {e}", exc_info=True)
             return "..."
@@ -292,13 +326,12 @@ class MessageOrchestrator:
 Максимум 1-2 предложения.
 """
         
-        response = await llm_service.analyze_text(
-            prompt=prompt,
-            system_prompt=NATASHA_PROVOCATIVE_PROMPT,
-            max_tokens=100
+        return await self._ask_llm(
+            prompt,
+            max_tokens=100,
+            fallback=lambda: get_trigger_phrase(TechniqueType.OMNISCIENCE),
+            site="orchestrator.inactivity"
         )
-        
-        return response
     
     async def _generate_milestone_message(self, context: SessionContext) -> str:
         """Генерирует поздравление с завершением этапа"""
@@ -313,13 +346,12 @@ class MessageOrchestrator:
 Максимум 2-3 предложения.
 """
         
-        response = await llm_service.analyze_text(
-            prompt=prompt,
-            system_prompt=NATASHA_PROVOCATIVE_PROMPT,
-            max_tokens=150
+        return await self._ask_llm(
+            prompt,
+            max_tokens=150,
+            fallback=lambda: get_support_phrase(UserState.READY),
+            site="orchestrator.milestone"
         )
-        
-        return response
     
     async def _generate_pattern_intervention(self, context: SessionContext) -> str:
         """Генерирует вмешательство при обнаружении паттерна"""
@@ -332,13 +364,12 @@ class MessageOrchestrator:
 Максимум 1-2 предложения.
 """
         
-        response = await llm_service.analyze_text(
-            prompt=prompt,
-            system_prompt=NATASHA_PROVOCATIVE_PROMPT,
-            max_tokens=100
+        return await self._ask_llm(
+            prompt,
+            max_tokens=100,
+            fallback=lambda: get_trigger_phrase(TechniqueType.WAR_EXPOSURE),
+            site="orchestrator.pattern"
         )
-        
-        return response
     
     async def _generate_morning_check(self, context: SessionContext) -> str:
         """Генерирует утреннее сообщение"""
@@ -349,10 +380,9 @@ class MessageOrchestrator:
 Максимум 1-2 предложения.
 """
         
-        response = await llm_service.analyze_text(
-            prompt=prompt,
-            system_prompt=NATASHA_PROVOCATIVE_PROMPT,
-            max_tokens=100
+        return await self._ask_llm(
+            prompt,
+            max_tokens=100,
+            fallback=lambda: get_trigger_phrase(TechniqueType.TIME_PRESSURE),
+            site="orchestrator.morning"
         )
-        
-        return response
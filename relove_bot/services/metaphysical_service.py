@@ -11,6 +11,8 @@ import logging
 from typing import Dict, List, Optional
 from enum import Enum
 
+from pydantic import BaseModel, Field, field_validator
+
 from relove_bot.services.llm_service import llm_service
 from relove_bot.services.prompts import NATASHA_PROVOCATIVE_PROMPT
 
@@ -35,6 +37,64 @@ class KarmicPattern(str, Enum):
     TRANSFORMER = "transformer"  # Трансформатор
 
 
+_PLANETARY_ALIASES = {
+    "световая": PlanetaryType.LIGHT,
+    "теневая": PlanetaryType.DARK,
+    "балансная": PlanetaryType.BALANCED,
+    "разрушенная": PlanetaryType.DESTROYED,
+}
+
+_PATTERN_ALIASES = {
+    "жертва": KarmicPattern.VICTIM,
+    "спаситель": KarmicPattern.RESCUER,
+    "преследователь": KarmicPattern.PERSECUTOR,
+    "наблюдатель": KarmicPattern.OBSERVER,
+    "трансформатор": KarmicPattern.TRANSFORMER,
+}
+
+
+class MetaphysicalProfile(BaseModel):
+    """Метафизический профиль из ответа LLM; неопределённые поля остаются пустыми."""
+    planetary_type: PlanetaryType = Field(PlanetaryType.UNKNOWN, description="Тип планетарной истории")
+    planetary_description: str = Field("", description="Что произошло с планетой и связь с текущей жизнью")
+    karmic_pattern: Optional[KarmicPattern] = Field(None, description="Основной кармический паттерн (null — не определён)")
+    pattern_manifestations: str = Field("", description="Как паттерн проявляется сейчас")
+    balance: str = Field("", description="Баланс света/тьмы: к чему тянет и что нужно для баланса")
+    core_trauma: str = Field("", description="Корень: изначальная травма или обида")
+    metaphor: str = Field("", description="Метафора, если подходит")
+    transformation_path: str = Field("", description="Путь трансформации")
+
+    @field_validator('planetary_type', mode='before')
+    @classmethod
+    def _planetary_type(cls, value):
+        value = str(value or "").strip().lower()
+        if value in PlanetaryType._value2member_map_:
+            return value
+        return _PLANETARY_ALIASES.get(value, PlanetaryType.UNKNOWN)
+
+    @field_validator('karmic_pattern', mode='before')
+    @classmethod
+    def _karmic_pattern(cls, value):
+        value = str(value or "").strip().lower()
+        if value in KarmicPattern._value2member_map_:
+            return value
+        return _PATTERN_ALIASES.get(value)
+
+    @field_validator(
+        'planetary_description', 'pattern_manifestations', 'balance', 'core_trauma', 'metaphor',
+        'transformation_path', mode='before'
+    )
+    @classmethod
+    def _text(cls, value):
+        return "" if value is None else value
+
+    def to_dict(self) -> Dict[str, str]:
+        """Профиль в виде словаря, который ожидают обработчики"""
+        data = self.model_dump(mode='json')
+        data["karmic_pattern"] = data["karmic_pattern"] or "unknown"
+        return data
+
+
 class MetaphysicalService:
     """
     Сервис для работы с метафизическими концептами.
@@ -66,14 +126,8 @@ class MetaphysicalService:
 {messages}
 
 Ответь кратко, только то, что ДЕЙСТВИТЕЛЬНО видишь в сообщениях.
-Не придумывай, если недостаточно данных.
-
-Формат (включай только те пункты, которые можешь определить):
-ПЛАНЕТА: [если видишь]
-ПАТТЕРН: [если видишь]
-БАЛАНС: [если видишь]
-КОРЕНЬ: [если видишь]
-МЕТАФОРА: [если подходит]
+Не придумывай, если недостаточно данных: оставляй такие поля пустыми,
+тип планеты — "unknown", паттерн — null.
 """
     
     async def analyze_metaphysical_profile(
@@ -101,58 +155,18 @@ class MetaphysicalService:
         prompt = self.METAPHYSICAL_ANALYSIS_PROMPT.format(messages=messages_text)
         
         try:
-            response = await llm_service.analyze_text(
+            profile = await llm_service.generate_structured(
+                MetaphysicalProfile,
                 prompt=prompt,
                 system_prompt=NATASHA_PROVOCATIVE_PROMPT,
                 max_tokens=500
             )
-            
-            # Парсим ответ
-            profile = self._parse_metaphysical_response(response)
-            
-            return profile
+            return profile.to_dict()
             
         except Exception as e:
             logger.error(f"Ошибка при анализе метафизического профиля: {e}")
             return {}
     
-    def _parse_metaphysical_response(self, response: str) -> Dict[str, str]:
-        """Парсит ответ LLM о метафизическом профиле."""
-        profile = {
-            "planetary_type": "unknown",
-            "planetary_description": "",
-            "karmic_pattern": "unknown",
-            "pattern_manifestations": "",
-            "balance": "",
-            "metaphor": "",
-            "transformation_path": "",
-            "core_trauma": ""
-        }
-        
-        lines = response.split('\n')
-        for line in lines:
-            line = line.strip()
-            if line.startswith("ПЛАНЕТА:"):
-                parts = line.replace("ПЛАНЕТА:", "").strip().split(" - ", 1)
-                if len(parts) >= 2:
-                    profile["planetary_type"] = parts[0].strip().lower()
-                    profile["planetary_description"] = parts[1].strip()
-            elif line.startswith("ПАТТЕРН:"):
-                parts = line.replace("ПАТТЕРН:", "").strip().split(" - ", 1)
-                if len(parts) >= 2:
-                    profile["karmic_pattern"] = parts[0].strip().lower()
-                    profile["pattern_manifestations"] = parts[1].strip()
-            elif line.startswith("БАЛАНС:"):
-                profile["balance"] = line.replace("БАЛАНС:", "").strip()
-            elif line.startswith("МЕТАФОРА:"):
-                profile["metaphor"] = line.replace("МЕТАФОРА:", "").strip()
-            elif line.startswith("ПУТЬ:"):
-                profile["transformation_path"] = line.replace("ПУТЬ:", "").strip()
-            elif line.startswith("КОРЕНЬ:"):
-                profile["core_trauma"] = line.replace("КОРЕНЬ:", "").strip()
-        
-        return profile
-    
     async def generate_provocative_question(
         self,
         metaphysical_profile: Dict[str, str],
@@ -173,8 +187,6 @@ class MetaphysicalService:
         
         # Формируем промпт для генерации вопроса
         prompt = f"""
-{NATASHA_PROVOCATIVE_PROMPT}
-
 МЕТАФИЗИЧЕСКИЙ ПРОФИЛЬ:
 - Планета: {metaphysical_profile.get('planetary_type', 'unknown')}
 - Описание планеты: {metaphysical_profile.get('planetary_description', '')}
@@ -232,8 +244,6 @@ class MetaphysicalService:
         ])
         
         prompt = f"""
-{NATASHA_PROVOCATIVE_PROMPT}
-
 МЕТАФИЗИЧЕСКИЙ ПРОФИЛЬ:
 {metaphysical_profile}
 
@@ -294,8 +304,6 @@ class MetaphysicalService:
             str: Инструкция для трансформации
         """
         prompt = f"""
-{NATASHA_PROVOCATIVE_PROMPT}
-
 КОРНЕВАЯ ТРАВМА:
 {core_trauma}
 
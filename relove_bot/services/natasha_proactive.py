@@ -47,12 +47,8 @@ class NatashaProactiveService:
                 for msg in conversation_history[-10:]
             ])
             
-            # Полный промпт
+            # Персона и этап — в системном префиксе, здесь только диалог
             full_prompt = f"""
-{NATASHA_PROVOCATIVE_PROMPT}
-
-{stage_prompt}
-
 ИСТОРИЯ ДИАЛОГА:
 {conversation_text}
 
@@ -66,7 +62,9 @@ class NatashaProactiveService:
             response = await llm_service.analyze_text(
                 prompt=full_prompt,
                 system_prompt=NATASHA_PROVOCATIVE_PROMPT,
-                max_tokens=200
+                max_tokens=200,
+                static_prompts=[stage_prompt],
+                site="proactive.stage_reply"
             )
             
             return response
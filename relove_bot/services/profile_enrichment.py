@@ -3,14 +3,57 @@
 Определяет hero_stage, metaphysics, streams на основе profile.
 """
 import logging
-import json
-from typing import Optional, Dict, Any, List
+from typing import Any, Dict, Hashable, List, Mapping, Optional
+
+from pydantic import BaseModel, Field
+
 from relove_bot.db.models import JourneyStageEnum
 from relove_bot.services.llm_service import llm_service
+from relove_bot.utils.structured_output import StructuredOutputError
 
 logger = logging.getLogger(__name__)
 
 
+JOURNEY_STAGES_TEXT = """ЭТАПЫ ПУТИ ГЕРОЯ:
+1. Обычный мир - привычная реальность, рутина, дискомфорт
+2. Зов к приключению - первые проблески осознанности, интерес к изменениям
+3. Отказ от призыва - сопротивление, страхи, сомнения
+4. Встреча с наставником - готовность получить поддержку
+5. Пересечение порога - начало реальных действий
+6. Испытания, союзники, враги - преодоление препятствий
+7. Приближение к сокровенной пещере - подготовка к главному
+8. Испытание - преодоление главного препятствия
+9. Награда - получение результатов
+10. Дорога назад - интеграция изменений
+11. Воскресение - финальная трансформация
+12. Возвращение с эликсиром - делимся опытом"""
+
+# Ключевые слова ответа -> этап (порядок важен: "испытания" раньше "испытание")
+_STAGE_MAPPING = {
+    "обычный мир": JourneyStageEnum.ORDINARY_WORLD,
+    "зов к приключению": JourneyStageEnum.CALL_TO_ADVENTURE,
+    "отказ от призыва": JourneyStageEnum.REFUSAL,
+    "встреча с наставником": JourneyStageEnum.MEETING_MENTOR,
+    "пересечение порога": JourneyStageEnum.CROSSING_THRESHOLD,
+    "испытания": JourneyStageEnum.TESTS_ALLIES_ENEMIES,
+    "приближение": JourneyStageEnum.APPROACH,
+    "испытание": JourneyStageEnum.ORDEAL,
+    "награда": JourneyStageEnum.REWARD,
+    "дорога назад": JourneyStageEnum.ROAD_BACK,
+    "воскресение": JourneyStageEnum.RESURRECTION,
+    "возвращение": JourneyStageEnum.RETURN_WITH_ELIXIR,
+}
+
+
+def _parse_journey_stage(response: Any) -> Optional[JourneyStageEnum]:
+    """Этап пути героя по ответу модели"""
+    response = str(response or "").strip().lower()
+    for key, stage in _STAGE_MAPPING.items():
+        if key in response:
+            return stage
+    return None
+
+
 async def determine_journey_stage(profile: str) -> Optional[JourneyStageEnum]:
     """
     Определяет этап пути героя на основе профиля.
@@ -29,19 +72,7 @@ async def determine_journey_stage(profile: str) -> Optional[JourneyStageEnum]:
 ПРОФИЛЬ:
 {profile[:2000]}  # Ограничиваем для экономии токенов
 
-ЭТАПЫ ПУТИ ГЕРОЯ:
-1. Обычный мир - привычная реальность, рутина, дискомфорт
-2. Зов к приключению - первые проблески осознанности, интерес к изменениям
-3. Отказ от призыва - сопротивление, страхи, сомнения
-4. Встреча с наставником - готовность получить поддержку
-5. Пересечение порога - начало реальных действий
-6. Испытания, союзники, враги - преодоление препятствий
-7. Приближение к сокровенной пещере - подготовка к главному
-8. Испытание - преодоление главного препятствия
-9. Награда - получение результатов
-10. Дорога назад - интеграция изменений
-11. Воскресение - финальная трансформация
-12. Возвращение с эликсиром - делимся опытом
+{JOURNEY_STAGES_TEXT}
 
 Проанализируй профиль и определи текущий этап.
 Ответь ТОЛЬКО названием этапа из списка выше (например: "Зов к приключению")."""
@@ -52,28 +83,10 @@ async def determine_journey_stage(profile: str) -> Optional[JourneyStageEnum]:
         if not response:
             return None
         
-        response = response.strip().lower()
-        
-        # Парсинг ответа
-        stage_mapping = {
-            "обычный мир": JourneyStageEnum.ORDINARY_WORLD,
-            "зов к приключению": JourneyStageEnum.CALL_TO_ADVENTURE,
-            "отказ от призыва": JourneyStageEnum.REFUSAL,
-            "встреча с наставником": JourneyStageEnum.MEETING_MENTOR,
-            "пересечение порога": JourneyStageEnum.CROSSING_THRESHOLD,
-            "испытания": JourneyStageEnum.TESTS_ALLIES_ENEMIES,
-            "приближение": JourneyStageEnum.APPROACH,
-            "испытание": JourneyStageEnum.ORDEAL,
-            "награда": JourneyStageEnum.REWARD,
-            "дорога назад": JourneyStageEnum.ROAD_BACK,
-            "воскресение": JourneyStageEnum.RESURRECTION,
-            "возвращение": JourneyStageEnum.RETURN_WITH_ELIXIR,
-        }
-        
-        for key, stage in stage_mapping.items():
-            if key in response:
-                logger.info(f"Determined journey stage: {stage.value}")
-                return stage
+        stage = _parse_journey_stage(response)
+        if stage:
+            logger.info(f"Determined journey stage: {stage.value}")
+            return stage
         
         logger.warning(f"Could not parse stage from response: {response}")
         return None
@@ -83,6 +96,45 @@ async def determine_journey_stage(profile: str) -> Optional[JourneyStageEnum]:
         return None
 
 
+async def determine_journey_stages_batch(profiles: Mapping[Hashable, str]) -> Dict[Hashable, Optional[JourneyStageEnum]]:
+    """
+    Определяет этапы пути героя для многих профилей пакетными запросами.
+    
+    Args:
+        profiles: Ключ (например, id пользователя) -> психологический профиль
+        
+    Returns:
+        Ключ -> JourneyStageEnum или None
+    """
+    result: Dict[Hashable, Optional[JourneyStageEnum]] = {key: None for key in profiles}
+    items = {key: profile for key, profile in profiles.items() if profile and len(profile) >= 50}
+    if not items:
+        return result
+    
+    stages = await llm_service.classify_batch(
+        name="journey_stage",
+        instruction=(
+            "Определи этап пути героя по Кэмпбеллу для каждого профиля.\n\n"
+            f"{JOURNEY_STAGES_TEXT}\n\n"
+            'Метка каждой записи — название этапа из списка выше (например: "Зов к приключению").'
+        ),
+        items=items,
+        parse_label=_parse_journey_stage,
+        item_max_tokens=600,
+        label_tokens=20,
+    )
+    result.update(stages)
+    logger.info(f"Determined journey stages for {sum(1 for stage in stages.values() if stage)}/{len(items)} profiles")
+    return result
+
+
+class MetaphysicalSketch(BaseModel):
+    """Метафизический профиль, выведенный из психологического"""
+    planet: str = Field(..., min_length=1, description="Планета-покровитель")
+    karma: str = Field(..., min_length=1, description="Кармические уроки (1-2 предложения)")
+    light_dark_balance: float = Field(..., ge=-10, le=10, description="Баланс свет/тьма от -10 до +10")
+
+
 async def create_metaphysical_profile(profile: str) -> Optional[Dict[str, Any]]:
     """
     Создаёт метафизический профиль на основе психологического.
@@ -121,46 +173,45 @@ async def create_metaphysical_profile(profile: str) -> Optional[Dict[str, Any]]:
    - +1 до +4: световая сторона, рост
    - +5 до +10: яркий свет, трансляция любви
 
-Ответь в формате JSON:
-{{
-    "planet": "название планеты",
-    "karma": "описание кармических уроков (1-2 предложения)",
-    "light_dark_balance": число от -10 до +10
-}}"""
+Заполни поля planet, karma и light_dark_balance."""
 
     try:
-        response = await llm_service.analyze_text(prompt, max_tokens=200)
-        
-        if not response:
-            return None
+        result = await llm_service.generate_structured(MetaphysicalSketch, prompt, max_tokens=200)
+        logger.info(f"Created metaphysical profile: {result.planet}, balance={result.light_dark_balance}")
+        return result.model_dump()
         
-        # Пытаемся распарсить JSON
-        try:
-            # Ищем JSON в ответе
-            start = response.find('{')
-            end = response.rfind('}') + 1
-            if start >= 0 and end > start:
-                json_str = response[start:end]
-                result = json.loads(json_str)
-                
-                # Валидация
-                if 'planet' in result and 'karma' in result and 'light_dark_balance' in result:
-                    # Проверяем баланс
-                    balance = result['light_dark_balance']
-                    if isinstance(balance, (int, float)) and -10 <= balance <= 10:
-                        logger.info(f"Created metaphysical profile: {result['planet']}, balance={balance}")
-                        return result
-        except json.JSONDecodeError:
-            pass
-        
-        logger.warning(f"Could not parse metaphysical profile from response: {response}")
+    except StructuredOutputError as e:
+        logger.warning(f"Could not parse metaphysical profile: {e}")
         return None
-        
     except Exception as e:
         logger.error(f"Error creating metaphysical profile: {e}")
         return None
 
 
+STREAMS_TEXT = """ПОТОКИ RELOVE:
+1. Путь Героя - трансформация через прохождение внутреннего пути
+2. Прошлые Жизни - работа с планетарными историями и кармой
+3. Открытие Сердца - работа с любовью и принятием
+4. Трансформация Тени - интеграция теневых частей личности
+5. Пробуждение - выход из матрицы обыденности"""
+
+AVAILABLE_STREAMS = [
+    "Путь Героя",
+    "Прошлые Жизни",
+    "Открытие Сердца",
+    "Трансформация Тени",
+    "Пробуждение"
+]
+
+
+def _parse_streams(response: Any) -> List[str]:
+    """Потоки reLove, упомянутые в ответе модели (строка через запятую или список)"""
+    if isinstance(response, list):
+        response = ", ".join(map(str, response))
+    response = str(response or "").lower()
+    return [stream for stream in AVAILABLE_STREAMS if stream.lower() in response]
+
+
 async def determine_streams(profile: str) -> List[str]:
     """
     Определяет пройденные потоки reLove на основе профиля.
@@ -179,12 +230,7 @@ async def determine_streams(profile: str) -> List[str]:
 ПРОФИЛЬ:
 {profile[:2000]}
 
-ПОТОКИ RELOVE:
-1. Путь Героя - трансформация через прохождение внутреннего пути
-2. Прошлые Жизни - работа с планетарными историями и кармой
-3. Открытие Сердца - работа с любовью и принятием
-4. Трансформация Тени - интеграция теневых частей личности
-5. Пробуждение - выход из матрицы обыденности
+{STREAMS_TEXT}
 
 Проанализируй профиль и определи 1-3 подходящих потока.
 Ответь ТОЛЬКО названиями потоков через запятую (например: "Путь Героя, Трансформация Тени")."""
@@ -195,23 +241,43 @@ async def determine_streams(profile: str) -> List[str]:
         if not response:
             return []
         
-        # Парсим ответ
-        available_streams = [
-            "Путь Героя",
-            "Прошлые Жизни",
-            "Открытие Сердца",
-            "Трансформация Тени",
-            "Пробуждение"
-        ]
-        
-        found_streams = []
-        for stream in available_streams:
-            if stream.lower() in response.lower():
-                found_streams.append(stream)
-        
+        found_streams = _parse_streams(response)
         logger.info(f"Determined streams: {found_streams}")
         return found_streams
         
     except Exception as e:
         logger.error(f"Error determining streams: {e}")
         return []
+
+
+async def determine_streams_batch(profiles: Mapping[Hashable, str]) -> Dict[Hashable, List[str]]:
+    """
+    Определяет потоки reLove для многих профилей пакетными запросами.
+    
+    Args:
+        profiles: Ключ (например, id пользователя) -> психологический профиль
+        
+    Returns:
+        Ключ -> список названий потоков
+    """
+    result: Dict[Hashable, List[str]] = {key: [] for key in profiles}
+    items = {key: profile for key, profile in profiles.items() if profile and len(profile) >= 50}
+    if not items:
+        return result
+    
+    streams = await llm_service.classify_batch(
+        name="streams",
+        instruction=(
+            "Определи 1-3 потока reLove, которые подходят каждому человеку по его профилю.\n\n"
+            f"{STREAMS_TEXT}\n\n"
+            'Метка каждой записи — названия потоков через запятую (например: "Путь Героя, Трансформация Тени").'
+        ),
+        items=items,
+        parse_label=lambda label: _parse_streams(label) or None,
+        item_max_tokens=600,
+        label_tokens=24,
+    )
+    for key, found in streams.items():
+        result[key] = found or []
+    logger.info(f"Determined streams for {sum(1 for found in streams.values() if found)}/{len(items)} profiles")
+    return result
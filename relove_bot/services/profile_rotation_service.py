@@ -12,7 +12,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from relove_bot.db.models import User, UserActivityLog
 from relove_bot.services.llm_service import llm_service
+from relove_bot.services.profile_rotation_service_v2 import ProfileUpdate
 from relove_bot.services.telegram_service import telegram_service
+from relove_bot.utils.structured_output import StructuredOutputError
 
 logger = logging.getLogger(__name__)
 
@@ -145,19 +147,20 @@ class ProfileRotationService:
             # Формируем промпт для LLM
             prompt = self.build_update_prompt(user, logs, posts)
             
-            # Получаем обновлённый анализ от LLM
-            analysis = await llm_service.analyze_text(
-                prompt,
-                max_tokens=800
-            )
-            
-            if not analysis:
-                logger.warning(f"Empty analysis for user {user.id}")
+            # Получаем обновлённый профиль от LLM, проверенный по схеме
+            try:
+                update = await llm_service.generate_structured(
+                    ProfileUpdate,
+                    prompt,
+                    max_tokens=800
+                )
+            except StructuredOutputError as e:
+                logger.warning(f"Invalid analysis for user {user.id}: {e}")
                 self.stats['skipped'] += 1
                 return
             
-            # Парсим и сохраняем обновлённый профиль
-            await self.save_updated_profile(user, analysis)
+            # Сохраняем обновлённый профиль
+            await self.save_updated_profile(user, update)
             
             self.stats['updated'] += 1
             logger.info(f"Successfully updated profile for user {user.id}")
@@ -234,11 +237,6 @@ class ProfileRotationService:
 - Открытие Сердца (работа с любовью)
 - Трансформация Тени (интеграция тьмы)
 - Пробуждение (выход из матрицы)
-
-Ответь в формате:
-SUMMARY: [обновлённое краткое описание психологического состояния, 2-3 предложения]
-STREAMS: [список потоков через запятую]
-CHANGES: [что изменилось с последнего обновления]
 """
         
         return prompt
@@ -262,23 +260,10 @@ CHANGES: [что изменилось с последнего обновлени
         
         return "\n".join(lines)
     
-    async def save_updated_profile(self, user: User, analysis: str):
-        """Парсит анализ и сохраняет обновлённый профиль"""
+    async def save_updated_profile(self, user: User, update: ProfileUpdate):
+        """Сохраняет обновлённый профиль"""
         try:
-            # Парсим ответ LLM
-            summary = ""
-            streams = []
-            changes = ""
-            
-            for line in analysis.split('\n'):
-                line = line.strip()
-                if line.startswith("SUMMARY:"):
-                    summary = line.replace("SUMMARY:", "").strip()
-                elif line.startswith("STREAMS:"):
-                    streams_str = line.replace("STREAMS:", "").strip()
-                    streams = [s.strip() for s in streams_str.split(',') if s.strip()]
-                elif line.startswith("CHANGES:"):
-                    changes = line.replace("CHANGES:", "").strip()
+            summary, streams, changes = update.summary, update.streams, update.changes
             
             # Обновляем пользователя
             if summary:
@@ -3,16 +3,19 @@
 Версия 2.0 с fallback стратегиями и улучшенной надёжностью.
 """
 import asyncio
-import json
 import logging
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 from dataclasses import dataclass, asdict
 
+from pydantic import BaseModel, Field, field_validator
+
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from relove_bot.db.models import User, UserActivityLog
 from relove_bot.services.llm_service import llm_service
+from relove_bot.utils.llm_telemetry import llm_usage_scope
+from relove_bot.utils.structured_output import StructuredOutputError
 from relove_bot.services.telegram_service import telegram_service
 from relove_bot.repositories.user_profile_repository import UserProfileRepository
 
@@ -32,6 +35,27 @@ class ProfileUpdateResult:
     processing_time: float = 0.0
 
 
+class ProfileUpdate(BaseModel):
+    """Обновлённый профиль из ответа LLM"""
+    summary: str = Field("", description="Краткое описание психологического состояния (2-3 предложения)")
+    streams: List[str] = Field(default_factory=list, description="Подходящие потоки reLove из списка доступных")
+    changes: str = Field("", description="Что изменилось с последнего обновления")
+
+    @field_validator('streams', mode='before')
+    @classmethod
+    def _split_streams(cls, value):
+        if value is None:
+            return []
+        if isinstance(value, str):
+            return [part.strip() for part in value.split(',') if part.strip()]
+        return value
+
+    @field_validator('summary', 'changes', mode='before')
+    @classmethod
+    def _text(cls, value):
+        return "" if value is None else value
+
+
 class ProfileRotationServiceV2:
     """Улучшенный сервис для ротации профилей"""
     
@@ -160,7 +184,8 @@ class ProfileRotationServiceV2:
         # Проверяем наличие логов активности
         has_activity = await self._has_recent_activity(user.id)
         
-        if has_activity and self.use_llm:
+        # Пока LLM недоступна (circuit breaker разомкнут), сразу берём базовый профиль
+        if has_activity and self.use_llm and llm_service.is_available():
             return 'llm'
         elif self.fallback_to_basic:
             return 'basic'
@@ -182,6 +207,10 @@ class ProfileRotationServiceV2:
     
     async def _update_with_llm(self, user: User) -> ProfileUpdateResult:
         """Обновление профиля через LLM анализ"""
+        if self.fallback_to_basic and not llm_service.is_available():
+            logger.info(f"LLM unavailable, using basic profile for user {user.id}")
+            return await self._update_with_basic(user)
+        
         try:
             # Получаем данные для анализа
             logs = await self._get_recent_logs(user.id, limit=50)
@@ -203,32 +232,23 @@ class ProfileRotationServiceV2:
             # Формируем промпт
             prompt = self._build_llm_prompt(user, logs, posts)
             
-            # Вызываем LLM с таймаутом
+            # Вызываем LLM с таймаутом; ответ сразу проверяется по схеме ProfileUpdate
             try:
-                analysis = await asyncio.wait_for(
-                    llm_service.analyze_text(prompt, max_tokens=800),
-                    timeout=self.llm_timeout
-                )
+                with llm_usage_scope() as usage:
+                    parsed = await asyncio.wait_for(
+                        llm_service.generate_structured(ProfileUpdate, prompt, max_tokens=800),
+                        timeout=self.llm_timeout
+                    )
             except asyncio.TimeoutError:
                 logger.warning(f"LLM timeout for user {user.id}")
                 if self.fallback_to_basic:
                     return await self._update_with_basic(user)
                 raise
+            except StructuredOutputError as e:
+                logger.warning(f"Invalid LLM response for user {user.id}: {e}")
+                parsed = ProfileUpdate()
             
-            if not analysis:
-                if self.fallback_to_basic:
-                    return await self._update_with_basic(user)
-                return ProfileUpdateResult(
-                    user_id=user.id,
-                    success=False,
-                    strategy_used='llm',
-                    error="Empty LLM response"
-                )
-            
-            # Парсим ответ
-            parsed = self._parse_llm_response(analysis)
-            
-            if not parsed.get('summary'):
+            if not parsed.summary:
                 if self.fallback_to_basic:
                     return await self._update_with_basic(user)
                 return ProfileUpdateResult(
@@ -241,11 +261,11 @@ class ProfileRotationServiceV2:
             # Сохраняем профиль
             await self._save_profile(
                 user,
-                summary=parsed['summary'],
-                streams=parsed.get('streams', []),
+                summary=parsed.summary,
+                streams=parsed.streams,
                 metadata={
                     'strategy': 'llm',
-                    'llm_changes': parsed.get('changes', '')
+                    'llm_changes': parsed.changes
                 }
             )
             
@@ -253,9 +273,9 @@ class ProfileRotationServiceV2:
                 user_id=user.id,
                 success=True,
                 strategy_used='llm',
-                summary=parsed['summary'],
-                streams=parsed.get('streams', []),
-                llm_tokens_used=len(analysis.split())  # Приблизительная оценка
+                summary=parsed.summary,
+                streams=parsed.streams,
+                llm_tokens_used=usage.total_tokens
             )
             
         except Exception as e:
@@ -361,13 +381,6 @@ class ProfileRotationServiceV2:
 ЗАДАЧА:
 Проанализируй данные и создай обновлённый профиль.
 
-Ответь СТРОГО в JSON формате:
-{{
-  "summary": "краткое описание психологического состояния (2-3 предложения)",
-  "streams": ["Поток 1", "Поток 2"],
-  "changes": "что изменилось с последнего обновления"
-}}
-
 ДОСТУПНЫЕ ПОТОКИ:
 - Путь Героя
 - Прошлые Жизни
@@ -394,37 +407,6 @@ class ProfileRotationServiceV2:
         
         return "\n".join(lines)
     
-    def _parse_llm_response(self, response: str) -> Dict[str, Any]:
-        """
-        Парсит ответ LLM с поддержкой JSON и текстового формата.
-        """
-        # Пытаемся распарсить как JSON
-        try:
-            # Ищем JSON в ответе
-            start = response.find('{')
-            end = response.rfind('}') + 1
-            if start != -1 and end > start:
-                json_str = response[start:end]
-                return json.loads(json_str)
-        except json.JSONDecodeError:
-            pass
-        
-        # Fallback: парсим текстовый формат
-        result = {}
-        lines = response.split('\n')
-        
-        for line in lines:
-            line = line.strip()
-            if line.startswith("SUMMARY:") or line.startswith('"summary"'):
-                result['summary'] = line.split(':', 1)[1].strip().strip('"')
-            elif line.startswith("STREAMS:") or line.startswith('"streams"'):
-                streams_str = line.split(':', 1)[1].strip().strip('[]"')
-                result['streams'] = [s.strip().strip('"') for s in streams_str.split(',') if s.strip()]
-            elif line.startswith("CHANGES:") or line.startswith('"changes"'):
-                result['changes'] = line.split(':', 1)[1].strip().strip('"')
-        
-        return result
-    
     async def _save_profile(
         self,
         user: User,
@@ -23,6 +23,7 @@ from io import BytesIO
 from pydantic import SecretStr
 from relove_bot.config import settings
 from relove_bot.utils.api_rate_limiter import APIRateLimiter
+from relove_bot.utils.prompt_budget import PromptBudget
 from relove_bot.db.models import GenderEnum
 from relove_bot.services.prompts import (
     PSYCHOLOGICAL_ANALYSIS_PROMPT,
@@ -276,9 +277,14 @@ async def get_full_psychological_summary(user_id: int, main_channel_id: Optional
         personal_posts = []
         photo_summaries = []
 
-    # Формируем текст для анализа
-    all_posts = main_posts + personal_posts
-    posts_text = "\n".join(all_posts)
+    # Формируем текст для анализа в пределах бюджета токенов:
+    # системный промпт и биография важнее, посты берутся по порядку, пока есть место
+    budget = PromptBudget(settings.prompt_budget_profile_tokens, model=settings.model_name, separator="", name=f"profile:{user_id}")
+    budget.add("system", PSYCHOLOGICAL_ANALYSIS_PROMPT, priority=0, required=True)
+    budget.add("bio", bio, priority=1)
+    budget.add("posts", main_posts + personal_posts, priority=2, keep='head')
+    packed = budget.pack()
+    llm_input = packed["bio"] + packed["posts"]
     
     # Собираем информацию о пользователе для передачи в LLM
     user_info = {}
@@ -291,7 +297,7 @@ async def get_full_psychological_summary(user_id: int, main_channel_id: Optional
             user_info['username'] = tg_user.username
     
     # Генерируем summary только на основе текста
-    summary = await openai_psychological_summary(text=(bio + "\n" + posts_text), image_url=None)
+    summary = await openai_psychological_summary(text=(packed["bio"] + "\n" + packed["posts"]), image_url=None)
     
     # Инициализируем переменные для фото (оставляем None, так как анализ фото отключен)
     last_photo_bytes = None
@@ -302,28 +308,6 @@ async def get_full_psychological_summary(user_id: int, main_channel_id: Optional
     
     # Возвращаем пустой список для streams, так как анализ фото отключен
     streams = []
-    # Собираем все посты и биографию
-    all_posts = main_posts + personal_posts
-    
-    # Ограничиваем общее количество символов (примерно 20K токенов для подстраховки)
-    max_chars = 80000  # Примерно 20K токенов с запасом
-    
-    # Обрезаем посты, если они слишком длинные
-    truncated_posts = []
-    total_chars = 0
-    
-    for post in all_posts:
-        if total_chars + len(post) > max_chars:
-            # Добавляем только часть поста, чтобы не превысить лимит
-            remaining_chars = max(0, max_chars - total_chars)
-            if remaining_chars > 100:  # Если осталось достаточно места для осмысленного фрагмента
-                truncated_posts.append(post[:remaining_chars] + '... [текст обрезан]')
-            break
-        truncated_posts.append(post)
-        total_chars += len(post)
-    
-    # Формируем финальный текст для LLM
-    llm_input = bio + '\n'.join(truncated_posts)
     
     logging.warning(f"LLM INPUT for user {user_id}: {llm_input[:500]}...")
     if img_b64 is not None:
@@ -8,6 +8,8 @@ from datetime import datetime, timedelta
 
 from relove_bot.db.session import async_session
 from relove_bot.services.profile_rotation_service import ProfileRotationService
+from relove_bot.utils.llm_scheduler import LLMPriority, llm_priority
+from relove_bot.utils.llm_telemetry import llm_caller
 
 logger = logging.getLogger(__name__)
 
@@ -21,9 +23,10 @@ async def profile_rotation_task():
         try:
             logger.info("Starting profile rotation task...")
             
-            async with async_session() as session:
-                service = ProfileRotationService(session)
-                await service.rotate_profiles()
+            with llm_priority(LLMPriority.BATCH), llm_caller("rotation"):
+                async with async_session() as session:
+                    service = ProfileRotationService(session)
+                    await service.rotate_profiles()
             
             logger.info("Profile rotation task completed")
             
@@ -102,16 +105,17 @@ async def check_proactive_triggers_task():
         try:
             logger.info("Starting proactive triggers check...")
             
-            async with async_session() as session:
-                from relove_bot.services.trigger_engine import TriggerEngine
+            with llm_priority(LLMPriority.PROACTIVE):
+                async with async_session() as session:
+                    from relove_bot.services.trigger_engine import TriggerEngine
                 
-                engine = TriggerEngine(session)
+                    engine = TriggerEngine(session)
                 
-                # Проверяем неактивность
-                await engine.check_inactivity_triggers()
+                    # Проверяем неактивность
+                    await engine.check_inactivity_triggers()
                 
-                # Проверяем завершённые этапы
-                await engine.check_milestone_triggers()
+                    # Проверяем завершённые этапы
+                    await engine.check_milestone_triggers()
             
             logger.info("Proactive triggers check completed")
             
@@ -132,65 +136,66 @@ async def send_proactive_messages_task(bot):
     """
     while True:
         try:
-            async with async_session() as session:
-                from relove_bot.services.trigger_engine import TriggerEngine
-                from relove_bot.services.message_orchestrator import MessageOrchestrator
-                from relove_bot.services.proactive_rate_limiter import ProactiveRateLimiter
+            with llm_priority(LLMPriority.PROACTIVE):
+                async with async_session() as session:
+                    from relove_bot.services.trigger_engine import TriggerEngine
+                    from relove_bot.services.message_orchestrator import MessageOrchestrator
+                    from relove_bot.services.proactive_rate_limiter import ProactiveRateLimiter
                 
-                engine = TriggerEngine(session)
-                orchestrator = MessageOrchestrator(session)
-                rate_limiter = ProactiveRateLimiter(session)
+                    engine = TriggerEngine(session)
+                    orchestrator = MessageOrchestrator(session)
+                    rate_limiter = ProactiveRateLimiter(session)
                 
-                # Получаем готовые триггеры
-                pending_triggers = await engine.get_pending_triggers()
+                    # Получаем готовые триггеры
+                    pending_triggers = await engine.get_pending_triggers()
                 
-                for trigger in pending_triggers:
-                    try:
-                        # Проверяем rate limit
-                        can_send = await rate_limiter.can_send_proactive(
-                            trigger.user_id,
-                            trigger.trigger_type.value
-                        )
-                        
-                        if not can_send:
-                            logger.info(f"Skipping trigger {trigger.id} due to rate limit")
-                            continue
+                    for trigger in pending_triggers:
+                        try:
+                            # Проверяем rate limit
+                            can_send = await rate_limiter.can_send_proactive(
+                                trigger.user_id,
+                                trigger.trigger_type.value
+                            )
                         
-                        # Генерируем сообщение
-                        response = await orchestrator.generate_proactive_message(
-                            trigger.user_id,
-                            trigger.trigger_type
-                        )
+                            if not can_send:
+                                logger.info(f"Skipping trigger {trigger.id} due to rate limit")
+                                continue
                         
-                        if response:
-                            # Отправляем сообщение
-                            await bot.send_message(
-                                chat_id=trigger.user_id,
-                                text=response.text,
-                                reply_markup=response.keyboard,
-                                parse_mode=response.parse_mode
+                            # Генерируем сообщение
+                            response = await orchestrator.generate_proactive_message(
+                                trigger.user_id,
+                                trigger.trigger_type
                             )
+                        
+                            if response:
+                                # Отправляем сообщение
+                                await bot.send_message(
+                                    chat_id=trigger.user_id,
+                                    text=response.text,
+                                    reply_markup=response.keyboard,
+                                    parse_mode=response.parse_mode
+                                )
                             
-                            # Отмечаем как выполненный
-                            await engine.mark_trigger_executed(
-                                trigger.id,
-                                message_sent=response.text
-                            )
+                                # Отмечаем как выполненный
+                                await engine.mark_trigger_executed(
+                                    trigger.id,
+                                    message_sent=response.text
+                                )
                             
-                            logger.info(f"Sent proactive message to user {trigger.user_id}")
-                        else:
-                            # Отмечаем с ошибкой
+                                logger.info(f"Sent proactive message to user {trigger.user_id}")
+                            else:
+                                # Отмечаем с ошибкой
+                                await engine.mark_trigger_executed(
+                                    trigger.id,
+                                    error="Failed to generate message"
+                                )
+                    
+                        except Exception as e:
+                            logger.error(f"Error sending proactive message for trigger {trigger.id}: {e}", exc_info=True)
                             await engine.mark_trigger_executed(
                                 trigger.id,
-                                error="Failed to generate message"
+                                error=str(e)
                             )
-                    
-                    except Exception as e:
-                        logger.error(f"Error sending proactive message for trigger {trigger.id}: {e}", exc_info=True)
-                        await engine.mark_trigger_executed(
-                            trigger.id,
-                            error=str(e)
-                        )
             
         except Exception as e:
             logger.error(f"Error in send proactive messages task: {e}", exc_info=True)
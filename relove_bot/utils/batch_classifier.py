@@ -0,0 +1,218 @@
+"""
+Пакетная классификация через LLM.
+
+Определение пола, потоков и этапа пути героя — это крошечные запросы с
+ответом в несколько токенов, и на тысячах пользователей время уходит на
+накладные расходы и лимиты, а не на генерацию. Классификатор упаковывает N
+элементов в один промпт с пронумерованными записями и просит ответить JSON-
+массивом вида [{"id": 1, "label": ...}]. Ответ разбирается и проверяется
+поэлементно: записи с неизвестным id, дублями или недопустимой меткой, а также
+пропущенные моделью, повторно ставятся в очередь по одной.
+"""
+import asyncio
+import json
+import logging
+import re
+from dataclasses import dataclass
+from typing import (
+    Any, Awaitable, Callable, Dict, Generic, Hashable, List, Mapping, Optional, Sequence, TypeVar,
+)
+
+from relove_bot.utils.prompt_budget import get_token_counter
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar('K', bound=Hashable)
+T = TypeVar('T')
+
+# (system_prompt, prompt, max_tokens) -> текст ответа модели
+CompleteFunc = Callable[[str, str, int], Awaitable[str]]
+
+BATCH_SYSTEM_PROMPT = (
+    "Ты классификатор. Тебе дают пронумерованные записи и задание. "
+    "Классифицируй каждую запись независимо от остальных. "
+    "Отвечай ТОЛЬКО JSON-массивом без пояснений и markdown."
+)
+
+_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+
+_stats = {"batches": 0, "single_requests": 0, "items": 0, "classified": 0, "requeued": 0, "failed": 0}
+
+
+def get_batch_classifier_stats() -> Dict[str, Any]:
+    """Сколько пакетов отправлено и сколько элементов пришлось переспросить"""
+    return dict(_stats)
+
+
+@dataclass
+class _Job(Generic[K]):
+    key: K
+    text: str
+    attempts: int = 0
+
+
+def parse_json_array(response: str) -> Optional[List[Any]]:
+    """
+    Достаёт JSON-массив из ответа модели.
+
+    Модели часто оборачивают ответ в ```json ... ``` или добавляют фразу до
+    и после, поэтому разбирается фрагмент от первой '[' до последней ']'.
+    Объект с единственным списком внутри ({"results": [...]}) тоже принимается.
+    """
+    if not response:
+        return None
+    text = _FENCE_RE.sub("", response.strip())
+    start, end = text.find("["), text.rfind("]")
+    candidates = [text[start:end + 1]] if 0 <= start < end else []
+    candidates.append(text)
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+        except (ValueError, TypeError):
+            continue
+        if isinstance(data, dict):
+            lists = [value for value in data.values() if isinstance(value, list)]
+            data = lists[0] if len(lists) == 1 else None
+        if isinstance(data, list):
+            return data
+    return None
+
+
+class BatchClassifier(Generic[K, T]):
+    """
+    Классификатор, отправляющий элементы пакетами.
+
+    Args:
+        name: Имя задачи для логов
+        instruction: Что определить для каждой записи и какие метки допустимы
+        parse_label: Проверяет метку из ответа и приводит её к типу результата;
+            None — метка недопустима, элемент будет переспрошен
+        complete: Функция запроса к LLM
+        batch_size: Сколько элементов в одном запросе
+        item_max_tokens: Лимит текста одного элемента в токенах
+        label_tokens: Сколько токенов ответа отводится на один элемент
+        max_attempts: Сколько раз элемент запрашивается до отказа
+        model: Модель (определяет токенизатор)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        instruction: str,
+        parse_label: Callable[[Any], Optional[T]],
+        complete: CompleteFunc,
+        batch_size: int = 20,
+        item_max_tokens: int = 300,
+        label_tokens: int = 16,
+        max_attempts: int = 2,
+        model: Optional[str] = None,
+    ):
+        self.name = name
+        self.instruction = instruction
+        self.parse_label = parse_label
+        self.complete = complete
+        self.batch_size = max(1, batch_size)
+        self.item_max_tokens = item_max_tokens
+        self.label_tokens = label_tokens
+        self.max_attempts = max(1, max_attempts)
+        self.counter = get_token_counter(model)
+
+    def _prepare(self, text: str) -> str:
+        text = " ".join((text or "").split())
+        return self.counter.truncate(text, self.item_max_tokens, 'head')
+
+    def build_prompt(self, jobs: Sequence[_Job]) -> str:
+        """Промпт с пронумерованными записями и форматом ответа"""
+        records = "\n".join(f"[{number}] {job.text}" for number, job in enumerate(jobs, start=1))
+        return (
+            f"{self.instruction}\n\n"
+            f"ЗАПИСИ ({len(jobs)}):\n{records}\n\n"
+            f'Ответь JSON-массивом из {len(jobs)} объектов вида {{"id": <номер записи>, "label": <метка>}} '
+            f"— по одному на каждую запись, в том же порядке."
+        )
+
+    def parse_response(self, response: str, jobs: Sequence[_Job]) -> Dict[int, T]:
+        """
+        Проверяет ответ поэлементно.
+
+        Returns:
+            Номер записи в пакете (с нуля) -> метка; записи с ошибками отсутствуют
+        """
+        items = parse_json_array(response)
+        if items is None:
+            return {}
+        results: Dict[int, T] = {}
+        duplicates = set()
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            try:
+                index = int(item.get("id")) - 1
+            except (TypeError, ValueError):
+                continue
+            if not 0 <= index < len(jobs):
+                continue
+            if index in results:
+                # Две разные метки одной записи — не доверяем ни одной
+                duplicates.add(index)
+                continue
+            label = self.parse_label(item.get("label"))
+            if label is not None:
+                results[index] = label
+        for index in duplicates:
+            results.pop(index, None)
+        return results
+
+    async def _run_batch(self, jobs: List[_Job]) -> Dict[int, T]:
+        prompt = self.build_prompt(jobs)
+        max_tokens = self.label_tokens * len(jobs) + 16
+        if len(jobs) > 1:
+            _stats["batches"] += 1
+        else:
+            _stats["single_requests"] += 1
+        try:
+            response = await self.complete(BATCH_SYSTEM_PROMPT, prompt, max_tokens)
+        except Exception as e:
+            logger.warning(f"{self.name}: ошибка запроса пакета из {len(jobs)} элементов: {e}")
+            return {}
+        results = self.parse_response(response, jobs)
+        if len(results) < len(jobs):
+            logger.info(f"{self.name}: из {len(jobs)} элементов пакета разобрано {len(results)}")
+        return results
+
+    async def classify(self, items: Mapping[K, str]) -> Dict[K, Optional[T]]:
+        """
+        Классифицирует элементы.
+
+        Args:
+            items: Ключ элемента (например, id пользователя) -> текст для анализа
+
+        Returns:
+            Ключ -> метка; None, если элемент не удалось классифицировать
+        """
+        results: Dict[K, Optional[T]] = {key: None for key in items}
+        queue = [_Job(key, self._prepare(text)) for key, text in items.items()]
+        _stats["items"] += len(queue)
+
+        # Сначала пакетами; то, что не разобралось, — по одному. Пакеты
+        # отправляются одновременно: очередь и лимиты держат планировщик и лимитер
+        batch_size = self.batch_size
+        while queue:
+            retry: List[_Job] = []
+            batches = [queue[start:start + batch_size] for start in range(0, len(queue), batch_size)]
+            responses = await asyncio.gather(*(self._run_batch(jobs) for jobs in batches))
+            for jobs, parsed in zip(batches, responses):
+                for index, job in enumerate(jobs):
+                    job.attempts += 1
+                    if index in parsed:
+                        results[job.key] = parsed[index]
+                        _stats["classified"] += 1
+                    elif job.attempts < self.max_attempts:
+                        retry.append(job)
+                    else:
+                        _stats["failed"] += 1
+                        logger.warning(f"{self.name}: не удалось классифицировать элемент {job.key}")
+            _stats["requeued"] += len(retry)
+            queue = retry
+            batch_size = 1
+        return results
@@ -0,0 +1,128 @@
+"""
+Автоматический выключатель (circuit breaker) для вызовов внешних сервисов.
+
+Пока провайдер отвечает ошибками, повторять к нему запросы бессмысленно:
+каждый вызов ждёт таймаута, а обработчики висят. Выключатель считает подряд
+идущие сбои и после порога размыкается (open) — вызовы сразу завершаются
+CircuitOpenError, и вызывающий код уходит на свой запасной вариант. Через
+recovery_timeout выключатель пропускает пробный запрос (half-open): успех
+замыкает цепь, сбой снова размыкает её.
+"""
+import logging
+import time
+from enum import Enum
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """Выключатель разомкнут — вызов отклонён без обращения к сервису"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"Сервис {name} временно недоступен, повтор через {retry_in:.1f} сек")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Выключатель для одного внешнего сервиса.
+
+    Args:
+        name: Имя сервиса для логов и статистики
+        failure_threshold: Сколько сбоев подряд размыкает цепь
+        recovery_timeout: Сколько секунд цепь остаётся разомкнутой до пробного запроса
+        half_open_max_calls: Сколько пробных запросов пропускается одновременно
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+        half_open_max_calls: int = 1,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._state = CircuitState.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_calls = 0
+        self.rejected = 0
+        self.opened = 0
+
+    @property
+    def state(self) -> CircuitState:
+        if self._state == CircuitState.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._state = CircuitState.HALF_OPEN
+            self._trial_calls = 0
+        return self._state
+
+    def is_available(self) -> bool:
+        """Пропустит ли выключатель вызов прямо сейчас (без занятия пробного слота)"""
+        state = self.state
+        if state == CircuitState.OPEN:
+            return False
+        return state == CircuitState.CLOSED or self._trial_calls < self.half_open_max_calls
+
+    def before_call(self) -> None:
+        """
+        Проверяет, можно ли выполнить вызов.
+
+        Raises:
+            CircuitOpenError: Цепь разомкнута или пробные запросы уже идут
+        """
+        state = self.state
+        if state == CircuitState.CLOSED:
+            return
+        if state == CircuitState.HALF_OPEN and self._trial_calls < self.half_open_max_calls:
+            self._trial_calls += 1
+            return
+        self.rejected += 1
+        retry_in = max(0.0, self.recovery_timeout - (time.monotonic() - self._opened_at))
+        raise CircuitOpenError(self.name, retry_in)
+
+    def record_success(self) -> None:
+        if self._state != CircuitState.CLOSED:
+            logger.info(f"Сервис {self.name} снова доступен, цепь замкнута")
+        self._state = CircuitState.CLOSED
+        self._failures = 0
+        self._trial_calls = 0
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._state == CircuitState.HALF_OPEN or self._failures >= self.failure_threshold:
+            self._open()
+
+    def record_ignored(self) -> None:
+        """Вызов завершился без вердикта (отменён, отклонён лимитом) — освобождаем пробный слот"""
+        if self._state == CircuitState.HALF_OPEN and self._trial_calls:
+            self._trial_calls -= 1
+
+    def _open(self) -> None:
+        if self._state != CircuitState.OPEN:
+            self.opened += 1
+            logger.warning(
+                f"Сервис {self.name}: {self._failures} сбоев подряд, цепь разомкнута "
+                f"на {self.recovery_timeout:.0f} сек"
+            )
+        self._state = CircuitState.OPEN
+        self._opened_at = time.monotonic()
+        self._trial_calls = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state.value,
+            "consecutive_failures": self._failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,105 @@
+"""
+Общий долгоживущий HTTP-клиент (aiohttp) для обращений к LLM API.
+
+Вместо новой ``aiohttp.ClientSession`` на каждый запрос процесс держит одну
+сессию с пулом keep-alive соединений, лимитом соединений на хост и DNS-кэшем.
+Сессия создаётся лениво при первом обращении и закрывается явно через
+``close_http_session()`` при остановке бота.
+"""
+import logging
+from typing import Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class SharedHTTPClient:
+    """
+    Ленивая обёртка над одной ``aiohttp.ClientSession`` на процесс.
+
+    Args:
+        limit: Общий лимит одновременных соединений
+        limit_per_host: Лимит одновременных соединений на один хост
+        dns_ttl: Время жизни записей DNS-кэша в секундах
+        keepalive_timeout: Сколько секунд держать простаивающее соединение открытым
+        timeout: Общий таймаут запроса по умолчанию в секундах
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 20,
+        dns_ttl: int = 300,
+        keepalive_timeout: float = 60,
+        timeout: float = 60,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _build_connector(self) -> aiohttp.TCPConnector:
+        return aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию, создавая её при первом вызове (или после закрытия)"""
+        # Между проверкой и созданием нет await, поэтому гонки внутри одного loop нет
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=self._build_connector(),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            logger.info(
+                f"HTTP-клиент создан: limit={self.limit}, limit_per_host={self.limit_per_host}, "
+                f"dns_ttl={self.dns_ttl}s, keepalive={self.keepalive_timeout}s"
+            )
+        return self._session
+
+    @property
+    def is_open(self) -> bool:
+        return self._session is not None and not self._session.closed
+
+    async def close(self) -> None:
+        """Закрывает сессию и все соединения пула"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("HTTP-клиент закрыт")
+        self._session = None
+
+
+_http_client: Optional[SharedHTTPClient] = None
+
+
+def get_http_client() -> SharedHTTPClient:
+    """Возвращает общий для процесса HTTP-клиент, настроенный из settings"""
+    global _http_client
+    if _http_client is None:
+        from relove_bot.config import settings
+        _http_client = SharedHTTPClient(
+            limit=settings.llm_http_pool_limit,
+            limit_per_host=settings.llm_http_limit_per_host,
+            dns_ttl=settings.llm_http_dns_ttl,
+            keepalive_timeout=settings.llm_http_keepalive_timeout,
+            timeout=settings.llm_http_timeout,
+        )
+    return _http_client
+
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """Короткий доступ к общей ``aiohttp.ClientSession``"""
+    return await get_http_client().get_session()
+
+
+async def close_http_session() -> None:
+    """Закрывает общий HTTP-клиент (вызывается при остановке процесса)"""
+    if _http_client is not None:
+        await _http_client.close()
@@ -4,7 +4,6 @@
 
 import logging
 from typing import List, Optional, Dict
-import openai
 
 from relove_bot.config import settings
 from relove_bot.services.llm_service import llm_service
@@ -15,9 +14,6 @@ from relove_bot.services.prompts import (
 
 logger = logging.getLogger(__name__)
 
-# Инициализация OpenAI клиента
-openai_client = openai.AsyncOpenAI(api_key=settings.llm_api_key.get_secret_value())
-
 # Константы для потоков
 STREAMS = [
     "Женский",
@@ -0,0 +1,288 @@
+"""
+Кэш ответов LLM.
+
+Ключ — стабильный SHA-256 дайджест (модель, сообщения, temperature, max_tokens),
+поэтому он одинаков между перезапусками процесса, в отличие от ``hash()``.
+Первый уровень — LRU в памяти с TTL и лимитом по количеству записей и байтам.
+Второй (опционально) — персистентный бэкенд: SQLite-файл или Redis.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(
+    model: str,
+    messages: List[Dict[str, Any]],
+    temperature: float,
+    max_tokens: int,
+    response_format: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Стабильный ключ кэша для запроса к chat/completions.
+
+    Args:
+        model: Имя модели
+        messages: Сообщения в формате OpenAI
+        temperature: Температура генерации
+        max_tokens: Максимальное количество токенов
+        response_format: Формат ответа (JSON mode), если задан
+
+    Returns:
+        str: Hex-дайджест SHA-256
+    """
+    payload = json.dumps(
+        {
+            "model": model,
+            "messages": messages,
+            "temperature": round(float(temperature), 4),
+            "max_tokens": int(max_tokens),
+            **({"response_format": response_format} if response_format else {}),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SQLiteCacheBackend:
+    """
+    Персистентный бэкенд кэша в SQLite-файле (запросы выполняются в потоке).
+
+    Одно соединение на бэкенд под блокировкой (как DiskVectorCache в
+    rag/embeddings.py); close() его закрывает.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _get_sync(self, key: str) -> Optional[str]:
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < time.time():
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            return value
+
+    def _set_sync(self, key: str, value: str, ttl: float) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl),
+            )
+
+    def _purge_sync(self) -> int:
+        with self._lock, self._conn:
+            cursor = self._conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),))
+            return cursor.rowcount
+
+    def _close_sync(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get_sync, key)
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        await asyncio.to_thread(self._set_sync, key, value, ttl)
+
+    async def purge_expired(self) -> int:
+        return await asyncio.to_thread(self._purge_sync)
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self._close_sync)
+
+
+class RedisCacheBackend:
+    """Персистентный бэкенд кэша в Redis (TTL выставляется самим Redis)"""
+
+    def __init__(self, url: str, prefix: str = "llm_cache:"):
+        import redis.asyncio as aioredis
+
+        self.prefix = prefix
+        self._redis = aioredis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._redis.get(self.prefix + key)
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        await self._redis.set(self.prefix + key, value, ex=max(1, int(ttl)))
+
+    async def purge_expired(self) -> int:
+        return 0
+
+    async def close(self) -> None:
+        await self._redis.close()
+
+
+class LLMResponseCache:
+    """
+    LRU+TTL кэш ответов LLM с лимитом памяти и опциональным персистентным бэкендом.
+
+    Args:
+        ttl: Время жизни записи в секундах
+        max_entries: Максимальное количество записей в памяти
+        max_bytes: Лимит суммарного размера ключей и значений в памяти
+        backend: Персистентный бэкенд (SQLiteCacheBackend / RedisCacheBackend) или None
+    """
+
+    def __init__(
+        self,
+        ttl: float = 24 * 3600,
+        max_entries: int = 5000,
+        max_bytes: int = 32 * 1024 * 1024,
+        backend: Optional[Any] = None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self._entries: "OrderedDict[str, Tuple[str, float, int]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.backend_hits = 0
+        self.backend_errors = 0
+
+    @staticmethod
+    def _entry_size(key: str, value: str) -> int:
+        return len(key) + len(value.encode("utf-8"))
+
+    def _drop(self, key: str) -> None:
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _store_memory(self, key: str, value: str, expires_at: float) -> None:
+        size = self._entry_size(key, value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (value, expires_at, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest_key = next(iter(self._entries))
+            self._drop(oldest_key)
+            self.evictions += 1
+
+    async def get(self, key: str) -> Optional[str]:
+        """Возвращает ответ из кэша или None"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at, _ = entry
+            if expires_at >= time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self._drop(key)
+            self.expirations += 1
+
+        if self.backend is not None:
+            try:
+                value = await self.backend.get(key)
+            except Exception as e:
+                self.backend_errors += 1
+                logger.warning(f"Ошибка чтения из бэкенда LLM-кэша: {e}")
+                value = None
+            if value is not None:
+                self._store_memory(key, value, time.monotonic() + self.ttl)
+                self.hits += 1
+                self.backend_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: str) -> None:
+        """Сохраняет ответ в кэш (пустые ответы не кэшируются)"""
+        if not value:
+            return
+        self._store_memory(key, value, time.monotonic() + self.ttl)
+        if self.backend is not None:
+            try:
+                await self.backend.set(key, value, self.ttl)
+            except Exception as e:
+                self.backend_errors += 1
+                logger.warning(f"Ошибка записи в бэкенд LLM-кэша: {e}")
+
+    def clear(self) -> None:
+        """Очищает уровень в памяти"""
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Счётчики кэша для метрик и логов"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "backend": type(self.backend).__name__ if self.backend else None,
+            "backend_hits": self.backend_hits,
+            "backend_errors": self.backend_errors,
+        }
+
+    async def close(self) -> None:
+        if self.backend is not None:
+            await self.backend.close()
+
+
+_llm_cache: Optional[LLMResponseCache] = None
+
+
+def get_llm_cache() -> LLMResponseCache:
+    """Возвращает общий для процесса кэш LLM, настроенный из settings"""
+    global _llm_cache
+    if _llm_cache is None:
+        from relove_bot.config import settings
+
+        backend = None
+        try:
+            if settings.llm_cache_backend == "sqlite":
+                backend = SQLiteCacheBackend(settings.llm_cache_sqlite_path)
+            elif settings.llm_cache_backend == "redis":
+                if not settings.REDIS_URL:
+                    raise ValueError("REDIS_URL не задан")
+                backend = RedisCacheBackend(settings.REDIS_URL)
+        except Exception as e:
+            logger.warning(
+                f"Бэкенд LLM-кэша '{settings.llm_cache_backend}' недоступен ({e}), используется только память"
+            )
+            backend = None
+
+        _llm_cache = LLMResponseCache(
+            ttl=settings.llm_cache_ttl,
+            max_entries=settings.llm_cache_max_entries,
+            max_bytes=settings.llm_cache_max_bytes,
+            backend=backend,
+        )
+    return _llm_cache
@@ -0,0 +1,302 @@
+"""
+Приоритетный планировщик запросов к LLM.
+
+Интерактивные ответы пользователям, проактивные сообщения и пакетные задачи
+(ротация профилей, определение пола) делят один бюджет провайдера. Планировщик
+выдаёт слоты по классам приоритета (interactive > proactive > batch), у каждого
+класса свой лимит одновременных запросов, а при нехватке слотов для живого
+чата пакетная работа приостанавливается и при необходимости вытесняется.
+
+Класс приоритета задаётся контекстом: фоновые задачи оборачивают свою работу в
+``with llm_priority(LLMPriority.BATCH):``, всё остальное считается интерактивным.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from enum import IntEnum
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, Mapping, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class LLMPriority(IntEnum):
+    """Классы приоритета запросов к LLM (меньше — важнее)"""
+    INTERACTIVE = 0
+    PROACTIVE = 1
+    BATCH = 2
+
+
+_current_priority: contextvars.ContextVar[LLMPriority] = contextvars.ContextVar(
+    'llm_priority', default=LLMPriority.INTERACTIVE
+)
+
+
+@contextmanager
+def llm_priority(priority: LLMPriority) -> Iterator[None]:
+    """Задаёт класс приоритета для всех запросов к LLM внутри блока (и порождённых задач)"""
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def current_llm_priority() -> LLMPriority:
+    return _current_priority.get()
+
+
+class _Job:
+    __slots__ = ('priority', 'task', 'preempted')
+
+    def __init__(self, priority: LLMPriority):
+        self.priority = priority
+        self.task: Optional[asyncio.Task] = None
+        self.preempted = False
+
+
+class _ClassStats:
+    __slots__ = ('completed', 'failed', 'preempted', 'total_wait', 'max_waiting', 'ewma_latency', 'last_finished')
+
+    def __init__(self):
+        self.completed = 0
+        self.failed = 0
+        self.preempted = 0
+        self.total_wait = 0.0
+        self.max_waiting = 0
+        self.ewma_latency: Optional[float] = None
+        self.last_finished = 0.0
+
+
+class LLMScheduler:
+    """
+    Планировщик слотов для запросов к LLM.
+
+    Args:
+        slots: Лимит одновременных запросов на класс приоритета
+        total_slots: Общий лимит одновременных запросов
+        interactive_slo: Целевая латентность интерактивного запроса в секундах;
+            пока сглаженная латентность выше неё, пакетные запросы не стартуют
+        preempt_batch: Вытеснять выполняющиеся пакетные запросы, если интерактивному
+            не хватает слота (вытесненный запрос повторяется позже)
+    """
+
+    # Сколько секунд сглаженная латентность интерактивных запросов считается актуальной
+    SLO_WINDOW = 60.0
+    # Период перепроверки очереди ожидающими
+    RECHECK_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        slots: Optional[Mapping[LLMPriority, int]] = None,
+        total_slots: int = 8,
+        interactive_slo: float = 8.0,
+        preempt_batch: bool = True,
+    ):
+        default_slots = {LLMPriority.INTERACTIVE: 8, LLMPriority.PROACTIVE: 3, LLMPriority.BATCH: 2}
+        default_slots.update(slots or {})
+        self.slots: Dict[LLMPriority, int] = default_slots
+        self.total_slots = total_slots
+        self.interactive_slo = interactive_slo
+        self.preempt_batch = preempt_batch
+        self._waiting: Dict[LLMPriority, Deque[Tuple[asyncio.Future, _Job]]] = {p: deque() for p in LLMPriority}
+        # dict вместо set — сохраняет порядок старта для выбора жертвы вытеснения
+        self._running: Dict[LLMPriority, Dict[_Job, None]] = {p: {} for p in LLMPriority}
+        self._stats: Dict[LLMPriority, _ClassStats] = {p: _ClassStats() for p in LLMPriority}
+
+    @property
+    def _total_running(self) -> int:
+        return sum(len(jobs) for jobs in self._running.values())
+
+    def _interactive_pressure(self) -> bool:
+        """Живой чат ждёт слот или отвечает медленнее SLO"""
+        if self._waiting[LLMPriority.INTERACTIVE]:
+            return True
+        stats = self._stats[LLMPriority.INTERACTIVE]
+        # Старая латентность не должна держать пакетные задачи вечно
+        if stats.ewma_latency is None or time.monotonic() - stats.last_finished > self.SLO_WINDOW:
+            return False
+        return stats.ewma_latency > self.interactive_slo
+
+    def _can_admit(self, priority: LLMPriority) -> bool:
+        if self._total_running >= self.total_slots:
+            return False
+        if len(self._running[priority]) >= self.slots[priority]:
+            return False
+        if priority == LLMPriority.BATCH and self._interactive_pressure():
+            return False
+        return True
+
+    def _dispatch(self) -> None:
+        """Раздаёт освободившиеся слоты ожидающим в порядке приоритета"""
+        for priority in LLMPriority:
+            queue = self._waiting[priority]
+            while queue and self._can_admit(priority):
+                future, job = queue.popleft()
+                if future.done():
+                    continue
+                self._running[priority][job] = None
+                future.set_result(None)
+
+    def _preempt_one_batch(self) -> None:
+        """Отменяет самый свежий пакетный запрос, чтобы освободить слот живому чату"""
+        candidates = [job for job in self._running[LLMPriority.BATCH] if job.task and not job.preempted]
+        if not candidates:
+            return
+        victim = candidates[-1]
+        victim.preempted = True
+        victim.task.cancel()
+        logger.info("Пакетный запрос к LLM вытеснен ради интерактивного")
+
+    async def _acquire(self, job: _Job) -> None:
+        priority = job.priority
+        # Без очереди, только если никто того же или более важного класса не ждёт
+        ahead = any(self._waiting[p] for p in LLMPriority if p <= priority)
+        if not ahead and self._can_admit(priority):
+            self._running[priority][job] = None
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._waiting[priority]
+        entry = (future, job)
+        queue.append(entry)
+        stats = self._stats[priority]
+        stats.max_waiting = max(stats.max_waiting, len(queue))
+
+        if (
+            priority == LLMPriority.INTERACTIVE
+            and self.preempt_batch
+            and self._total_running >= self.total_slots
+        ):
+            self._preempt_one_batch()
+
+        try:
+            while not future.done():
+                # Давление со стороны живого чата может спасть без событий освобождения
+                await asyncio.wait({future}, timeout=self.RECHECK_INTERVAL)
+                if not future.done():
+                    self._dispatch()
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но ожидающий отменён — возвращаем слот
+                self._release(job)
+            elif entry in queue:
+                queue.remove(entry)
+                self._dispatch()
+            raise
+
+    def _release(self, job: _Job) -> None:
+        self._running[job.priority].pop(job, None)
+        self._dispatch()
+
+    async def run(self, func: Callable[[], Awaitable[T]], priority: Optional[LLMPriority] = None) -> T:
+        """
+        Выполняет запрос к LLM в слоте своего класса приоритета.
+
+        Args:
+            func: Фабрика корутины с запросом (может вызываться повторно после вытеснения)
+            priority: Класс приоритета (по умолчанию — из контекста llm_priority)
+
+        Returns:
+            Результат ``func``
+        """
+        if priority is None:
+            priority = current_llm_priority()
+        stats = self._stats[priority]
+        enqueued_at = time.monotonic()
+
+        while True:
+            job = _Job(priority)
+            await self._acquire(job)
+            stats.total_wait += time.monotonic() - enqueued_at
+            job.task = asyncio.ensure_future(func())
+            try:
+                result = await job.task
+            except asyncio.CancelledError:
+                current = asyncio.current_task()
+                if job.preempted and not (current and current.cancelling()):
+                    stats.preempted += 1
+                    enqueued_at = time.monotonic()
+                    continue
+                raise
+            except Exception:
+                stats.failed += 1
+                raise
+            finally:
+                self._release(job)
+
+            stats.completed += 1
+            latency = time.monotonic() - enqueued_at
+            if priority == LLMPriority.INTERACTIVE:
+                stats.last_finished = time.monotonic()
+                stats.ewma_latency = latency if stats.ewma_latency is None else 0.8 * stats.ewma_latency + 0.2 * latency
+            return result
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[LLMPriority] = None) -> AsyncIterator[None]:
+        """
+        Держит слот своего класса на время блока — для потоковой генерации,
+        которую нельзя повторить с начала. Такие запросы не вытесняются.
+        """
+        if priority is None:
+            priority = current_llm_priority()
+        stats = self._stats[priority]
+        enqueued_at = time.monotonic()
+        job = _Job(priority)
+        await self._acquire(job)
+        stats.total_wait += time.monotonic() - enqueued_at
+        try:
+            yield
+        except Exception:
+            stats.failed += 1
+            raise
+        else:
+            # Длительность потока зависит от длины ответа, в EWMA латентности её не учитываем
+            stats.completed += 1
+        finally:
+            self._release(job)
+
+    def stats(self) -> Dict[str, Any]:
+        """Глубина очередей, занятые слоты и счётчики по классам приоритета"""
+        result: Dict[str, Any] = {"total_slots": self.total_slots, "running": self._total_running}
+        for priority in LLMPriority:
+            stats = self._stats[priority]
+            done = stats.completed + stats.failed
+            result[priority.name.lower()] = {
+                "slots": self.slots[priority],
+                "running": len(self._running[priority]),
+                "waiting": len(self._waiting[priority]),
+                "max_waiting": stats.max_waiting,
+                "completed": stats.completed,
+                "failed": stats.failed,
+                "preempted": stats.preempted,
+                "avg_wait_ms": round(stats.total_wait / done * 1000, 1) if done else 0.0,
+                "ewma_latency_ms": round(stats.ewma_latency * 1000, 1) if stats.ewma_latency is not None else None,
+            }
+        return result
+
+
+_llm_scheduler: Optional[LLMScheduler] = None
+
+
+def get_llm_scheduler() -> LLMScheduler:
+    """Общий для процесса планировщик запросов к LLM, настроенный из settings"""
+    global _llm_scheduler
+    if _llm_scheduler is None:
+        from relove_bot.config import settings
+
+        _llm_scheduler = LLMScheduler(
+            slots={
+                LLMPriority.INTERACTIVE: settings.llm_interactive_slots,
+                LLMPriority.PROACTIVE: settings.llm_proactive_slots,
+                LLMPriority.BATCH: settings.llm_batch_slots,
+            },
+            total_slots=settings.llm_total_slots,
+            interactive_slo=settings.llm_interactive_slo_seconds,
+            preempt_batch=settings.llm_preempt_batch,
+        )
+    return _llm_scheduler
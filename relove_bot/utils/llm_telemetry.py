@@ -0,0 +1,391 @@
+"""
+Телеметрия вызовов LLM.
+
+Каждый логический вызов (анализ, генерация, поток) записывается как одна
+запись: место вызова (тег), модель и бэкенд, реальный usage из ответа
+провайдера, время до первого байта и полная латентность, число повторов,
+попадание в кэш и стоимость по таблице цен. Записи агрегируются по тегам в
+гистограммы (экспорт в формате Prometheus) и, если задан путь, пишутся в
+JSONL-файл для офлайн-анализа.
+
+Тег места вызова задаётся контекстом: ``with llm_caller("rotation"):``. Без
+явного тега он выводится из приоритета планировщика (handler / proactive /
+batch).
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, List, Mapping, Optional, Sequence
+
+from relove_bot.utils.llm_scheduler import LLMPriority, current_llm_priority
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 60.0)
+TOKEN_BUCKETS = (64, 256, 1024, 4096, 16384, 65536)
+
+_PRIORITY_CALLERS = {
+    LLMPriority.INTERACTIVE: "handler",
+    LLMPriority.PROACTIVE: "proactive",
+    LLMPriority.BATCH: "batch",
+}
+
+_current_caller: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('llm_caller', default=None)
+_current_call: contextvars.ContextVar[Optional["LLMCall"]] = contextvars.ContextVar('llm_call', default=None)
+_usage_scopes: contextvars.ContextVar[tuple] = contextvars.ContextVar('llm_usage_scopes', default=())
+
+
+@contextmanager
+def llm_caller(tag: str) -> Iterator[None]:
+    """Задаёт тег места вызова для всех запросов к LLM внутри блока (и порождённых задач)"""
+    token = _current_caller.set(tag)
+    try:
+        yield
+    finally:
+        _current_caller.reset(token)
+
+
+def current_llm_caller() -> str:
+    return _current_caller.get() or _PRIORITY_CALLERS.get(current_llm_priority(), "handler")
+
+
+@dataclass
+class LLMUsage:
+    """Суммарный расход токенов и денег за блок кода"""
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost_usd: float = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+@contextmanager
+def llm_usage_scope() -> Iterator[LLMUsage]:
+    """Считает токены всех вызовов LLM внутри блока (например, на одного пользователя)"""
+    usage = LLMUsage()
+    token = _usage_scopes.set(_usage_scopes.get() + (usage,))
+    try:
+        yield usage
+    finally:
+        _usage_scopes.reset(token)
+
+
+@dataclass
+class LLMCall:
+    """Запись об одном логическом вызове LLM"""
+    operation: str
+    model: str
+    caller: str = field(default_factory=current_llm_caller)
+    backend: Optional[str] = None
+    status: str = "ok"
+    cache_hit: bool = False
+    retries: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    usage_estimated: bool = False
+    ttfb: Optional[float] = None
+    latency: float = 0.0
+    cost_usd: float = 0.0
+    error: Optional[str] = None
+    timestamp: float = field(default_factory=time.time)
+    _started: float = field(default_factory=time.monotonic, repr=False)
+
+    def mark_first_byte(self) -> None:
+        if self.ttfb is None:
+            self.ttfb = time.monotonic() - self._started
+
+    def fail(self, error: BaseException) -> None:
+        """Отмечает ошибку, которую вызывающий код перехватил сам"""
+        self.status = "error"
+        self.error = f"{type(error).__name__}: {error}"[:200]
+
+    def set_usage(self, usage: Any) -> None:
+        """Usage из ответа провайдера (объект SDK или dict)"""
+        if usage is None:
+            return
+        get = usage.get if isinstance(usage, Mapping) else lambda name: getattr(usage, name, None)
+        self.prompt_tokens = int(get("prompt_tokens") or 0)
+        self.completion_tokens = int(get("completion_tokens") or 0)
+        # Токены промпта, взятые провайдером из кэша префикса
+        details = get("prompt_tokens_details")
+        if details is not None:
+            cached = details.get("cached_tokens") if isinstance(details, Mapping) else getattr(details, "cached_tokens", None)
+            self.cached_prompt_tokens = int(cached or 0)
+        self.usage_estimated = False
+
+    def estimate_usage(self, prompt: str, completion: str) -> None:
+        """Оценка по токенизатору, если провайдер не вернул usage"""
+        from relove_bot.utils.prompt_budget import count_tokens
+
+        self.prompt_tokens = count_tokens(prompt, self.model)
+        self.completion_tokens = count_tokens(completion, self.model)
+        self.usage_estimated = True
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {key: value for key, value in asdict(self).items() if not key.startswith("_")}
+        data["total_tokens"] = self.total_tokens
+        return data
+
+
+def current_llm_call() -> Optional[LLMCall]:
+    """Запись текущего вызова (маршрутизатор дописывает в неё бэкенд и usage)"""
+    return _current_call.get()
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин (как в Prometheus)"""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                return
+        self.counts[-1] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Приближённый квантиль — верхняя граница корзины"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for index, bound in enumerate(self.buckets):
+            seen += self.counts[index]
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def cumulative(self) -> List[int]:
+        result, total = [], 0
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], self.cumulative())),
+        }
+
+
+class _CallerStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.cache_hits = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.cost_usd = 0.0
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.ttfb = Histogram(LATENCY_BUCKETS)
+        self.tokens = Histogram(TOKEN_BUCKETS)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "cancelled": self.cancelled,
+            "cache_hits": self.cache_hits,
+            "retries": self.retries,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+            "cost_usd": round(self.cost_usd, 6),
+            "latency": self.latency.stats(),
+            "ttfb": self.ttfb.stats(),
+            "tokens": self.tokens.stats(),
+        }
+
+
+class JsonlSink:
+    """Построчная запись вызовов в JSONL-файл"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+        self._lock = threading.Lock()
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class LLMTelemetry:
+    """
+    Агрегатор телеметрии вызовов LLM.
+
+    Args:
+        prices: Цены в USD за 1M токенов: {модель: {"prompt": ..., "completion": ...}}
+        sink: Куда дополнительно писать каждую запись (JsonlSink) или None
+    """
+
+    def __init__(self, prices: Optional[Mapping[str, Mapping[str, float]]] = None, sink: Optional[JsonlSink] = None):
+        self.prices = dict(prices or {})
+        self.sink = sink
+        self._callers: Dict[str, _CallerStats] = {}
+        self._models: Dict[str, Dict[str, Any]] = {}
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        price = self.prices.get(model) or self.prices.get((model or "").split("/")[-1])
+        if not price:
+            return 0.0
+        return (prompt_tokens * price.get("prompt", 0.0) + completion_tokens * price.get("completion", 0.0)) / 1_000_000
+
+    def record(self, call: LLMCall) -> None:
+        if not call.cache_hit:
+            call.cost_usd = self.cost(call.model, call.prompt_tokens, call.completion_tokens)
+
+        stats = self._callers.setdefault(call.caller, _CallerStats())
+        stats.calls += 1
+        stats.retries += call.retries
+        if call.cache_hit:
+            stats.cache_hits += 1
+        elif call.status == "cancelled":
+            stats.cancelled += 1
+        elif call.status != "ok":
+            stats.errors += 1
+        else:
+            stats.prompt_tokens += call.prompt_tokens
+            stats.completion_tokens += call.completion_tokens
+            stats.cached_prompt_tokens += call.cached_prompt_tokens
+            stats.cost_usd += call.cost_usd
+            stats.latency.observe(call.latency)
+            stats.ttfb.observe(call.ttfb if call.ttfb is not None else call.latency)
+            stats.tokens.observe(call.total_tokens)
+
+            model = self._models.setdefault(call.model, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+            model["calls"] += 1
+            model["prompt_tokens"] += call.prompt_tokens
+            model["completion_tokens"] += call.completion_tokens
+            model["cost_usd"] += call.cost_usd
+
+            for scope in _usage_scopes.get():
+                scope.calls += 1
+                scope.prompt_tokens += call.prompt_tokens
+                scope.completion_tokens += call.completion_tokens
+                scope.cost_usd += call.cost_usd
+
+        if self.sink is not None:
+            try:
+                self.sink.write(call.to_dict())
+            except Exception as e:
+                logger.warning(f"Не удалось записать телеметрию LLM: {e}")
+
+    @asynccontextmanager
+    async def track(self, operation: str, model: str) -> AsyncIterator[LLMCall]:
+        """
+        Замеряет логический вызов LLM и записывает его по выходу из блока.
+
+        Внутри блока маршрутизатор дописывает в запись бэкенд и usage, а
+        вызывающий код — время первого байта и число повторов.
+        """
+        call = LLMCall(operation=operation, model=model)
+        token = _current_call.set(call)
+        try:
+            yield call
+        except (asyncio.CancelledError, GeneratorExit):
+            call.status = "cancelled"
+            raise
+        except BaseException as e:
+            call.fail(e)
+            raise
+        finally:
+            _current_call.reset(token)
+            call.latency = time.monotonic() - call._started
+            self.record(call)
+
+    def record_cache_hit(self, operation: str, model: str) -> None:
+        self.record(LLMCall(operation=operation, model=model, status="cache", cache_hit=True))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "callers": {caller: stats.stats() for caller, stats in self._callers.items()},
+            "models": {
+                model: {**stats, "cost_usd": round(stats["cost_usd"], 6)} for model, stats in self._models.items()
+            },
+        }
+
+    def prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        lines = [
+            "# TYPE llm_calls_total counter",
+            "# TYPE llm_errors_total counter",
+            "# TYPE llm_cache_hits_total counter",
+            "# TYPE llm_retries_total counter",
+            "# TYPE llm_tokens_total counter",
+            "# TYPE llm_cost_usd_total counter",
+        ]
+        for caller, stats in sorted(self._callers.items()):
+            label = f'caller="{caller}"'
+            lines.append(f"llm_calls_total{{{label}}} {stats.calls}")
+            lines.append(f"llm_errors_total{{{label}}} {stats.errors}")
+            lines.append(f"llm_cache_hits_total{{{label}}} {stats.cache_hits}")
+            lines.append(f"llm_retries_total{{{label}}} {stats.retries}")
+            lines.append(f'llm_tokens_total{{{label},kind="prompt"}} {stats.prompt_tokens}')
+            lines.append(f'llm_tokens_total{{{label},kind="completion"}} {stats.completion_tokens}')
+            lines.append(f'llm_tokens_total{{{label},kind="cached_prompt"}} {stats.cached_prompt_tokens}')
+            lines.append(f"llm_cost_usd_total{{{label}}} {stats.cost_usd:.6f}")
+        for name, attr in (("llm_latency_seconds", "latency"), ("llm_ttfb_seconds", "ttfb")):
+            lines.append(f"# TYPE {name} histogram")
+            for caller, stats in sorted(self._callers.items()):
+                histogram: Histogram = getattr(stats, attr)
+                bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, histogram.cumulative()):
+                    lines.append(f'{name}_bucket{{caller="{caller}",le="{bound}"}} {count}')
+                lines.append(f'{name}_sum{{caller="{caller}"}} {histogram.sum:.6f}')
+                lines.append(f'{name}_count{{caller="{caller}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+_telemetry: Optional[LLMTelemetry] = None
+
+
+def get_llm_telemetry() -> LLMTelemetry:
+    """Общий агрегатор телеметрии процесса (настройки из settings)"""
+    global _telemetry
+    if _telemetry is None:
+        from relove_bot.config import settings
+
+        sink = None
+        if settings.llm_telemetry_jsonl_path:
+            try:
+                sink = JsonlSink(settings.llm_telemetry_jsonl_path)
+            except OSError as e:
+                logger.warning(f"Не удалось открыть файл телеметрии LLM: {e}")
+        _telemetry = LLMTelemetry(prices=settings.llm_token_prices, sink=sink)
+    return _telemetry
@@ -0,0 +1,259 @@
+"""
+Бюджет токенов для промптов.
+
+Вместо обрезки по символам (которая не совпадает с тем, что считает
+провайдер, особенно для кириллицы) промпт собирается из секций с
+приоритетами: системный промпт, профиль, история, новое сообщение. Секции
+заполняются в порядке приоритета, пока не кончится бюджет, а всё, что не
+поместилось, учитывается как отброшенные токены.
+
+Токены считаются токенизатором tiktoken (кэшируется по модели), если он
+установлен; иначе — приближённой оценкой по словам.
+"""
+import logging
+import math
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Literal, Optional, Sequence, Union
+
+logger = logging.getLogger(__name__)
+
+Keep = Literal['head', 'tail']
+
+TRUNCATION_MARK = "… [текст обрезан]"
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+class _EstimatingCounter:
+    """Приближённый подсчёт: латиница ~4 символа на токен, кириллица и прочее ~3"""
+
+    def count(self, text: str) -> int:
+        tokens = 0
+        for match in _WORD_RE.finditer(text):
+            word = match.group()
+            tokens += math.ceil(len(word) / (4 if word.isascii() else 3))
+        return tokens
+
+    def truncate(self, text: str, max_tokens: int, keep: Keep) -> str:
+        total = self.count(text)
+        if total <= max_tokens:
+            return text
+        chars = int(len(text) * max_tokens / total)
+        return text[:chars] if keep == 'head' else text[len(text) - chars:]
+
+
+class _TiktokenCounter:
+    def __init__(self, encoding):
+        self.encoding = encoding
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int, keep: Keep) -> str:
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        kept = tokens[:max_tokens] if keep == 'head' else tokens[len(tokens) - max_tokens:]
+        return self.encoding.decode(kept)
+
+
+@lru_cache(maxsize=32)
+def get_token_counter(model: Optional[str] = None):
+    """Токенизатор для модели (кэшируется; без tiktoken — приближённая оценка)"""
+    try:
+        import tiktoken
+    except ImportError:
+        return _EstimatingCounter()
+    try:
+        try:
+            # Имена вида "openai/gpt-4o" у OpenRouter
+            encoding = tiktoken.encoding_for_model((model or "").split("/")[-1])
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # Словарь кодировки скачивается при первом обращении и может быть недоступен
+        logger.warning(f"Токенизатор tiktoken недоступен ({e}), используется приближённая оценка")
+        return _EstimatingCounter()
+    return _TiktokenCounter(encoding)
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """Число токенов в тексте для модели"""
+    return get_token_counter(model).count(text) if text else 0
+
+
+@dataclass
+class PromptSection:
+    """
+    Секция промпта.
+
+    Args:
+        name: Имя секции (для отчёта и доступа к результату)
+        content: Текст или список элементов (например, сообщений истории)
+        priority: Чем меньше, тем раньше секция получает бюджет
+        keep: Какую часть сохранять при нехватке места — начало или конец
+        max_tokens: Собственный лимит секции
+        required: Секция не обрезается (если не помещается — ошибка)
+        separator: Разделитель элементов списка
+    """
+    name: str
+    content: Union[str, Sequence[str]]
+    priority: int
+    keep: Keep = 'head'
+    max_tokens: Optional[int] = None
+    required: bool = False
+    separator: str = "\n"
+
+
+@dataclass
+class PackedPrompt:
+    """Результат упаковки промпта"""
+    text: str
+    sections: Dict[str, str]
+    tokens: int
+    dropped: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def dropped_tokens(self) -> int:
+        return sum(self.dropped.values())
+
+    def __getitem__(self, name: str) -> str:
+        return self.sections[name]
+
+
+class PromptBudgetExceeded(ValueError):
+    """Обязательные секции не помещаются в бюджет"""
+
+
+_stats = {"packed": 0, "truncated": 0, "prompt_tokens": 0, "dropped_tokens": 0}
+
+
+def get_prompt_budget_stats() -> Dict[str, Any]:
+    """Сколько промптов упаковано и сколько токенов отброшено"""
+    return dict(_stats)
+
+
+class PromptBudget:
+    """
+    Упаковщик промпта в бюджет токенов.
+
+    Args:
+        max_tokens: Бюджет промпта в токенах
+        model: Модель (определяет токенизатор)
+        separator: Разделитель секций в итоговом тексте
+        name: Имя промпта для логов
+    """
+
+    def __init__(self, max_tokens: int, model: Optional[str] = None, separator: str = "\n\n", name: str = "prompt"):
+        self.max_tokens = max_tokens
+        self.model = model
+        self.separator = separator
+        self.name = name
+        self.counter = get_token_counter(model)
+        self._sections: List[PromptSection] = []
+        # Секции, добавленные пустыми: в тексте их нет, а packed[name] даёт ""
+        self._empty: List[str] = []
+
+    def add(
+        self,
+        name: str,
+        content: Union[str, Sequence[str], None],
+        priority: int,
+        keep: Keep = 'head',
+        max_tokens: Optional[int] = None,
+        required: bool = False,
+        separator: str = "\n",
+    ) -> "PromptBudget":
+        """Добавляет секцию; порядок добавления — порядок в итоговом тексте"""
+        if content:
+            self._sections.append(PromptSection(name, content, priority, keep, max_tokens, required, separator))
+        else:
+            self._empty.append(name)
+        return self
+
+    def _fit(self, section: PromptSection, budget: int) -> str:
+        """Текст секции, урезанный до budget токенов"""
+        if isinstance(section.content, str):
+            text = section.content
+            if self.counter.count(text) <= budget:
+                return text
+            return self._truncate(text, budget, section.keep)
+
+        # Список элементов: отбрасываем целые элементы с противоположного края
+        items = list(section.content) if section.keep == 'head' else list(reversed(section.content))
+        separator_tokens = self.counter.count(section.separator)
+        kept: List[str] = []
+        used = 0
+        for item in items:
+            cost = self.counter.count(item) + (separator_tokens if kept else 0)
+            if used + cost > budget:
+                if not kept:
+                    # Даже один элемент не влезает — обрезаем его
+                    kept.append(self._truncate(item, budget, section.keep))
+                break
+            kept.append(item)
+            used += cost
+        if section.keep == 'tail':
+            kept.reverse()
+        return section.separator.join(kept)
+
+    def _truncate(self, text: str, budget: int, keep: Keep) -> str:
+        mark_tokens = self.counter.count(TRUNCATION_MARK)
+        if budget <= mark_tokens:
+            return ""
+        cut = self.counter.truncate(text, budget - mark_tokens, keep)
+        return cut + TRUNCATION_MARK if keep == 'head' else TRUNCATION_MARK + cut
+
+    def pack(self) -> PackedPrompt:
+        """
+        Распределяет бюджет между секциями по приоритету.
+
+        Returns:
+            PackedPrompt: итоговый текст, тексты секций и отброшенные токены
+
+        Raises:
+            PromptBudgetExceeded: Обязательные секции не помещаются в бюджет
+        """
+        separator_tokens = self.counter.count(self.separator)
+        remaining = self.max_tokens - separator_tokens * max(0, len(self._sections) - 1)
+        fitted: Dict[str, str] = {name: "" for name in self._empty}
+        dropped: Dict[str, int] = {}
+
+        for section in sorted(self._sections, key=lambda s: s.priority):
+            full_text = section.content if isinstance(section.content, str) else section.separator.join(section.content)
+            full_tokens = self.counter.count(full_text)
+            if section.required:
+                if full_tokens > remaining:
+                    raise PromptBudgetExceeded(
+                        f"{self.name}: секция {section.name} ({full_tokens} ток.) не помещается в бюджет {self.max_tokens}"
+                    )
+                text = full_text
+            else:
+                budget = max(0, remaining if section.max_tokens is None else min(remaining, section.max_tokens))
+                text = full_text if full_tokens <= budget else self._fit(section, budget)
+            tokens = self.counter.count(text) if text is not full_text else full_tokens
+            remaining -= tokens
+            fitted[section.name] = text
+            if tokens < full_tokens:
+                dropped[section.name] = full_tokens - tokens
+
+        texts = [fitted[section.name] for section in self._sections if fitted[section.name]]
+        result = PackedPrompt(
+            text=self.separator.join(texts),
+            sections=fitted,
+            tokens=self.max_tokens - remaining if texts else 0,
+            dropped=dropped,
+        )
+
+        _stats["packed"] += 1
+        _stats["prompt_tokens"] += result.tokens
+        if dropped:
+            _stats["truncated"] += 1
+            _stats["dropped_tokens"] += result.dropped_tokens
+            logger.info(
+                f"{self.name}: промпт урезан до {result.tokens}/{self.max_tokens} ток., отброшено "
+                + ", ".join(f"{name}={count}" for name, count in dropped.items())
+            )
+        return result
@@ -0,0 +1,154 @@
+"""
+Стабильный префикс промпта и подсказки кэширования провайдеру.
+
+Провайдеры кэшируют общий префикс запроса: OpenAI и DeepSeek — автоматически
+(от 1024 токенов), Anthropic и Gemini через OpenRouter — по явной отметке
+cache_control. Чтобы префикс совпадал между ходами диалога, статичные блоки
+(персона Наташи, дополнение этапа пути) собираются в системный промпт в
+постоянном порядке, а всё меняющееся (история, новое сообщение) идёт в
+сообщение пользователя. Статичный блок, который вызывающий код по старой
+привычке вставил ещё и в текст запроса, оттуда вырезается — раньше персона
+оплачивалась дважды за каждый ход.
+
+Экономия считается по месту вызова: сколько токенов вырезано как дубли,
+сколько ушло в кэшируемом префиксе и сколько провайдер реально взял из кэша
+(по usage.prompt_tokens_details.cached_tokens из телеметрии).
+"""
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence
+
+from relove_bot.utils.prompt_budget import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Модели, которым нужна явная отметка cache_control (остальные кэшируют префикс сами)
+CACHE_CONTROL_MODEL_PREFIXES = ("anthropic/", "claude", "google/gemini", "gemini")
+
+_stats: Dict[str, Dict[str, int]] = defaultdict(
+    lambda: {"calls": 0, "static_tokens": 0, "dynamic_tokens": 0, "deduplicated_tokens": 0}
+)
+
+
+@lru_cache(maxsize=256)
+def _block_tokens(text: str, model: Optional[str]) -> int:
+    # Статичные блоки повторяются от вызова к вызову — считаем их один раз
+    return count_tokens(text, model)
+
+
+@dataclass
+class PrefixedPrompt:
+    """Промпт со статичным префиксом"""
+    system_prompt: str
+    content: str
+    deduplicated_tokens: int = 0
+
+
+def assemble_prompt(
+    site: str,
+    static_blocks: Sequence[Optional[str]],
+    content: str,
+    model: Optional[str] = None,
+) -> PrefixedPrompt:
+    """
+    Собирает системный промпт из статичных блоков и убирает их дубли из текста запроса.
+
+    Args:
+        site: Место вызова (для отчёта об экономии)
+        static_blocks: Статичные блоки в порядке префикса; пустые и повторы пропускаются
+        content: Меняющаяся часть запроса
+        model: Модель (определяет токенизатор)
+    """
+    blocks: List[str] = []
+    for block in static_blocks:
+        block = (block or "").strip()
+        if block and block not in blocks:
+            blocks.append(block)
+
+    deduplicated = 0
+    for block in blocks:
+        occurrences = content.count(block)
+        if occurrences:
+            content = content.replace(block, "")
+            deduplicated += occurrences * _block_tokens(block, model)
+    content = content.strip()
+
+    system_prompt = "\n\n".join(blocks)
+    stats = _stats[site]
+    stats["calls"] += 1
+    stats["static_tokens"] += sum(_block_tokens(block, model) for block in blocks)
+    stats["dynamic_tokens"] += count_tokens(content, model)
+    stats["deduplicated_tokens"] += deduplicated
+    if deduplicated:
+        logger.debug(f"{site}: из запроса вырезано {deduplicated} ток. повторов статичного префикса")
+    return PrefixedPrompt(system_prompt, content, deduplicated)
+
+
+def needs_cache_control(model: Optional[str], mode: str) -> bool:
+    """Нужна ли модели явная отметка кэшируемого префикса"""
+    if mode == 'always':
+        return True
+    if mode != 'auto':
+        return False
+    name = (model or "").lower()
+    return name.startswith(CACHE_CONTROL_MODEL_PREFIXES)
+
+
+def apply_cache_hints(
+    messages: List[Dict[str, Any]],
+    model: Optional[str],
+    mode: str = 'auto',
+    min_tokens: int = 1024,
+) -> List[Dict[str, Any]]:
+    """
+    Отмечает системный промпт как кэшируемый префикс (cache_control).
+
+    Короткие префиксы не отмечаются: провайдеры кэшируют только от
+    min_tokens токенов, а отметка сама по себе стоит дороже обычного ввода.
+
+    Returns:
+        Новый список сообщений (исходный не меняется)
+    """
+    if not messages or not needs_cache_control(model, mode):
+        return messages
+    first = messages[0]
+    if first.get("role") != "system" or not isinstance(first.get("content"), str):
+        return messages
+    if _block_tokens(first["content"], model) < min_tokens:
+        return messages
+    hinted = {
+        **first,
+        "content": [{"type": "text", "text": first["content"], "cache_control": {"type": "ephemeral"}}],
+    }
+    return [hinted, *messages[1:]]
+
+
+def get_prompt_prefix_stats() -> Dict[str, Any]:
+    """Экономия токенов промпта по местам вызова"""
+    cached_by_caller: Dict[str, int] = {}
+    try:
+        from relove_bot.utils.llm_telemetry import get_llm_telemetry
+
+        callers = get_llm_telemetry().stats()["callers"]
+        cached_by_caller = {caller: stats.get("cached_prompt_tokens", 0) for caller, stats in callers.items()}
+    except Exception as e:
+        logger.debug(f"Телеметрия LLM недоступна для отчёта о префиксах: {e}")
+
+    sites = {}
+    for site, stats in _stats.items():
+        site_stats = dict(stats)
+        sent = site_stats["static_tokens"] + site_stats["dynamic_tokens"]
+        site_stats["prompt_tokens"] = sent
+        site_stats["cacheable_share"] = round(site_stats["static_tokens"] / sent, 4) if sent else 0.0
+        site_stats["saved_share"] = (
+            round(site_stats["deduplicated_tokens"] / (sent + site_stats["deduplicated_tokens"]), 4) if sent else 0.0
+        )
+        site_stats["provider_cached_tokens"] = cached_by_caller.get(site, 0)
+        sites[site] = site_stats
+    return {
+        "deduplicated_tokens": sum(stats["deduplicated_tokens"] for stats in sites.values()),
+        "static_tokens": sum(stats["static_tokens"] for stats in sites.values()),
+        "sites": sites,
+    }
@@ -1,51 +1,403 @@
+"""
+Асинхронный token-bucket лимитер запросов.
+
+Каждый вызов ``acquire`` резервирует токены сразу (баланс может уйти в минус)
+и получает время, когда его слот наступит. Ожидание идёт вне каких-либо
+блокировок, поэтому другие корутины не стоят в очереди за спящей, а слоты
+выдаются строго в порядке обращения (FIFO).
+
+Поддерживаются несколько корзин на запрос (например, лимит на API-ключ в минуту,
+в сутки и лимит на модель), блокировка по ``Retry-After`` после ответа 429 и
+общее состояние между процессами через Redis.
+"""
 import asyncio
+import hashlib
+import logging
 import time
+from email.utils import parsedate_to_datetime
 from functools import wraps
-from typing import Callable, Any, TypeVar, Coroutine, Union, Awaitable
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, NamedTuple, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
 
 T = TypeVar('T')
 
+
+class RateLimitExceeded(Exception):
+    """Слот не освободится за допустимое время ожидания"""
+
+    def __init__(self, wait: float):
+        super().__init__(f"Лимит запросов исчерпан, ближайший слот через {wait:.1f} сек")
+        self.wait = wait
+
+
+class BucketSpec(NamedTuple):
+    """Параметры одной корзины: имя, скорость пополнения (токенов/сек) и ёмкость"""
+    name: str
+    rate: float
+    capacity: float
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Разбирает заголовок Retry-After (секунды или HTTP-дата).
+
+    Returns:
+        Optional[float]: Количество секунд ожидания или None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class LocalBucketStore:
+    """Состояние корзин в памяти процесса"""
+
+    def __init__(self):
+        # name -> [tokens, updated_at, blocked_until]
+        self._state: Dict[str, List[float]] = {}
+
+    @staticmethod
+    def now() -> float:
+        return time.monotonic()
+
+    def _refill(self, spec: BucketSpec, now: float) -> List[float]:
+        state = self._state.get(spec.name)
+        if state is None:
+            state = [spec.capacity, now, 0.0]
+            self._state[spec.name] = state
+        else:
+            state[0] = min(spec.capacity, state[0] + (now - state[1]) * spec.rate)
+            state[1] = now
+        return state
+
+    async def reserve(self, specs: List[BucketSpec], cost: float, max_wait: Optional[float]) -> float:
+        now = self.now()
+        states = [self._refill(spec, now) for spec in specs]
+        wait = 0.0
+        for spec, state in zip(specs, states):
+            tokens_after = state[0] - cost
+            if tokens_after < 0:
+                wait = max(wait, -tokens_after / spec.rate)
+            wait = max(wait, state[2] - now)
+        if max_wait is not None and wait > max_wait:
+            raise RateLimitExceeded(wait)
+        for state in states:
+            state[0] -= cost
+        return wait
+
+    async def refund(self, specs: List[BucketSpec], cost: float) -> None:
+        for spec in specs:
+            state = self._state.get(spec.name)
+            if state is not None:
+                state[0] = min(spec.capacity, state[0] + cost)
+
+    async def block(self, names: List[str], seconds: float) -> None:
+        until = self.now() + seconds
+        for name in names:
+            state = self._state.setdefault(name, [0.0, self.now(), 0.0])
+            state[2] = max(state[2], until)
+
+    async def blocked_for(self, names: List[str]) -> float:
+        now = self.now()
+        return max((self._state[n][2] - now for n in names if n in self._state), default=0.0)
+
+    async def tokens(self, spec: BucketSpec) -> float:
+        return self._refill(spec, self.now())[0]
+
+
+# Та же логика резервирования, что и в LocalBucketStore.reserve, но атомарно в Redis.
+# KEYS — корзины; ARGV: now, cost, max_wait (-1 = без ограничения), затем rate/capacity по каждой корзине.
+_RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 + 2 * i])
+    local capacity = tonumber(ARGV[3 + 2 * i])
+    local data = redis.call('HMGET', key, 'tokens', 'ts', 'blocked')
+    local t = tonumber(data[1]) or capacity
+    local ts = tonumber(data[2]) or now
+    local blocked = tonumber(data[3]) or 0
+    t = math.min(capacity, t + math.max(0, now - ts) * rate) - cost
+    if t < 0 and -t / rate > wait then wait = -t / rate end
+    if blocked - now > wait then wait = blocked - now end
+    tokens[i] = t
+end
+if max_wait >= 0 and wait > max_wait then
+    return {0, tostring(wait)}
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', tostring(tokens[i]), 'ts', tostring(now))
+    redis.call('EXPIRE', key, 172800)
+end
+return {1, tostring(wait)}
+"""
+
+
+class RedisBucketStore:
+    """Состояние корзин в Redis — общий лимит для всех процессов и реплик"""
+
+    def __init__(self, url: str, prefix: str = "ratelimit:"):
+        import redis.asyncio as aioredis
+
+        self.prefix = prefix
+        self._redis = aioredis.from_url(url, decode_responses=True)
+        self._reserve = self._redis.register_script(_RESERVE_SCRIPT)
+
+    @staticmethod
+    def now() -> float:
+        return time.time()
+
+    async def reserve(self, specs: List[BucketSpec], cost: float, max_wait: Optional[float]) -> float:
+        args: List[Any] = [self.now(), cost, -1 if max_wait is None else max_wait]
+        for spec in specs:
+            args.extend([spec.rate, spec.capacity])
+        granted, wait = await self._reserve(keys=[self.prefix + s.name for s in specs], args=args)
+        wait = float(wait)
+        if not int(granted):
+            raise RateLimitExceeded(wait)
+        return wait
+
+    async def refund(self, specs: List[BucketSpec], cost: float) -> None:
+        for spec in specs:
+            await self._redis.hincrbyfloat(self.prefix + spec.name, 'tokens', cost)
+
+    async def block(self, names: List[str], seconds: float) -> None:
+        until = self.now() + seconds
+        for name in names:
+            key = self.prefix + name
+            current = await self._redis.hget(key, 'blocked')
+            if current is None or float(current) < until:
+                await self._redis.hset(key, 'blocked', until)
+                await self._redis.expire(key, 172800)
+
+    async def blocked_for(self, names: List[str]) -> float:
+        values = [await self._redis.hget(self.prefix + n, 'blocked') for n in names]
+        now = self.now()
+        return max((float(v) - now for v in values if v is not None), default=0.0)
+
+    async def tokens(self, spec: BucketSpec) -> float:
+        data = await self._redis.hmget(self.prefix + spec.name, 'tokens', 'ts')
+        if data[0] is None:
+            return spec.capacity
+        return min(spec.capacity, float(data[0]) + (self.now() - float(data[1])) * spec.rate)
+
+
+class TokenBucketLimiter:
+    """
+    Лимитер запросов с бюджетами на API-ключ и на модель.
+
+    Args:
+        per_minute: Запросов в минуту на ключ
+        per_day: Запросов в сутки на ключ (0 — без дневного лимита)
+        model_limits: Запросов в минуту на модель {имя модели: лимит}
+        max_wait: Максимальное ожидание слота, после которого бросается RateLimitExceeded
+        store: Хранилище состояния (по умолчанию — в памяти процесса)
+        default_penalty: Пауза после 429 без заголовка Retry-After
+    """
+
+    def __init__(
+        self,
+        per_minute: float = 20,
+        per_day: float = 0,
+        model_limits: Optional[Mapping[str, float]] = None,
+        max_wait: Optional[float] = 60,
+        store: Optional[Any] = None,
+        default_penalty: float = 5,
+    ):
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.model_limits = dict(model_limits or {})
+        self.max_wait = max_wait
+        self.store = store or LocalBucketStore()
+        self.default_penalty = default_penalty
+        self.granted = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.penalties = 0
+        self.total_wait = 0.0
+
+    @staticmethod
+    def _key_id(key: Optional[str]) -> str:
+        # Сам API-ключ не храним ни в памяти, ни в Redis — только его дайджест
+        if not key:
+            return "default"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+    def _specs(self, key: Optional[str], model: Optional[str]) -> List[BucketSpec]:
+        key_id = self._key_id(key)
+        specs = [BucketSpec(f"key:{key_id}:minute", self.per_minute / 60.0, self.per_minute)]
+        if self.per_day:
+            specs.append(BucketSpec(f"key:{key_id}:day", self.per_day / 86400.0, self.per_day))
+        if model and model in self.model_limits:
+            limit = self.model_limits[model]
+            specs.append(BucketSpec(f"model:{model}", limit / 60.0, limit))
+        return specs
+
+    async def acquire(
+        self,
+        key: Optional[str] = None,
+        model: Optional[str] = None,
+        cost: float = 1,
+        max_wait: Optional[float] = ...,
+    ) -> float:
+        """
+        Занимает слот для запроса, при необходимости дожидаясь его.
+
+        Args:
+            key: API-ключ (или любой идентификатор бюджета)
+            model: Имя модели
+            cost: Стоимость запроса в токенах корзины
+            max_wait: Переопределение максимального ожидания (None — ждать сколько нужно)
+
+        Returns:
+            float: Сколько секунд пришлось ждать
+
+        Raises:
+            RateLimitExceeded: Если слот не освободится за max_wait
+        """
+        if max_wait is ...:
+            max_wait = self.max_wait
+        specs = self._specs(key, model)
+        try:
+            wait = await self.store.reserve(specs, cost, max_wait)
+        except RateLimitExceeded:
+            self.rejected += 1
+            raise
+
+        waited = 0.0
+        try:
+            while wait > 0:
+                await asyncio.sleep(wait)
+                waited += wait
+                # Retry-After мог прийти, пока мы ждали свой слот
+                wait = await self.store.blocked_for([s.name for s in specs])
+        except asyncio.CancelledError:
+            await self.store.refund(specs, cost)
+            raise
+
+        self.granted += 1
+        if waited:
+            self.delayed += 1
+            self.total_wait += waited
+            logger.debug(f"Ожидание слота лимитера: {waited:.2f} сек")
+        return waited
+
+    async def penalize(
+        self,
+        key: Optional[str] = None,
+        model: Optional[str] = None,
+        retry_after: Optional[float] = None,
+    ) -> float:
+        """
+        Блокирует бюджеты ключа и модели после ответа 429.
+
+        Args:
+            key: API-ключ
+            model: Имя модели
+            retry_after: Пауза из заголовка Retry-After (None — default_penalty)
+
+        Returns:
+            float: Применённая пауза в секундах
+        """
+        seconds = retry_after if retry_after is not None else self.default_penalty
+        self.penalties += 1
+        await self.store.block([s.name for s in self._specs(key, model)], seconds)
+        logger.warning(f"Провайдер ответил 429, пауза лимитера {seconds:.1f} сек")
+        return seconds
+
+    async def remaining(self, key: Optional[str] = None, model: Optional[str] = None) -> Dict[str, float]:
+        """Оставшиеся токены по каждой корзине"""
+        return {spec.name: await self.store.tokens(spec) for spec in self._specs(key, model)}
+
+    def stats(self) -> Dict[str, Any]:
+        """Счётчики для метрик"""
+        return {
+            "store": type(self.store).__name__,
+            "granted": self.granted,
+            "delayed": self.delayed,
+            "rejected": self.rejected,
+            "penalties": self.penalties,
+            "total_wait_seconds": round(self.total_wait, 3),
+        }
+
+
+_llm_limiter: Optional[TokenBucketLimiter] = None
+
+
+def get_llm_limiter() -> TokenBucketLimiter:
+    """Общий для процесса лимитер запросов к LLM, настроенный из settings"""
+    global _llm_limiter
+    if _llm_limiter is None:
+        from relove_bot.config import settings
+
+        store = None
+        if settings.USE_REDIS and settings.REDIS_URL:
+            try:
+                store = RedisBucketStore(settings.REDIS_URL)
+            except Exception as e:
+                logger.warning(f"Redis для лимитера недоступен ({e}), используется память процесса")
+        _llm_limiter = TokenBucketLimiter(
+            per_minute=settings.llm_rate_limit_per_minute,
+            per_day=settings.llm_rate_limit_per_day,
+            model_limits=settings.llm_model_rate_limits,
+            max_wait=settings.llm_rate_limit_max_wait,
+            store=store,
+        )
+    return _llm_limiter
+
+
 class RateLimiter:
     """
-    Декоратор для ограничения частоты вызовов асинхронных функций.
-    
+    Декоратор и асинхронный контекстный менеджер для ограничения частоты вызовов.
+
+    Без аргументов использует общий лимитер LLM (``get_llm_limiter``), модель
+    берёт из именованного аргумента ``model`` декорируемой функции, а ключ
+    бюджета — из атрибута ``rate_limit_key`` экземпляра.
+
     Args:
         max_calls: Максимальное количество вызовов за период
         period: Период в секундах
     """
-    def __init__(self, max_calls: int, period: float):
+    def __init__(self, max_calls: Optional[int] = None, period: Optional[float] = None):
         self.max_calls = max_calls
         self.period = period
-        self.calls = 0
-        self.last_reset = time.time()
-        self.lock = asyncio.Lock()
-    
+        self._limiter: Optional[TokenBucketLimiter] = None
+        if max_calls is not None and period is not None:
+            self._limiter = TokenBucketLimiter(per_minute=max_calls * 60.0 / period, max_wait=None)
+
+    @property
+    def limiter(self) -> TokenBucketLimiter:
+        return self._limiter or get_llm_limiter()
+
+    async def __aenter__(self) -> 'RateLimiter':
+        await self.limiter.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        return None
+
     def __call__(self, func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
         @wraps(func)
         async def wrapped(*args, **kwargs) -> T:
-            async with self.lock:
-                now = time.time()
-                
-                # Сбрасываем счетчик, если прошел период
-                if now - self.last_reset > self.period:
-                    self.calls = 0
-                    self.last_reset = now
-                
-                # Если превысили лимит, ждем
-                if self.calls >= self.max_calls:
-                    sleep_time = self.period - (now - self.last_reset)
-                    if sleep_time > 0:
-                        # await asyncio.sleep(sleep_time)
-                        pass
-                    self.calls = 0
-                    self.last_reset = time.time()
-                
-                self.calls += 1
-            
-            # Вызываем оригинальную функцию вне блока lock, чтобы не блокировать другие вызовы
+            # Для методов бюджет ключа берётся из атрибута rate_limit_key экземпляра
+            key = getattr(args[0], 'rate_limit_key', None) if args else None
+            await self.limiter.acquire(key=key, model=kwargs.get('model'))
             return await func(*args, **kwargs)
-            
+
         return wrapped
 
-# Глобальный rate limiter для LLM API (3 запроса в минуту)
-llm_rate_limiter = RateLimiter(max_calls=3, period=60)  # Ограничение: 3 запроса в минуту
+
+# Общий декоратор для вызовов LLM API (бюджеты — в settings.llm_rate_limit_*)
+llm_rate_limiter = RateLimiter()
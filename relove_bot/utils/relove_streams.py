@@ -3,8 +3,10 @@ import logging
 import json
 import re
 from typing import List, Dict, Any, Optional
+from pydantic import BaseModel, Field, field_validator
 from relove_bot.services.llm_service import llm_service
 from relove_bot.config import settings
+from relove_bot.utils.structured_output import StructuredOutputError
 from relove_bot.services.prompts import (
     STREAMS_ANALYSIS_PROMPT,
     STREAMS_INTERACTION_PROMPT
@@ -29,6 +31,22 @@ async def detect_relove_streams(user, summary=None):
         logger.warning(f"Не удалось определить потоки reLove для пользователя {getattr(user, 'id', None)}: {e}")
         return []
 
+class StreamsByPosts(BaseModel):
+    """Взаимодействие пользователя с потоками reLove по его постам"""
+    interest: List[str] = Field(default_factory=list, description="Потоки, которые упоминались или к которым проявлен интерес")
+    completed: List[str] = Field(default_factory=list, description="Потоки, которые пользователь явно проходил")
+
+    @field_validator('interest', 'completed', mode='before')
+    @classmethod
+    def _split_string(cls, value: Any) -> Any:
+        # Модели иногда отвечают строкой через запятую вместо списка
+        if value is None:
+            return []
+        if isinstance(value, str):
+            return [part.strip() for part in value.split(',') if part.strip()]
+        return value
+
+
 async def detect_relove_streams_by_posts(posts: list) -> dict:
     """
     Определяет потоки reLove по постам пользователя.
@@ -38,83 +56,42 @@ async def detect_relove_streams_by_posts(posts: list) -> dict:
     """
     if not posts:
         return {'interest': [], 'completed': []}
-    
+
     try:
         posts_text = '\n'.join(str(p) for p in posts if p)
-        
-        # Получаем список доступных потоков из настроек
-        valid_streams = settings.relove_streams
-        
-        # Создаем структурированный запрос с четким описанием формата вывода
-        system_prompt = f"""Ты помощник, который анализирует посты пользователя и определяет его взаимодействие с потоками reLove. 
-Отвечай ТОЛЬКО в формате JSON с полями:
-- interest: список потоков, которые упоминались или к которым проявлен интерес
-- completed: список потоков, которые пользователь явно проходил
-
-Доступные потоки: {valid_streams}
+        valid_streams = {stream.lower(): stream for stream in settings.relove_streams}
 
-Пример ответа:
-{{
-  "interest": ["{valid_streams[1]}"],
-  "completed": ["{valid_streams[0]}"]
-}}"""
-        
+        system_prompt = (
+            "Ты помощник, который анализирует посты пользователя и определяет его взаимодействие с потоками reLove. "
+            f"Доступные потоки: {settings.relove_streams}"
+        )
         prompt = f"""Проанализируй посты пользователя и определи:
 1. Какие потоки reLove упоминались или к ним проявлен интерес
 2. Какие потоки пользователь явно проходил (есть признаки завершения/участия)
 
 Посты пользователя:
-{posts_text}
+{posts_text}"""
 
-Ответ в формате JSON:"""
-        
-        # Получаем структурированный ответ
-        result_str = await llm_service.analyze_text(
+        result = await llm_service.generate_structured(
+            StreamsByPosts,
             prompt=prompt,
             system_prompt=system_prompt,
             max_tokens=128
         )
-        
-        # Обрабатываем ответ
-        import json
-        
-        try:
-            # Парсим JSON из ответа
-            if isinstance(result_str, dict):
-                result = result_str
-            else:
-                # Пытаемся извлечь JSON из текстового ответа
-                import re
-                json_match = re.search(r'\{.*\}', result_str, re.DOTALL)
-                if json_match:
-                    result = json.loads(json_match.group(0))
-                else:
-                    result = json.loads(result_str)
-            
-            # Нормализуем результаты
-            def normalize_streams(streams):
-                if not isinstance(streams, list):
-                    if isinstance(streams, str):
-                        streams = [s.strip() for s in streams.split(',')]
-                    else:
-                        streams = []
-                return [s.strip().capitalize() for s in streams if s and isinstance(s, str) and s.strip()]
-            
-            interest = normalize_streams(result.get('interest', []))
-            completed = normalize_streams(result.get('completed', []))
-            
-            # Фильтруем только допустимые потоки
-            valid_streams = settings.relove_streams
-            interest = [s for s in interest if s in valid_streams]
-            completed = [s for s in completed if s in valid_streams]
-            
-            logger.info(f"Потоки по постам: интерес={interest}, прохождение={completed}")
-            return {'interest': interest, 'completed': completed}
-            
-        except (json.JSONDecodeError, AttributeError) as e:
-            logger.warning(f"Не удалось распарсить ответ от LLM: {e}. Ответ: {result_str}")
-            return {'interest': [], 'completed': []}
-            
+
+        # Оставляем только допустимые потоки
+        def normalize_streams(streams: List[str]) -> List[str]:
+            names = [valid_streams.get(name.strip().lower()) for name in streams]
+            return [name for name in names if name]
+
+        interest = normalize_streams(result.interest)
+        completed = normalize_streams(result.completed)
+        logger.info(f"Потоки по постам: интерес={interest}, прохождение={completed}")
+        return {'interest': interest, 'completed': completed}
+
+    except StructuredOutputError as e:
+        logger.warning(f"Не удалось разобрать ответ LLM о потоках по постам: {e}")
+        return {'interest': [], 'completed': []}
     except Exception as e:
         logger.warning(f"Не удалось определить потоки reLove по постам: {e}", exc_info=True)
         return {'interest': [], 'completed': []}
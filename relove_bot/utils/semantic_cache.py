@@ -0,0 +1,310 @@
+"""
+Семантический кэш ответов на короткие сообщения.
+
+Точный кэш (llm_cache) срабатывает только на побайтно одинаковые промпты, а
+в общий чат приходят «привет», «Привет!», «не знаю…», «что дальше?» — почти
+одинаковые реплики, на каждую из которых тратится полная генерация. Здесь
+нормализованное сообщение превращается в вектор, и в индексе в памяти ищется
+близкое (косинусная близость не ниже порога) сообщение с тем же отпечатком
+контекста. Найденный ответ переиспользуется; чтобы ответы не звучали
+одинаково, у записи копится несколько вариантов, которые выдаются по кругу.
+
+Кэш включается явно (semantic_cache_enabled) и отдельно для каждой темы
+(semantic_cache_topics). Эмбеддер подключаемый: по умолчанию — хеширование
+символьных n-грамм, не требующее модели.
+"""
+import hashlib
+import importlib
+import logging
+import math
+import random
+import re
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Protocol, Tuple
+
+logger = logging.getLogger(__name__)
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s?]", re.UNICODE)
+_SPACES_RE = re.compile(r"\s+")
+
+
+class Embedder(Protocol):
+    """Эмбеддер текста для семантического кэша"""
+
+    async def embed(self, text: str) -> List[float]:
+        ...
+
+
+class HashingEmbedder:
+    """
+    Эмбеддер без модели: хеширование слов и символьных n-грамм в вектор
+    фиксированной размерности. Ловит опечатки, регистр и окончания в коротких
+    репликах, но не синонимы — для них нужен настоящий эмбеддер.
+
+    Args:
+        dim: Размерность вектора
+        ngram: Длина символьных n-грамм
+    """
+
+    def __init__(self, dim: int = 512, ngram: int = 3):
+        self.dim = dim
+        self.ngram = ngram
+
+    def _features(self, text: str) -> List[str]:
+        features = []
+        for word in text.split():
+            features.append(f"w:{word}")
+            padded = f" {word} "
+            features.extend(padded[i:i + self.ngram] for i in range(max(1, len(padded) - self.ngram + 1)))
+        return features
+
+    async def embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        for feature in self._features(text):
+            digest = zlib.crc32(feature.encode("utf-8"))
+            vector[digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        return vector
+
+
+def normalize_message(text: str) -> str:
+    """Нормализация реплики: регистр, ё, пунктуация (кроме вопроса) и пробелы"""
+    text = (text or "").lower().replace("ё", "е")
+    text = _PUNCTUATION_RE.sub(" ", text)
+    text = re.sub(r"\?+", " ?", text)
+    return _SPACES_RE.sub(" ", text).strip()
+
+
+def context_fingerprint(*parts: Any) -> str:
+    """Короткий отпечаток контекста: ответ переиспользуется только при совпадении"""
+    payload = "\x1f".join(_SPACES_RE.sub(" ", str(part or "")).strip().lower() for part in parts)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def _unit(vector: List[float]) -> Optional[List[float]]:
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else None
+
+
+@dataclass
+class _Entry:
+    vector: List[float]
+    fingerprint: str
+    message: str
+    answers: List[str]
+    created_at: float = field(default_factory=time.monotonic)
+    hits: int = 0
+    next_answer: int = 0
+
+
+class SemanticCache:
+    """
+    Кэш ответов по смысловой близости сообщений.
+
+    Args:
+        embedder: Эмбеддер (по умолчанию HashingEmbedder)
+        threshold: Минимальная косинусная близость для попадания
+        ttl: Время жизни записи в секундах
+        max_entries: Максимум записей на тему
+        max_chars: Сообщения длиннее (после нормализации) не кэшируются
+        max_variants: Сколько вариантов ответа копится у записи
+        variant_probability: Вероятность вместо попадания запросить новый
+            вариант, пока их меньше max_variants
+        topics: Темы, для которых кэш включён (None — все)
+        rng: Генератор случайных чисел (для тестов)
+    """
+
+    def __init__(
+        self,
+        embedder: Optional[Embedder] = None,
+        threshold: float = 0.9,
+        ttl: float = 3600.0,
+        max_entries: int = 500,
+        max_chars: int = 120,
+        max_variants: int = 3,
+        variant_probability: float = 0.3,
+        topics: Optional[List[str]] = None,
+        rng: Optional[random.Random] = None,
+    ):
+        self.embedder = embedder or HashingEmbedder()
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.max_variants = max_variants
+        self.variant_probability = variant_probability
+        self.topics = set(topics) if topics is not None else None
+        self.rng = rng or random.Random()
+        self._entries: Dict[str, "OrderedDict[int, _Entry]"] = defaultdict(OrderedDict)
+        self._next_id = 0
+        # Последние эмбеддинги: lookup и store одного сообщения считают вектор один раз
+        self._vectors: "OrderedDict[str, Optional[List[float]]]" = OrderedDict()
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {"lookups": 0, "hits": 0, "misses": 0, "variant_refreshes": 0, "skipped": 0, "stores": 0}
+        )
+
+    def enabled_for(self, topic: str) -> bool:
+        """Включён ли кэш для темы"""
+        return self.topics is None or topic in self.topics
+
+    def _cacheable(self, normalized: str) -> bool:
+        return bool(normalized) and len(normalized) <= self.max_chars
+
+    async def _vector(self, normalized: str) -> Optional[List[float]]:
+        if normalized in self._vectors:
+            self._vectors.move_to_end(normalized)
+            return self._vectors[normalized]
+        vector = _unit(await self.embedder.embed(normalized))
+        self._vectors[normalized] = vector
+        if len(self._vectors) > 1024:
+            self._vectors.popitem(last=False)
+        return vector
+
+    def _nearest(self, topic: str, vector: List[float], fingerprint: str) -> Tuple[Optional[int], float]:
+        """Ближайшая живая запись темы с тем же отпечатком контекста"""
+        entries = self._entries[topic]
+        now = time.monotonic()
+        best_id, best_score = None, -1.0
+        for entry_id in list(entries):
+            entry = entries[entry_id]
+            if now - entry.created_at > self.ttl:
+                del entries[entry_id]
+                continue
+            if entry.fingerprint != fingerprint:
+                continue
+            score = sum(a * b for a, b in zip(vector, entry.vector))
+            if score > best_score:
+                best_id, best_score = entry_id, score
+        return best_id, best_score
+
+    async def lookup(self, topic: str, message: str, fingerprint: str = "") -> Optional[str]:
+        """
+        Ищет ответ на близкое сообщение.
+
+        Returns:
+            Кэшированный ответ или None (промах — нужно сгенерировать и вызвать store)
+        """
+        answer, _ = await self.probe(topic, message, fingerprint)
+        return answer
+
+    async def probe(self, topic: str, message: str, fingerprint: str = "") -> Tuple[Optional[str], bool]:
+        """
+        Как lookup, но сообщает, что промах — запрос нового варианта.
+
+        Returns:
+            (ответ или None, refresh). При refresh=True ответ нужно сгенерировать
+            заново в обход точного кэша LLM: иначе тот же промпт вернёт тот же
+            ответ, и store не добавит вариант.
+        """
+        stats = self._stats[topic]
+        normalized = normalize_message(message)
+        if not self.enabled_for(topic) or not self._cacheable(normalized):
+            stats["skipped"] += 1
+            return None, False
+        stats["lookups"] += 1
+        vector = await self._vector(normalized)
+        entry_id, score = self._nearest(topic, vector, fingerprint) if vector else (None, 0.0)
+        if entry_id is None or score < self.threshold:
+            stats["misses"] += 1
+            return None, False
+
+        entry = self._entries[topic][entry_id]
+        if len(entry.answers) < self.max_variants and self.rng.random() < self.variant_probability:
+            # Промах ради нового варианта: store допишет его к этой записи
+            stats["variant_refreshes"] += 1
+            return None, True
+
+        self._entries[topic].move_to_end(entry_id)
+        entry.hits += 1
+        stats["hits"] += 1
+        answer = entry.answers[entry.next_answer % len(entry.answers)]
+        entry.next_answer += 1
+        logger.debug(f"Семантический кэш [{topic}]: «{normalized}» ~ «{entry.message}» ({score:.2f})")
+        return answer, False
+
+    async def store(self, topic: str, message: str, answer: str, fingerprint: str = "") -> None:
+        """Сохраняет ответ; близкое сообщение получает ещё один вариант ответа"""
+        normalized = normalize_message(message)
+        if not answer or not self.enabled_for(topic) or not self._cacheable(normalized):
+            return
+        vector = await self._vector(normalized)
+        if not vector:
+            return
+        self._stats[topic]["stores"] += 1
+        entries = self._entries[topic]
+        entry_id, score = self._nearest(topic, vector, fingerprint)
+        if entry_id is not None and score >= self.threshold:
+            entry = entries[entry_id]
+            if answer not in entry.answers and len(entry.answers) < self.max_variants:
+                entry.answers.append(answer)
+            entries.move_to_end(entry_id)
+            return
+
+        self._next_id += 1
+        entries[self._next_id] = _Entry(vector, fingerprint, normalized, [answer])
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._vectors.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Доля попаданий по темам"""
+        topics = {}
+        for topic in set(self._stats) | set(self._entries):
+            stats = dict(self._stats[topic])
+            stats["entries"] = len(self._entries[topic])
+            stats["enabled"] = self.enabled_for(topic)
+            stats["hit_rate"] = round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+            topics[topic] = stats
+        lookups = sum(stats["lookups"] for stats in topics.values())
+        hits = sum(stats["hits"] for stats in topics.values())
+        return {
+            "enabled": self.topics is None or bool(self.topics),
+            "threshold": self.threshold,
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "topics": topics,
+        }
+
+
+def load_embedder(spec: str) -> Embedder:
+    """
+    Эмбеддер по имени из настроек: 'hashing' или путь 'package.module:factory'
+    к классу/функции без аргументов, возвращающей объект с методом embed.
+    """
+    if not spec or spec == "hashing":
+        return HashingEmbedder()
+    module_name, _, attr = spec.partition(":")
+    factory = getattr(importlib.import_module(module_name), attr or "get_embedder")
+    return factory()
+
+
+_semantic_cache: Optional[SemanticCache] = None
+
+
+def get_semantic_cache() -> SemanticCache:
+    """Общий семантический кэш процесса (настройки из settings)"""
+    global _semantic_cache
+    if _semantic_cache is None:
+        from relove_bot.config import settings
+
+        try:
+            embedder = load_embedder(settings.semantic_cache_embedder)
+        except Exception as e:
+            logger.warning(f"Эмбеддер {settings.semantic_cache_embedder} недоступен ({e}), используется хеширование")
+            embedder = HashingEmbedder()
+        _semantic_cache = SemanticCache(
+            embedder=embedder,
+            threshold=settings.semantic_cache_threshold,
+            ttl=settings.semantic_cache_ttl,
+            max_entries=settings.semantic_cache_max_entries,
+            max_chars=settings.semantic_cache_max_chars,
+            max_variants=settings.semantic_cache_variants,
+            topics=list(settings.semantic_cache_topics) if settings.semantic_cache_enabled else [],
+        )
+    return _semantic_cache
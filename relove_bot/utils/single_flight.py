@@ -0,0 +1,76 @@
+"""
+Single-flight: схлопывание одинаковых одновременных запросов к LLM.
+
+Первый вызов с ключом запускает запрос, остальные вызовы с тем же ключом,
+пришедшие пока он выполняется, ждут тот же результат вместо нового запроса.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    """Группа схлопывания одинаковых запросов по ключу"""
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.collapsed = 0
+
+    async def do(self, key: str, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Выполняет ``func`` один раз на ключ среди одновременных вызовов.
+
+        Запрос выполняется в отдельной задаче: отмена одного из ожидающих
+        не отменяет запрос для остальных.
+
+        Args:
+            key: Ключ запроса (обычно ключ кэша LLM)
+            func: Фабрика корутины, выполняющей запрос
+
+        Returns:
+            Результат ``func`` (общий для всех ожидающих)
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            self.collapsed += 1
+            logger.debug(f"Запрос {key[:16]}... схлопнут с выполняющимся")
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._forget(k, t))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Забираем исключение, чтобы не было "exception was never retrieved",
+        # если все ожидающие были отменены
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        """Счётчики для метрик: сколько запросов ушло и сколько схлопнуто"""
+        total = self.leaders + self.collapsed
+        return {
+            "inflight": len(self._inflight),
+            "leaders": self.leaders,
+            "collapsed": self.collapsed,
+            "collapse_rate": round(self.collapsed / total, 4) if total else 0.0,
+        }
+
+
+_single_flight: Optional[SingleFlight] = None
+
+
+def get_single_flight() -> SingleFlight:
+    """Общая для процесса группа схлопывания запросов к LLM"""
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
@@ -0,0 +1,290 @@
+"""
+Структурированные ответы LLM.
+
+Сервисы просили свободный текст и разбирали его регулярками и поиском по
+строкам «ПЛАНЕТА:», «SUMMARY:» — любое отклонение модели от формата означало
+пустой результат, повтор или запасной вариант, то есть ещё один вызов.
+Здесь ответ описывается pydantic-моделью: схема уходит в промпт и, если
+провайдер поддерживает, в response_format (JSON mode), а ответ проверяется
+валидатором модели.
+
+Невалидный ответ сначала чинится локально по грамматике JSON — снимаются
+```-обёртки, висячие запятые, закрываются незакрытые строки и скобки (ответ,
+обрезанный по max_tokens). Только если это не помогло, модель один раз
+просят исправить ответ по схеме и списку ошибок валидации. Повторы
+считаются по каждой схеме.
+"""
+import json
+import logging
+import re
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Type, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+logger = logging.getLogger(__name__)
+
+M = TypeVar('M', bound=BaseModel)
+
+# (system_prompt, prompt, max_tokens, response_format) -> текст ответа модели
+StructuredCompleteFunc = Callable[[str, str, int, Optional[Dict[str, Any]]], Awaitable[str]]
+
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_PY_LITERAL_RE = re.compile(r"(?<![\w\"])(True|False|None)(?![\w\"])")
+# Типографские кавычки, которыми модель иногда обрамляет ключи и значения.
+# «ёлочки» сюда не входят: в русском тексте это обычные кавычки внутри значений
+_SMART_QUOTES = "“”"
+
+REPAIR_SYSTEM_PROMPT = (
+    "Ты исправляешь JSON. Верни ТОЛЬКО исправленный JSON-объект, соответствующий схеме, "
+    "без пояснений и markdown. Не меняй смысл значений, только формат."
+)
+
+_stats: Dict[str, Dict[str, int]] = defaultdict(
+    lambda: {"requests": 0, "parsed": 0, "local_repairs": 0, "repair_calls": 0, "repaired": 0, "failures": 0}
+)
+
+
+class StructuredOutputError(ValueError):
+    """Ответ модели не удалось привести к схеме"""
+
+    def __init__(self, message: str, raw: str = ""):
+        super().__init__(message)
+        self.raw = raw
+
+
+def get_structured_output_stats() -> Dict[str, Any]:
+    """Сколько ответов разобрано сразу, сколько починено и сколько раз пришлось переспрашивать"""
+    schemas = {name: dict(stats) for name, stats in _stats.items()}
+    totals = {key: sum(stats[key] for stats in schemas.values()) for key in ("requests", "parsed", "repair_calls", "failures")}
+    return {**totals, "schemas": schemas}
+
+
+def schema_name(schema: Type[BaseModel]) -> str:
+    return schema.__name__
+
+
+def schema_instruction(schema: Type[BaseModel]) -> str:
+    """Описание формата ответа для системного промпта"""
+    json_schema = json.dumps(schema.model_json_schema(), ensure_ascii=False, separators=(",", ":"))
+    return (
+        "Отвечай ТОЛЬКО одним JSON-объектом без пояснений и markdown. "
+        f"JSON Schema ответа:\n{json_schema}"
+    )
+
+
+def response_format_for(schema: Type[BaseModel], mode: str) -> Optional[Dict[str, Any]]:
+    """
+    Параметр response_format для OpenAI-совместимого API.
+
+    Args:
+        mode: 'json_schema' — строгая схема, 'json_object' — просто JSON,
+            'off' — провайдер не поддерживает response_format
+    """
+    if mode == 'json_schema':
+        return {
+            "type": "json_schema",
+            "json_schema": {"name": schema_name(schema), "schema": schema.model_json_schema()},
+        }
+    if mode == 'json_object':
+        return {"type": "json_object"}
+    return None
+
+
+def _open_brackets(text: str) -> Tuple[List[str], bool]:
+    """Незакрытые скобки (закрывающие символы) и незакрытая строка"""
+    stack: List[str] = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+    return stack, in_string
+
+
+def close_json(text: str) -> str:
+    """
+    Дописывает незакрытые строки и скобки: ответ, обрезанный по max_tokens,
+    превращается в валидный JSON без последнего недописанного значения.
+    """
+    stack, in_string = _open_brackets(text)
+    if not stack and not in_string:
+        return text
+    candidate = text
+    while True:
+        stack, in_string = _open_brackets(candidate)
+        closed = candidate + ('"' if in_string else "")
+        closed = _drop_trailing_commas(closed.rstrip().rstrip(",") + "".join(reversed(stack)))
+        try:
+            json.loads(closed)
+            return closed
+        except ValueError:
+            pass
+        # Отбрасываем недописанный хвост до предыдущей запятой
+        cut = candidate.rfind(",")
+        if cut < 0:
+            return closed
+        candidate = candidate[:cut]
+
+
+def _normalize_quotes(text: str) -> str:
+    """
+    Заменяет “ и ” на " там, где они служат разделителями JSON-строк.
+    Внутри строк, открытых обычной кавычкой, типографские кавычки остаются как есть.
+    """
+    out: List[str] = []
+    closing = ""  # чем закроется текущая строка: '"' или любая из '"“”'
+    escaped = False
+    for char in text:
+        if not closing:
+            if char == '"' or char in _SMART_QUOTES:
+                closing = '"' if char == '"' else '"' + _SMART_QUOTES
+                char = '"'
+        elif escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char in closing:
+            closing = ""
+            char = '"'
+        out.append(char)
+    return "".join(out)
+
+
+def _outside_strings(text: str, fix: Callable[[str], str]) -> str:
+    """Применяет fix только к участкам вне строковых литералов"""
+    parts: List[str] = []
+    chunk_start = 0
+    in_string = escaped = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+                parts.append(text[chunk_start:i + 1])
+                chunk_start = i + 1
+        elif char == '"':
+            in_string = True
+            parts.append(fix(text[chunk_start:i]))
+            chunk_start = i
+    tail = text[chunk_start:]
+    parts.append(tail if in_string else fix(tail))
+    return "".join(parts)
+
+
+def _drop_trailing_commas(text: str) -> str:
+    return _outside_strings(text, lambda chunk: _TRAILING_COMMA_RE.sub(r"\1", chunk))
+
+
+def repair_json_text(text: str) -> str:
+    """Локальная починка частых ошибок формата; содержимое строк не трогаем"""
+    text = _normalize_quotes(_FENCE_RE.sub("", text.strip()))
+    text = _outside_strings(text, lambda chunk: _PY_LITERAL_RE.sub(lambda m: _PY_LITERALS[m.group(1)], chunk))
+    return _drop_trailing_commas(close_json(text))
+
+
+def extract_json(text: str) -> Tuple[Optional[Any], bool]:
+    """
+    Достаёт первый JSON-объект из ответа.
+
+    Returns:
+        (данные или None, понадобилась ли локальная починка)
+    """
+    if not text:
+        return None, False
+    decoder = json.JSONDecoder()
+    for candidate, repaired in ((text, False), (repair_json_text(text), True)):
+        start = candidate.find("{")
+        if start < 0:
+            continue
+        try:
+            data, _ = decoder.raw_decode(candidate[start:])
+        except ValueError:
+            continue
+        return data, repaired
+    return None, False
+
+
+def _validate(schema: Type[M], text: str) -> Tuple[Optional[M], bool, str]:
+    """(объект, была ли локальная починка, описание ошибки)"""
+    data, repaired = extract_json(text)
+    if data is None:
+        return None, False, "ответ не содержит JSON-объекта"
+    try:
+        return schema.model_validate(data), repaired, ""
+    except ValidationError as e:
+        errors = "; ".join(f"{'.'.join(map(str, err['loc'])) or '<root>'}: {err['msg']}" for err in e.errors())
+        return None, repaired, errors
+
+
+async def generate_structured(
+    schema: Type[M],
+    complete: StructuredCompleteFunc,
+    prompt: str,
+    system_prompt: str = "",
+    max_tokens: int = 512,
+    response_format: Optional[Dict[str, Any]] = None,
+    max_repairs: int = 1,
+) -> M:
+    """
+    Запрашивает ответ и возвращает его как проверенный объект схемы.
+
+    Args:
+        schema: pydantic-модель ответа
+        complete: Функция запроса к LLM
+        prompt: Промпт
+        system_prompt: Системный промпт (к нему добавляется описание схемы)
+        max_tokens: Лимит ответа
+        response_format: JSON mode провайдера (см. response_format_for)
+        max_repairs: Сколько раз просить модель исправить невалидный ответ
+
+    Raises:
+        StructuredOutputError: Ответ не удалось привести к схеме
+    """
+    name = schema_name(schema)
+    stats = _stats[name]
+    stats["requests"] += 1
+    instruction = schema_instruction(schema)
+    system = f"{system_prompt}\n\n{instruction}" if system_prompt else instruction
+
+    text = await complete(system, prompt, max_tokens, response_format)
+    result, repaired, error = _validate(schema, text)
+    for attempt in range(max_repairs):
+        # Пустой ответ — ошибка запроса, а не формата: чинить нечего
+        if result is not None or not text:
+            break
+        stats["repair_calls"] += 1
+        logger.info(f"{name}: ответ не прошёл проверку ({error}), просим модель исправить")
+        repair_prompt = (
+            f"{instruction}\n\n"
+            f"ОШИБКИ ПРОВЕРКИ:\n{error}\n\n"
+            f"ОТВЕТ, КОТОРЫЙ НУЖНО ИСПРАВИТЬ:\n{text}"
+        )
+        text = await complete(REPAIR_SYSTEM_PROMPT, repair_prompt, max_tokens, response_format)
+        result, repaired, error = _validate(schema, text)
+        if result is not None:
+            stats["repaired"] += 1
+
+    if result is None:
+        stats["failures"] += 1
+        logger.warning(f"{name}: ответ не соответствует схеме ({error}). Ответ: {(text or '')[:300]}")
+        raise StructuredOutputError(f"{name}: {error}", raw=text or "")
+    stats["parsed"] += 1
+    if repaired:
+        stats["local_repairs"] += 1
+    return result
@@ -0,0 +1,164 @@
+"""
+Постепенный вывод потокового ответа LLM в сообщение Telegram.
+
+Бот сразу отправляет заглушку, а затем редактирует её по мере прихода текста.
+Частота правок ограничена: Telegram допускает примерно одну правку в секунду
+в личном чате и заметно меньше в группах, а при превышении отвечает
+RetryAfter — тогда промежуточные правки пропускаются до окончания паузы.
+"""
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, List, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def _split_point(text: str, limit: int) -> int:
+    """Позиция разреза длинного текста — по последнему переводу строки или пробелу"""
+    for separator in ("\n", " "):
+        position = text.rfind(separator, 0, limit)
+        if position > limit // 2:
+            return position + 1
+    return limit
+
+
+class StreamingReply:
+    """
+    Сообщение-ответ, которое наполняется по мере генерации.
+
+    Args:
+        message: Сообщение пользователя, на которое отвечаем
+        edit_interval: Минимальный интервал между правками в секундах
+        placeholder: Текст заглушки до прихода первых токенов
+    """
+
+    def __init__(self, message: Message, edit_interval: float = 1.0, placeholder: str = "…"):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.placeholder = placeholder
+        self.text = ""
+        self.edits = 0
+        self._sent: List[Message] = []
+        self._offset = 0  # начало текста текущего сообщения
+        self._shown = ""
+        self._next_edit_at = 0.0
+
+    @property
+    def _current(self) -> str:
+        return self.text[self._offset:]
+
+    async def start(self) -> None:
+        """Отправляет заглушку"""
+        self._sent.append(await self.message.answer(self.placeholder))
+        self._shown = self.placeholder
+
+    async def _edit(self, text: str, final: bool = False, **kwargs) -> None:
+        target = self._sent[-1]
+        while True:
+            try:
+                await target.edit_text(text, **kwargs)
+                self._shown = text
+                self.edits += 1
+                return
+            except TelegramRetryAfter as e:
+                self._next_edit_at = time.monotonic() + e.retry_after
+                if not final:
+                    return
+                # Итоговый текст должен дойти до пользователя
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    self._shown = text
+                    return
+                raise
+
+    async def feed(self, chunk: str) -> None:
+        """Добавляет фрагмент ответа и при необходимости обновляет сообщение"""
+        self.text += chunk
+        # Длинный ответ продолжается в новом сообщении
+        while len(self._current) > TELEGRAM_MESSAGE_LIMIT:
+            cut = self._offset + _split_point(self._current, TELEGRAM_MESSAGE_LIMIT)
+            await self._edit(self.text[self._offset:cut], final=True)
+            self._offset = cut
+            self._sent.append(await self.message.answer(self._current or self.placeholder))
+            self._shown = self._current or self.placeholder
+
+        if time.monotonic() < self._next_edit_at or not self._current.strip() or self._current == self._shown:
+            return
+        self._next_edit_at = time.monotonic() + self.edit_interval
+        await self._edit(self._current)
+
+    async def finish(self, fallback_text: Optional[str] = None, **kwargs) -> str:
+        """
+        Выставляет итоговый текст (с клавиатурой и т.п. из kwargs).
+
+        Returns:
+            Полный текст ответа, а если он пуст — показанный вместо него fallback_text
+        """
+        final = self._current if self.text.strip() else fallback_text
+        if final:
+            if final != self._shown or kwargs:
+                await self._edit(final, final=True, **kwargs)
+        else:
+            try:
+                await self._sent[-1].delete()
+            except Exception as e:
+                logger.debug(f"Не удалось удалить заглушку: {e}")
+        return self.text if self.text.strip() else fallback_text or ""
+
+
+async def stream_reply(
+    message: Message,
+    chunks: AsyncIterator[str],
+    edit_interval: Optional[float] = None,
+    placeholder: str = "…",
+    fallback_text: Optional[str] = None,
+    **kwargs
+) -> str:
+    """
+    Отвечает на сообщение, выводя потоковый ответ LLM по мере генерации.
+
+    Ошибка или отмена (таймаут) посреди потока не теряет уже показанный
+    текст: сообщение дописывается тем, что успело прийти, а если не пришло
+    ничего — заменяется на fallback_text. Отмена после этого пробрасывается.
+
+    Args:
+        message: Сообщение пользователя
+        chunks: Асинхронный итератор фрагментов ответа
+        edit_interval: Интервал между правками (по умолчанию из settings)
+        placeholder: Текст заглушки
+        fallback_text: Текст на случай пустого ответа или ошибки
+        **kwargs: Параметры итогового сообщения (reply_markup, parse_mode)
+
+    Returns:
+        Текст, который увидел пользователь: ответ или fallback_text
+    """
+    if edit_interval is None:
+        from relove_bot.config import settings
+
+        edit_interval = settings.telegram_stream_edit_interval
+        if message.chat.type != "private":
+            edit_interval = max(edit_interval, settings.telegram_stream_group_edit_interval)
+
+    reply = StreamingReply(message, edit_interval=edit_interval, placeholder=placeholder)
+    await reply.start()
+    try:
+        async for chunk in chunks:
+            await reply.feed(chunk)
+    except asyncio.CancelledError:
+        # Таймаут или отмена задачи: не оставляем заглушку висеть
+        try:
+            await reply.finish(fallback_text=fallback_text, **kwargs)
+        except Exception as e:
+            logger.error(f"Не удалось дописать прерванный ответ: {e}")
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка потоковой генерации ответа: {e}", exc_info=True)
+    return await reply.finish(fallback_text=fallback_text, **kwargs)
@@ -0,0 +1,315 @@
+"""
+Шардирование апдейтов Telegram между репликами бота (BOT_MODE=webhook).
+
+Telegram шлёт все апдейты на один webhook URL, а балансировщик раздаёт
+запросы репликам как попало. Чтобы апдейты одного пользователя шли по порядку
+и через одну реплику (FSM, кэш сессий, очередь свободных сообщений), реплика,
+принявшая запрос, апдейт не обрабатывает, а кладёт в поток Redis его шарда:
+шард = blake2b(id пользователя) % UPDATE_SHARDS. Каждым шардом владеет ровно
+одна реплика (rendezvous-хэширование по REPLICA_COUNT: при добавлении реплики
+переезжает примерно 1/N шардов), и её ShardConsumer читает потоки своих
+шардов через consumer group. Апдейт подтверждается (XACK) только после
+обработки, поэтому прочитанное, но не обработанное упавшей репликой
+дочитывается после её перезапуска.
+
+Внутри реплики OrderedUpdateFeeder передаёт апдейты в Dispatcher: по порядку
+для одного пользователя, параллельно (до max_concurrency) для разных.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from aiogram import Bot, Dispatcher
+
+from .user_queue import SubmitResult, UserWorkQueue
+
+logger = logging.getLogger(__name__)
+
+UPDATE_STREAM_PREFIX = "relove:updates:"
+UPDATE_CONSUMER_GROUP = "relove-bot"
+
+Ack = Callable[[], Awaitable[Any]]
+
+
+def update_shard_key(update: Dict[str, Any]) -> int:
+    """Чей апдейт: id пользователя, иначе id чата, иначе сам update_id"""
+    for name, payload in update.items():
+        if name == "update_id" or not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return int(user["id"])
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return int(chat["id"])
+    return int(update.get("update_id", 0))
+
+
+def _stable_hash(value: str) -> int:
+    # Одинаковый во всех процессах (в отличие от hash()) и без перекосов на похожих строках (в отличие от crc32)
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+def shard_of(key: int, shards: int) -> int:
+    """Шард пользователя"""
+    return _stable_hash(str(key)) % shards
+
+
+def shard_owner(shard: int, replica_count: int) -> int:
+    """Реплика-владелец шарда: та, у которой наибольший хэш пары (шард, реплика)"""
+    return max(range(replica_count), key=lambda replica: _stable_hash(f"{shard}:{replica}"))
+
+
+def owned_shards(replica_index: int, replica_count: int, shards: int) -> List[int]:
+    """Шарды, которые читает реплика replica_index"""
+    return [shard for shard in range(shards) if shard_owner(shard, replica_count) == replica_index]
+
+
+class OrderedUpdateFeeder:
+    """
+    Передаёт апдейты в Dispatcher по порядку внутри пользователя.
+
+    Args:
+        dispatcher: Dispatcher бота
+        bot: Бот, от имени которого обрабатываются апдейты
+        max_concurrency: Сколько пользователей обслуживается одновременно
+        max_inflight: Сколько апдейтов может быть принято и не обработано
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrency: int = 50, max_inflight: int = 200):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.max_inflight = max(1, max_inflight)
+        self.inflight = 0
+        self._queue: UserWorkQueue[Tuple[Dict[str, Any], Optional[Ack]]] = UserWorkQueue(
+            self._process,
+            max_concurrency=max_concurrency,
+            max_per_user=self.max_inflight,
+            max_pending=self.max_inflight,
+            merge_window=0,
+        )
+        self._stats = {"processed": 0, "failed": 0}
+
+    @property
+    def has_room(self) -> bool:
+        return self.inflight < self.max_inflight
+
+    def submit(self, update: Dict[str, Any], done: Optional[Ack] = None) -> SubmitResult:
+        """Ставит апдейт в очередь его пользователя; done вызывается после обработки"""
+        result = self._queue.submit(update_shard_key(update), (update, done))
+        if result is SubmitResult.QUEUED:
+            self.inflight += 1
+        return result
+
+    async def _process(self, key: int, items: List[Tuple[Dict[str, Any], Optional[Ack]]]) -> None:
+        for update, done in items:
+            try:
+                await self.dispatcher.feed_raw_update(self.bot, update)
+            except Exception as e:
+                self._stats["failed"] += 1
+                logger.error(f"Ошибка обработки апдейта {update.get('update_id')}: {e}", exc_info=True)
+            finally:
+                self.inflight -= 1
+                self._stats["processed"] += 1
+            if done is not None:
+                try:
+                    await done()
+                except Exception as e:
+                    logger.warning(f"Не удалось подтвердить апдейт {update.get('update_id')}: {e}")
+
+    async def close(self, timeout: float = 30.0) -> None:
+        await self._queue.close(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        queue = self._queue.stats()
+        return {
+            **self._stats,
+            "inflight": self.inflight,
+            "max_running": queue["max_running"],
+            "avg_wait_ms": queue["avg_wait_ms"],
+        }
+
+
+class ShardedUpdateStream:
+    """
+    Потоки апдейтов по шардам в Redis.
+
+    Args:
+        redis: Асинхронный клиент Redis (redis.asyncio)
+        shards: Число шардов (одинаковое на всех репликах)
+        maxlen: Сколько апдейтов хранит поток одного шарда (приблизительно)
+        prefix: Префикс ключей потоков
+    """
+
+    def __init__(self, redis, shards: int = 64, maxlen: int = 10000, prefix: str = UPDATE_STREAM_PREFIX):
+        self.redis = redis
+        self.shards = max(1, shards)
+        self.maxlen = maxlen
+        self.prefix = prefix
+        self.published = 0
+
+    def key(self, shard: int) -> str:
+        return f"{self.prefix}{shard}"
+
+    async def publish(self, update: Dict[str, Any]) -> int:
+        """Кладёт апдейт в поток его шарда; возвращает номер шарда"""
+        shard = shard_of(update_shard_key(update), self.shards)
+        await self.redis.xadd(
+            self.key(shard),
+            {"update": json.dumps(update, ensure_ascii=False)},
+            maxlen=self.maxlen,
+            approximate=True,
+        )
+        self.published += 1
+        return shard
+
+
+class ShardConsumer:
+    """
+    Читает потоки шардов реплики и передаёт апдейты в OrderedUpdateFeeder.
+
+    Новые апдейты читаются, только пока у feeder есть место, — при перегрузке
+    они ждут в Redis, а не в памяти реплики.
+
+    Args:
+        stream: Потоки апдейтов
+        feeder: Кому передавать апдейты
+        shards: Шарды этой реплики
+        consumer: Имя читателя в consumer group (постоянное для реплики)
+        block_ms: Сколько Redis ждёт новых апдейтов в одном XREADGROUP
+        idle_interval: Пауза, когда читать нечего или некуда
+        claim_idle_ms: Чужие неподтверждённые апдейты старше этого забираются при запуске
+        retry_interval: Пауза перед повтором после ошибки Redis
+    """
+
+    def __init__(
+        self,
+        stream: ShardedUpdateStream,
+        feeder: OrderedUpdateFeeder,
+        shards: Iterable[int],
+        consumer: str = "replica-0",
+        block_ms: int = 1000,
+        idle_interval: float = 0.05,
+        claim_idle_ms: int = 60000,
+        retry_interval: float = 1.0,
+    ):
+        self.stream = stream
+        self.feeder = feeder
+        self.keys = [stream.key(shard) for shard in shards]
+        self.consumer = consumer
+        self.block_ms = block_ms
+        self.idle_interval = idle_interval
+        self.claim_idle_ms = claim_idle_ms
+        self.retry_interval = retry_interval
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._stats = {"consumed": 0, "acked": 0, "recovered": 0, "claimed": 0, "bad": 0}
+
+    async def start(self) -> None:
+        from redis.exceptions import ResponseError
+
+        for key in self.keys:
+            try:
+                await self.stream.redis.xgroup_create(key, UPDATE_CONSUMER_GROUP, id="0", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+        self._task = asyncio.create_task(self._run(), name=f"shard-consumer-{self.consumer}")
+        logger.info(f"Реплика {self.consumer} читает {len(self.keys)} шардов апдейтов")
+
+    async def _run(self) -> None:
+        recovering = True
+        while not self._stopping:
+            try:
+                if recovering:
+                    # Один раз и до новых: апдейты, прочитанные, но не подтверждённые до перезапуска
+                    recovering = False
+                    await self._claim_abandoned()
+                    await self._read_pending()
+                if not self.keys or not self.feeder.has_room or not await self._read(self.block_ms):
+                    await asyncio.sleep(self.idle_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка чтения шардов апдейтов: {e}")
+                await asyncio.sleep(self.retry_interval)
+
+    async def _claim_abandoned(self) -> None:
+        """Забирает апдейты, которые читала другая реплика (до смены REPLICA_COUNT) и не подтвердила"""
+        for key in self.keys:
+            start = "0-0"
+            while True:
+                response = await self.stream.redis.xautoclaim(
+                    key, UPDATE_CONSUMER_GROUP, self.consumer, self.claim_idle_ms, start_id=start, count=100,
+                )
+                start, claimed = response[0], response[1]
+                self._stats["claimed"] += len(claimed)
+                if not claimed or start in (b"0-0", "0-0"):
+                    break
+
+    async def _read_pending(self) -> None:
+        cursors = {key: "0" for key in self.keys}
+        while cursors and not self._stopping:
+            while not self.feeder.has_room:
+                await asyncio.sleep(self.idle_interval)
+            response = await self.stream.redis.xreadgroup(
+                UPDATE_CONSUMER_GROUP, self.consumer, cursors, count=self.feeder.max_inflight - self.feeder.inflight,
+            )
+            for key, entries in response or []:
+                key = key.decode() if isinstance(key, bytes) else key
+                if not entries:
+                    cursors.pop(key, None)
+                    continue
+                cursors[key] = entries[-1][0]
+                self._stats["recovered"] += len(entries)
+                await self._submit(key, entries)
+
+    async def _read(self, block_ms: int) -> int:
+        response = await self.stream.redis.xreadgroup(
+            UPDATE_CONSUMER_GROUP, self.consumer, {key: ">" for key in self.keys},
+            count=self.feeder.max_inflight - self.feeder.inflight, block=block_ms,
+        )
+        read = 0
+        for key, entries in response or []:
+            key = key.decode() if isinstance(key, bytes) else key
+            read += len(entries)
+            await self._submit(key, entries)
+        return read
+
+    async def _submit(self, key: str, entries: List[Tuple[Any, Dict[Any, Any]]]) -> None:
+        for entry_id, fields in entries:
+            self._stats["consumed"] += 1
+            ack = partial(self._ack, key, entry_id)
+            try:
+                update = json.loads(fields.get(b"update") or fields.get("update"))
+            except (TypeError, ValueError):
+                self._stats["bad"] += 1
+                logger.warning(f"Повреждённый апдейт {entry_id} в {key} — пропущен")
+                await ack()
+                continue
+            if self.feeder.submit(update, ack) is SubmitResult.REJECTED:
+                # Места нет — апдейт остаётся неподтверждённым и будет прочитан после перезапуска
+                logger.warning(f"Апдейт {entry_id} из {key} не принят в обработку")
+
+    async def _ack(self, key: str, entry_id: Any) -> None:
+        await self.stream.redis.xack(key, UPDATE_CONSUMER_GROUP, entry_id)
+        self._stats["acked"] += 1
+
+    async def stop(self) -> None:
+        """Перестаёт читать новые апдейты (уже принятые дорабатывает feeder)"""
+        if self._task is None:
+            return
+        # Флаг — на случай, если клиент Redis поглотит отмену посреди команды
+        self._stopping = True
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "shards": len(self.keys)}
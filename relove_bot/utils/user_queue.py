@@ -0,0 +1,171 @@
+"""
+Очередь свободных сообщений по пользователям.
+
+Раньше каждое сообщение запускало свою фоновую задачу: два быстрых
+сообщения одного пользователя обгоняли друг друга в LLM и в истории сессии,
+а поток пользователей порождал неограниченное число задач. UserWorkQueue
+держит у каждого пользователя свою очередь и одного обработчика:
+
+- сообщения одного пользователя обрабатываются строго по порядку;
+- разные пользователи обрабатываются параллельно, но не больше
+  max_concurrency ходов одновременно;
+- серия быстрых сообщений склеивается в один ход: обработчик ждёт
+  merge_window секунд тишины (не дольше max_merge_wait) и забирает всё,
+  что пришло, а сообщения, пришедшие во время хода, образуют следующий;
+- при переполнении (max_per_user у пользователя или max_pending всего)
+  сообщение не ставится в очередь — обработчик отвечает, что бот занят.
+"""
+import asyncio
+import enum
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Generic, List, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# (user_id, сообщения хода по порядку) -> обработка одного хода
+TurnHandler = Callable[[int, List[T]], Awaitable[None]]
+
+
+class SubmitResult(enum.Enum):
+    """Что стало с сообщением"""
+    QUEUED = "queued"
+    REJECTED = "rejected"
+
+
+class UserWorkQueue(Generic[T]):
+    """
+    Очередь ходов по пользователям с общим лимитом параллельности.
+
+    Args:
+        handler: Обработка хода: user_id и склеенные сообщения
+        max_concurrency: Сколько ходов разных пользователей идёт одновременно
+        max_per_user: Сколько сообщений может ждать у одного пользователя
+        max_pending: Сколько сообщений может ждать всего
+        merge_window: Сколько секунд тишины ждать, прежде чем начать ход
+        max_merge_wait: Дольше этого ход не откладывается ради склейки
+    """
+
+    def __init__(
+        self,
+        handler: TurnHandler,
+        max_concurrency: int = 20,
+        max_per_user: int = 5,
+        max_pending: int = 500,
+        merge_window: float = 0.4,
+        max_merge_wait: float = 2.0,
+    ):
+        self.handler = handler
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_per_user = max(1, max_per_user)
+        self.max_pending = max(1, max_pending)
+        self.merge_window = max(0.0, merge_window)
+        self.max_merge_wait = max(self.merge_window, max_merge_wait)
+        self._queues: Dict[int, Deque[Tuple[float, T]]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._arrived: Dict[int, asyncio.Event] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._pending = 0
+        self._running = 0
+        self._stats = {
+            "submitted": 0, "rejected": 0, "turns": 0, "merged": 0, "failed": 0, "max_running": 0,
+        }
+        self._wait_time = 0.0
+
+    def submit(self, user_id: int, item: T) -> SubmitResult:
+        """Ставит сообщение в очередь пользователя (не ждёт обработки)"""
+        queue = self._queues.get(user_id)
+        if (queue is not None and len(queue) >= self.max_per_user) or self._pending >= self.max_pending:
+            self._stats["rejected"] += 1
+            logger.warning(
+                f"Очередь сообщений переполнена (пользователь {user_id}: {len(queue or ())}, "
+                f"всего {self._pending}) — сообщение отклонено"
+            )
+            return SubmitResult.REJECTED
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+        queue.append((time.monotonic(), item))
+        self._pending += 1
+        self._stats["submitted"] += 1
+        if user_id in self._arrived:
+            self._arrived[user_id].set()
+        worker = self._workers.get(user_id)
+        if worker is None or worker.done():
+            self._workers[user_id] = asyncio.create_task(self._work(user_id), name=f"user-queue-{user_id}")
+        return SubmitResult.QUEUED
+
+    async def _settle(self, user_id: int) -> None:
+        """Ждёт, пока пользователь перестанет присылать сообщения"""
+        if not self.merge_window:
+            return
+        arrived = self._arrived.setdefault(user_id, asyncio.Event())
+        deadline = time.monotonic() + self.max_merge_wait
+        while True:
+            arrived.clear()
+            timeout = min(self.merge_window, deadline - time.monotonic())
+            if timeout <= 0:
+                return
+            try:
+                await asyncio.wait_for(arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+            if len(self._queues.get(user_id, ())) >= self.max_per_user:
+                return
+
+    async def _work(self, user_id: int) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        try:
+            while self._queues.get(user_id):
+                await self._settle(user_id)
+                async with self._semaphore:
+                    queue = self._queues.get(user_id)
+                    if not queue:
+                        break
+                    batch = list(queue)
+                    queue.clear()
+                    self._pending -= len(batch)
+                    now = time.monotonic()
+                    self._wait_time += sum(now - queued_at for queued_at, _ in batch)
+                    self._stats["turns"] += 1
+                    self._stats["merged"] += len(batch) - 1
+                    self._running += 1
+                    self._stats["max_running"] = max(self._stats["max_running"], self._running)
+                    try:
+                        await self.handler(user_id, [item for _, item in batch])
+                    except Exception as e:
+                        self._stats["failed"] += 1
+                        logger.error(f"Ошибка обработки сообщений пользователя {user_id}: {e}", exc_info=True)
+                    finally:
+                        self._running -= 1
+        finally:
+            if not self._queues.get(user_id):
+                self._queues.pop(user_id, None)
+                self._arrived.pop(user_id, None)
+            if self._workers.get(user_id) is asyncio.current_task():
+                del self._workers[user_id]
+
+    async def close(self, timeout: float = 30.0) -> None:
+        """Дожидается текущих ходов (не дольше timeout), остальные отменяет"""
+        workers = [task for task in self._workers.values() if not task.done()]
+        if not workers:
+            return
+        done, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Очередь сообщений: отменено {len(pending)} незавершённых обработчиков")
+
+    def stats(self) -> Dict[str, Any]:
+        turns = self._stats["turns"]
+        items = self._stats["submitted"] - self._pending
+        return {
+            **self._stats,
+            "pending": self._pending,
+            "users": len(self._queues),
+            "running": self._running,
+            "avg_wait_ms": round(self._wait_time / items * 1000, 1) if items and turns else 0.0,
+        }
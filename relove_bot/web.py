@@ -14,6 +14,8 @@ from aiohttp.web_request import Request
 from aiohttp.web_response import Response
 from aiohttp.web import HTTPFound
 from .config import settings
+from .utils.llm_scheduler import LLMPriority, llm_priority
+from .utils.llm_telemetry import get_llm_telemetry, llm_caller
 from datetime import datetime
 from sqlalchemy import text
 
@@ -422,6 +424,41 @@ async def users_gallery_api(request: web.Request):
 
         return web.json_response(data)
 
+async def llm_stats_api(request: web.Request):
+    """Статистика работы с LLM: бэкенды, планировщик, лимиты, кэш"""
+    from relove_bot.rag.embeddings import get_embedding_stats
+    from relove_bot.rag.llm_router import get_llm_router
+    from relove_bot.rag.local_worker import get_local_inference_stats
+    from relove_bot.utils.batch_classifier import get_batch_classifier_stats
+    from relove_bot.utils.llm_cache import get_llm_cache
+    from relove_bot.utils.llm_scheduler import get_llm_scheduler
+    from relove_bot.utils.prompt_budget import get_prompt_budget_stats
+    from relove_bot.utils.prompt_prefix import get_prompt_prefix_stats
+    from relove_bot.utils.rate_limiter import get_llm_limiter
+    from relove_bot.utils.semantic_cache import get_semantic_cache
+    from relove_bot.utils.single_flight import get_single_flight
+    from relove_bot.utils.structured_output import get_structured_output_stats
+
+    return web.json_response({
+        'router': get_llm_router().stats(),
+        'scheduler': get_llm_scheduler().stats(),
+        'rate_limiter': get_llm_limiter().stats(),
+        'cache': get_llm_cache().stats(),
+        'single_flight': get_single_flight().stats(),
+        'prompt_budget': get_prompt_budget_stats(),
+        'prompt_prefix': get_prompt_prefix_stats(),
+        'batch_classifier': get_batch_classifier_stats(),
+        'structured_output': get_structured_output_stats(),
+        'local_inference': get_local_inference_stats(),
+        'embeddings': get_embedding_stats(),
+        'semantic_cache': get_semantic_cache().stats(),
+        'telemetry': get_llm_telemetry().stats(),
+    })
+
+async def llm_metrics_api(request: web.Request):
+    """Телеметрия вызовов LLM в формате Prometheus"""
+    return web.Response(text=get_llm_telemetry().prometheus(), content_type='text/plain', charset='utf-8')
+
 async def setup_webhook(bot: Bot, dispatcher: Dispatcher):
     if not settings.webhook_host:
         logger.warning("WEBHOOK_HOST not set, skipping webhook setup.")
@@ -465,6 +502,8 @@ async def on_shutdown(app: web.Application):
     #    logger.info("Database pool closed.")
     await bot.session.close()
     logger.info("Bot session closed.")
+    from relove_bot.utils.http_client import close_http_session
+    await close_http_session()
     logger.info("Web server shutdown complete.")
 
 def b64encode(value):
@@ -507,8 +546,9 @@ async def analyze_gender_middleware(request, handler):
             users = await session.execute("SELECT id FROM users WHERE gender IS NULL")
             users = [row[0] for row in users.fetchall()]
             gender_service = GenderAnalysisService(session)
-            for uid in users:
-                await gender_service.analyze_and_save_gender(uid)
+            with llm_priority(LLMPriority.BATCH), llm_caller("gender"):
+                for uid in users:
+                    await gender_service.analyze_and_save_gender(uid)
         raise web.HTTPFound('/admin')
     return await handler(request)
 
@@ -717,7 +757,8 @@ async def automation_settings(request: web.Request):
             
             async with AsyncSessionFactory() as session:
                 service = ProfileRotationService(session)
-                await service.rotate_profiles()
+                with llm_priority(LLMPriority.BATCH), llm_caller("rotation"):
+                    await service.rotate_profiles()
                 
                 return web.json_response({
                     'success': True,
@@ -765,6 +806,8 @@ def create_dashboard_app() -> web.Application:
     app.router.add_post('/api/user/{user_id}/status', update_user_status)
     app.router.add_post('/api/streams/manage', manage_streams)
     app.router.add_post('/api/automation/settings', automation_settings)
+    app.router.add_get('/api/llm/stats', llm_stats_api)
+    app.router.add_get('/api/llm/metrics', llm_metrics_api)
 
 
     # Добавляем обработчики startup и shutdown
@@ -820,6 +863,8 @@ def create_app(bot: Bot, dp: Dispatcher) -> web.Application:
     app.router.add_post('/api/user/{user_id}/status', update_user_status)
     app.router.add_post('/api/streams/manage', manage_streams)
     app.router.add_post('/api/automation/settings', automation_settings)
+    app.router.add_get('/api/llm/stats', llm_stats_api)
+    app.router.add_get('/api/llm/metrics', llm_metrics_api)
 
     # Настраиваем приложение aiogram (необходимо для SimpleRequestHandler)
     setup_application(app, dp, bot=bot)
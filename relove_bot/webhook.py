@@ -0,0 +1,156 @@
+"""
+Приём апдейтов через webhook (BOT_MODE=webhook).
+
+POST на WEBHOOK_PATH проверяет секрет Telegram и сразу отвечает 200:
+- с Redis (USE_REDIS) апдейт кладётся в поток своего шарда, а обрабатывает
+  его реплика-владелец шарда (см. utils/update_sharding.py) — реплик может
+  быть сколько угодно, FSM общий и переживает перезапуск;
+- без Redis апдейт обрабатывает эта же реплика (по порядку внутри
+  пользователя); при перегрузке отвечаем 503, и Telegram повторит доставку.
+
+Webhook у Telegram регистрирует только реплика с REPLICA_INDEX=0.
+"""
+import asyncio
+import logging
+import signal
+from typing import Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.redis import RedisStorage
+from aiohttp import web
+
+from .config import settings
+from .utils.update_sharding import OrderedUpdateFeeder, ShardConsumer, ShardedUpdateStream, owned_shards
+from .utils.user_queue import SubmitResult
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+async def handle_update(request: web.Request) -> web.Response:
+    secret = settings.webhook_secret
+    if secret and request.headers.get(SECRET_HEADER) != secret.get_secret_value():
+        return web.Response(status=401)
+    try:
+        update = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+
+    stream: Optional[ShardedUpdateStream] = request.app['update_stream']
+    if stream is not None:
+        try:
+            await stream.publish(update)
+        except Exception as e:
+            logger.error(f"Не удалось положить апдейт {update.get('update_id')} в Redis: {e}")
+            return web.Response(status=503)
+    elif request.app['update_feeder'].submit(update) is SubmitResult.REJECTED:
+        return web.Response(status=503)
+    return web.Response()
+
+
+async def health_check(request: web.Request) -> web.Response:
+    return web.json_response({
+        'replica': request.app['replica_index'],
+        'feeder': request.app['update_feeder'].stats(),
+        'consumer': request.app['shard_consumer'].stats() if request.app['shard_consumer'] else None,
+    })
+
+
+async def _start_consumer(app: web.Application) -> None:
+    if app['shard_consumer'] is not None:
+        await app['shard_consumer'].start()
+
+
+async def _stop_consumer(app: web.Application) -> None:
+    # Сначала перестаём читать шарды, потом дорабатываем принятые апдейты
+    if app['shard_consumer'] is not None:
+        await app['shard_consumer'].stop()
+    await app['update_feeder'].close()
+
+
+def create_webhook_app(
+    bot: Bot,
+    dp: Dispatcher,
+    redis=None,
+    replica_index: Optional[int] = None,
+    replica_count: Optional[int] = None,
+) -> web.Application:
+    """
+    Создаёт aiohttp-приложение webhook одной реплики.
+
+    :param redis: Клиент Redis для шардирования (None — апдейты обрабатываются на месте)
+    :param replica_index: Номер реплики (по умолчанию REPLICA_INDEX)
+    :param replica_count: Число реплик (по умолчанию REPLICA_COUNT)
+    """
+    replica_index = settings.replica_index if replica_index is None else replica_index
+    replica_count = settings.replica_count if replica_count is None else replica_count
+
+    app = web.Application()
+    app['replica_index'] = replica_index
+    app['update_feeder'] = feeder = OrderedUpdateFeeder(
+        dp, bot, max_concurrency=settings.update_max_concurrency, max_inflight=settings.update_max_inflight,
+    )
+    app['update_stream'] = app['shard_consumer'] = None
+    if redis is not None:
+        app['update_stream'] = stream = ShardedUpdateStream(
+            redis, shards=settings.update_shards, maxlen=settings.update_stream_maxlen,
+        )
+        app['shard_consumer'] = ShardConsumer(
+            stream, feeder, owned_shards(replica_index, replica_count, stream.shards),
+            consumer=f"replica-{replica_index}",
+        )
+    elif replica_count > 1:
+        logger.warning("REPLICA_COUNT > 1 без USE_REDIS: апдейты не шардируются, порядок и FSM не гарантированы")
+
+    app.router.add_post(settings.webhook_path, handle_update)
+    app.router.add_get('/healthz', health_check)
+    app.on_startup.append(_start_consumer)
+    app.on_shutdown.append(_stop_consumer)
+    return app
+
+
+async def register_webhook(bot: Bot, dp: Dispatcher) -> bool:
+    """Сообщает Telegram адрес webhook (WEBHOOK_HOST + WEBHOOK_PATH)"""
+    if not settings.webhook_host:
+        logger.warning("WEBHOOK_HOST не задан — webhook должен быть зарегистрирован вручную")
+        return False
+    url = f"{str(settings.webhook_host).rstrip('/')}{settings.webhook_path}"
+    await bot.set_webhook(
+        url=url,
+        secret_token=settings.webhook_secret.get_secret_value() if settings.webhook_secret else None,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logger.info(f"Webhook зарегистрирован: {url}")
+    return True
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher) -> None:
+    """Поднимает webhook-сервер реплики и работает до отмены"""
+    redis = dp.storage.redis if isinstance(dp.storage, RedisStorage) else None
+    app = create_webhook_app(bot, dp, redis)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, settings.web_server_host, settings.web_server_port).start()
+        logger.info(
+            f"Webhook-сервер реплики {settings.replica_index}/{settings.replica_count} слушает "
+            f"{settings.web_server_host}:{settings.web_server_port}{settings.webhook_path}"
+            f"{' (шардирование через Redis)' if redis is not None else ''}"
+        )
+        if settings.replica_index == 0:
+            try:
+                await register_webhook(bot, dp)
+            except Exception as e:
+                logger.error(f"Не удалось зарегистрировать webhook: {e}")
+        # Как и start_polling, по SIGTERM/SIGINT штатно останавливаемся (дорабатывая принятые апдейты)
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        await stop.wait()
+        logger.info("Webhook-сервер останавливается...")
+    finally:
+        await runner.cleanup()
@@ -29,6 +29,7 @@ import io
 
 # === ДОБАВЛЕНО: импорт для LLM ===
 from relove_bot.services.llm_service import llm_service
+from relove_bot.utils.prompt_budget import count_tokens
 
 # Настройка логирования
 logging.basicConfig(
@@ -1863,23 +1864,23 @@ class ChatAnalyzerLLM:
                             parts.append(str(x['text']))
                 return " ".join(parts)
             return str(t)
-        MAX_CHARS = 20000  # лимит символов на батч
-        def split_batches(messages, max_chars):
+        MAX_TOKENS = 6000  # бюджет токенов сообщений на батч
+        def split_batches(messages, max_tokens):
             batch = []
             total = 0
             for msg in messages:
-                text = msg_text_to_str(msg)
-                if total + len(text) > max_chars and batch:
+                tokens = count_tokens(msg_text_to_str(msg), llm_service.model)
+                if total + tokens > max_tokens and batch:
                     yield batch
                     batch = []
                     total = 0
                 batch.append(msg)
-                total += len(text)
+                total += tokens
             if batch:
                 yield batch
         for user_id, user_messages in users.items():
             all_answers = []
-            for batch in split_batches(user_messages, MAX_CHARS):
+            for batch in split_batches(user_messages, MAX_TOKENS):
                 user_text = "\n".join([msg_text_to_str(msg) for msg in batch if msg_text_to_str(msg)])
                 prompt = (
                     "На основе сообщений пользователя, строго в формате:\n"
@@ -2055,23 +2056,23 @@ class ShortAnalyzer:
                             parts.append(str(x['text']))
                 return " ".join(parts)
             return str(t)
-        MAX_CHARS = 20000
-        def split_batches(messages, max_chars):
+        MAX_TOKENS = 6000  # бюджет токенов сообщений на батч
+        def split_batches(messages, max_tokens):
             batch = []
             total = 0
             for msg in messages:
-                text = msg_text_to_str(msg)
-                if total + len(text) > max_chars and batch:
+                tokens = count_tokens(msg_text_to_str(msg), llm_service.model)
+                if total + tokens > max_tokens and batch:
                     yield batch
                     batch = []
                     total = 0
                 batch.append(msg)
-                total += len(text)
+                total += tokens
             if batch:
                 yield batch
         for user_id, user_messages in users.items():
             all_answers = []
-            for batch in split_batches(user_messages, MAX_CHARS):
+            for batch in split_batches(user_messages, MAX_TOKENS):
                 user_text = "\n".join([msg_text_to_str(msg) for msg in batch if msg_text_to_str(msg)])
                 prompt = SHORT_ANALYSIS_PROMPT.format(user_text=user_text)
                 analysis = await llm_service.analyze_text(prompt=prompt, system_prompt=None, max_tokens=512)
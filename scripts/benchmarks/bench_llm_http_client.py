@@ -0,0 +1,132 @@
+"""
+Бенчмарк HTTP-клиента LLM: новая aiohttp.ClientSession на каждый запрос
+против общего keep-alive пула (relove_bot.utils.http_client.SharedHTTPClient).
+
+Поднимает локальный mock /chat/completions и меряет p50/p99 латентности.
+Mock работает по plain HTTP, поэтому выигрыш занижен: в проде к TCP-хендшейку
+добавляется ещё и TLS до OpenRouter.
+
+Запуск:
+    python scripts/benchmarks/bench_llm_http_client.py --requests 500 --concurrency 10
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from relove_bot.utils.http_client import SharedHTTPClient
+
+MOCK_RESPONSE = {
+    "id": "chatcmpl-bench",
+    "object": "chat.completion",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11},
+}
+
+PAYLOAD = {
+    "model": "bench",
+    "messages": [{"role": "user", "content": "Привет"}],
+    "max_tokens": 1,
+}
+
+
+async def _mock_chat_completions(request: web.Request) -> web.Response:
+    await request.read()
+    return web.json_response(MOCK_RESPONSE)
+
+
+async def start_mock_server(port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", _mock_chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_per_call_session(url: str, total: int, concurrency: int) -> list:
+    """Старое поведение: новая ClientSession на каждый запрос"""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            async with aiohttp.ClientSession() as session:
+                async with session.post(url, json=PAYLOAD) as response:
+                    await response.json()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(one() for _ in range(total)))
+    return latencies
+
+
+async def run_shared_session(url: str, total: int, concurrency: int) -> list:
+    """Новое поведение: одна сессия с keep-alive пулом на процесс"""
+    client = SharedHTTPClient(limit_per_host=concurrency)
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            session = await client.get_session()
+            async with session.post(url, json=PAYLOAD) as response:
+                await response.json()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    try:
+        await asyncio.gather(*(one() for _ in range(total)))
+    finally:
+        await client.close()
+    return latencies
+
+
+def report(name: str, latencies: list, elapsed: float) -> None:
+    print(
+        f"{name:<22} n={len(latencies):<6} "
+        f"p50={percentile(latencies, 50):7.2f}ms "
+        f"p99={percentile(latencies, 99):7.2f}ms "
+        f"mean={statistics.mean(latencies):7.2f}ms "
+        f"rps={len(latencies) / elapsed:8.1f}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--port", type=int, default=18089)
+    args = parser.parse_args()
+
+    runner = await start_mock_server(args.port)
+    url = f"http://127.0.0.1:{args.port}/v1/chat/completions"
+    try:
+        for name, runner_func in (
+            ("session-per-call", run_per_call_session),
+            ("shared-pool", run_shared_session),
+        ):
+            started = time.perf_counter()
+            latencies = await runner_func(url, args.requests, args.concurrency)
+            report(name, latencies, time.perf_counter() - started)
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,288 @@
+"""
+Локальный OpenAI-совместимый сервер-заглушка для нагрузочных тестов.
+
+Отвечает на /v1/chat/completions (обычный и потоковый режим) короткими
+репликами в стиле Наташи, не тратя платные токены. Латентность берётся из
+заданного распределения, в потоке токены идут с паузой между фрагментами,
+часть запросов можно завершать 429 (с Retry-After) или 5xx — чтобы проверить
+повторы, переключение бэкендов и circuit breaker под нагрузкой.
+
+Если в системном промпте есть JSON Schema (структурированный ответ, см.
+relove_bot.utils.structured_output), заглушка возвращает объект,
+собранный по этой схеме.
+
+Запуск отдельно:
+    python scripts/loadtest/mock_llm_server.py --port 18090 --latency lognormal --latency-ms 800 --rate-429 0.05
+
+Статистика запросов: GET /stats
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from collections import Counter
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+PERSONA_REPLIES = [
+    "А что ты на самом деле хочешь услышать?",
+    "Ты опять спасаешься. От чего?",
+    "Интересно. И где в этом ты сам?",
+    "Стоп. Ты сейчас говоришь из головы, а не из тела.",
+    "Хорошо. А если это не случайность, а твой выбор?",
+    "Чайку попить. А потом честно ответить себе: зачем тебе это?",
+    "Ты правда веришь в то, что сейчас написал?",
+    "Я слышу страх. Давай посмотрим на него прямо.",
+]
+
+_SCHEMA_RE = re.compile(r"JSON Schema ответа:\s*(\{.*\})\s*$", re.DOTALL)
+
+
+@dataclass
+class MockLLMConfig:
+    """Параметры заглушки"""
+    latency: str = "lognormal"  # fixed | uniform | exponential | lognormal
+    latency_ms: float = 600.0  # медиана (fixed/lognormal), среднее (exponential), верхняя граница (uniform)
+    latency_sigma: float = 0.5  # разброс lognormal
+    token_delay_ms: float = 15.0  # пауза между фрагментами потока
+    rate_429: float = 0.0  # доля ответов 429
+    rate_5xx: float = 0.0  # доля ответов 500/502/503
+    retry_after: float = 1.0  # Retry-After для 429, сек
+    seed: Optional[int] = None
+
+
+class MockLLMServer:
+    """OpenAI-совместимая заглушка на aiohttp"""
+
+    def __init__(self, config: MockLLMConfig = None):
+        self.config = config or MockLLMConfig()
+        self.random = random.Random(self.config.seed)
+        self.counters: Counter = Counter()
+        self._runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+
+    def sample_latency(self) -> float:
+        """Задержка до первого байта, сек"""
+        cfg = self.config
+        if cfg.latency == "fixed":
+            value = cfg.latency_ms
+        elif cfg.latency == "uniform":
+            value = self.random.uniform(0, cfg.latency_ms)
+        elif cfg.latency == "exponential":
+            value = self.random.expovariate(1 / cfg.latency_ms) if cfg.latency_ms > 0 else 0.0
+        else:
+            value = self.random.lognormvariate(0, cfg.latency_sigma) * cfg.latency_ms
+        return max(0.0, value) / 1000
+
+    def _injected_error(self) -> Optional[web.Response]:
+        roll = self.random.random()
+        if roll < self.config.rate_429:
+            self.counters["status_429"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={"Retry-After": str(self.config.retry_after)},
+            )
+        if roll < self.config.rate_429 + self.config.rate_5xx:
+            status = self.random.choice((500, 502, 503))
+            self.counters[f"status_{status}"] += 1
+            return web.json_response({"error": {"message": "Upstream error (mock)", "type": "server_error"}}, status=status)
+        return None
+
+    def reply_text(self, messages: List[Dict[str, Any]]) -> str:
+        system = "\n".join(_message_text(m) for m in messages if m.get("role") == "system")
+        match = _SCHEMA_RE.search(system)
+        if match:
+            try:
+                return json.dumps(sample_from_schema(json.loads(match.group(1))), ensure_ascii=False)
+            except ValueError:
+                pass
+        return self.random.choice(PERSONA_REPLIES)
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.counters["requests"] += 1
+        await asyncio.sleep(self.sample_latency())
+        error = self._injected_error()
+        if error is not None:
+            return error
+
+        messages = body.get("messages") or []
+        text = self.reply_text(messages)
+        if body.get("response_format") and not text.startswith("{"):
+            text = json.dumps({"summary": text}, ensure_ascii=False)
+        usage = {
+            "prompt_tokens": sum(_estimate_tokens(_message_text(m)) for m in messages),
+            "completion_tokens": _estimate_tokens(text),
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        model = body.get("model") or "mock"
+
+        if not body.get("stream"):
+            self.counters["completions"] += 1
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        self.counters["streams"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None, **extra) -> bytes:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if delta is not None else [],
+                **extra,
+            }
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode()
+
+        await response.write(chunk({"role": "assistant", "content": ""}))
+        for piece in re.findall(r"\S+\s*", text):
+            await asyncio.sleep(self.config.token_delay_ms / 1000)
+            await response.write(chunk({"content": piece}))
+        await response.write(chunk({}, "stop"))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await response.write(chunk(None, usage=usage))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "loadtest"}]})
+
+    async def stats_handler(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    def stats(self) -> Dict[str, Any]:
+        return {"config": asdict(self.config), **self.counters}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/chat/completions", self.chat_completions)
+        app.router.add_get("/v1/models", self.models)
+        app.router.add_get("/stats", self.stats_handler)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер и возвращает base_url для клиента OpenAI"""
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{bound_port}/v1"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def _message_text(message: Dict[str, Any]) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return str(content)
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def sample_from_schema(schema: Dict[str, Any], root: Dict[str, Any] = None) -> Any:
+    """Минимальный объект, проходящий проверку JSON Schema (pydantic model_json_schema)"""
+    root = root or schema
+    if "$ref" in schema:
+        name = schema["$ref"].rsplit("/", 1)[-1]
+        return sample_from_schema(root.get("$defs", {}).get(name, {}), root)
+    if "default" in schema:
+        return schema["default"]
+    if "enum" in schema:
+        return schema["enum"][0]
+    if "const" in schema:
+        return schema["const"]
+    for key in ("anyOf", "oneOf", "allOf"):
+        if schema.get(key):
+            options = [option for option in schema[key] if option.get("type") != "null"] or schema[key]
+            return sample_from_schema(options[0], root)
+
+    kind = schema.get("type")
+    if kind == "object" or "properties" in schema:
+        return {name: sample_from_schema(prop, root) for name, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [sample_from_schema(schema["items"], root) for _ in range(schema.get("minItems", 0))] if "items" in schema else []
+    if kind == "integer":
+        return int(schema.get("minimum", 0))
+    if kind == "number":
+        return float(schema.get("minimum", 0))
+    if kind == "boolean":
+        return False
+    if kind == "null":
+        return None
+    return "заглушка"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18090)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockLLMServer(mock_config_from_args(args))
+    url = await server.start(args.host, args.port)
+    print(f"Mock LLM: {url} (статистика: {url[:-3]}/stats)")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser) -> None:
+    """Аргументы командной строки для MockLLMConfig (общие с run_loadtest.py)"""
+    defaults = MockLLMConfig()
+    parser.add_argument("--latency", choices=("fixed", "uniform", "exponential", "lognormal"), default=defaults.latency)
+    parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms)
+    parser.add_argument("--latency-sigma", type=float, default=defaults.latency_sigma)
+    parser.add_argument("--token-delay-ms", type=float, default=defaults.token_delay_ms)
+    parser.add_argument("--rate-429", type=float, default=defaults.rate_429)
+    parser.add_argument("--rate-5xx", type=float, default=defaults.rate_5xx)
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def mock_config_from_args(args: argparse.Namespace) -> MockLLMConfig:
+    return MockLLMConfig(
+        latency=args.latency,
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        token_delay_ms=args.token_delay_ms,
+        rate_429=args.rate_429,
+        rate_5xx=args.rate_5xx,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
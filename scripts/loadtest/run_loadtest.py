@@ -0,0 +1,429 @@
+"""
+Нагрузочный тест бота целиком без платных API и без Telegram.
+
+Поднимает mock_llm_server.py как единственный бэкенд LLM, подменяет сессию
+Bot API заглушкой и прогоняет синтетические апдейты через настоящий
+Dispatcher из relove_bot/bot.py — со всеми middleware и роутерами. Каждый
+виртуальный пользователь пишет /start, а затем сообщения, дожидаясь ответа
+бота перед следующим (как в живом чате); пользователи работают параллельно.
+
+Отчёт: апдейтов в секунду, p50/p95/p99 времени до первого ответа в чат,
+запросов к БД и вызовов LLM на апдейт (включая фоновые задачи, запущенные
+обработчиком апдейта), HTTP-запросов к заглушке LLM с учётом повторов,
+занятость пула соединений БД.
+
+По умолчанию используется временная SQLite-база (таблицы создаются);
+для проверки на Postgres передайте --db-url.
+
+Запуск:
+    python scripts/loadtest/run_loadtest.py --users 50 --messages 5 --latency-ms 800 --rate-429 0.02
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, AsyncGenerator, Dict, List, Optional, get_args, get_origin
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, Message, Update, User
+
+from mock_llm_server import MockLLMServer, add_mock_arguments, mock_config_from_args
+
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+
+USER_MESSAGES = [
+    "привет",
+    "не знаю, что со мной происходит",
+    "чувствую, что застрял на работе и ничего не хочу",
+    "а как понять, чего я на самом деле хочу?",
+    "мне страшно что-то менять",
+    "расскажи про потоки",
+    "спасибо, подумаю",
+]
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "reLove", "username": "relove_loadtest_bot"}
+
+
+@dataclass
+class UpdateStats:
+    """Счётчики одного апдейта (наследуются фоновыми задачами через contextvars)"""
+    db_queries: int = 0
+    api_calls: int = 0
+    llm_usage: Any = None  # LLMUsage из llm_usage_scope
+
+
+_current_update: contextvars.ContextVar[Optional[UpdateStats]] = contextvars.ContextVar("loadtest_update", default=None)
+
+
+class FakeTelegramSession(BaseSession):
+    """
+    Сессия Bot API без сети: отвечает на методы как Telegram и будит
+    ожидающих ответа в чате.
+    """
+
+    def __init__(self, api_latency: float = 0.0):
+        super().__init__()
+        self.api_latency = api_latency
+        self.calls: Counter = Counter()
+        self._message_id = 0
+        self._waiters: Dict[int, asyncio.Future] = {}
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = future
+        return future
+
+    async def close(self) -> None:
+        pass
+
+    async def make_request(self, bot, method: TelegramMethod, timeout: Optional[int] = None):
+        name = type(method).__name__
+        self.calls[name] += 1
+        stats = _current_update.get()
+        if stats is not None:
+            stats.api_calls += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+
+        chat_id = getattr(method, "chat_id", None)
+        result = self._result(method, chat_id)
+        if name.startswith("Send") and name != "SendChatAction" and chat_id is not None:
+            waiter = self._waiters.pop(int(chat_id), None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(time.perf_counter())
+
+        # Тот же разбор ответа, что у настоящей сессии
+        content = json.dumps({"ok": True, "result": result}, ensure_ascii=False)
+        return self.check_response(bot, method, 200, content).result
+
+    def _result(self, method: TelegramMethod, chat_id: Any) -> Any:
+        returning = method.__returning__
+        options = get_args(returning) or (returning,)
+        if Message in options:
+            self._message_id += 1
+            return {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id or 0), "type": "private"},
+                "from": BOT_USER,
+                "text": getattr(method, "text", None) or "",
+            }
+        if User in options:
+            return BOT_USER
+        if get_origin(returning) is list:
+            return []
+        return True
+
+    async def stream_content(self, url: str, headers=None, timeout: int = 30, chunk_size: int = 65536,
+                             raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        yield b""
+
+
+@dataclass
+class LoadTestResult:
+    updates: int = 0
+    replies: int = 0
+    timeouts: int = 0
+    errors: int = 0
+    elapsed: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+    per_update: List[UpdateStats] = field(default_factory=list)
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def make_update(update_id: int, user_id: int, message_id: int, text: str) -> Update:
+    user = User(id=user_id, is_bot=False, first_name=f"Нагрузка{user_id}", username=f"load_{user_id}", language_code="ru")
+    return Update(
+        update_id=update_id,
+        message=Message(
+            message_id=message_id,
+            date=datetime.now(),
+            chat=Chat(id=user_id, type="private", first_name=user.first_name),
+            from_user=user,
+            text=text,
+        ),
+    )
+
+
+async def run_user(dp, bot, session: FakeTelegramSession, user_id: int, messages: int, reply_timeout: float,
+                   think_time: float, result: LoadTestResult, update_ids) -> None:
+    from relove_bot.utils.llm_telemetry import llm_usage_scope
+
+    texts = ["/start"] + [USER_MESSAGES[(user_id + i) % len(USER_MESSAGES)] for i in range(messages)]
+    for message_id, text in enumerate(texts, start=1):
+        stats = UpdateStats()
+        token = _current_update.set(stats)
+        waiter = session.expect_reply(user_id)
+        started = time.perf_counter()
+        try:
+            with llm_usage_scope() as stats.llm_usage:
+                await dp.feed_update(bot, make_update(next(update_ids), user_id, message_id, text))
+        except Exception as e:
+            result.errors += 1
+            logging.getLogger(__name__).warning(f"Апдейт пользователя {user_id} упал: {e}")
+        finally:
+            _current_update.reset(token)
+        result.updates += 1
+        result.per_update.append(stats)
+        try:
+            replied_at = await asyncio.wait_for(waiter, reply_timeout)
+            result.replies += 1
+            result.latencies.append((replied_at - started) * 1000)
+        except asyncio.TimeoutError:
+            result.timeouts += 1
+        if think_time:
+            await asyncio.sleep(think_time)
+
+
+class PoolMonitor:
+    """Занятость пула соединений: сколько соединений выдано одновременно и в среднем по времени"""
+
+    def __init__(self):
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self._area = 0.0
+        self._since = self._started = time.perf_counter()
+
+    def _advance(self) -> None:
+        now = time.perf_counter()
+        self._area += self.checked_out * (now - self._since)
+        self._since = now
+
+    def on_checkout(self, dbapi_conn, record, proxy) -> None:
+        self._advance()
+        self.checked_out += 1
+        self.checkouts += 1
+        self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def on_checkin(self, dbapi_conn, record) -> None:
+        self._advance()
+        self.checked_out = max(0, self.checked_out - 1)
+
+    def stats(self) -> Dict[str, Any]:
+        self._advance()
+        elapsed = self._since - self._started
+        return {
+            "checkouts": self.checkouts,
+            "max_checked_out": self.max_checked_out,
+            "mean_checked_out": round(self._area / elapsed, 3) if elapsed else 0.0,
+        }
+
+
+def count_db_query(conn, cursor, statement, parameters, context, executemany) -> None:
+    stats = _current_update.get()
+    if stats is not None:
+        stats.db_queries += 1
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    workdir = Path(tempfile.mkdtemp(prefix="relove_loadtest_"))
+    mock = MockLLMServer(mock_config_from_args(args))
+    llm_url = await mock.start(port=args.mock_port)
+
+    # Настройки читаются при импорте relove_bot — окружение готовим до него
+    os.environ.update({
+        "LLM_API_BASE": llm_url,
+        "OPENAI_API_BASE": llm_url,
+        "LLM_API_KEY": "mock",
+        "LLM_BACKENDS": "[]",
+        "LOG_DIR": str(workdir / "logs"),
+        "LOG_LEVEL": args.log_level,
+        "DB_URL": args.db_url or f"sqlite+aiosqlite:///{workdir / 'loadtest.db'}",
+    })
+    for name, value in {
+        "BOT_TOKEN": "123456:loadtest",
+        "OUR_CHANNEL_ID": "0",
+        "DISCUSSION_CHANNEL_ID": "0",
+        "TG_API_ID": "1",
+        "TG_API_HASH": "loadtest",
+        "TG_SESSION": "loadtest",
+        # Лимиты ключа рассчитаны на платный API и исказили бы замер
+        "LLM_RATE_LIMIT_PER_MINUTE": "100000",
+        "LLM_RATE_LIMIT_PER_DAY": "0",
+    }.items():
+        os.environ.setdefault(name, value)
+    # Часть модулей пишет логи в текущую директорию
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    from relove_bot import bot as bot_module
+    from relove_bot.db.models import Base
+    from relove_bot.db.lazy_session import get_db_session_stats
+    from relove_bot.db.session import engine
+    from relove_bot.handlers import common
+    from relove_bot.db.write_behind import (
+        close_activity_log_writer, close_user_touch_coalescer, get_activity_log_writer, get_user_touch_coalescer,
+    )
+
+    logging.getLogger().setLevel(args.log_level)
+    if args.db_url is None or args.create_tables:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    event.listen(Engine, "before_cursor_execute", count_db_query)
+    pool_monitor = PoolMonitor()
+    event.listen(engine.sync_engine.pool, "checkout", pool_monitor.on_checkout)
+    event.listen(engine.sync_engine.pool, "checkin", pool_monitor.on_checkin)
+
+    session = FakeTelegramSession(api_latency=args.api_latency_ms / 1000)
+    bot = bot_module.bot
+    bot.session = session
+    dp = bot_module.dp
+
+    result = LoadTestResult()
+    update_ids = iter(range(1, 10 ** 9))
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(
+            run_user(dp, bot, session, 100000 + i, args.messages, args.reply_timeout, args.think_time / 1000, result, update_ids)
+            for i in range(args.users)
+        ))
+        result.elapsed = time.perf_counter() - started
+        # Очередь сообщений и буферы отложенной записи дописываются до ожидания фоновых задач
+        await common.close_message_queue()
+        await close_activity_log_writer()
+        await close_user_touch_coalescer()
+        write_behind = {
+            "activity_log": get_activity_log_writer().stats(),
+            "user_touches": get_user_touch_coalescer().stats(),
+            "db_pool": pool_monitor.stats(),
+            "db_sessions": get_db_session_stats(),
+            "message_queue": common.get_message_queue_stats(),
+        }
+        # Фоновые задачи обработчиков (профили, логи) досчитываются в статистику апдейтов
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if pending:
+            await asyncio.wait(pending, timeout=args.drain_timeout)
+    finally:
+        event.remove(Engine, "before_cursor_execute", count_db_query)
+        await mock.stop()
+        await engine.dispose()
+        os.chdir(cwd)
+        if args.keep_workdir:
+            print(f"Логи и база: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return build_report(result, mock.stats(), session.calls, write_behind)
+
+
+def build_report(
+    result: LoadTestResult, mock_stats: Dict[str, Any], api_calls: Counter, write_behind: Dict[str, Any]
+) -> Dict[str, Any]:
+    updates = max(result.updates, 1)
+    llm_calls = [stats.llm_usage.calls for stats in result.per_update if stats.llm_usage is not None]
+    db_queries = [stats.db_queries for stats in result.per_update]
+    return {
+        "updates": result.updates,
+        "replies": result.replies,
+        "reply_timeouts": result.timeouts,
+        "update_errors": result.errors,
+        "elapsed_sec": round(result.elapsed, 3),
+        "updates_per_sec": round(result.updates / result.elapsed, 2) if result.elapsed else 0.0,
+        "reply_latency_ms": {
+            "p50": round(percentile(result.latencies, 50), 1),
+            "p95": round(percentile(result.latencies, 95), 1),
+            "p99": round(percentile(result.latencies, 99), 1),
+            "mean": round(statistics.mean(result.latencies), 1) if result.latencies else 0.0,
+        },
+        "db_queries_per_update": {
+            "mean": round(sum(db_queries) / updates, 2),
+            "p95": percentile(db_queries, 95),
+            "max": max(db_queries, default=0),
+        },
+        "llm_calls_per_update": round(sum(llm_calls) / updates, 2),
+        "llm_http_requests_per_update": round(mock_stats.get("requests", 0) / updates, 2),
+        "bot_api_calls_per_update": round(sum(stats.api_calls for stats in result.per_update) / updates, 2),
+        "mock_llm": mock_stats,
+        "bot_api_calls": dict(api_calls),
+        **write_behind,
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    latency = report["reply_latency_ms"]
+    db = report["db_queries_per_update"]
+    print(f"Апдейтов: {report['updates']} за {report['elapsed_sec']} с — {report['updates_per_sec']} апд/с")
+    print(f"Ответов: {report['replies']}, без ответа: {report['reply_timeouts']}, ошибок: {report['update_errors']}")
+    print(f"Время до ответа: p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms mean={latency['mean']}ms")
+    print(f"Запросов к БД на апдейт: mean={db['mean']} p95={db['p95']} max={db['max']}")
+    print(
+        f"LLM на апдейт: вызовов={report['llm_calls_per_update']} "
+        f"HTTP-запросов={report['llm_http_requests_per_update']}"
+    )
+    print(f"Bot API на апдейт: {report['bot_api_calls_per_update']} {report['bot_api_calls']}")
+    print(f"Mock LLM: {json.dumps({k: v for k, v in report['mock_llm'].items() if k != 'config'}, ensure_ascii=False)}")
+    activity = report["activity_log"]
+    print(
+        f"Журнал активности: записано={activity['written']} пачек={activity['flushes']} "
+        f"строк на пачку={activity['avg_rows_per_flush']} запись пачки avg={activity['avg_flush_ms']}ms "
+        f"max={activity['max_flush_ms']}ms отброшено={activity['dropped']}"
+    )
+    pool, sessions = report["db_pool"], report["db_sessions"]
+    print(
+        f"Пул БД: выдач={pool['checkouts']} одновременно max={pool['max_checked_out']} "
+        f"в среднем={pool['mean_checked_out']}; апдейтов без сессии БД: "
+        f"{sessions['updates_without_db']}/{sessions['updates']}, сессия жила avg={sessions['avg_hold_ms']}ms"
+    )
+    touches = report["user_touches"]
+    print(
+        f"Касания пользователей: {touches['touches']}, поглощено={touches['absorbed']} "
+        f"записано пользователей={touches['users_written']} пачек={touches['flushes']}"
+    )
+    queue = report["message_queue"]
+    if queue:
+        print(
+            f"Очередь сообщений: ходов={queue['turns']} склеено={queue['merged']} отклонено={queue['rejected']} "
+            f"одновременно max={queue['max_running']} ожидание avg={queue['avg_wait_ms']}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="Параллельных пользователей")
+    parser.add_argument("--messages", type=int, default=3, help="Сообщений на пользователя после /start")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Пауза пользователя между сообщениями, мс")
+    parser.add_argument("--reply-timeout", type=float, default=30.0, help="Сколько ждать ответа бота, сек")
+    parser.add_argument("--drain-timeout", type=float, default=30.0, help="Сколько ждать фоновые задачи в конце, сек")
+    parser.add_argument("--api-latency-ms", type=float, default=30.0, help="Латентность заглушки Bot API, мс")
+    parser.add_argument("--db-url", default=None, help="База данных (по умолчанию временная SQLite)")
+    parser.add_argument("--create-tables", action="store_true", help="Создать таблицы в базе из --db-url")
+    parser.add_argument("--mock-port", type=int, default=0, help="Порт заглушки LLM (0 — любой свободный)")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--keep-workdir", action="store_true", help="Не удалять временную директорию с логами и базой")
+    parser.add_argument("--json", action="store_true", help="Вывести отчёт в JSON")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
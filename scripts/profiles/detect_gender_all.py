@@ -4,32 +4,34 @@ from relove_bot.db.repository import UserRepository
 from relove_bot.config import settings
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
-from relove_bot.utils.gender import detect_gender
-from tqdm.asyncio import tqdm
+from relove_bot.services.llm_service import llm_service
+from relove_bot.utils.llm_scheduler import LLMPriority, llm_priority
+from relove_bot.utils.llm_telemetry import llm_caller
 
 # Загружаем переменные окружения
 load_dotenv()
 
-async def process_user(user, repo):
-    """Обрабатывает одного пользователя"""
-    try:
-        # Проверяем, есть ли уже пол
-        if user.gender and user.gender != 'unknown':
-            print(f"Пол пользователя {user.id} уже определен: {user.gender}")
-            return user.gender.value if hasattr(user.gender, 'value') else user.gender
+def known_gender(user):
+    """Уже определённый пол пользователя или None"""
+    gender = user.gender.value if hasattr(user.gender, 'value') else user.gender
+    return gender if gender and gender != 'unknown' else None
 
-        # Определяем пол
-        gender = await detect_gender(user)
-        print(f"Определенный пол: {gender}")
-        
-        # Обновляем пол в базе данных
-        await repo.update_gender(user.id, gender)
-        print(f"Пол пользователя {user.id} обновлен")
-        
-        return gender
-    except Exception as e:
-        print(f"Ошибка при обработке пользователя {user.id}: {e}")
-        return 'unknown'
+async def detect_genders(users, repo):
+    """Определяет пол пользователей без пола пакетными запросами и сохраняет его"""
+    pending = {
+        user.id: {'first_name': user.first_name, 'last_name': user.last_name, 'username': user.username}
+        for user in users if not known_gender(user)
+    }
+    print(f"Пользователей без пола: {len(pending)}")
+    with llm_priority(LLMPriority.BATCH), llm_caller("script"):
+        genders = await llm_service.analyze_text_gender_batch(pending)
+    for user_id, gender in genders.items():
+        if gender:
+            try:
+                await repo.update_gender(user_id, gender)
+            except Exception as e:
+                print(f"Ошибка при обновлении пола пользователя {user_id}: {e}")
+    return genders
 
 async def main():
     """Основная функция"""
@@ -57,9 +59,11 @@ async def main():
         female_count = 0
         unknown_count = 0
         
-        # Обрабатываем всех пользователей
-        for user in tqdm(users, desc="Определение пола пользователей"):
-            gender = await process_user(user, repo)
+        # Определяем пол всех пользователей без пола
+        genders = await detect_genders(users, repo)
+        for user in users:
+            gender = genders.get(user.id) or known_gender(user)
+            gender = gender.value if hasattr(gender, 'value') else gender
             if gender == 'male':
                 male_count += 1
             elif gender == 'female':
@@ -28,6 +28,11 @@ from tqdm import tqdm
 from relove_bot.config import settings
 from relove_bot.db.models import User, GenderEnum
 from relove_bot.db.session import async_session
+from relove_bot.services.profile_enrichment import (
+    create_metaphysical_profile,
+    determine_journey_stages_batch,
+    determine_streams_batch,
+)
 from relove_bot.services.profile_service import ProfileService
 
 logging.basicConfig(
@@ -63,6 +68,9 @@ class ChannelProfileFiller:
         # Словарь для накопления данных пользователей из всех каналов
         # {user_id: {'tg_user': TelethonUser, 'channels': [channel_names], 'posts': [messages]}}
         self.user_data_accumulator = {}
+        # Заполненные профили, ждущие пакетного определения этапа пути героя и потоков
+        # {user_id: User}
+        self.pending_classification = {}
     
     CURRENT_PROFILE_VERSION = 2
     
@@ -399,8 +407,39 @@ class ChannelProfileFiller:
                     
                     pbar.update(1)
                     
+                    if len(self.pending_classification) >= settings.llm_batch_classify_size:
+                        await self.classify_pending_profiles(session)
+                    
                     # Небольшая пауза
                     await asyncio.sleep(0.1)
+            
+            await self.classify_pending_profiles(session)
+    
+    async def classify_pending_profiles(self, session):
+        """
+        Определяет этап пути героя и потоки для заполненных профилей:
+        по одному пакетному запросу к LLM на LLM_BATCH_CLASSIFY_SIZE профилей
+        вместо двух запросов на каждый.
+        """
+        if not self.pending_classification:
+            return
+        users, self.pending_classification = self.pending_classification, {}
+        profiles = {user_id: user.profile for user_id, user in users.items()}
+        try:
+            stages = await determine_journey_stages_batch(profiles)
+            streams = await determine_streams_batch(profiles)
+            for user_id, user in users.items():
+                if stages.get(user_id):
+                    user.hero_stage = stages[user_id]
+                    logger.info(f"Determined hero_stage for user {user_id}: {stages[user_id].value}")
+                if streams.get(user_id):
+                    user.streams = streams[user_id]
+                    logger.info(f"Determined streams for user {user_id}: {streams[user_id]}")
+            await session.commit()
+        except Exception as e:
+            logger.error(f"Error classifying {len(users)} profiles: {e}")
+            self.stats['errors'] += 1
+            await session.rollback()
     
     async def fill_user_profile_with_posts(
         self,
@@ -518,17 +557,8 @@ class ChannelProfileFiller:
                     user.profile = profile
                     user.profile_version = self.CURRENT_PROFILE_VERSION
                     
-                    # Определяем этап пути героя на основе профиля
-                    from relove_bot.services.profile_enrichment import (
-                        determine_journey_stage,
-                        create_metaphysical_profile,
-                        determine_streams
-                    )
-                    
-                    journey_stage = await determine_journey_stage(profile)
-                    if journey_stage:
-                        user.hero_stage = journey_stage
-                        logger.info(f"Determined hero_stage for user {user.id}: {journey_stage.value}")
+                    # Этап пути героя и потоки определяются пакетно (classify_pending_profiles)
+                    self.pending_classification[user.id] = user
                     
                     # Создаём метафизику
                     metaphysics = await create_metaphysical_profile(profile)
@@ -536,12 +566,6 @@ class ChannelProfileFiller:
                         user.metaphysics = metaphysics
                         logger.info(f"Created metaphysics for user {user.id}")
                     
-                    # Определяем потоки
-                    streams = await determine_streams(profile)
-                    if streams:
-                        user.streams = streams
-                        logger.info(f"Determined streams for user {user.id}: {streams}")
-                    
                     # Сохраняем фото если есть
                     if photo_url:
                         try:
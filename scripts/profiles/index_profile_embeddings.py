@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Индексирует профили пользователей для команды /similar (встроенный
+векторный индекс или Qdrant, см. VECTOR_BACKEND). Заодно создаёт коллекцию
+Qdrant, если её ещё нет.
+
+Векторы считает локальная модель эмбеддингов (relove_bot.rag.embeddings)
+пакетами, без сети и платного API. С EMBEDDING_CACHE_PATH повторный запуск
+пересчитывает только изменившиеся профили.
+
+Запуск:
+    python scripts/profiles/index_profile_embeddings.py --batch-size 256
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+
+from sqlalchemy import select
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from relove_bot.db.models import User
+from relove_bot.db.session import SessionLocal
+from relove_bot.db.vector import close_vector_db, flush_vector_db, init_vector_db, upsert_user_embeddings
+from relove_bot.rag.embeddings import get_embedding_service
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def profile_text(user: User) -> str:
+    """Тот же текст профиля, по которому /similar строит запрос"""
+    markers = user.markers or {}
+    return markers.get("summary") or user.profile or ""
+
+
+def profile_metadata(user: User) -> dict:
+    """Payload для ответа /similar и поля для фильтров поиска"""
+    markers = user.markers or {}
+    gender = user.gender.value if hasattr(user.gender, 'value') else user.gender
+    return {
+        "username": user.username,
+        "context": markers.get("relove_context"),
+        "gender": gender,
+        "is_active": bool(user.is_active),
+        "streams": list(user.streams or []),
+    }
+
+
+async def index_profiles(batch_size: int, limit: int = None) -> int:
+    if not await init_vector_db():
+        logger.error("Векторное хранилище недоступно, индексация отменена")
+        return 0
+    service = get_embedding_service()
+    indexed = 0
+    try:
+        async with SessionLocal() as session:
+            # Неактивные тоже: их вектор обновляется, а поиск отсекает их фильтром is_active
+            stmt = select(User).order_by(User.id)
+            if limit:
+                stmt = stmt.limit(limit)
+            users = [user for user in (await session.execute(stmt)).scalars() if profile_text(user)]
+        logger.info(f"Профилей для индексации: {len(users)}")
+
+        for start in range(0, len(users), batch_size):
+            batch = users[start:start + batch_size]
+            vectors = await service.embed_many([profile_text(user) for user in batch])
+            indexed += await upsert_user_embeddings(
+                (user.id, vector, profile_metadata(user)) for user, vector in zip(batch, vectors)
+            )
+            logger.info(f"Проиндексировано {indexed}/{len(users)}; {service.stats()}")
+        if await flush_vector_db():
+            logger.info("Векторный индекс сохранён на диск")
+    finally:
+        service.close()
+        await close_vector_db()
+    return indexed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=256, help="Профилей на одну порцию кодирования")
+    parser.add_argument("--limit", type=int, default=None, help="Проиндексировать не больше N пользователей")
+    args = parser.parse_args()
+    asyncio.run(index_profiles(args.batch_size, args.limit))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Тесты пакетной классификации: разбор JSON-массива и переспрос по одному
+"""
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+from relove_bot.utils.batch_classifier import BatchClassifier, parse_json_array
+
+
+def parse_gender(label):
+    label = str(label or "").lower()
+    return label if label in ("male", "female") else None
+
+
+class FakeLLM:
+    """Отвечает по правилу answer(номер, текст) для каждой записи промпта"""
+
+    def __init__(self, answer, wrap=lambda text: text):
+        self.answer = answer
+        self.wrap = wrap
+        self.prompts = []
+
+    async def __call__(self, system_prompt, prompt, max_tokens):
+        self.prompts.append(prompt)
+        records = re.findall(r"^\[(\d+)\] (.*)$", prompt, re.MULTILINE)
+        items = [item for item in (self.answer(int(number), text) for number, text in records) if item]
+        return self.wrap(json.dumps(items, ensure_ascii=False))
+
+
+def gender_by_name(number, text):
+    return {"id": number, "label": "female" if text.endswith(("а", "я")) else "male"}
+
+
+class TestParseJsonArray:
+    """Тесты parse_json_array"""
+
+    def test_fenced_and_wrapped(self):
+        assert parse_json_array('```json\n[{"id": 1}]\n```') == [{"id": 1}]
+        assert parse_json_array('Вот ответ: [{"id": 1}] Готово.') == [{"id": 1}]
+        assert parse_json_array('{"results": [{"id": 2}]}') == [{"id": 2}]
+
+    def test_garbage(self):
+        assert parse_json_array("male") is None
+        assert parse_json_array("") is None
+
+
+class TestBatchClassifier:
+    """Тесты BatchClassifier"""
+
+    def test_packs_items_into_batches(self):
+        llm = FakeLLM(gender_by_name, wrap=lambda text: f"```json\n{text}\n```")
+        classifier = BatchClassifier("gender", "Определи пол", parse_gender, llm, batch_size=3)
+        names = {1: "Анна", 2: "Иван", 3: "Мария", 4: "Олег", 5: "Елена"}
+
+        result = asyncio.run(classifier.classify(names))
+
+        assert result == {1: "female", 2: "male", 3: "female", 4: "male", 5: "female"}
+        assert len(llm.prompts) == 2
+
+    def test_failed_items_are_requeued_individually(self):
+        def answer(number, text):
+            # В пакете модель пропускает Олега и путает метку Ивана
+            if text == "Олег" and number > 1:
+                return None
+            if text == "Иван" and number > 1:
+                return {"id": number, "label": "кот"}
+            return gender_by_name(number, text)
+
+        llm = FakeLLM(answer)
+        classifier = BatchClassifier("gender", "Определи пол", parse_gender, llm, batch_size=10)
+
+        result = asyncio.run(classifier.classify({1: "Анна", 2: "Иван", 3: "Олег"}))
+
+        assert result == {1: "female", 2: "male", 3: "male"}
+        # Один пакет и два одиночных повтора
+        assert len(llm.prompts) == 3
+        assert llm.prompts[1].count("\n[") == 1
+
+    def test_unparseable_item_gives_none(self):
+        llm = FakeLLM(lambda number, text: {"id": number, "label": "?"})
+        classifier = BatchClassifier("gender", "Определи пол", parse_gender, llm, batch_size=10, max_attempts=2)
+
+        result = asyncio.run(classifier.classify({1: "Анна", 2: "Иван"}))
+
+        assert result == {1: None, 2: None}
+        assert len(llm.prompts) == 3
+
+    def test_request_error_requeues_batch(self):
+        calls = []
+
+        async def flaky(system_prompt, prompt, max_tokens):
+            calls.append(prompt)
+            if len(calls) == 1:
+                raise RuntimeError("timeout")
+            return '[{"id": 1, "label": "female"}]'
+
+        classifier = BatchClassifier("gender", "Определи пол", parse_gender, flaky, batch_size=10)
+
+        assert asyncio.run(classifier.classify({"a": "Анна", "b": "Мария"})) == {"a": "female", "b": "female"}
+        assert len(calls) == 3
+
+    def test_duplicate_ids_are_not_trusted(self):
+        async def duplicated(system_prompt, prompt, max_tokens):
+            return '[{"id": 1, "label": "male"}, {"id": 1, "label": "female"}, {"id": 2, "label": "male"}]'
+
+        classifier = BatchClassifier("gender", "Определи пол", parse_gender, duplicated, batch_size=10, max_attempts=1)
+
+        assert asyncio.run(classifier.classify({1: "Саша", 2: "Иван"})) == {1: None, 2: "male"}
+
+
+def test_enrichment_batches_classify_profiles_in_one_request(tmp_path):
+    """Этапы пути героя и потоки для нескольких профилей — по одному запросу к LLM"""
+    script = textwrap.dedent("""
+        import asyncio
+        import json
+        import re
+
+        from relove_bot.db.models import JourneyStageEnum
+        from relove_bot.services import profile_enrichment
+        from relove_bot.services.llm_service import llm_service
+
+        LABELS = {"journey_stage": "Зов к приключению", "streams": "Путь Героя, Трансформация Тени"}
+        prompts = []
+
+        async def analyze_content(content, model, system_prompt, max_tokens, temperature):
+            prompts.append(content)
+            label = LABELS["streams" if "потока reLove" in content else "journey_stage"]
+            records = re.findall(r"^\\[(\\d+)\\] ", content, re.MULTILINE)
+            return json.dumps([{"id": int(number), "label": label} for number in records], ensure_ascii=False)
+
+        llm_service.llm.analyze_content = analyze_content
+
+        async def main():
+            profiles = {1: "Ищет себя и готов к переменам. " * 3, 2: "Много сомневается, но пробует новое. " * 3, 3: "кратко"}
+            stages = await profile_enrichment.determine_journey_stages_batch(profiles)
+            streams = await profile_enrichment.determine_streams_batch(profiles)
+            assert stages == {1: JourneyStageEnum.CALL_TO_ADVENTURE, 2: JourneyStageEnum.CALL_TO_ADVENTURE, 3: None}, stages
+            assert streams == {1: ["Путь Героя", "Трансформация Тени"], 2: ["Путь Героя", "Трансформация Тени"], 3: []}, streams
+            # Короткий профиль в модель не отправляется, два остальных — одним запросом на задачу
+            assert len(prompts) == 2, prompts
+
+        asyncio.run(main())
+        print("ok")
+    """)
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(ROOT),
+        "BOT_TOKEN": "123456:TEST",
+        "DB_URL": "sqlite+aiosqlite:///:memory:",
+        "OUR_CHANNEL_ID": "0",
+        "DISCUSSION_CHANNEL_ID": "0",
+        "TG_API_ID": "1",
+        "TG_API_HASH": "test",
+        "TG_SESSION": "test",
+        "LLM_API_KEY": "test",
+        "LOG_DIR": str(tmp_path / "logs"),
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr[-3000:]
+    assert result.stdout.strip().endswith("ok")
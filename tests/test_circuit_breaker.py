@@ -0,0 +1,69 @@
+"""
+Тесты circuit breaker
+"""
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from relove_bot.utils.circuit_breaker import CircuitBreaker, CircuitOpenError, CircuitState
+
+
+def test_opens_after_threshold():
+    breaker = CircuitBreaker("llm", failure_threshold=3, recovery_timeout=60)
+    for _ in range(3):
+        breaker.before_call()
+        breaker.record_failure()
+
+    assert breaker.state == CircuitState.OPEN
+    assert not breaker.is_available()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker("llm", failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_half_open_allows_single_trial():
+    breaker = CircuitBreaker("llm", failure_threshold=1, recovery_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+
+    assert breaker.state == CircuitState.HALF_OPEN
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_success()
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_failed_trial_reopens():
+    breaker = CircuitBreaker("llm", failure_threshold=1, recovery_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    breaker.before_call()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.stats()["opened"] == 2
+
+
+def test_ignored_trial_frees_slot():
+    breaker = CircuitBreaker("llm", failure_threshold=1, recovery_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    breaker.before_call()
+    breaker.record_ignored()
+
+    assert breaker.is_available()
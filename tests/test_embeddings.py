@@ -0,0 +1,114 @@
+"""
+Тесты сервиса эмбеддингов: пакетирование одновременных запросов, кэш по
+хешу содержимого (память и диск) и кодирование в отдельном процессе
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from relove_bot.rag.embeddings import EmbeddingError, EmbeddingService
+from relove_bot.utils.semantic_cache import SemanticCache
+
+FAKE_BACKEND = "tests.test_embeddings:FakeEmbeddingModel"
+
+
+class FakeEmbeddingModel:
+    """Модель без весов: вектор из длины текста и числа гласных, учёт проходов"""
+
+    calls = []
+
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+
+    def load(self):
+        if self.model_name == "broken":
+            raise OSError("модель не найдена")
+
+    def encode(self, texts):
+        FakeEmbeddingModel.calls.append(list(texts))
+        return [[float(len(text)), float(sum(ch in "аеиоуыэюя" for ch in text)), 1.0] for text in texts]
+
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+    FakeEmbeddingModel.calls = []
+
+
+def test_concurrent_requests_share_one_batch():
+    service = EmbeddingService("fake", backend=FAKE_BACKEND, batch_wait=0.05, use_process=False)
+
+    async def scenario():
+        return await asyncio.gather(
+            service.embed("привет"),
+            service.embed("как дела"),
+            service.embed("привет"),
+            service.embed_many(["не знаю", "  как дела "]),
+        )
+
+    first, second, repeated, many = asyncio.run(scenario())
+    assert first == repeated == [6.0, 2.0, 1.0]
+    assert many[1] == second
+    # Один проход модели, каждый уникальный текст — один раз
+    assert len(FakeEmbeddingModel.calls) == 1
+    assert sorted(FakeEmbeddingModel.calls[0]) == ["как дела", "не знаю", "привет"]
+    stats = service.stats()
+    assert stats["batches"] == 1 and stats["encoded"] == 3 and stats["dim"] == 3
+
+
+def test_batches_are_split_by_size_and_cached():
+    service = EmbeddingService("fake", backend=FAKE_BACKEND, batch_size=2, batch_wait=0.01, use_process=False)
+    texts = [f"текст {i}" for i in range(5)]
+
+    vectors = asyncio.run(service.embed_many(texts))
+    assert len(vectors) == 5
+    assert [len(batch) for batch in FakeEmbeddingModel.calls] == [2, 2, 1]
+
+    asyncio.run(service.embed_many(texts))
+    assert len(FakeEmbeddingModel.calls) == 3
+    assert service.stats()["memory_hits"] == 5
+
+
+def test_disk_cache_survives_restart(tmp_path):
+    path = str(tmp_path / "vectors.db")
+    service = EmbeddingService("fake", backend=FAKE_BACKEND, cache_path=path, use_process=False)
+    vector = asyncio.run(service.embed("профиль"))
+    service.close()
+
+    restarted = EmbeddingService("fake", backend=FAKE_BACKEND, cache_path=path, use_process=False)
+    assert asyncio.run(restarted.embed("профиль")) == vector
+    assert restarted.stats()["disk_hits"] == 1
+    assert len(FakeEmbeddingModel.calls) == 1
+    restarted.close()
+
+    # Векторы другой модели не подмешиваются
+    other = EmbeddingService("other", backend=FAKE_BACKEND, cache_path=path, use_process=False)
+    asyncio.run(other.embed("профиль"))
+    assert other.stats()["disk_hits"] == 0
+    other.close()
+
+
+def test_worker_process_encodes_and_reports_load_errors():
+    service = EmbeddingService("fake", backend=FAKE_BACKEND, use_process=True)
+    broken = EmbeddingService("broken", backend=FAKE_BACKEND, use_process=True)
+    try:
+        assert asyncio.run(service.embed_many(["а", "бб"])) == [[1.0, 1.0, 1.0], [2.0, 0.0, 1.0]]
+        with pytest.raises(EmbeddingError):
+            asyncio.run(broken.embed("привет"))
+    finally:
+        service.close()
+        broken.close()
+
+
+def test_usable_as_semantic_cache_embedder():
+    service = EmbeddingService("fake", backend=FAKE_BACKEND, use_process=False)
+    cache = SemanticCache(embedder=service, threshold=0.99, variant_probability=0.0, topics=["reply"])
+
+    async def scenario():
+        await cache.store("reply", "привет", "И тебе привет", "ctx")
+        return await cache.lookup("reply", "привет!", "ctx")
+
+    assert asyncio.run(scenario()) == "И тебе привет"
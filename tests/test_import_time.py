@@ -0,0 +1,82 @@
+"""
+Время импорта: бот и LLM-сервис не должны тянуть тяжёлые пакеты при старте.
+
+Проверяется не время (оно зависит от машины), а то, какие пакеты загружены
+после ``import`` в отдельном процессе (``python -X importtime``).
+"""
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+
+IMPORT_TIME_BUDGET_MS = int(os.environ.get("IMPORT_TIME_BUDGET_MS", "4000"))
+
+# Тяжёлые пакеты: локальная модель, эмбеддинги, векторный поиск и SDK openai
+# (нужен только при первом запросе к LLM)
+HEAVY_MODULES = (
+    "torch", "transformers", "huggingface_hub", "bitsandbytes", "accelerate",
+    "sentence_transformers", "numpy", "qdrant_client", "openai",
+)
+
+# Обязательные настройки, без которых не создаётся settings
+DUMMY_ENV = {
+    "BOT_TOKEN": "123456:TEST",
+    "DB_URL": "sqlite+aiosqlite:///:memory:",
+    "OUR_CHANNEL_ID": "0",
+    "DISCUSSION_CHANNEL_ID": "0",
+    "TG_API_ID": "1",
+    "TG_API_HASH": "test",
+    "TG_SESSION": "test",
+    "LLM_API_KEY": "test",
+}
+
+_LINE_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+
+
+def profile_import(module: str, tmp_path: Path) -> dict:
+    """Импортирует модуль в чистом процессе; возвращает {модуль: накопленное время, мкс}"""
+    env = {**os.environ, **DUMMY_ENV, "PYTHONPATH": str(ROOT)}
+    # Рабочий каталог — временный, чтобы не подхватить .env и не создать logs/ в репозитории
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120,
+    )
+    if result.returncode != 0:
+        missing = re.search(r"ModuleNotFoundError: No module named '([^']+)'", result.stderr)
+        if missing:
+            pytest.skip(f"не установлена зависимость {missing.group(1)}")
+        pytest.fail(f"import {module} завершился ошибкой:\n{result.stderr[-2000:]}")
+
+    timings = {}
+    for line in result.stderr.splitlines():
+        match = _LINE_RE.match(line)
+        if match:
+            timings[match.group(4)] = int(match.group(2))
+    return timings
+
+
+@pytest.mark.parametrize("module", ["relove_bot.bot", "relove_bot.services.llm_service"])
+def test_no_heavy_imports(module, tmp_path):
+    timings = profile_import(module, tmp_path)
+    heavy = sorted(name for name in timings if name.split(".")[0] in HEAVY_MODULES)
+    assert not heavy, f"import {module} тянет тяжёлые пакеты: {', '.join(heavy[:10])}"
+
+
+
+@pytest.mark.skipif(not IMPORT_TIME_BUDGET_MS, reason="IMPORT_TIME_BUDGET_MS=0")
+def test_bot_import_time_budget(tmp_path):
+    timings = profile_import("relove_bot.bot", tmp_path)
+    total_ms = timings["relove_bot.bot"] / 1000
+    slowest = sorted(
+        ((name, us) for name, us in timings.items() if "." not in name),
+        key=lambda item: item[1], reverse=True,
+    )[:5]
+    assert total_ms <= IMPORT_TIME_BUDGET_MS, (
+        f"import relove_bot.bot занял {total_ms:.0f} мс (бюджет {IMPORT_TIME_BUDGET_MS} мс); "
+        f"самые медленные: " + ", ".join(f"{name}={us / 1000:.0f} мс" for name, us in slowest)
+    )
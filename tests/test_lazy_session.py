@@ -0,0 +1,164 @@
+"""
+Тесты ленивой сессии БД в DbSessionMiddleware: апдейты без работы с БД не
+открывают сессию и не берут соединение из пула
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+pytest.importorskip("aiosqlite")
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from relove_bot.db.lazy_session import LazySession, get_db_session_stats
+from relove_bot.middlewares.db import DbSessionMiddleware
+
+
+def make_pool(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'lazy.db'}")
+    checkouts = []
+    event.listen(engine.sync_engine.pool, "checkout", lambda *args: checkouts.append(1))
+    return engine, async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession), checkouts
+
+
+def test_updates_without_db_do_not_checkout(tmp_path):
+    async def scenario():
+        engine, factory, checkouts = make_pool(tmp_path)
+        middleware = DbSessionMiddleware(factory)
+        before = get_db_session_stats()
+
+        async def idle_handler(event, data):
+            assert isinstance(data["session"], LazySession)
+            return "ok"
+
+        async def db_handler(event, data):
+            return (await data["session"].execute(text("SELECT 41 + 1"))).scalar_one()
+
+        assert await middleware(idle_handler, object(), {}) == "ok"
+        assert checkouts == []
+        assert await middleware(db_handler, object(), {}) == 42
+        assert len(checkouts) == 1
+
+        after = get_db_session_stats()
+        assert after["updates"] - before["updates"] == 2
+        assert after["updates_without_db"] - before["updates_without_db"] == 1
+        assert after["sessions_opened"] - before["sessions_opened"] == 1
+        assert after["open_now"] == before["open_now"]
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_session_closed_on_error_and_release_returns_connection(tmp_path):
+    async def scenario():
+        engine, factory, _ = make_pool(tmp_path)
+        middleware = DbSessionMiddleware(factory)
+        pool = engine.sync_engine.pool
+
+        async def failing_handler(event, data):
+            await data["session"].execute(text("SELECT 1"))
+            raise ValueError("boom")
+
+        with pytest.raises(ValueError):
+            await middleware(failing_handler, object(), {})
+        assert pool.checkedout() == 0
+
+        lazy = LazySession(factory)
+        await lazy.execute(text("SELECT 1"))
+        assert pool.checkedout() == 1
+        # Перед долгой работой без БД соединение можно отдать в пул
+        await lazy.release()
+        assert pool.checkedout() == 0
+        assert (await lazy.execute(text("SELECT 2"))).scalar_one() == 2
+        await lazy.close()
+        assert pool.checkedout() == 0
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("streaming", ["true", "false"])
+def test_dialog_handler_returns_connection_during_llm_call(tmp_path, streaming):
+    """Сессия с Наташей через DbSessionMiddleware: пока генерируется ответ LLM, соединение в пуле"""
+    script = textwrap.dedent("""
+        import asyncio
+        import os
+        import sys
+
+        sys.path.insert(0, os.path.join(os.environ["PYTHONPATH"], "scripts", "loadtest"))
+
+        from aiogram import Bot
+        from run_loadtest import FakeTelegramSession, make_update
+
+        from relove_bot.db.models import Base
+        from relove_bot.db.session import SessionLocal, engine
+        from relove_bot.handlers import provocative_natasha
+        from relove_bot.middlewares.db import DbSessionMiddleware
+        from relove_bot.services.session_service import SessionService
+
+        checked_out = []
+        REPLY = "А что ты сам об этом думаешь?"
+
+        async def generate(self, user_message):
+            checked_out.append(engine.sync_engine.pool.checkedout())
+            return REPLY
+
+        async def stream(self, user_message):
+            checked_out.append(engine.sync_engine.pool.checkedout())
+            yield REPLY
+
+        provocative_natasha.ProvocativeSession.generate_provocative_response = generate
+        provocative_natasha.ProvocativeSession.stream_provocative_response = stream
+
+        async def main():
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            async with SessionLocal() as session:
+                await SessionService(session).get_or_create_session(800, "provocative", "waiting_for_response")
+
+            bot = Bot("123456:TEST", session=FakeTelegramSession())
+            message = make_update(1, 800, 1, "Мне тревожно").message.as_(bot)
+            await DbSessionMiddleware(SessionLocal)(
+                lambda event, data: provocative_natasha.handle_provocative_response(event, None, data["session"]),
+                message, {},
+            )
+
+            assert checked_out == [0], checked_out
+            async with SessionLocal() as session:
+                history = (await SessionService(session).get_active_session(800, "provocative")).conversation_history
+            assert history[-2:] == [
+                {"role": "user", "content": "Мне тревожно"}, {"role": "assistant", "content": REPLY},
+            ], history
+            await engine.dispose()
+
+        asyncio.run(main())
+        print("ok")
+    """)
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(ROOT),
+        "BOT_TOKEN": "123456:TEST",
+        "DB_URL": f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}",
+        "OUR_CHANNEL_ID": "0",
+        "DISCUSSION_CHANNEL_ID": "0",
+        "TG_API_ID": "1",
+        "TG_API_HASH": "test",
+        "TG_SESSION": "test",
+        "LLM_API_KEY": "test",
+        "LOG_DIR": str(tmp_path / "logs"),
+        "LLM_STREAMING_ENABLED": streaming,
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr[-3000:]
+    assert result.stdout.strip().endswith("ok")
@@ -0,0 +1,119 @@
+"""
+Тесты кэша ответов LLM
+"""
+import asyncio
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from relove_bot.utils.llm_cache import LLMResponseCache, SQLiteCacheBackend, make_cache_key
+
+
+MESSAGES = [{"role": "system", "content": "sys"}, {"role": "user", "content": "привет"}]
+
+
+class TestCacheKey:
+    """Тесты стабильного ключа кэша"""
+
+    def test_key_is_stable(self):
+        """Ключ не зависит от процесса и порядка полей"""
+        key = make_cache_key("model", MESSAGES, 0.7, 100)
+        assert key == make_cache_key("model", [dict(m) for m in MESSAGES], 0.7, 100)
+        assert len(key) == 64
+
+    def test_key_depends_on_params(self):
+        """Ключ меняется при смене любого параметра"""
+        base = make_cache_key("model", MESSAGES, 0.7, 100)
+        assert base != make_cache_key("other", MESSAGES, 0.7, 100)
+        assert base != make_cache_key("model", MESSAGES, 0.2, 100)
+        assert base != make_cache_key("model", MESSAGES, 0.7, 50)
+        assert base != make_cache_key("model", MESSAGES[1:], 0.7, 100)
+
+
+class TestLLMResponseCache:
+    """Тесты LRU/TTL кэша"""
+
+    def test_hit_and_miss_counters(self):
+        cache = LLMResponseCache()
+
+        async def scenario():
+            assert await cache.get("k") is None
+            await cache.set("k", "v")
+            assert await cache.get("k") == "v"
+
+        asyncio.run(scenario())
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+
+    def test_lru_eviction_by_entries(self):
+        cache = LLMResponseCache(max_entries=2)
+
+        async def scenario():
+            await cache.set("a", "1")
+            await cache.set("b", "2")
+            await cache.get("a")  # "a" становится самым свежим
+            await cache.set("c", "3")
+            return await cache.get("a"), await cache.get("b"), await cache.get("c")
+
+        assert asyncio.run(scenario()) == ("1", None, "3")
+        assert cache.stats()["evictions"] == 1
+
+    def test_eviction_by_bytes(self):
+        cache = LLMResponseCache(max_bytes=30)
+
+        async def scenario():
+            await cache.set("a", "x" * 20)
+            await cache.set("b", "y" * 20)
+            return await cache.get("a"), await cache.get("b")
+
+        assert asyncio.run(scenario()) == (None, "y" * 20)
+        assert cache.stats()["bytes"] <= 30
+
+    def test_ttl_expiration(self):
+        cache = LLMResponseCache(ttl=0)
+
+        async def scenario():
+            await cache.set("k", "v")
+            await asyncio.sleep(0.01)
+            return await cache.get("k")
+
+        assert asyncio.run(scenario()) is None
+        assert cache.stats()["expirations"] == 1
+
+    def test_empty_values_not_cached(self):
+        cache = LLMResponseCache()
+        asyncio.run(cache.set("k", ""))
+        assert cache.stats()["entries"] == 0
+
+    def test_sqlite_backend_survives_restart(self, tmp_path):
+        path = str(tmp_path / "cache.sqlite3")
+
+        async def scenario():
+            first = LLMResponseCache(backend=SQLiteCacheBackend(path))
+            await first.set("k", "ответ")
+            second = LLMResponseCache(backend=SQLiteCacheBackend(path))
+            return await second.get("k"), second.stats()
+
+        value, stats = asyncio.run(scenario())
+        assert value == "ответ"
+        assert stats["backend_hits"] == 1
+
+    def test_sqlite_backend_expires_and_closes(self, tmp_path):
+        backend = SQLiteCacheBackend(str(tmp_path / "cache.sqlite3"))
+
+        async def scenario():
+            await backend.set("old", "a", ttl=-1)
+            await backend.set("fresh", "b", ttl=60)
+            purged = await backend.purge_expired()
+            values = (await backend.get("old"), await backend.get("fresh"))
+            await backend.close()
+            return purged, values
+
+        assert asyncio.run(scenario()) == (1, (None, "b"))
+        with pytest.raises(sqlite3.ProgrammingError):
+            backend._conn.execute("SELECT 1")
@@ -0,0 +1,144 @@
+"""
+Тесты маршрутизатора LLM: hedging, failover и статистика бэкендов
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+pytest.importorskip("openai")
+
+from relove_bot.rag.llm_router import LLMBackend, LLMRouter
+from relove_bot.utils.circuit_breaker import CircuitOpenError
+
+
+class FakeCompletions:
+    def __init__(self, delay=0.0, error=None):
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self.cancelled = 0
+
+    async def create(self, **params):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error:
+            raise self.error
+        return {"model": params["model"], "stream": params.get("stream", False)}
+
+
+class FakeClient:
+    def __init__(self, completions):
+        self.chat = type("Chat", (), {"completions": completions})()
+
+
+def make_backend(name, delay=0.0, error=None, model=None):
+    backend = LLMBackend(name, f"http://{name}.local/v1", f"key-{name}", model=model)
+    completions = FakeCompletions(delay, error)
+    backend.client = FakeClient(completions)
+    return backend, completions
+
+
+class TestLLMRouter:
+    """Тесты LLMRouter"""
+
+    def test_fast_primary_no_hedge(self):
+        primary, primary_calls = make_backend("primary")
+        backup, backup_calls = make_backend("backup")
+        router = LLMRouter([primary, backup], hedge_default_delay=0.5)
+
+        result = asyncio.run(router.chat(model="m", messages=[]))
+
+        assert result["model"] == "m"
+        assert primary_calls.calls == 1
+        assert backup_calls.calls == 0
+        assert router.hedged == 0
+
+    def test_slow_primary_is_hedged_and_cancelled(self):
+        primary, primary_calls = make_backend("primary", delay=1.0)
+        backup, backup_calls = make_backend("backup", model="backup-model")
+        router = LLMRouter([primary, backup], hedge_default_delay=0.05)
+
+        result = asyncio.run(router.chat(model="m", messages=[]))
+
+        assert result["model"] == "backup-model"
+        assert router.hedged == 1
+        assert router.hedge_wins == 1
+        assert primary_calls.cancelled == 1
+        assert router.stats()["backends"]["primary"]["cancelled"] == 1
+
+    def test_failover_on_error(self):
+        primary, _ = make_backend("primary", error=RuntimeError("down"))
+        backup, backup_calls = make_backend("backup")
+        router = LLMRouter([primary, backup], hedge=False)
+
+        result = asyncio.run(router.chat(model="m", messages=[]))
+
+        assert result["model"] == "m"
+        assert backup_calls.calls == 1
+        assert router.failovers == 1
+        stats = router.stats()["backends"]["primary"]
+        assert stats["errors"] == 1
+        assert stats["health"] < 1.0
+
+    def test_all_backends_fail(self):
+        primary, _ = make_backend("primary", error=RuntimeError("down"))
+        backup, _ = make_backend("backup", error=ValueError("also down"))
+        router = LLMRouter([primary, backup], hedge=False)
+
+        with pytest.raises(ValueError):
+            asyncio.run(router.chat(model="m", messages=[]))
+
+    def test_unhealthy_backend_is_ranked_last(self):
+        primary, _ = make_backend("primary")
+        backup, _ = make_backend("backup")
+        router = LLMRouter([primary, backup])
+
+        primary.record_error()
+        primary.record_error()
+
+        assert [backend.name for backend in router.ranked()] == ["backup", "primary"]
+
+    def test_stream_failover(self):
+        primary, _ = make_backend("primary", error=RuntimeError("down"))
+        backup, _ = make_backend("backup")
+        router = LLMRouter([primary, backup])
+
+        result = asyncio.run(router.stream(model="m", messages=[]))
+
+        assert result["stream"] is True
+        assert router.failovers == 1
+
+    def test_hedge_delay_uses_latency_percentile(self):
+        primary, _ = make_backend("primary")
+        router = LLMRouter([primary], hedge_min_delay=0.1, hedge_default_delay=4.0)
+        assert router.hedge_delay(primary) == 4.0
+
+        for latency in [0.2] * 9 + [2.0]:
+            primary.record_success(latency)
+
+        assert router.hedge_delay(primary) == 2.0
+
+    def test_open_circuit_fails_fast(self):
+        primary, primary_calls = make_backend("primary", delay=0.2, error=RuntimeError("down"))
+        primary.breaker.failure_threshold = 1
+        router = LLMRouter([primary], hedge=False)
+
+        async def scenario():
+            with pytest.raises(RuntimeError):
+                await router.chat(model="m", messages=[])
+            started = asyncio.get_running_loop().time()
+            with pytest.raises(CircuitOpenError):
+                await router.chat(model="m", messages=[])
+            return asyncio.get_running_loop().time() - started
+
+        assert asyncio.run(scenario()) < 0.05
+        assert primary_calls.calls == 1
+        assert not router.is_available()
@@ -0,0 +1,147 @@
+"""
+Тесты приоритетного планировщика запросов к LLM
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from relove_bot.utils.llm_scheduler import (
+    LLMPriority,
+    LLMScheduler,
+    current_llm_priority,
+    llm_priority,
+)
+
+
+def test_priority_from_context():
+    assert current_llm_priority() == LLMPriority.INTERACTIVE
+    with llm_priority(LLMPriority.BATCH):
+        assert current_llm_priority() == LLMPriority.BATCH
+    assert current_llm_priority() == LLMPriority.INTERACTIVE
+
+
+class TestLLMScheduler:
+    """Тесты LLMScheduler"""
+
+    def test_waiters_served_by_priority(self):
+        scheduler = LLMScheduler(total_slots=1, preempt_batch=False)
+        order = []
+
+        async def scenario():
+            release = asyncio.Event()
+
+            async def blocker():
+                await release.wait()
+
+            async def job(name):
+                order.append(name)
+
+            first = asyncio.create_task(scheduler.run(blocker))
+            await asyncio.sleep(0)
+            tasks = [
+                asyncio.create_task(scheduler.run(lambda: job("batch"), LLMPriority.BATCH)),
+                asyncio.create_task(scheduler.run(lambda: job("proactive"), LLMPriority.PROACTIVE)),
+                asyncio.create_task(scheduler.run(lambda: job("interactive"), LLMPriority.INTERACTIVE)),
+            ]
+            await asyncio.sleep(0)
+            release.set()
+            await asyncio.gather(first, *tasks)
+
+        asyncio.run(scenario())
+        assert order == ["interactive", "proactive", "batch"]
+
+    def test_class_slot_cap(self):
+        scheduler = LLMScheduler(slots={LLMPriority.BATCH: 2}, total_slots=8)
+        peak = 0
+        running = 0
+
+        async def job():
+            nonlocal peak, running
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        async def scenario():
+            await asyncio.gather(*(scheduler.run(job, LLMPriority.BATCH) for _ in range(6)))
+
+        asyncio.run(scenario())
+        assert peak == 2
+        assert scheduler.stats()["batch"]["completed"] == 6
+
+    def test_batch_held_while_interactive_over_slo(self):
+        scheduler = LLMScheduler(total_slots=4, interactive_slo=0.001)
+
+        async def slow():
+            await asyncio.sleep(0.01)
+
+        async def scenario():
+            await scheduler.run(slow, LLMPriority.INTERACTIVE)
+            batch = asyncio.create_task(scheduler.run(slow, LLMPriority.BATCH))
+            await asyncio.sleep(0.05)
+            held = not batch.done()
+            batch.cancel()
+            await asyncio.gather(batch, return_exceptions=True)
+            return held
+
+        assert asyncio.run(scenario())
+        assert scheduler.stats()["batch"]["waiting"] == 0
+
+    def test_batch_preempted_and_retried(self):
+        scheduler = LLMScheduler(total_slots=1)
+        attempts = 0
+
+        async def batch_job():
+            nonlocal attempts
+            attempts += 1
+            await asyncio.sleep(0.05)
+            return "batch"
+
+        async def interactive_job():
+            return "interactive"
+
+        async def scenario():
+            batch = asyncio.create_task(scheduler.run(batch_job, LLMPriority.BATCH))
+            await asyncio.sleep(0.01)
+            interactive = await scheduler.run(interactive_job, LLMPriority.INTERACTIVE)
+            return interactive, await batch
+
+        assert asyncio.run(scenario()) == ("interactive", "batch")
+        assert attempts == 2
+        stats = scheduler.stats()
+        assert stats["batch"]["preempted"] == 1
+        assert stats["running"] == 0
+
+    def test_outer_cancel_is_not_retried(self):
+        scheduler = LLMScheduler(total_slots=1)
+
+        async def scenario():
+            task = asyncio.create_task(scheduler.run(lambda: asyncio.sleep(1), LLMPriority.BATCH))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            results = await asyncio.gather(task, return_exceptions=True)
+            return results[0]
+
+        assert isinstance(asyncio.run(scenario()), asyncio.CancelledError)
+        assert scheduler.stats()["running"] == 0
+
+    def test_stream_slot_is_not_preempted(self):
+        scheduler = LLMScheduler(total_slots=1)
+
+        async def scenario():
+            async def stream():
+                async with scheduler.slot(LLMPriority.BATCH):
+                    await asyncio.sleep(0.05)
+                return "stream"
+
+            batch = asyncio.create_task(stream())
+            await asyncio.sleep(0.01)
+            interactive = await scheduler.run(lambda: asyncio.sleep(0, "interactive"))
+            return await batch, interactive
+
+        assert asyncio.run(scenario()) == ("stream", "interactive")
+        stats = scheduler.stats()
+        assert stats["batch"]["completed"] == 1
+        assert stats["batch"]["preempted"] == 0
@@ -0,0 +1,138 @@
+"""
+Тесты телеметрии LLM: теги вызовов, usage, гистограммы и JSONL
+"""
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from relove_bot.utils.llm_scheduler import LLMPriority, llm_priority
+from relove_bot.utils.llm_telemetry import (
+    Histogram, JsonlSink, LLMTelemetry, current_llm_call, llm_caller, llm_usage_scope,
+)
+
+
+class TestLLMTelemetry:
+    """Тесты LLMTelemetry"""
+
+    def test_caller_tag_from_context_and_priority(self):
+        telemetry = LLMTelemetry()
+
+        async def scenario():
+            async with telemetry.track("analyze", "m"):
+                pass
+            with llm_priority(LLMPriority.PROACTIVE):
+                async with telemetry.track("analyze", "m"):
+                    pass
+                with llm_caller("rotation"):
+                    async with telemetry.track("analyze", "m"):
+                        pass
+
+        asyncio.run(scenario())
+        assert set(telemetry.stats()["callers"]) == {"handler", "proactive", "rotation"}
+
+    def test_usage_cost_and_scope(self):
+        telemetry = LLMTelemetry(prices={"gpt-4o-mini": {"prompt": 1.0, "completion": 2.0}})
+
+        async def scenario():
+            with llm_usage_scope() as usage:
+                async with telemetry.track("generate", "openai/gpt-4o-mini") as call:
+                    # Так usage дописывает маршрутизатор
+                    current_llm_call().set_usage({"prompt_tokens": 1000, "completion_tokens": 500})
+                    call.retries = 2
+                telemetry.record_cache_hit("generate", "openai/gpt-4o-mini")
+            return usage
+
+        usage = asyncio.run(scenario())
+        assert usage.total_tokens == 1500
+        assert usage.calls == 1
+        stats = telemetry.stats()["callers"]["handler"]
+        assert stats["calls"] == 2
+        assert stats["cache_hits"] == 1
+        assert stats["retries"] == 2
+        assert stats["cost_usd"] == pytest.approx(0.002)
+
+    def test_errors_and_cancellations(self):
+        telemetry = LLMTelemetry()
+
+        async def scenario():
+            with pytest.raises(ValueError):
+                async with telemetry.track("generate", "m"):
+                    raise ValueError("boom")
+            async with telemetry.track("generate", "m") as call:
+                call.fail(RuntimeError("handled"))
+            task = asyncio.ensure_future(slow())
+            await asyncio.sleep(0)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        async def slow():
+            async with telemetry.track("generate", "m"):
+                await asyncio.sleep(1)
+
+        asyncio.run(scenario())
+        stats = telemetry.stats()["callers"]["handler"]
+        assert stats["errors"] == 2
+        assert stats["cancelled"] == 1
+        assert stats["latency"]["count"] == 0
+
+    def test_histogram(self):
+        histogram = Histogram((0.5, 1.0, 5.0))
+        for value in (0.1, 0.2, 0.7, 3.0, 10.0):
+            histogram.observe(value)
+        assert histogram.cumulative() == [2, 3, 4, 5]
+        assert histogram.quantile(0.5) == 1.0
+        assert histogram.quantile(1.0) == float("inf")
+
+    def test_prometheus_and_jsonl(self, tmp_path):
+        path = tmp_path / "llm_calls.jsonl"
+        telemetry = LLMTelemetry(sink=JsonlSink(str(path)))
+
+        async def scenario():
+            with llm_caller("script"):
+                async with telemetry.track("stream", "m") as call:
+                    call.mark_first_byte()
+                    call.estimate_usage("привет", "ответ")
+
+        asyncio.run(scenario())
+        telemetry.sink.close()
+
+        text = telemetry.prometheus()
+        assert 'llm_calls_total{caller="script"} 1' in text
+        assert 'llm_ttfb_seconds_bucket{caller="script",le="+Inf"} 1' in text
+        record = json.loads(path.read_text(encoding="utf-8"))
+        assert record["caller"] == "script"
+        assert record["operation"] == "stream"
+        assert record["usage_estimated"] is True
+        assert record["total_tokens"] > 0
+
+
+class TestRouterTelemetry:
+    """Маршрутизатор дописывает бэкенд и usage в текущий вызов"""
+
+    def test_backend_and_usage(self):
+        pytest.importorskip("openai")
+        from relove_bot.rag.llm_router import LLMBackend, LLMRouter
+
+        class Completions:
+            async def create(self, **params):
+                return type("Response", (), {"usage": {"prompt_tokens": 7, "completion_tokens": 3}})()
+
+        backend = LLMBackend("primary", "http://primary.local/v1", "key")
+        backend.client = type("Client", (), {"chat": type("Chat", (), {"completions": Completions()})()})()
+        router = LLMRouter([backend], hedge=False)
+        telemetry = LLMTelemetry()
+
+        async def scenario():
+            async with telemetry.track("analyze", "m") as call:
+                await router.chat(model="m", messages=[])
+            return call
+
+        call = asyncio.run(scenario())
+        assert call.backend == "primary"
+        assert call.total_tokens == 10
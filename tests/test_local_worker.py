@@ -0,0 +1,128 @@
+"""
+Тесты процесса локального инференса: планирование пакетов по бюджету
+KV-кэша и пакетирование одновременных запросов в отдельном процессе
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from relove_bot.rag.local_worker import (
+    InferenceJob, LocalInferenceClient, LocalInferenceError, kv_cache_batch_limit, plan_batches,
+)
+from relove_bot.utils import llm_telemetry
+from relove_bot.utils.llm_telemetry import LLMTelemetry
+
+FAKE_BACKEND = "tests.test_local_worker:FakeBackend"
+
+
+class FakeBackend:
+    """Бэкенд без модели: отвечает промптом и размером пакета"""
+
+    kv_bytes_per_token = 1
+
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+
+    def load(self):
+        if self.model_name == "broken":
+            raise OSError("модель не найдена")
+
+    def format_prompt(self, messages):
+        return messages[-1]["content"]
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+    def generate_batch(self, prompts, max_tokens, temperature):
+        if "boom" in prompts:
+            raise ValueError("boom")
+        return [f"{prompt}|{len(prompts)}" for prompt in prompts]
+
+
+def job(order, prompt_tokens, max_tokens=10, temperature=0.0):
+    return InferenceJob(order, f"p{order}", prompt_tokens, max_tokens, temperature, order)
+
+
+def test_kv_cache_batch_limit():
+    assert kv_cache_batch_limit(100, 10, 4500, 8) == 4
+    assert kv_cache_batch_limit(100, 10, 500, 8) == 1
+    assert kv_cache_batch_limit(100, 0, 0, 8) == 8
+
+
+def test_plan_batches_respects_kv_budget_and_temperature():
+    jobs = [job(0, 50), job(1, 10), job(2, 20, temperature=0.7), job(3, 40), job(4, 30)]
+    # (промпт + ответ) × число × 1 байт ≤ 130: в пакет помещаются два промпта
+    batches = plan_batches(jobs, max_batch_size=8, kv_budget_bytes=130, kv_bytes_per_token=1)
+    ids = [[j.request_id for j in batch] for batch in batches]
+    # Короткие промпты — вместе, длинные — вместе; пакеты по самому раннему запросу
+    assert ids == [[3, 0], [1, 4], [2]]
+    for batch in batches:
+        assert len({j.temperature for j in batch}) == 1
+        seq = max(j.prompt_tokens for j in batch) + max(j.max_tokens for j in batch)
+        assert len(batch) == 1 or len(batch) * seq <= 130
+
+    # Без бюджета — только ограничение размера пакета
+    batches = plan_batches(jobs, max_batch_size=2)
+    assert all(len(batch) <= 2 for batch in batches)
+    assert sorted(j.request_id for batch in batches for j in batch) == [0, 1, 2, 3, 4]
+
+
+def test_concurrent_requests_are_batched(monkeypatch):
+    monkeypatch.setattr(llm_telemetry, "_telemetry", LLMTelemetry())
+    client = LocalInferenceClient("fake", max_batch_size=8, batch_wait=0.3, backend=FAKE_BACKEND)
+
+    async def scenario():
+        prompts = [f"вопрос {i}" for i in range(4)]
+        answers = await asyncio.gather(*(
+            client.generate([{"role": "user", "content": prompt}], max_tokens=5, temperature=0.0, timeout=60)
+            for prompt in prompts
+        ))
+        return prompts, answers
+
+    try:
+        prompts, answers = asyncio.run(scenario())
+        assert [answer.rsplit("|", 1)[0] for answer in answers] == prompts
+        # Все четыре запроса ушли одним пакетом
+        assert {answer.rsplit("|", 1)[1] for answer in answers} == {"4"}
+        stats = client.stats()
+        assert stats["completed"] == 4 and stats["batched_requests"] == 4 and stats["pending"] == 0
+        assert llm_telemetry._telemetry.stats()["models"]["fake"]["calls"] == 4
+    finally:
+        client.close()
+    assert not client.stats()["alive"]
+
+
+def test_failed_prompt_does_not_fail_batch(monkeypatch):
+    monkeypatch.setattr(llm_telemetry, "_telemetry", LLMTelemetry())
+    client = LocalInferenceClient("fake", batch_wait=0.3, backend=FAKE_BACKEND)
+
+    async def scenario():
+        return await asyncio.gather(
+            client.analyze_content("ок", system_prompt="s", timeout=60),
+            client.analyze_content("boom", system_prompt="s", timeout=60),
+        )
+
+    try:
+        ok, failed = asyncio.run(scenario())
+        assert ok == "ок|1"
+        assert failed == {"error": "boom"}
+    finally:
+        client.close()
+
+
+def test_model_load_error_is_reported(monkeypatch):
+    monkeypatch.setattr(llm_telemetry, "_telemetry", LLMTelemetry())
+    client = LocalInferenceClient("broken", backend=FAKE_BACKEND)
+
+    async def scenario():
+        try:
+            await client.generate([{"role": "user", "content": "привет"}], timeout=60)
+        except LocalInferenceError as e:
+            return str(e)
+
+    try:
+        assert "модель не найдена" in asyncio.run(scenario())
+    finally:
+        client.close()
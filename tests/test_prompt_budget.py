@@ -0,0 +1,158 @@
+"""
+Тесты бюджета токенов промпта
+"""
+import os
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+from relove_bot.utils.prompt_budget import (
+    PromptBudget,
+    PromptBudgetExceeded,
+    count_tokens,
+    get_prompt_budget_stats,
+)
+
+
+def test_fits_without_truncation():
+    packed = (
+        PromptBudget(1000)
+        .add("system", "Ты помощник.", priority=0, required=True)
+        .add("message", "Привет!", priority=1)
+        .pack()
+    )
+
+    assert packed.text == "Ты помощник.\n\nПривет!"
+    assert packed.dropped == {}
+
+
+def test_low_priority_section_is_truncated_first():
+    profile = "очень длинный профиль " * 200
+    budget = PromptBudget(200)
+    budget.add("system", "Системный промпт.", priority=0, required=True)
+    budget.add("profile", profile, priority=2)
+    budget.add("message", "Новое сообщение пользователя", priority=1)
+
+    packed = budget.pack()
+
+    assert packed["message"] == "Новое сообщение пользователя"
+    assert packed["profile"].endswith("[текст обрезан]")
+    assert packed.dropped["profile"] > 0
+    assert count_tokens(packed.text) <= 200
+    # Порядок в тексте — порядок добавления, а не приоритета
+    assert packed.text.index("Системный") < packed.text.index("профиль") < packed.text.index("Новое")
+
+
+def test_history_keeps_most_recent_items():
+    history = [f"сообщение номер {i}" for i in range(100)]
+    packed = PromptBudget(60).add("history", history, priority=1, keep='tail').pack()
+
+    kept = packed["history"].split("\n")
+    assert kept[-1] == "сообщение номер 99"
+    assert "сообщение номер 0" not in kept
+    assert packed.dropped["history"] > 0
+
+
+def test_empty_sections_read_as_empty_strings():
+    packed = (
+        PromptBudget(1000, separator="")
+        .add("system", "Системный промпт.", priority=0, required=True)
+        .add("bio", "", priority=1)
+        .add("posts", [], priority=2)
+        .pack()
+    )
+
+    # Пустая биография и нет постов — обычный случай, а не KeyError
+    assert packed["bio"] == "" and packed["posts"] == ""
+    assert packed.text == "Системный промпт."
+
+
+def test_section_cap():
+    packed = PromptBudget(10_000).add("context", "слово " * 500, priority=1, max_tokens=50).pack()
+
+    assert count_tokens(packed["context"]) <= 50
+
+
+def test_required_section_must_fit():
+    budget = PromptBudget(10).add("system", "слово " * 100, priority=0, required=True)
+
+    with pytest.raises(PromptBudgetExceeded):
+        budget.pack()
+
+
+def test_dropped_tokens_are_reported():
+    before = get_prompt_budget_stats()["dropped_tokens"]
+    PromptBudget(20).add("text", "слово " * 100, priority=1).pack()
+
+    assert get_prompt_budget_stats()["dropped_tokens"] > before
+
+
+def test_profile_summary_without_bio_or_posts(tmp_path):
+    """get_full_psychological_summary: пустая биография и/или нет постов"""
+    pytest.importorskip("telethon")
+    script = textwrap.dedent("""
+        import asyncio
+        from types import SimpleNamespace
+
+        from relove_bot.services import telegram_service
+        from relove_bot.utils import relove_streams
+
+        llm_inputs = []
+
+        async def get_client():
+            return None
+
+        async def summary(text, image_url=None):
+            return "summary"
+
+        async def streams(posts):
+            return {"completed": []}
+
+        class FakeLLM:
+            async def analyze_content(self, text, **kwargs):
+                llm_inputs.append(text)
+                return {"summary": "портрет", "raw_response": ""}
+
+        telegram_service.get_client = get_client
+        telegram_service.openai_psychological_summary = summary
+        telegram_service.LLM = FakeLLM
+        relove_streams.detect_relove_streams_by_posts = streams
+
+        async def main():
+            summarize = telegram_service.get_full_psychological_summary
+            # Ни биографии, ни постов — пользователь пропускается без обращения к LLM
+            assert await summarize(1, tg_user=SimpleNamespace(about=""), posts=[]) == (None, None, [])
+            assert llm_inputs == []
+            # Только посты или только биография
+            assert (await summarize(2, tg_user=SimpleNamespace(about=None), posts=["пост"]))[0] == "портрет"
+            assert (await summarize(3, tg_user=SimpleNamespace(about="о себе"), posts=[]))[0] == "портрет"
+            assert llm_inputs == ["пост", "о себе"], llm_inputs
+
+        asyncio.run(main())
+        print("ok")
+    """)
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(ROOT),
+        "BOT_TOKEN": "123456:TEST",
+        "DB_URL": "sqlite+aiosqlite:///:memory:",
+        "OUR_CHANNEL_ID": "0",
+        "DISCUSSION_CHANNEL_ID": "0",
+        "TG_API_ID": "1",
+        "TG_API_HASH": "test",
+        "TG_SESSION": "test",
+        "LLM_API_KEY": "test",
+        "LOG_DIR": str(tmp_path / "logs"),
+        "TELEGRAM_EXPORT_PATH": str(tmp_path),
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr[-3000:]
+    assert result.stdout.strip().endswith("ok")
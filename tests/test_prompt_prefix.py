@@ -0,0 +1,83 @@
+"""
+Тесты стабильного префикса промпта: дедупликация статичных блоков,
+отметки cache_control и учёт закэшированных провайдером токенов
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from relove_bot.utils import llm_telemetry, prompt_prefix
+from relove_bot.utils.llm_telemetry import LLMTelemetry, llm_caller
+from relove_bot.utils.prompt_prefix import (
+    apply_cache_hints, assemble_prompt, get_prompt_prefix_stats, needs_cache_control,
+)
+
+PERSONA = "Ты Наташа. Отвечай коротко и провокативно. " * 20
+STAGE = "Этап: глубина. Задавай вопросы о корне."
+
+
+def test_persona_copy_is_removed_from_content(monkeypatch):
+    monkeypatch.setattr(prompt_prefix, "_stats", prompt_prefix.defaultdict(prompt_prefix._stats.default_factory))
+    content = f"{PERSONA}\n\n{STAGE}\n\nИСТОРИЯ ДИАЛОГА:\nuser: привет"
+    assembled = assemble_prompt("test.reply", [PERSONA, STAGE], content)
+
+    assert assembled.system_prompt == f"{PERSONA.strip()}\n\n{STAGE}"
+    assert assembled.content == "ИСТОРИЯ ДИАЛОГА:\nuser: привет"
+    assert assembled.deduplicated_tokens > 0
+
+    stats = get_prompt_prefix_stats()["sites"]["test.reply"]
+    assert stats["calls"] == 1
+    assert stats["deduplicated_tokens"] == assembled.deduplicated_tokens
+    assert 0 < stats["saved_share"] < 1
+    assert stats["cacheable_share"] > 0.5
+
+
+def test_blank_and_repeated_blocks_are_skipped():
+    assembled = assemble_prompt("test.blocks", [STAGE, None, "", STAGE], "вопрос")
+    assert assembled.system_prompt == STAGE
+    assert assembled.content == "вопрос"
+    assert assembled.deduplicated_tokens == 0
+
+
+def test_cache_hints_only_for_explicit_cache_models():
+    messages = [{"role": "system", "content": PERSONA}, {"role": "user", "content": "привет"}]
+
+    hinted = apply_cache_hints(messages, "anthropic/claude-3.5-haiku", min_tokens=10)
+    assert hinted[0]["content"][0]["cache_control"] == {"type": "ephemeral"}
+    assert hinted[0]["content"][0]["text"] == PERSONA
+    assert hinted[1] is messages[1]
+    # Исходный список не меняется
+    assert messages[0]["content"] == PERSONA
+
+    # OpenAI и DeepSeek кэшируют префикс сами
+    assert apply_cache_hints(messages, "openai/gpt-4o-mini", min_tokens=10) is messages
+    assert apply_cache_hints(messages, "deepseek-chat", min_tokens=10) is messages
+    assert apply_cache_hints(messages, "anthropic/claude-3.5-haiku", mode="off", min_tokens=10) is messages
+    assert needs_cache_control("deepseek-chat", "always")
+
+
+def test_short_prefix_is_not_hinted():
+    messages = [{"role": "system", "content": STAGE}, {"role": "user", "content": "привет"}]
+    assert apply_cache_hints(messages, "google/gemini-2.0-flash", min_tokens=1024) is messages
+
+
+def test_provider_cached_tokens_reported_per_site(monkeypatch):
+    telemetry = LLMTelemetry()
+    monkeypatch.setattr(llm_telemetry, "_telemetry", telemetry)
+
+    async def scenario():
+        with llm_caller("test.cached"):
+            async with telemetry.track("analyze", "m") as call:
+                call.set_usage({
+                    "prompt_tokens": 1500,
+                    "completion_tokens": 20,
+                    "prompt_tokens_details": {"cached_tokens": 1280},
+                })
+
+    asyncio.run(scenario())
+    assemble_prompt("test.cached", [PERSONA], "вопрос")
+
+    assert telemetry.stats()["callers"]["test.cached"]["cached_prompt_tokens"] == 1280
+    assert get_prompt_prefix_stats()["sites"]["test.cached"]["provider_cached_tokens"] == 1280
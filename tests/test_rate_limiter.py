@@ -0,0 +1,151 @@
+"""
+Тесты token-bucket лимитера запросов к LLM
+"""
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from relove_bot.utils.api_rate_limiter import APIRateLimiter
+from relove_bot.utils.rate_limiter import (
+    RateLimiter,
+    RateLimitExceeded,
+    TokenBucketLimiter,
+    parse_retry_after,
+)
+
+
+class TestTokenBucketLimiter:
+    """Тесты TokenBucketLimiter"""
+
+    def test_burst_within_capacity_does_not_wait(self):
+        limiter = TokenBucketLimiter(per_minute=5)
+
+        async def scenario():
+            return [await limiter.acquire(key="k") for _ in range(5)]
+
+        assert asyncio.run(scenario()) == [0.0] * 5
+
+    def test_waiters_are_served_in_fifo_order(self):
+        # 6000 в минуту = 100 токенов в секунду; после опустошения корзины
+        # каждый следующий запрос стоимостью 2 ждёт на 20 мс дольше предыдущего
+        limiter = TokenBucketLimiter(per_minute=6000, max_wait=None)
+        order = []
+
+        async def worker(i):
+            await limiter.acquire(key="k", cost=2)
+            order.append(i)
+
+        async def scenario():
+            await limiter.acquire(key="k", cost=6000)
+            await asyncio.gather(*(worker(i) for i in range(4)))
+
+        asyncio.run(scenario())
+        assert order == [0, 1, 2, 3]
+
+    def test_waiting_key_does_not_block_other_keys(self):
+        limiter = TokenBucketLimiter(per_minute=60, max_wait=None)
+
+        async def scenario():
+            await limiter.acquire(key="busy", cost=60)
+            slow = asyncio.create_task(limiter.acquire(key="busy"))
+            await asyncio.sleep(0)
+            started = time.monotonic()
+            await limiter.acquire(key="free")
+            elapsed = time.monotonic() - started
+            slow.cancel()
+            return elapsed
+
+        assert asyncio.run(scenario()) < 0.1
+
+    def test_max_wait_raises(self):
+        limiter = TokenBucketLimiter(per_minute=1, max_wait=0.5)
+
+        async def scenario():
+            await limiter.acquire(key="k")
+            await limiter.acquire(key="k")
+
+        with pytest.raises(RateLimitExceeded):
+            asyncio.run(scenario())
+        assert limiter.stats()["rejected"] == 1
+
+    def test_retry_after_blocks_key(self):
+        limiter = TokenBucketLimiter(per_minute=100, max_wait=None)
+
+        async def scenario():
+            await limiter.penalize(key="k", retry_after=0.05)
+            return await limiter.acquire(key="k")
+
+        assert asyncio.run(scenario()) >= 0.05
+
+    def test_model_budget(self):
+        limiter = TokenBucketLimiter(per_minute=100, model_limits={"slow-model": 1}, max_wait=0)
+
+        async def scenario():
+            await limiter.acquire(key="k", model="slow-model")
+            await limiter.acquire(key="k", model="other-model")
+            await limiter.acquire(key="k", model="slow-model")
+
+        with pytest.raises(RateLimitExceeded):
+            asyncio.run(scenario())
+
+    def test_cancelled_waiter_refunds_tokens(self):
+        limiter = TokenBucketLimiter(per_minute=1, max_wait=None)
+
+        async def scenario():
+            await limiter.acquire(key="k")
+            waiter = asyncio.create_task(limiter.acquire(key="k"))
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            return await limiter.remaining(key="k")
+
+        remaining = asyncio.run(scenario())
+        assert min(remaining.values()) > -0.5
+
+
+class TestRateLimiterCompat:
+    """Тесты декоратора и контекстного менеджера RateLimiter"""
+
+    def test_context_manager(self):
+        limiter = RateLimiter(30, 1)
+
+        async def scenario():
+            for _ in range(3):
+                async with limiter:
+                    pass
+
+        asyncio.run(scenario())
+        assert limiter.limiter.stats()["granted"] == 3
+
+    def test_decorator(self):
+        limiter = RateLimiter(10, 1)
+
+        @limiter
+        async def call(model=None):
+            return model
+
+        assert asyncio.run(call(model="m")) == "m"
+
+
+def test_remaining_limits_skip_disabled_window():
+    async def scenario():
+        limiter = APIRateLimiter(max_requests_per_minute=5, max_requests_per_day=100)
+        await limiter.wait_for_limit("k")
+        unlimited_day = APIRateLimiter(max_requests_per_minute=5, max_requests_per_day=0)
+        await unlimited_day.wait_for_limit("k")
+        return await limiter.get_remaining_limits("k"), await unlimited_day.get_remaining_limits("k")
+
+    # LLM_RATE_LIMIT_PER_DAY=0 — суточного лимита нет, а не IndexError
+    assert asyncio.run(scenario()) == ((4, 99), (4, None))
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("garbage") is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
@@ -0,0 +1,176 @@
+"""
+Тесты семантического кэша: близкие реплики, отпечаток контекста, варианты
+"""
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+from relove_bot.utils.semantic_cache import SemanticCache, context_fingerprint, normalize_message
+
+
+def make_cache(**kwargs):
+    kwargs.setdefault("variant_probability", 0.0)
+    return SemanticCache(**kwargs)
+
+
+class TestSemanticCache:
+    """Тесты SemanticCache"""
+
+    def test_normalize_message(self):
+        assert normalize_message("  Привет!!! ") == "привет"
+        assert normalize_message("Что дальше??") == "что дальше ?"
+        assert normalize_message("Ещё") == "еще"
+
+    def test_near_duplicate_hit(self):
+        cache = make_cache()
+
+        async def scenario():
+            assert await cache.lookup("reply", "Привет!") is None
+            await cache.store("reply", "Привет!", "Ну привет. С чем пришла?")
+            return await cache.lookup("reply", "привет")
+
+        assert asyncio.run(scenario()) == "Ну привет. С чем пришла?"
+        stats = cache.stats()["topics"]["reply"]
+        assert stats["hits"] == 1
+        assert stats["hit_rate"] == 0.5
+
+    def test_different_message_misses(self):
+        cache = make_cache()
+
+        async def scenario():
+            await cache.store("reply", "не знаю", "А кто знает?")
+            return await cache.lookup("reply", "знаю")
+
+        assert asyncio.run(scenario()) is None
+
+    def test_context_fingerprint_must_match(self):
+        cache = make_cache()
+
+        async def scenario():
+            await cache.store("reply", "что дальше?", "Дальше — поток.", context_fingerprint("этап 1"))
+            other = await cache.lookup("reply", "что дальше?", context_fingerprint("этап 2"))
+            same = await cache.lookup("reply", "Что дальше?", context_fingerprint("Этап  1"))
+            return other, same
+
+        assert asyncio.run(scenario()) == (None, "Дальше — поток.")
+
+    def test_topic_flags_and_long_messages(self):
+        cache = make_cache(topics=["reply"], max_chars=20)
+
+        async def scenario():
+            await cache.store("natasha", "привет", "Ответ")
+            await cache.store("reply", "очень длинное сообщение про всю мою жизнь", "Ответ")
+            return (
+                await cache.lookup("natasha", "привет"),
+                await cache.lookup("reply", "очень длинное сообщение про всю мою жизнь"),
+            )
+
+        assert asyncio.run(scenario()) == (None, None)
+        assert cache.stats()["topics"]["reply"]["entries"] == 0
+
+    def test_variants_are_collected_and_rotated(self):
+        cache = SemanticCache(max_variants=2, variant_probability=1.0, rng=random.Random(0))
+
+        async def scenario():
+            await cache.store("reply", "привет", "Первый")
+            # Пока вариантов меньше max_variants — промах ради нового варианта
+            assert await cache.lookup("reply", "привет") is None
+            await cache.store("reply", "привет!", "Второй")
+            return [await cache.lookup("reply", "Привет") for _ in range(3)]
+
+        assert asyncio.run(scenario()) == ["Первый", "Второй", "Первый"]
+        assert cache.stats()["topics"]["reply"]["variant_refreshes"] == 1
+
+    def test_pluggable_embedder(self):
+        class SynonymEmbedder:
+            async def embed(self, text):
+                return [1.0, 0.0] if text in ("привет", "здравствуй") else [0.0, 1.0]
+
+        cache = make_cache(embedder=SynonymEmbedder())
+
+        async def scenario():
+            await cache.store("reply", "привет", "Здравствуй.")
+            return await cache.lookup("reply", "Здравствуй")
+
+        assert asyncio.run(scenario()) == "Здравствуй."
+
+
+@pytest.mark.parametrize("streaming", ["true", "false"])
+def test_variant_refresh_reaches_llm_end_to_end(tmp_path, streaming):
+    """
+    Обработчик сообщений с точным кэшем LLM и заглушкой LLM: запрос нового
+    варианта должен дойти до модели, а не вернуть тот же ответ из точного кэша
+    """
+    script = textwrap.dedent("""
+        import asyncio
+        import os
+        import sys
+
+        sys.path.insert(0, os.path.join(os.environ["PYTHONPATH"], "scripts", "loadtest"))
+
+        from aiogram import Bot
+        from mock_llm_server import MockLLMConfig, MockLLMServer
+        from run_loadtest import FakeTelegramSession, make_update
+
+        async def main():
+            mock = MockLLMServer(MockLLMConfig(latency="fixed", latency_ms=0, token_delay_ms=0, seed=3))
+            os.environ["LLM_API_BASE"] = os.environ["OPENAI_API_BASE"] = await mock.start()
+
+            from relove_bot.db.models import Base
+            from relove_bot.db.session import engine
+            from relove_bot.handlers import common
+            from relove_bot.utils.semantic_cache import get_semantic_cache
+
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            cache = get_semantic_cache()
+            cache.variant_probability = 1.0
+            bot = Bot("123456:TEST", session=FakeTelegramSession())
+            for i in range(4):
+                message = make_update(i + 1, 500, i + 1, "привет").message.as_(bot)
+                await common._process_message_async(500, message)
+
+            [entry] = cache._entries["reply"].values()
+            stats = cache.stats()["topics"]["reply"]
+            assert len(entry.answers) >= 2, (entry.answers, mock.stats())
+            assert len(set(entry.answers)) == len(entry.answers)
+            assert stats["variant_refreshes"] >= 1
+            # Первый ответ и каждый запрос варианта — отдельный поход в модель
+            assert mock.counters["requests"] == 1 + stats["variant_refreshes"]
+            await mock.stop()
+            await engine.dispose()
+
+        asyncio.run(main())
+        print("ok")
+    """)
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(ROOT),
+        "BOT_TOKEN": "123456:TEST",
+        "DB_URL": f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}",
+        "OUR_CHANNEL_ID": "0",
+        "DISCUSSION_CHANNEL_ID": "0",
+        "TG_API_ID": "1",
+        "TG_API_HASH": "test",
+        "TG_SESSION": "test",
+        "LLM_API_KEY": "test",
+        "LLM_BACKENDS": "[]",
+        "LOG_DIR": str(tmp_path / "logs"),
+        "LLM_CACHE_BACKEND": "memory",
+        "LLM_STREAMING_ENABLED": streaming,
+        "SEMANTIC_CACHE_ENABLED": "true",
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr[-3000:]
+    assert result.stdout.strip().endswith("ok")
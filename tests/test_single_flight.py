@@ -0,0 +1,80 @@
+"""
+Тесты схлопывания одинаковых запросов (single-flight)
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from relove_bot.utils.single_flight import SingleFlight
+
+
+class TestSingleFlight:
+    """Тесты SingleFlight"""
+
+    def test_concurrent_calls_share_one_request(self):
+        group = SingleFlight()
+        calls = 0
+
+        async def request():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "ответ"
+
+        async def scenario():
+            return await asyncio.gather(*(group.do("key", request) for _ in range(5)))
+
+        assert asyncio.run(scenario()) == ["ответ"] * 5
+        assert calls == 1
+        assert group.stats()["collapsed"] == 4
+        assert group.stats()["inflight"] == 0
+
+    def test_different_keys_not_collapsed(self):
+        group = SingleFlight()
+
+        async def scenario():
+            return await asyncio.gather(
+                group.do("a", lambda: asyncio.sleep(0, result="a")),
+                group.do("b", lambda: asyncio.sleep(0, result="b")),
+            )
+
+        assert asyncio.run(scenario()) == ["a", "b"]
+        assert group.stats()["leaders"] == 2
+
+    def test_exception_propagates_to_all_waiters(self):
+        group = SingleFlight()
+
+        async def failing():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        async def scenario():
+            return await asyncio.gather(
+                group.do("key", failing), group.do("key", failing), return_exceptions=True
+            )
+
+        results = asyncio.run(scenario())
+        assert all(isinstance(r, ValueError) for r in results)
+
+    def test_leader_cancellation_does_not_cancel_followers(self):
+        group = SingleFlight()
+
+        async def request():
+            await asyncio.sleep(0.02)
+            return "ok"
+
+        async def scenario():
+            leader = asyncio.create_task(group.do("key", request))
+            await asyncio.sleep(0)
+            follower = asyncio.create_task(group.do("key", request))
+            await asyncio.sleep(0)
+            leader.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await leader
+            return await follower
+
+        assert asyncio.run(scenario()) == "ok"
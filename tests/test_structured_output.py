@@ -0,0 +1,109 @@
+"""
+Тесты структурированных ответов: локальная починка JSON, проверка схемой
+и повторный запрос с исправлением
+"""
+import asyncio
+import json
+import sys
+from pathlib import Path
+from typing import List
+
+import pytest
+from pydantic import BaseModel, Field
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from relove_bot.utils.structured_output import (
+    StructuredOutputError, close_json, extract_json, generate_structured, get_structured_output_stats,
+    response_format_for,
+)
+
+
+class Verdict(BaseModel):
+    label: str
+    score: int = Field(..., ge=0, le=10)
+    tags: List[str] = Field(default_factory=list)
+
+
+class FakeLLM:
+    """Отдаёт заготовленные ответы по очереди и запоминает запросы"""
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.calls = []
+
+    async def __call__(self, system_prompt, prompt, max_tokens, response_format):
+        self.calls.append((system_prompt, prompt, response_format))
+        return self.answers.pop(0)
+
+
+def stats_for(name):
+    return get_structured_output_stats()["schemas"].get(name, {})
+
+
+def test_close_json_drops_truncated_tail():
+    assert json.loads(close_json('{"label": "ok", "tags": ["a", "b')) == {"label": "ok", "tags": ["a", "b"]}
+    assert json.loads(close_json('{"label": "ok", "score": ')) == {"label": "ok"}
+    assert close_json('{"a": 1}') == '{"a": 1}'
+
+
+def test_extract_json_repairs_common_mistakes():
+    data, repaired = extract_json('Вот ответ:\n```json\n{"label": "ok", "score": 3, "tags": ["x",],}\n```')
+    assert data == {"label": "ok", "score": 3, "tags": ["x"]} and repaired
+    data, repaired = extract_json('Ответ: {"label": "ok", "score": 3} — всё')
+    assert data == {"label": "ok", "score": 3} and not repaired
+    assert extract_json("нет json") == (None, False)
+
+
+@pytest.mark.parametrize("text", [
+    '{"core": "страх «не справлюсь»", "themes": ["a",]}',
+    '{"core": "страх «не справлюсь»", "themes": ["a",',
+])
+def test_repair_keeps_quotes_inside_values(text):
+    data, repaired = extract_json(text)
+    assert data == {"core": "страх «не справлюсь»", "themes": ["a"]} and repaired
+
+
+def test_smart_quotes_repaired_only_as_delimiters():
+    data, repaired = extract_json('{“label”: “ok”, "tags": ["он сказал “да”", "True, ]"],}')
+    assert data == {"label": "ok", "tags": ["он сказал “да”", "True, ]"]} and repaired
+
+
+def test_valid_answer_needs_one_call():
+    llm = FakeLLM('{"label": "ok", "score": 7}')
+    before = stats_for("Verdict").get("parsed", 0)
+    result = asyncio.run(generate_structured(
+        Verdict, llm, "промпт", system_prompt="система", response_format=response_format_for(Verdict, "json_object")
+    ))
+    assert result == Verdict(label="ok", score=7)
+    assert len(llm.calls) == 1
+    system_prompt, _, response_format = llm.calls[0]
+    assert system_prompt.startswith("система") and '"score"' in system_prompt
+    assert response_format == {"type": "json_object"}
+    assert stats_for("Verdict")["parsed"] == before + 1
+
+
+def test_invalid_answer_is_repaired_by_model():
+    llm = FakeLLM('{"label": "ok", "score": 42}', '{"label": "ok", "score": 10}')
+    before = stats_for("Verdict").get("repair_calls", 0)
+    result = asyncio.run(generate_structured(Verdict, llm, "промпт"))
+    assert result.score == 10
+    assert len(llm.calls) == 2
+    # В запрос на исправление уходят ошибки проверки и исходный ответ
+    assert "score" in llm.calls[1][1] and '"score": 42' in llm.calls[1][1]
+    assert stats_for("Verdict")["repair_calls"] == before + 1
+
+
+def test_unrepairable_answer_raises():
+    llm = FakeLLM("не знаю", "всё ещё не знаю")
+    before = stats_for("Verdict").get("failures", 0)
+    with pytest.raises(StructuredOutputError):
+        asyncio.run(generate_structured(Verdict, llm, "промпт", max_repairs=1))
+    assert len(llm.calls) == 2
+    assert stats_for("Verdict")["failures"] == before + 1
+
+    # Пустой ответ — ошибка запроса: переспрашивать модель бессмысленно
+    llm = FakeLLM("")
+    with pytest.raises(StructuredOutputError):
+        asyncio.run(generate_structured(Verdict, llm, "промпт"))
+    assert len(llm.calls) == 1
@@ -0,0 +1,116 @@
+"""
+Тесты потокового вывода ответа в сообщение Telegram
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+pytest.importorskip("aiogram")
+
+from relove_bot.utils.telegram_stream import TELEGRAM_MESSAGE_LIMIT, stream_reply
+
+
+class FakeSentMessage:
+    def __init__(self, text):
+        self.text = text
+        self.edits = []
+        self.deleted = False
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        self.edits.append(text)
+
+    async def delete(self):
+        self.deleted = True
+
+
+class FakeMessage:
+    def __init__(self):
+        self.sent = []
+
+    async def answer(self, text, **kwargs):
+        sent = FakeSentMessage(text)
+        self.sent.append(sent)
+        return sent
+
+
+async def _chunks(parts, delay=0.0):
+    for part in parts:
+        await asyncio.sleep(delay)
+        yield part
+
+
+def test_edits_are_throttled():
+    message = FakeMessage()
+    parts = ["слово "] * 20
+
+    text = asyncio.run(stream_reply(message, _chunks(parts), edit_interval=10))
+
+    assert text == "".join(parts)
+    sent = message.sent[0]
+    # Первая правка сразу, затем только итоговая
+    assert len(sent.edits) == 2
+    assert sent.text == text
+
+
+def test_long_answer_is_split():
+    message = FakeMessage()
+    parts = ["а" * 1000 + "\n"] * 6
+
+    text = asyncio.run(stream_reply(message, _chunks(parts), edit_interval=0))
+
+    assert len(message.sent) == 2
+    assert all(len(sent.text) <= TELEGRAM_MESSAGE_LIMIT for sent in message.sent)
+    assert "".join(sent.text for sent in message.sent) == text
+
+
+def test_error_keeps_partial_text():
+    async def failing():
+        yield "начало"
+        raise RuntimeError("обрыв")
+
+    message = FakeMessage()
+    text = asyncio.run(stream_reply(message, failing(), edit_interval=0, fallback_text="..."))
+
+    assert text == "начало"
+    assert message.sent[0].text == "начало"
+
+
+def test_empty_answer_uses_fallback():
+    message = FakeMessage()
+    text = asyncio.run(stream_reply(message, _chunks([]), edit_interval=0, fallback_text="..."))
+
+    # Возвращается то, что увидел пользователь
+    assert text == "..."
+    assert message.sent[0].text == "..."
+
+
+def test_empty_answer_without_fallback_removes_placeholder():
+    message = FakeMessage()
+    text = asyncio.run(stream_reply(message, _chunks([]), edit_interval=0))
+
+    assert text == ""
+    assert message.sent[0].deleted
+
+
+@pytest.mark.parametrize("parts, shown", [(["нач", "ало"], "начало"), ([], "...")])
+def test_timeout_finishes_reply(parts, shown):
+    async def hanging():
+        for part in parts:
+            yield part
+        await asyncio.sleep(60)
+
+    async def scenario():
+        async with asyncio.timeout(0.05):
+            await stream_reply(message, hanging(), edit_interval=10, fallback_text="...")
+
+    message = FakeMessage()
+    with pytest.raises(TimeoutError):
+        asyncio.run(scenario())
+
+    # Вместо зависшей заглушки — начало ответа или fallback_text
+    assert message.sent[0].text == shown
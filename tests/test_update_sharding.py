@@ -0,0 +1,246 @@
+"""
+Тесты шардирования апдейтов между репликами (utils/update_sharding.py, webhook.py):
+несколько реплик в одном процессе делят общий fakeredis
+"""
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from aiogram import Bot, Dispatcher, Router
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.types import Message
+
+from relove_bot.utils.update_sharding import (
+    OrderedUpdateFeeder,
+    ShardConsumer,
+    ShardedUpdateStream,
+    owned_shards,
+    shard_of,
+    shard_owner,
+    update_shard_key,
+)
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+            "text": text,
+        },
+    }
+
+
+def make_replica(index: int, server, log: list):
+    """Реплика: свой Bot и Dispatcher, FSM — в общем Redis"""
+    router = Router()
+
+    @router.message()
+    async def record(message: Message, state: FSMContext):
+        # Случайная задержка: без упорядочивания сообщения одного пользователя перепутались бы
+        await asyncio.sleep(random.random() * 0.01)
+        seen = (await state.get_data()).get("seen", [])
+        await state.update_data(seen=seen + [message.text])
+        log.append((index, message.from_user.id, message.text))
+
+    dp = Dispatcher(storage=RedisStorage(fakeredis.aioredis.FakeRedis(server=server)))
+    dp.include_router(router)
+    return Bot("123456:TEST"), dp
+
+
+def test_shard_key_and_rendezvous_assignment():
+    assert update_shard_key(make_update(1, 42, "hi")) == 42
+    assert update_shard_key({"update_id": 2, "callback_query": {"id": "c", "from": {"id": 7}}}) == 7
+    assert update_shard_key({"update_id": 3, "channel_post": {"chat": {"id": -100}}}) == -100
+    assert update_shard_key({"update_id": 4, "poll": {"id": "p"}}) == 4
+    assert shard_of(42, 64) == shard_of(42, 64) < 64
+
+    # Каждый шард ровно у одной реплики
+    owners = [owned_shards(i, 3, 64) for i in range(3)]
+    assert sorted(sum(owners, [])) == list(range(64))
+    assert all(owners)
+    # При добавлении четвёртой реплики переезжают только её шарды
+    moved = [shard for shard in range(64) if shard_owner(shard, 3) != shard_owner(shard, 4)]
+    assert all(shard_owner(shard, 4) == 3 for shard in moved)
+    assert len(moved) < 64 / 2
+
+
+def test_replicas_process_each_user_in_order_on_owner():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        log = []
+        replicas = []
+        for index in range(3):
+            bot, dp = make_replica(index, server, log)
+            redis = fakeredis.aioredis.FakeRedis(server=server)
+            stream = ShardedUpdateStream(redis, shards=16)
+            feeder = OrderedUpdateFeeder(dp, bot, max_concurrency=8, max_inflight=20)
+            consumer = ShardConsumer(stream, feeder, owned_shards(index, 3, 16), consumer=f"replica-{index}", idle_interval=0.005)
+            await consumer.start()
+            replicas.append((stream, feeder, consumer))
+
+        users = list(range(1000, 1012))
+        messages = 6
+        update_id = 0
+        for step in range(messages):
+            for user_id in users:
+                update_id += 1
+                # Балансировщик отдаёт запрос случайной реплике
+                stream = random.choice(replicas)[0]
+                await stream.publish(make_update(update_id, user_id, f"m{step}"))
+
+        for _ in range(500):
+            if len(log) == len(users) * messages:
+                break
+            await asyncio.sleep(0.02)
+        for _, feeder, consumer in replicas:
+            await consumer.stop()
+            await feeder.close()
+
+        assert len(log) == len(users) * messages
+        storage = RedisStorage(fakeredis.aioredis.FakeRedis(server=server))
+        bot_id = Bot("123456:TEST").id
+        for user_id in users:
+            handled = [(replica, text) for replica, uid, text in log if uid == user_id]
+            owner = shard_owner(shard_of(user_id, 16), 3)
+            assert {replica for replica, _ in handled} == {owner}
+            assert [text for _, text in handled] == [f"m{i}" for i in range(messages)]
+            # FSM общий: состояние пользователя собрано по порядку
+            data = await storage.get_data(StorageKey(bot_id=bot_id, chat_id=user_id, user_id=user_id))
+            assert data["seen"] == [f"m{i}" for i in range(messages)]
+        assert sum(consumer.stats()["acked"] for _, _, consumer in replicas) == len(log)
+
+    asyncio.run(scenario())
+
+
+def test_unacked_updates_are_redelivered_after_restart():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        log = []
+        bot, dp = make_replica(0, server, log)
+        stream = ShardedUpdateStream(fakeredis.aioredis.FakeRedis(server=server), shards=1)
+        for i in range(3):
+            await stream.publish(make_update(i + 1, 5, f"m{i}"))
+
+        # Реплика прочитала апдейты и упала до обработки
+        await stream.redis.xgroup_create(stream.key(0), "relove-bot", id="0", mkstream=True)
+        await stream.redis.xreadgroup("relove-bot", "replica-0", {stream.key(0): ">"}, count=10)
+
+        feeder = OrderedUpdateFeeder(dp, bot)
+        consumer = ShardConsumer(stream, feeder, [0], consumer="replica-0", idle_interval=0.005)
+        await consumer.start()
+        await stream.publish(make_update(4, 5, "m3"))
+        for _ in range(200):
+            if len(log) == 4:
+                break
+            await asyncio.sleep(0.01)
+        await consumer.stop()
+        await feeder.close()
+
+        assert [text for _, _, text in log] == ["m0", "m1", "m2", "m3"]
+        assert consumer.stats()["recovered"] == 3
+        assert await stream.redis.xpending(stream.key(0), "relove-bot") == {
+            "pending": 0, "min": None, "max": None, "consumers": [],
+        }
+
+    asyncio.run(scenario())
+
+
+def test_webhook_replicas_over_http(tmp_path):
+    """Три webhook-приложения (как три пода за балансировщиком) и общий Redis"""
+    script = textwrap.dedent("""
+        import asyncio
+
+        import fakeredis
+        from aiogram import Bot, Dispatcher, Router
+        from aiogram.fsm.storage.redis import RedisStorage
+        from aiohttp.test_utils import TestClient, TestServer
+
+        from relove_bot.utils.update_sharding import shard_of, shard_owner
+        from relove_bot.webhook import create_webhook_app
+
+        async def main():
+            server = fakeredis.FakeServer()
+            log = []
+            clients = []
+            for index in range(3):
+                router = Router()
+
+                @router.message()
+                async def record(message, index=index):
+                    log.append((index, message.from_user.id, message.text))
+
+                dp = Dispatcher(storage=RedisStorage(fakeredis.aioredis.FakeRedis(server=server)))
+                dp.include_router(router)
+                app = create_webhook_app(
+                    Bot("123456:TEST"), dp, fakeredis.aioredis.FakeRedis(server=server), replica_index=index, replica_count=3,
+                )
+                app["shard_consumer"].idle_interval = 0.005
+                client = TestClient(TestServer(app))
+                await client.start_server()
+                clients.append(client)
+
+            headers = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+            response = await clients[0].post("/hook", json={"update_id": 1})
+            assert response.status == 401, response.status
+            for n in range(30):
+                user_id = 100 + n % 5
+                update = {"update_id": n + 1, "message": {
+                    "message_id": n + 1, "date": 0, "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": "U"}, "text": str(n),
+                }}
+                response = await clients[n % 3].post("/hook", json=update, headers=headers)
+                assert response.status == 200, response.status
+            for _ in range(300):
+                if len(log) == 30:
+                    break
+                await asyncio.sleep(0.02)
+            health = await (await clients[1].get("/healthz")).json()
+            for client in clients:
+                await client.close()
+
+            assert len(log) == 30, log
+            for user_id in range(100, 105):
+                handled = [(replica, int(text)) for replica, uid, text in log if uid == user_id]
+                assert {replica for replica, _ in handled} == {shard_owner(shard_of(user_id, 64), 3)}
+                assert [n for _, n in handled] == sorted(n for _, n in handled)
+            assert health["replica"] == 1 and health["consumer"]["shards"] > 0
+
+        asyncio.run(main())
+        print("ok")
+    """)
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(ROOT),
+        "BOT_TOKEN": "123456:TEST",
+        "DB_URL": "sqlite+aiosqlite:///:memory:",
+        "OUR_CHANNEL_ID": "0",
+        "DISCUSSION_CHANNEL_ID": "0",
+        "TG_API_ID": "1",
+        "TG_API_HASH": "test",
+        "TG_SESSION": "test",
+        "LLM_API_KEY": "test",
+        "WEBHOOK_PATH": "/hook",
+        "WEBHOOK_SECRET": "s3cret",
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr[-3000:]
+    assert result.stdout.strip().endswith("ok")
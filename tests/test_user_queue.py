@@ -0,0 +1,104 @@
+"""
+Тесты очереди свободных сообщений по пользователям (utils/user_queue.py)
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from relove_bot.utils.user_queue import SubmitResult, UserWorkQueue
+
+
+def test_messages_of_one_user_are_processed_in_order():
+    async def scenario():
+        turns = []
+
+        async def handler(user_id, items):
+            turns.append((user_id, list(items)))
+            await asyncio.sleep(0.02)
+
+        queue = UserWorkQueue(handler, merge_window=0)
+        queue.submit(1, "a")
+        await asyncio.sleep(0.005)
+        # Пришли во время первого хода — будут следующим ходом, не параллельно
+        queue.submit(1, "b")
+        queue.submit(1, "c")
+        await queue.close()
+
+        assert turns == [(1, ["a"]), (1, ["b", "c"])]
+        assert queue.stats()["merged"] == 1 and queue.stats()["pending"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_burst_is_merged_into_one_turn():
+    async def scenario():
+        turns = []
+
+        async def handler(user_id, items):
+            turns.append(items)
+
+        queue = UserWorkQueue(handler, merge_window=0.05, max_merge_wait=1.0)
+        for text in ("привет", "я тут", "есть вопрос"):
+            queue.submit(7, text)
+            await asyncio.sleep(0.01)
+        await queue.close()
+
+        assert turns == [["привет", "я тут", "есть вопрос"]]
+        assert queue.stats()["turns"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_global_concurrency_cap():
+    async def scenario():
+        running, peak = 0, 0
+
+        async def handler(user_id, items):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.02)
+            running -= 1
+
+        queue = UserWorkQueue(handler, max_concurrency=3, merge_window=0)
+        for user_id in range(10):
+            assert queue.submit(user_id, "hi") is SubmitResult.QUEUED
+        await queue.close()
+
+        assert peak == 3
+        assert queue.stats()["turns"] == 10 and queue.stats()["max_running"] == 3
+
+    asyncio.run(scenario())
+
+
+def test_overflow_is_rejected_and_handler_errors_do_not_stop_queue():
+    async def scenario():
+        seen = []
+        release = asyncio.Event()
+
+        async def handler(user_id, items):
+            await release.wait()
+            seen.extend(items)
+            if "boom" in items:
+                raise RuntimeError("boom")
+
+        queue = UserWorkQueue(handler, max_per_user=2, max_pending=3, merge_window=0)
+        assert queue.submit(1, "boom") is SubmitResult.QUEUED
+        await asyncio.sleep(0)
+        # Первое сообщение уже в обработке, очередь пользователя — 2 места
+        assert queue.submit(1, "x") is SubmitResult.QUEUED
+        assert queue.submit(1, "y") is SubmitResult.QUEUED
+        assert queue.submit(1, "z") is SubmitResult.REJECTED
+        assert queue.submit(2, "a") is SubmitResult.QUEUED
+        # Всего ждут 3 сообщения — больше не принимаем ни от кого
+        assert queue.submit(3, "b") is SubmitResult.REJECTED
+
+        release.set()
+        await queue.close()
+        assert seen.count("boom") == 1 and {"x", "y", "a"} <= set(seen)
+        stats = queue.stats()
+        assert stats["rejected"] == 2 and stats["failed"] == 1 and stats["users"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,227 @@
+"""
+Тесты встроенного векторного индекса: точный и IVF-поиск, фильтры по
+метаданным, инкрементальный upsert и сохранение на диск
+"""
+import os
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+from relove_bot.db.vector_index import VectorIndex, normalize_rows
+
+
+def clustered(count, dim=16, topics=8, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = normalize_rows(rng.standard_normal((topics, dim)))
+    labels = rng.integers(0, topics, count)
+    return normalize_rows(centers[labels] + rng.standard_normal((count, dim)) * 0.15).astype(np.float32)
+
+
+def test_exact_search_and_filters():
+    index = VectorIndex(4)
+    index.upsert([
+        (1, [1, 0, 0, 0], {"username": "anna", "gender": "female", "streams": ["Путь Героя"]}),
+        (2, [0.9, 0.1, 0, 0], {"username": "ivan", "gender": "male", "is_active": False}),
+        (3, [0.8, 0.2, 0, 0], {"username": "olga", "gender": "female", "streams": ["Портал"]}),
+        (4, [0, 0, 1, 0], {"username": "far", "gender": "female"}),
+    ])
+
+    hits = index.search([1, 0, 0, 0], top_k=2)
+    assert [hit.id for hit in hits] == [1, 2]
+    assert hits[0].payload["username"] == "anna"
+    assert hits[0].score == pytest.approx(1.0)
+
+    assert [hit.id for hit in index.search([1, 0, 0, 0], 3, filters={"gender": "male"})] == [2]
+    assert [hit.id for hit in index.search([1, 0, 0, 0], 2, filters={"is_active": True})] == [1, 3]
+    assert [hit.id for hit in index.search([1, 0, 0, 0], 3, filters={"streams": ["Портал"]})] == [3]
+    assert index.search([1, 0, 0, 0], 3, filters={"streams": ["Неизвестный"]}) == []
+    assert [hit.id for hit in index.search([1, 0, 0, 0], 1, filters={"exclude_ids": [1]})] == [2]
+
+
+def test_upsert_overwrites_and_delete_hides():
+    index = VectorIndex(4, initial_capacity=2)
+    index.upsert([(1, [1, 0, 0, 0], {}), (2, [0, 1, 0, 0], {}), (3, [0, 0, 1, 0], {})])
+    assert len(index) == 3 and index.capacity >= 3
+
+    index.upsert([(1, [0, 0, 1, 0], {"gender": "female"})])
+    assert len(index) == 3
+    assert {hit.id for hit in index.search([0, 0, 1, 0], 2)} == {1, 3}
+
+    assert index.delete([3]) == 1
+    assert [hit.id for hit in index.search([0, 0, 1, 0], 5)][0] == 1
+    assert 3 not in {hit.id for hit in index.search([0, 0, 1, 0], 5)}
+
+    with pytest.raises(ValueError):
+        index.upsert([(5, [1, 0], {})])
+
+
+def test_ivf_recall_and_incremental_assignment():
+    vectors = clustered(3000)
+    index = VectorIndex(16, nprobe=6, exact_threshold=1000)
+    index.upsert((i, vector, {}) for i, vector in enumerate(vectors[:2500]))
+    assert index.centroids is not None
+
+    # Новые векторы сразу попадают в кластеры и находятся
+    index.upsert((i, vector, {}) for i, vector in enumerate(vectors[2500:], start=2500))
+    assert (index.assign[:index.count] >= 0).all()
+
+    hits = 0
+    for query_id in range(2500, 2600):
+        exact = {hit.id for hit in index.search(vectors[query_id], 10, exact=True)}
+        found = {hit.id for hit in index.search(vectors[query_id], 10)}
+        hits += len(exact & found)
+        assert index.search(vectors[query_id], 1)[0].id == query_id
+    assert hits / 1000 >= 0.9
+
+
+def test_persistence_roundtrip(tmp_path):
+    path = str(tmp_path / "index")
+    vectors = clustered(1500)
+    index = VectorIndex(16, path=path, dtype="float16", exact_threshold=1000, initial_capacity=256)
+    index.upsert((i, vector, {"gender": "female" if i % 2 else "male", "streams": ["Портал"]}) for i, vector in enumerate(vectors))
+    index.delete([7])
+    index.save()
+    expected = [hit.id for hit in index.search(vectors[3], 5, filters={"gender": "female"})]
+
+    reloaded = VectorIndex(16, path=path)
+    assert reloaded.dtype == np.float16
+    assert len(reloaded) == 1499
+    assert reloaded.centroids is not None
+    assert [hit.id for hit in reloaded.search(vectors[3], 5, filters={"gender": "female"})] == expected
+    assert 7 not in {hit.id for hit in reloaded.search(vectors[7], 5)}
+    assert reloaded.search(vectors[3], 1)[0].payload["streams"] == ["Портал"]
+
+    # Индекс другой размерности не открывается молча
+    with pytest.raises(ValueError):
+        VectorIndex(8, path=path)
+
+
+def test_vector_facade_is_lazy_and_async(tmp_path):
+    """db.vector при импорте не создаёт клиентов, а поиск не блокирует цикл событий"""
+    script = textwrap.dedent("""
+        import asyncio, sys
+        from relove_bot.db import vector
+        assert "qdrant_client" not in sys.modules and vector._index is None
+
+        async def main():
+            assert await vector.init_vector_db()
+            saves = []
+            save = vector._index.save
+            vector._index.save = lambda: saves.append(1) or save()
+
+            # Пачки только в памяти: индекс сохраняется один раз, а не после каждой
+            saved = await vector.upsert_user_embeddings([
+                (1, [1.0, 0.0, 0.0, 0.0], {"username": "anna", "is_active": True}),
+                (2, [0.9, 0.1, 0.0, 0.0], {"username": "ivan", "is_active": False}),
+            ])
+            saved += await vector.upsert_user_embeddings([
+                (3, [0.8, 0.2, 0.0, 0.0], {"username": "olga", "is_active": True}),
+            ])
+            assert saved == 3 and saves == []
+            hits = await vector.search_similar_users(
+                [1.0, 0.0, 0.0, 0.0], top_k=5, filters={"is_active": True, "exclude_ids": [1]}
+            )
+            assert [hit.id for hit in hits] == [3], hits
+            assert await vector.flush_vector_db() and len(saves) == 1
+            await vector.close_vector_db()
+            assert len(saves) == 1
+
+            # После перезапуска индекс читается с диска целиком
+            vector._index = None
+            assert await vector.init_vector_db() and len(vector._index) == 3
+
+        asyncio.run(main())
+        print("ok")
+    """)
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(ROOT),
+        "BOT_TOKEN": "123456:TEST",
+        "DB_URL": "sqlite+aiosqlite:///:memory:",
+        "OUR_CHANNEL_ID": "0",
+        "DISCUSSION_CHANNEL_ID": "0",
+        "TG_API_ID": "1",
+        "TG_API_HASH": "test",
+        "TG_SESSION": "test",
+        "LLM_API_KEY": "test",
+        "VECTOR_BACKEND": "local",
+        "VECTOR_INDEX_PATH": str(tmp_path / "index"),
+        "EMBEDDING_DIM": "4",
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().endswith("ok")
+
+
+def test_similar_command_is_routed_past_free_text_handler(tmp_path):
+    """/similar через диспетчер бота доходит до handle_similar, а не до обработчика свободного текста"""
+    script = textwrap.dedent("""
+        import asyncio
+        import os
+        import sys
+
+        sys.path.insert(0, os.path.join(os.environ["PYTHONPATH"], "scripts", "loadtest"))
+
+        from aiogram import Bot
+        from run_loadtest import FakeTelegramSession, make_update
+
+        from relove_bot.bot import dp
+        from relove_bot.db.models import Base
+        from relove_bot.db.session import engine
+        from relove_bot.db.write_behind import close_activity_log_writer, close_user_touch_coalescer
+        from relove_bot.handlers import common
+
+        routed = []
+
+        @common.router.message.middleware()
+        async def record(handler, event, data):
+            # Только запоминаем выбранный обработчик, сам он не вызывается
+            routed.append((event.text, data["handler"].callback.__name__))
+
+        async def main():
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            bot = Bot("123456:TEST", session=FakeTelegramSession())
+            for n, text in enumerate(["/similar", "/similar 3", "привет"], 1):
+                await dp.feed_update(bot, make_update(n, 700, n, text))
+            await close_activity_log_writer()
+            await close_user_touch_coalescer()
+            await engine.dispose()
+
+            assert routed == [
+                ("/similar", "handle_similar"),
+                ("/similar 3", "handle_similar"),
+                ("привет", "handle_message"),
+            ], routed
+
+        asyncio.run(main())
+        print("ok")
+    """)
+    env = {
+        **os.environ,
+        "PYTHONPATH": str(ROOT),
+        "BOT_TOKEN": "123456:TEST",
+        "DB_URL": f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}",
+        "OUR_CHANNEL_ID": "0",
+        "DISCUSSION_CHANNEL_ID": "0",
+        "TG_API_ID": "1",
+        "TG_API_HASH": "test",
+        "TG_SESSION": "test",
+        "LLM_API_KEY": "test",
+        "LOG_DIR": str(tmp_path / "logs"),
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr[-3000:]
+    assert result.stdout.strip().endswith("ok")
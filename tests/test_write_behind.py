@@ -0,0 +1,241 @@
+"""
+Тесты отложенной записи (db/write_behind.py): пакетный журнал активности и
+склейка касаний пользователей
+"""
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+pytest.importorskip("aiosqlite")
+
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from sqlalchemy.dialects import postgresql
+
+from relove_bot.db.models import User, UserActivityLog
+from relove_bot.db.write_behind import ActivityLogWriter, UserTouchCoalescer
+
+
+async def make_db(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'activity.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(lambda sync_conn: UserActivityLog.__table__.create(sync_conn))
+    inserts = []
+    event.listen(
+        engine.sync_engine, "before_cursor_execute",
+        lambda conn, cursor, statement, params, context, executemany:
+            inserts.append(statement) if statement.startswith("INSERT") else None,
+    )
+    return engine, async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession), inserts
+
+
+async def count_rows(factory) -> int:
+    async with factory() as session:
+        return (await session.execute(select(func.count()).select_from(UserActivityLog))).scalar_one()
+
+
+def test_rows_are_flushed_in_batches(tmp_path):
+    async def scenario():
+        engine, factory, inserts = await make_db(tmp_path)
+        writer = ActivityLogWriter(factory, batch_size=50, flush_interval=0.05)
+        for i in range(120):
+            assert await writer.add(user_id=i % 7, activity_type="message", details={"text": f"m{i}"})
+        await asyncio.sleep(0.3)
+
+        stats = writer.stats()
+        assert await count_rows(factory) == 120
+        assert stats["written"] == 120 and stats["flushes"] == 3
+        assert stats["max_rows_per_flush"] == 50
+        # Каждая пачка — один многострочный INSERT, а не 120 отдельных
+        assert len(inserts) == 3
+
+        await writer.close()
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_close_flushes_pending_and_later_rows(tmp_path):
+    async def scenario():
+        engine, factory, _ = await make_db(tmp_path)
+        writer = ActivityLogWriter(factory, batch_size=1000, flush_interval=60)
+        for i in range(10):
+            await writer.add(user_id=1, activity_type="command", details={"command": "/start"})
+        assert await count_rows(factory) == 0
+
+        await writer.close()
+        assert await count_rows(factory) == 10
+        # После остановки запись идёт напрямую и не теряется
+        await writer.add(user_id=2, activity_type="message")
+        assert await count_rows(factory) == 11
+        async with factory() as session:
+            logs = (await session.execute(select(UserActivityLog).order_by(UserActivityLog.id))).scalars().all()
+        assert logs[0].details == {"command": "/start"} and logs[0].timestamp is not None
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_applies_backpressure_then_drops():
+    class SlowSession:
+        """Сессия, запись через которую не завершается, пока её не отпустят"""
+        release = asyncio.Event()
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def execute(self, statement, rows):
+            await self.release.wait()
+
+        async def commit(self):
+            pass
+
+    async def scenario():
+        SlowSession.release = asyncio.Event()
+        writer = ActivityLogWriter(SlowSession, batch_size=2, flush_interval=0.01, max_pending=3, put_timeout=0.05)
+        results = [await writer.add(user_id=1, activity_type="message") for _ in range(8)]
+        stats = writer.stats()
+        assert results.count(False) == stats["dropped"] > 0
+        assert stats["backpressure_waits"] >= stats["dropped"]
+        assert stats["pending"] <= 3
+
+        SlowSession.release.set()
+        await writer.close()
+        assert writer.stats()["written"] == results.count(True)
+
+    asyncio.run(scenario())
+
+
+def test_bad_batch_falls_back_to_single_rows():
+    class FlakySession:
+        """Пакетная запись падает, а по одной строке — только для user_id=0"""
+        written = []
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def execute(self, statement, rows):
+            if len(rows) > 1 or rows[0]["user_id"] == 0:
+                raise RuntimeError("FOREIGN KEY constraint failed")
+            self.written.extend(rows)
+
+        async def commit(self):
+            pass
+
+    async def scenario():
+        FlakySession.written = []
+        writer = ActivityLogWriter(FlakySession, batch_size=10, flush_interval=0.01)
+        for user_id in range(5):
+            await writer.add(user_id=user_id, activity_type="message")
+        await writer.close()
+        stats = writer.stats()
+        assert stats["written"] == 4 and stats["failed"] == 1 and stats["fallback_flushes"] == 1
+        assert sorted(row["user_id"] for row in FlakySession.written) == [1, 2, 3, 4]
+
+    asyncio.run(scenario())
+
+
+def test_touches_are_coalesced_per_user(tmp_path):
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'users.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(lambda sync_conn: User.__table__.create(sync_conn))
+        factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+        async with factory() as session:
+            session.add_all([User(id=1, markers={"relove_context": "путь"}), User(id=2)])
+            await session.commit()
+
+        updates = []
+        event.listen(
+            engine.sync_engine, "before_cursor_execute",
+            lambda conn, cursor, statement, params, context, executemany:
+                updates.append(statement) if statement.startswith("UPDATE") else None,
+        )
+        coalescer = UserTouchCoalescer(factory, flush_interval=60)
+        base = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        for i in range(10):
+            await coalescer.touch(1, seen_at=base + timedelta(minutes=i), markers={"last_message": f"m{i}"})
+        await coalescer.touch(2, seen_at=base)
+        # Пользователя ещё нет в БД — касание просто ничего не обновит
+        await coalescer.touch(3, seen_at=base)
+        assert coalescer.stats()["absorbed"] == 9 and coalescer.stats()["pending"] == 3
+
+        await coalescer.close()
+        stats = coalescer.stats()
+        assert stats["flushes"] == 1 and stats["users_written"] == 3
+        # Одиннадцать касаний — один UPDATE last_seen и один UPDATE маркеров
+        assert len(updates) == 2
+        async with factory() as session:
+            user = await session.get(User, 1)
+        assert user.markers == {"relove_context": "путь", "last_message": "m9"}
+        assert user.last_seen_date.replace(tzinfo=timezone.utc) == base + timedelta(minutes=9)
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_postgres_touches_use_update_from_values():
+    class RecordingSession:
+        statements = []
+
+        def get_bind(self):
+            return SimpleNamespace(dialect=SimpleNamespace(name="postgresql"))
+
+        async def execute(self, statement, params=None):
+            self.statements.append(statement)
+
+    async def scenario():
+        session = RecordingSession()
+        seen = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        await UserTouchCoalescer()._apply(session, {1: {"seen_at": seen, "markers": {}}, 2: {"seen_at": seen, "markers": {}}})
+        sql = str(session.statements[0].compile(dialect=postgresql.asyncpg.dialect()))
+        assert sql.startswith("UPDATE users SET last_seen_date=touches.seen_at FROM (VALUES")
+        assert "WHERE users.id = touches.id" in sql
+        assert len(session.statements) == 1
+
+    asyncio.run(scenario())
+
+
+def test_middleware_unwraps_update_without_profile_refresh(monkeypatch):
+    from aiogram.types import Chat, Message, Update
+    from aiogram.types import User as TgUser
+
+    from relove_bot.middlewares import profile_update
+
+    touches, activity = [], []
+    monkeypatch.setattr(profile_update, "get_user_touch_coalescer", lambda: SimpleNamespace(
+        touch=lambda user_id: asyncio.sleep(0, touches.append(user_id))))
+    monkeypatch.setattr(profile_update, "get_activity_log_writer", lambda: SimpleNamespace(
+        add=lambda **row: asyncio.sleep(0, activity.append(row))))
+
+    middleware = profile_update.ProfileUpdateMiddleware()
+    checks = []
+    monkeypatch.setattr(middleware, "_check_and_schedule_profile_update",
+                        lambda user_id: asyncio.sleep(0, checks.append(user_id)))
+
+    sender = TgUser(id=7, is_bot=False, first_name="Тест")
+    update = Update(update_id=1, message=Message(
+        message_id=1, date=datetime.now(), chat=Chat(id=7, type="private"), from_user=sender, text="привет",
+    ))
+
+    async def handler(event, data):
+        return "handled"
+
+    assert asyncio.run(middleware(handler, update, {})) == "handled"
+    assert touches == [7]
+    assert activity == [{"user_id": 7, "chat_id": 7, "activity_type": "message", "details": {"text": "привет"}}]
+    # Фоновое обновление профиля выключено, пока ProfileRotationService не починен
+    assert checks == []